@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Compares the crop sampling paths of the CropSampler
+
+    Run from the root of the repository, by default with two boxes per
+    frame:
+
+        python -m benchmarks.crop_sampler_benchmark --crop-sizes 64 128 256 \
+            --batch-sizes 1 4 16 --boxes-per-frame 2
+
+    For every crop size and number of boxes the benchmark cuts the crops
+    from padded frames, from packed frames with the per-frame
+    `grid_sample` path and from packed frames with the previous
+    implementation, which gathered the four neighbours of every pixel by
+    hand. It reports the time per call, the number and size of the
+    allocations of a call and the maximum difference w.r.t. the padded
+    frames. The previous implementation checked the bounds of the right
+    and bottom neighbours with those of the left and top ones, so its
+    crops differ at the borders of the frames. The sampling grids are
+    computed once, so only the sampling itself is measured.
+
+    Before the timings, the crops of batches whose boxes share frames,
+    e.g. with the frame indices `[0, 0]` or `[0, 1, 1]`, are checked
+    against the crops of the same boxes with one frame per box.
+'''
+
+import sys
+import time
+import argparse
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from loguru import logger
+
+from expose.data.targets.image_list import (
+    to_image_list_concat, to_image_list_packed)
+from expose.models.common.bbox_sampler import CropSampler
+from expose.utils.device_utils import select_device, synchronize
+
+FRAME_SIZES = ((1080, 1920), (720, 1280))
+# The frame indices of the boxes of the checked batches
+FRAME_LAYOUTS = ([0, 0, 1], [0, 0], [0, 1, 1], [0, 1])
+
+
+def legacy_sample_packed(full_imgs, sampling_grid, crop_size):
+    ''' The bilinear interpolation with masked gathers used before
+
+        The grid is expected in the pixel coordinates of the frames.
+    '''
+    device, dtype = sampling_grid.device, sampling_grid.dtype
+    batch_size = sampling_grid.shape[0]
+    tensor = full_imgs.as_tensor()
+
+    flat_sampling_grid = sampling_grid.reshape(batch_size, -1, 2)
+    x, y = flat_sampling_grid[:, :, 0], flat_sampling_grid[:, :, 1]
+
+    x0 = torch.floor(x).to(dtype=torch.long)
+    x1 = x0 + 1
+    y0 = torch.floor(y).to(dtype=torch.long)
+    y1 = y0 + 1
+
+    start_idxs = torch.tensor(
+        full_imgs.starts, dtype=torch.long, device=device)
+    rgb_idxs = torch.arange(3, dtype=torch.long, device=device)
+    height_tensor = torch.tensor(
+        full_imgs.heights, dtype=torch.long, device=device)
+    width_tensor = torch.tensor(
+        full_imgs.widths, dtype=torch.long, device=device)
+    if full_imgs.frame_idxs is not None:
+        frame_idxs = full_imgs.frame_idxs.to(device=device)
+        start_idxs = start_idxs[frame_idxs]
+        height_tensor = height_tensor[frame_idxs]
+        width_tensor = width_tensor[frame_idxs]
+
+    x0_in_bounds = x0.ge(0) & x0.le(width_tensor[:, None] - 1)
+    x1_in_bounds = x0.ge(0) & x0.le(width_tensor[:, None] - 1)
+    y0_in_bounds = y0.ge(0) & y0.le(height_tensor[:, None] - 1)
+    y1_in_bounds = y0.ge(0) & y0.le(height_tensor[:, None] - 1)
+
+    zero = torch.tensor(0, dtype=torch.long, device=device)
+    x0 = torch.max(torch.min(x0, width_tensor[:, None] - 1), zero)
+    x1 = torch.max(torch.min(x1, width_tensor[:, None] - 1), zero)
+    y0 = torch.max(torch.min(y0, height_tensor[:, None] - 1), zero)
+    y1 = torch.max(torch.min(y1, height_tensor[:, None] - 1), zero)
+
+    flat_rgb_idxs = (
+        rgb_idxs[None, :, None] * (width_tensor[:, None, None]) *
+        height_tensor[:, None, None])
+
+    def gather(x_idxs, y_idxs, in_bounds):
+        in_bounds = in_bounds.unsqueeze(dim=1).expand(-1, 3, -1)
+        idxs = (start_idxs[:, None, None] + flat_rgb_idxs +
+                y_idxs[:, None, :] * width_tensor[:, None, None] +
+                x_idxs[:, None, :])
+        values = torch.zeros(idxs.shape, dtype=dtype, device=device)
+        values[in_bounds] = tensor[idxs[in_bounds]]
+        return values
+
+    Ia = gather(x0, y0, x0_in_bounds & y0_in_bounds)
+    Ib = gather(x1, y0, x1_in_bounds & y0_in_bounds)
+    Ic = gather(x0, y1, x0_in_bounds & y1_in_bounds)
+    Id = gather(x1, y1, x1_in_bounds & y1_in_bounds)
+
+    f1 = (x1 - x)[:, None] * Ia + (x - x0)[:, None] * Ib
+    f2 = (x1 - x)[:, None] * Ic + (x - x0)[:, None] * Id
+
+    output = (y1 - y)[:, None] * f1 + (y - y0)[:, None] * f2
+    return output.reshape(batch_size, 3, crop_size, crop_size)
+
+
+def build_batch(batch_size, boxes_per_frame, device, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    num_frames = (batch_size + boxes_per_frame - 1) // boxes_per_frame
+    images = [
+        torch.rand(3, *FRAME_SIZES[ii % len(FRAME_SIZES)],
+                   generator=generator)
+        for ii in range(num_frames)]
+    frame_idxs = torch.arange(batch_size) // boxes_per_frame
+
+    sizes = torch.tensor(
+        [images[idx].shape[1:] for idx in frame_idxs.tolist()],
+        dtype=torch.float32)
+    # Centers and sizes that also produce crops outside of the frames
+    center = (torch.rand(batch_size, 2, generator=generator) * 1.2 -
+              0.1) * sizes.flip(-1)
+    bbox_size = 50 + torch.rand(batch_size, generator=generator) * 400
+
+    padded = to_image_list_concat(images, frame_idxs=frame_idxs)
+    packed = to_image_list_packed(images, frame_idxs=frame_idxs)
+    return (padded.to(device=device), packed.to(device=device),
+            center.to(device=device), bbox_size.to(device=device),
+            sizes.to(device=device))
+
+
+def check_shared_frames(crop_size, device, atol=1e-5):
+    ''' Compares crops of shared frames to crops of one frame per box '''
+    sampler = CropSampler(crop_size).to(device=device)
+    generator = torch.Generator().manual_seed(0)
+    for layout in FRAME_LAYOUTS:
+        frame_idxs = torch.tensor(layout)
+        images = [torch.rand(3, 48 + 8 * ii, 64, generator=generator)
+                  for ii in range(max(layout) + 1)]
+        center = torch.rand(len(layout), 2, generator=generator) * 48
+        bbox_size = 10 + torch.rand(len(layout), generator=generator) * 40
+        center, bbox_size = center.to(device), bbox_size.to(device)
+
+        ref_imgs = [images[idx] for idx in layout]
+        for to_image_list in (to_image_list_concat, to_image_list_packed):
+            crops = sampler(
+                to_image_list(images, frame_idxs=frame_idxs).to(
+                    device=device), center, bbox_size)['images']
+            ref_crops = sampler(
+                to_image_list(ref_imgs).to(device=device), center,
+                bbox_size)['images']
+            diff = (crops - ref_crops).abs().max().item()
+            assert diff < atol, (
+                f'{to_image_list.__name__} with frames {layout}: crops'
+                f' differ by {diff:.2e}')
+    logger.info(f'Crops of shared frames match for {FRAME_LAYOUTS}')
+
+
+def time_call(func, num_iters, device):
+    func()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        func()
+    synchronize(device)
+    return (time.perf_counter() - start) / num_iters
+
+
+def count_allocations(func, device):
+    ''' Returns the number and the size in MB of the allocations of a call '''
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, profile_memory=True) as prof:
+        func()
+        synchronize(device)
+    key = 'device_memory_usage' if device.type == 'cuda' else (
+        'cpu_memory_usage')
+    # Only count the leaf operators, the memory of nested calls is also
+    # reported by their parents
+    sizes = [getattr(event, key, 0) for event in prof.events()
+             if len(event.cpu_children) == 0]
+    sizes = [size for size in sizes if size > 0]
+    return len(sizes), sum(sizes) / 2 ** 20
+
+
+@torch.no_grad()
+def main(crop_sizes, batch_sizes, boxes_per_frame=2, num_iters=20,
+         device='auto'):
+    device = select_device(device)
+    logger.info(f'Device: {device}')
+
+    for crop_size in crop_sizes:
+        check_shared_frames(crop_size, device)
+        sampler = CropSampler(crop_size).to(device=device)
+        for batch_size in batch_sizes:
+            padded, packed, center, bbox_size, _ = build_batch(
+                batch_size, boxes_per_frame, device)
+
+            # Time only the sampling, the grids are computed once
+            padded_grid = sampler(padded, center, bbox_size)[
+                'normalized_grid'].reshape(-1, crop_size, crop_size, 2)
+            packed_out = sampler(packed, center, bbox_size)
+            packed_grid = packed_out['normalized_grid'].reshape(
+                -1, crop_size, crop_size, 2)
+            # The previous implementation expects pixel coordinates
+            pixel_grid = packed_out['sampling_grid'].reshape(
+                -1, crop_size, crop_size, 2)
+
+            def run_padded():
+                return sampler._sample_padded(padded, padded_grid)
+
+            def run_packed():
+                return sampler._sample_packed(packed, packed_grid)
+
+            def run_legacy():
+                return legacy_sample_packed(packed, pixel_grid, crop_size)
+
+            ref_crops = run_padded()
+            results = {}
+            for name, func in [('padded', run_padded),
+                               ('packed', run_packed),
+                               ('legacy packed', run_legacy)]:
+                diff = (func() - ref_crops).abs().max().item()
+                results[name] = (time_call(func, num_iters, device),
+                                 *count_allocations(func, device), diff)
+
+            legacy_time = results['legacy packed'][0]
+            for name, (curr_time, num_allocs, alloc_mb, diff) in (
+                    results.items()):
+                logger.info(
+                    f'crop: {crop_size}, boxes: {batch_size}, {name}:'
+                    f' {curr_time * 1000:.2f} ms,'
+                    f' speedup: {legacy_time / curr_time:.2f}x,'
+                    f' allocations: {num_allocs} ({alloc_mb:.1f} MB),'
+                    f' max abs difference: {diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the crop sampling paths',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--crop-sizes', dest='crop_sizes', type=int,
+                        nargs='+', default=[64, 128, 256],
+                        help='The sizes of the square crops')
+    parser.add_argument('--batch-sizes', dest='batch_sizes', type=int,
+                        nargs='+', default=[1, 4, 16],
+                        help='The numbers of boxes per call')
+    parser.add_argument('--boxes-per-frame', dest='boxes_per_frame',
+                        default=2, type=int,
+                        help='The number of boxes cut from every frame')
+    parser.add_argument('--num-iters', dest='num_iters', default=20,
+                        type=int, help='Number of timed iterations')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for the benchmark')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(crop_sizes=cmd_args.crop_sizes, batch_sizes=cmd_args.batch_sizes,
+         boxes_per_frame=cmd_args.boxes_per_frame,
+         num_iters=cmd_args.num_iters, device=cmd_args.device)
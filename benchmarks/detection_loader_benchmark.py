@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+''' Compares the throughput of the folder loaders of the demo
+
+    Run from the root of the repository:
+
+        python -m benchmarks.detection_loader_benchmark \
+            --num-frames 64 --people 4 --num-workers 4
+
+    The `two-pass` loader collates a full frame per box, so large frames
+    and batches need several GB of memory.
+
+    The frames are synthetic JPEG images and the detector returns a fixed
+    set of boxes per frame after `--detector-ms` of simulated device time,
+    so only the decoding, cropping and collation are measured. Three loaders
+    are compared:
+    - `two-pass`: the detector reads the folder and a `DataLoader` over
+      `ImageFolderWithBoxes` decodes each frame again for every box, with
+      the crops in its worker processes.
+    - `main-thread`: the `DetectionCropLoader` with all the crops on the
+      main thread.
+    - `crop-workers`: the `DetectionCropLoader` with the crops on its thread
+      pool.
+'''
+
+import sys
+import os.path as osp
+import time
+import argparse
+import functools
+import tempfile
+
+import numpy as np
+import cv2
+import torch
+import torch.nn as nn
+import torch.utils.data as dutils
+
+from loguru import logger
+
+from expose.config import cfg
+from expose.data.build import collate_batch
+from expose.data.datasets.image_folder import (
+    ImageFolder, ImageFolderWithBoxes)
+from expose.data.detection import (
+    DetectionCropLoader, collate_frames, detect_people)
+from expose.data.transforms import build_transforms
+
+
+class FixedBoxDetector(nn.Module):
+    ''' Returns the same boxes for every image after a fixed delay '''
+
+    def __init__(self, num_people, delay=0.0):
+        super(FixedBoxDetector, self).__init__()
+        self.num_people = num_people
+        self.delay = delay
+
+    def forward(self, images):
+        outputs = []
+        for img in images:
+            _, H, W = img.shape
+            width = W / self.num_people
+            xmin = torch.arange(self.num_people, dtype=torch.float32) * width
+            boxes = torch.stack([
+                xmin + 0.1 * width, torch.full_like(xmin, 0.1 * H),
+                xmin + 0.9 * width, torch.full_like(xmin, 0.9 * H)], dim=1)
+            outputs.append({'boxes': boxes,
+                            'scores': torch.ones(self.num_people)})
+        # Sleeping releases the GIL, like a detector running on a GPU
+        time.sleep(self.delay)
+        return outputs
+
+
+def write_frames(folder, num_frames, height, width, seed=0):
+    rng = np.random.RandomState(seed)
+    # Smooth noise, so that the images compress like photographs
+    small = rng.randint(0, 256, size=(num_frames, height // 16, width // 16,
+                                      3), dtype=np.uint8)
+    for ii in range(num_frames):
+        img = cv2.resize(small[ii], (width, height),
+                         interpolation=cv2.INTER_CUBIC)
+        cv2.imwrite(osp.join(folder, f'{ii:05d}.jpg'), img)
+
+
+def run_two_pass(image_folder, detector, transforms, batch_size,
+                 num_workers):
+    dataset = ImageFolder(image_folder)
+    frame_loader = dutils.DataLoader(
+        dataset, batch_size=1, num_workers=num_workers,
+        collate_fn=collate_frames)
+    img_paths, bboxes = [], []
+    for frames in frame_loader:
+        boxes = detect_people(
+            detector, frames['images'], torch.device('cpu'))
+        for img_path, img_boxes in zip(frames['paths'], boxes):
+            img_paths += [img_path] * len(img_boxes)
+            bboxes += list(img_boxes)
+
+    box_dataset = ImageFolderWithBoxes(
+        img_paths, bboxes, transforms=transforms)
+    box_loader = dutils.DataLoader(
+        box_dataset, batch_size=batch_size, num_workers=num_workers,
+        collate_fn=functools.partial(
+            collate_batch, use_shared_memory=num_workers > 0,
+            return_full_imgs=True, pin_memory=False))
+    return [batch[1] for batch in box_loader]
+
+
+def run_fused(image_folder, detector, transforms, batch_size, num_workers,
+              crop_workers):
+    loader = DetectionCropLoader(
+        image_folder, detector, transforms=transforms,
+        batch_size=batch_size, num_workers=num_workers,
+        crop_workers=crop_workers)
+    return [batch[1] for batch in loader]
+
+
+def main(num_frames=64, people=4, height=720, width=1280, num_workers=4,
+         batch_size=16, detector_ms=0.0):
+    body_transfs_cfg = cfg.datasets.body.transforms
+    transforms = build_transforms(body_transfs_cfg, is_train=False)
+    detector = FixedBoxDetector(people, delay=detector_ms / 1000)
+
+    loaders = {
+        'two-pass': functools.partial(
+            run_two_pass, num_workers=num_workers),
+        'main-thread': functools.partial(
+            run_fused, num_workers=num_workers, crop_workers=0),
+        'crop-workers': functools.partial(
+            run_fused, num_workers=num_workers, crop_workers=num_workers),
+    }
+
+    with tempfile.TemporaryDirectory() as image_folder:
+        write_frames(image_folder, num_frames, height, width)
+        logger.info(
+            f'{num_frames} frames of {width}x{height}, {people} people per'
+            f' frame, {num_workers} workers, detector: {detector_ms} ms')
+
+        reference, timings = None, {}
+        for name, loader in loaders.items():
+            start = time.perf_counter()
+            crops = torch.cat(
+                loader(image_folder, detector, transforms, batch_size))
+            timings[name] = time.perf_counter() - start
+            if reference is None:
+                reference = crops
+            diff = (crops - reference).abs().max().item()
+            logger.info(
+                f'{name}: {timings[name]:.2f} s,'
+                f' {num_frames / timings[name]:.1f} frames/s,'
+                f' {len(crops) / timings[name]:.1f} crops/s,'
+                f' speedup: {timings["two-pass"] / timings[name]:.2f}x,'
+                f' max abs difference: {diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the folder loaders of the demo',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-frames', dest='num_frames', default=64,
+                        type=int, help='Number of frames in the folder')
+    parser.add_argument('--people', default=4, type=int,
+                        help='Number of people detected per frame')
+    parser.add_argument('--height', default=720, type=int,
+                        help='Height of the frames')
+    parser.add_argument('--width', default=1280, type=int,
+                        help='Width of the frames')
+    parser.add_argument('--num-workers', dest='num_workers', default=4,
+                        type=int, help='Number of loader workers')
+    parser.add_argument('--batch-size', dest='batch_size', default=16,
+                        type=int, help='Number of crops per batch')
+    parser.add_argument('--detector-ms', dest='detector_ms', default=0.0,
+                        type=float,
+                        help='Simulated device time of the detector per'
+                        ' frame batch')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(num_frames=cmd_args.num_frames, people=cmd_args.people,
+         height=cmd_args.height, width=cmd_args.width,
+         num_workers=cmd_args.num_workers, batch_size=cmd_args.batch_size,
+         detector_ms=cmd_args.detector_ms)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Exports SMPLXNet to TorchScript and ONNX and compares the three runtimes
+
+    Run from the root of the repository:
+
+        python -m benchmarks.export_benchmark \
+            --exp-cfg data/conf.yaml --batch-size 4
+
+    The inputs are synthetic boxes in random frames. The script checks the
+    parity of the exported graphs against the eager model and fails when an
+    output differs by more than `--atol`. It then reports the startup time,
+    i.e. loading a saved graph until its first output, and the steady-state
+    latency of every runtime. The ONNX part needs `onnx` and `onnxruntime`
+    and is skipped when they are not installed.
+'''
+
+import sys
+import os.path as osp
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from loguru import logger
+
+from expose.config import cfg
+from expose.config.cmd_parser import set_face_contour
+from expose.data.targets import BoundingBox
+from expose.data.targets.image_list import to_image_list
+from expose.data.utils.bbox import bbox_to_center_scale
+from expose.models.common.bbox_sampler import crop_targets_from_list
+from expose.models.export import (
+    SMPLXInferenceModule, OUTPUT_NAMES, outputs_to_tuple,
+    export_torchscript, export_onnx, build_onnx_session, run_onnx_session,
+    compare_outputs)
+from expose.utils.demo_utils import build_model
+from expose.utils.device_utils import synchronize
+from expose.utils.transf_utils import get_transform
+
+
+def build_inputs(batch_size, crop_size, height=720, width=1280, seed=0):
+    ''' Creates random boxes, their crops and the eager model targets '''
+    rng = np.random.RandomState(seed)
+    full_imgs = torch.from_numpy(
+        rng.rand(batch_size, 3, height, width).astype(np.float32))
+
+    targets = []
+    for ii in range(batch_size):
+        box_height = rng.uniform(0.5, 0.9) * height
+        xmin = rng.uniform(0, width - box_height * 0.5)
+        ymin = rng.uniform(0, height - box_height)
+        bbox = np.array(
+            [xmin, ymin, xmin + box_height * 0.5, ymin + box_height],
+            dtype=np.float32)
+        center, scale, bbox_size = bbox_to_center_scale(
+            bbox, dset_scale_factor=1.2)
+
+        target = BoundingBox(bbox, size=(height, width, 3))
+        target.add_field('bbox_size', bbox_size)
+        target.add_field('orig_bbox_size', bbox_size)
+        target.add_field('orig_center', center)
+        target.add_field('center', center)
+        target.add_field('scale', scale)
+        target.add_field(
+            'crop_transform',
+            get_transform(center, scale, [crop_size, crop_size]))
+        targets.append(target)
+
+    images = torch.from_numpy(
+        rng.rand(batch_size, 3, crop_size, crop_size).astype(np.float32))
+    return images, full_imgs, targets
+
+
+def time_call(func, num_iters, device):
+    func()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        func()
+    synchronize(device)
+    return (time.perf_counter() - start) / num_iters
+
+
+def check_parity(name, diffs, atol=1e-4):
+    ''' Logs the differences to the eager outputs and fails above `atol` '''
+    worst = max(diffs, key=diffs.get)
+    logger.info(f'{name} parity, max abs difference: {diffs[worst]:.2e}'
+                f' ({worst})')
+    for key in OUTPUT_NAMES:
+        logger.debug(f'  {key}: {diffs[key]:.2e}')
+    assert diffs[worst] < atol, (
+        f'{name} does not match the eager model: {worst} differs by'
+        f' {diffs[worst]:.2e}, the tolerance is {atol:.1e}')
+
+
+@torch.no_grad()
+def main(exp_cfg, batch_size=4, output_folder='export', num_iters=10,
+         opset_version=17, atol=1e-4):
+    device = torch.device('cpu')
+    crop_size = exp_cfg.datasets.body.transforms.get('crop_size', 256)
+
+    start = time.perf_counter()
+    model = build_model(exp_cfg, device)
+    eager_startup = time.perf_counter() - start
+
+    images, full_imgs, targets = build_inputs(batch_size, crop_size)
+    crop_targets = crop_targets_from_list(targets, device=device)
+    inputs = (images, full_imgs, torch.arange(batch_size),
+              crop_targets.crop_transforms, crop_targets.bbox_sizes)
+
+    def run_eager():
+        output = model(images, targets, full_imgs=to_image_list(
+            list(full_imgs)), device=device)
+        return outputs_to_tuple(output, model.smplx.num_stages)
+
+    module = SMPLXInferenceModule(model).eval()
+    reference = run_eager()
+    check_parity('SMPLXInferenceModule', compare_outputs(
+        reference, module(*inputs)), atol=atol)
+
+    ts_path = osp.join(output_folder, f'smplx_net_b{batch_size}.pt')
+    export_torchscript(module, inputs, ts_path)
+    start = time.perf_counter()
+    ts_module = torch.jit.load(ts_path, map_location=device)
+    ts_outputs = ts_module(*inputs)
+    ts_startup = time.perf_counter() - start
+    check_parity('TorchScript', compare_outputs(reference, ts_outputs),
+                 atol=atol)
+
+    latencies = {
+        'eager': (eager_startup, time_call(run_eager, num_iters, device)),
+        'torchscript': (
+            ts_startup,
+            time_call(lambda: ts_module(*inputs), num_iters, device)),
+    }
+
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        logger.warning('onnxruntime is not installed, skipping ONNX')
+    else:
+        onnx_path = osp.join(output_folder, f'smplx_net_b{batch_size}.onnx')
+        export_onnx(module, inputs, onnx_path, opset_version=opset_version)
+        start = time.perf_counter()
+        session = build_onnx_session(
+            onnx_path, num_threads=torch.get_num_threads())
+        onnx_outputs = run_onnx_session(session, inputs)
+        onnx_startup = time.perf_counter() - start
+        check_parity('ONNX Runtime',
+                     compare_outputs(reference, onnx_outputs), atol=atol)
+        latencies['onnxruntime'] = (
+            onnx_startup,
+            time_call(lambda: run_onnx_session(session, inputs), num_iters,
+                      device))
+
+    eager_latency = latencies['eager'][1]
+    for name, (startup, latency) in latencies.items():
+        logger.info(
+            f'{name}: startup {startup:.2f} s, latency'
+            f' {latency * 1000:.1f} ms per batch of {batch_size},'
+            f' speedup: {eager_latency / latency:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the exported SMPLXNet graphs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--exp-cfg', type=str, dest='exp_cfg',
+                        help='The configuration of the experiment')
+    parser.add_argument('--exp-opts', default=[], dest='exp_opts',
+                        nargs='*', help='Extra command line arguments')
+    parser.add_argument('--batch-size', dest='batch_size', default=4,
+                        type=int,
+                        help='The batch size of the exported graphs')
+    parser.add_argument('--output-folder', dest='output_folder',
+                        default='export', type=str,
+                        help='The folder for the exported graphs')
+    parser.add_argument('--num-iters', dest='num_iters', default=10,
+                        type=int, help='Number of timed iterations')
+    parser.add_argument('--opset', dest='opset_version', default=17,
+                        type=int, help='The ONNX opset version')
+    parser.add_argument('--atol', dest='atol', default=1e-4, type=float,
+                        help='The largest allowed absolute difference to'
+                        ' the outputs of the eager model')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
+    cfg.is_training = False
+    set_face_contour(cfg, use_face_contour=cfg.datasets.use_face_contour)
+
+    main(cfg, batch_size=cmd_args.batch_size,
+         output_folder=cmd_args.output_folder, num_iters=cmd_args.num_iters,
+         opset_version=cmd_args.opset_version, atol=cmd_args.atol)
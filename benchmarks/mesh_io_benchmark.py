@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Measures the throughput of the mesh writers and readers
+
+    Run from the root of the repository:
+
+        python -m benchmarks.mesh_io_benchmark --num-meshes 10000 \
+            --num-legacy 200
+
+    Meshes with the size of SMPL-X, 10475 vertices and 20908 triangles,
+    are written to and read back from a temporary folder with
+    `expose.utils.mesh_io` in all its formats. For reference, the
+    open3d writer that the demo used before, when open3d is installed,
+    and the pure-Python OBJ writer and reader of the face fitting code are
+    run on `--num-legacy` meshes. The benchmark reports meshes per second
+    and the size of a file.
+'''
+
+import os
+import os.path as osp
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from loguru import logger
+
+from expose.utils.mesh_io import (
+    MESH_FORMATS, MESH_READERS, MESH_WRITERS, get_topology)
+
+NUM_VERTICES = 10475
+NUM_FACES = 20908
+
+
+def open3d_write_ply(path, vertices, faces):
+    ''' The per-person open3d mesh the demo wrote before '''
+    import open3d as o3d
+
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(vertices)
+    mesh.triangles = o3d.utility.Vector3iVector(faces)
+    o3d.io.write_triangle_mesh(path, mesh)
+
+
+def open3d_read_ply(path):
+    import open3d as o3d
+
+    mesh = o3d.io.read_triangle_mesh(path)
+    return np.asarray(mesh.vertices), np.asarray(mesh.triangles)
+
+
+def python_write_obj(path, vertices, faces):
+    ''' The vertex by vertex OBJ writer of the face fitting code '''
+    with open(path, 'w') as fp:
+        for x, y, z in vertices:
+            fp.write('v %f %f %f\n' % (x, y, z))
+        for v1, v2, v3 in faces + 1:
+            fp.write('f %d %d %d\n' % (v1, v2, v3))
+
+
+def python_read_obj(path):
+    ''' The line by line OBJ reader of the face fitting code '''
+    vertices = []
+    lines = open(path, 'r').readlines()
+    for line in lines:
+        if line.startswith('v '):
+            toks = line.split(' ')[1:]
+            vertices.append([float(toks[0]), float(toks[1]), float(toks[2])])
+    return np.array(vertices)
+
+
+def measure(write, read, folder, ext, vertices, faces, num_meshes):
+    ''' Returns the meshes per second of the writer and the reader '''
+    paths = [osp.join(folder, f'{idx:06d}.{ext}')
+             for idx in range(num_meshes)]
+    start = time.perf_counter()
+    for idx, path in enumerate(paths):
+        write(path, vertices[idx % len(vertices)], faces)
+    write_rate = num_meshes / (time.perf_counter() - start)
+    file_size = osp.getsize(paths[0])
+
+    start = time.perf_counter()
+    for path in paths:
+        read(path)
+    read_rate = num_meshes / (time.perf_counter() - start)
+
+    for path in paths:
+        os.remove(path)
+    return write_rate, read_rate, file_size
+
+
+def main(num_meshes=10000, num_legacy=200, output_folder=''):
+    folder = tempfile.mkdtemp(dir=output_folder or None)
+    rng = np.random.default_rng(0)
+    faces = rng.integers(0, NUM_VERTICES, size=[NUM_FACES, 3])
+    # A few different sets of vertices, so that the files differ
+    vertices = rng.standard_normal(
+        [16, NUM_VERTICES, 3]).astype(np.float32)
+
+    paths = {}
+    try:
+        import open3d  # noqa: F401
+        paths['open3d ply'] = (
+            open3d_write_ply, open3d_read_ply, 'ply', faces, num_legacy)
+    except ImportError:
+        logger.warning('open3d is not installed, skipping its writer')
+    paths['python obj'] = (
+        python_write_obj, python_read_obj, 'obj', faces, num_legacy)
+    topology = get_topology(faces)
+    for ext in MESH_FORMATS:
+        paths[f'mesh_io {ext}'] = (
+            MESH_WRITERS[ext], MESH_READERS[ext], ext, topology, num_meshes)
+
+    try:
+        results = {}
+        for name, (write, read, ext, curr_faces, count) in paths.items():
+            results[name] = measure(
+                write, read, folder, ext, vertices, curr_faces, count)
+            write_rate, read_rate, file_size = results[name]
+            logger.info(
+                f'{name}: {count} meshes, write: {write_rate:.0f} meshes/s,'
+                f' read: {read_rate:.0f} meshes/s,'
+                f' file size: {file_size / 2 ** 10:.0f} KiB')
+    finally:
+        shutil.rmtree(folder)
+
+    reference = 'open3d ply' if 'open3d ply' in results else 'python obj'
+    ref_write, ref_read, _ = results[reference]
+    for name, (write_rate, read_rate, _) in results.items():
+        logger.info(
+            f'{name}: write {write_rate / ref_write:.1f}x, read'
+            f' {read_rate / ref_read:.1f}x w.r.t. {reference}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the mesh writers and readers',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-meshes', dest='num_meshes', default=10000,
+                        type=int,
+                        help='The number of meshes per mesh_io format')
+    parser.add_argument('--num-legacy', dest='num_legacy', default=200,
+                        type=int,
+                        help='The number of meshes of the reference paths')
+    parser.add_argument('--output-folder', dest='output_folder', default='',
+                        type=str,
+                        help='The folder of the temporary files, defaults'
+                        ' to the system temporary folder')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(num_meshes=cmd_args.num_meshes, num_legacy=cmd_args.num_legacy,
+         output_folder=cmd_args.output_folder)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Counts the host synchronizations of the post-processing per frame
+
+    Run from the root of the repository:
+
+        python -m benchmarks.postprocess_benchmark --batch-sizes 1 8 32 \
+            --boxes-per-frame 2
+
+    Synthetic detector and SMPLXNet outputs are post-processed with the
+    previous per-image / per-tensor code and with the batched path, i.e.
+    `detect_people` and `postprocess_output`. The benchmark reports the
+    number of blocking device-to-host points per frame and the time per
+    frame. A blocking point is a `.cpu()`, `.item()`, `.tolist()` or a
+    boolean mask, each of which waits for the device, and one per batched
+    `to_host` call. On CUDA the synchronizations reported by the sync
+    debug mode of PyTorch are counted as well.
+'''
+
+import sys
+import time
+import argparse
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from loguru import logger
+
+from expose.data.detection import detect_people
+from expose.data.targets import BoundingBox
+from expose.utils import demo_utils
+from expose.utils.demo_utils import postprocess_output
+from expose.utils.device_utils import select_device, synchronize
+
+NUM_VERTICES = 10475
+PARAM_SHAPES = {
+    'global_orient': (1, 3, 3), 'body_pose': (21, 3, 3),
+    'left_hand_pose': (15, 3, 3), 'right_hand_pose': (15, 3, 3),
+    'jaw_pose': (1, 3, 3), 'betas': (10,), 'expression': (10,),
+}
+FRAME_SIZE = (1080, 1920)
+
+
+class SyncCounter(object):
+    ''' Counts the blocking device-to-host points of a code block '''
+
+    def __init__(self):
+        self.count = 0
+        self.cuda_syncs = 0
+
+    def _wrap(self, func, condition=None):
+        def wrapper(*args, **kwargs):
+            if condition is None or condition(*args, **kwargs):
+                self.count += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def __call__(self, device):
+        def is_mask(tensor, idx):
+            return torch.is_tensor(idx) and idx.dtype == torch.bool
+
+        patched = [
+            (torch.Tensor, 'cpu', None), (torch.Tensor, 'item', None),
+            (torch.Tensor, 'tolist', None), (torch.Tensor, '__bool__', None),
+            (torch.Tensor, '__getitem__', is_mask),
+            (demo_utils, 'to_host', None),
+        ]
+        originals = [(obj, name, getattr(obj, name))
+                     for obj, name, _ in patched]
+        for obj, name, condition in patched:
+            setattr(obj, name, self._wrap(getattr(obj, name), condition))
+
+        use_debug_mode = device.type == 'cuda'
+        try:
+            with warnings.catch_warnings(record=True) as records:
+                warnings.simplefilter('always')
+                if use_debug_mode:
+                    torch.cuda.set_sync_debug_mode('warn')
+                try:
+                    yield self
+                finally:
+                    if use_debug_mode:
+                        torch.cuda.set_sync_debug_mode('default')
+            self.cuda_syncs += sum(
+                'synchronizing' in str(record.message) for record in records)
+        finally:
+            for obj, name, func in originals:
+                setattr(obj, name, func)
+
+
+class FakeDetector(object):
+    ''' Returns precomputed detections for every image '''
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def __call__(self, images):
+        return self.outputs[:len(images)]
+
+
+def legacy_detect_people(rcnn_model, images, device, min_score=0.5):
+    ''' The per-image masking and transfer used before '''
+    rcnn_images = [
+        torch.from_numpy(img).permute(2, 0, 1).to(device=device)
+        for img in images]
+    output = rcnn_model(rcnn_images)
+
+    boxes = []
+    for out in output:
+        keep = out['scores'] >= min_score
+        boxes.append(out['boxes'][keep].detach().cpu().numpy())
+    return boxes
+
+
+def legacy_weak_persp_to_blender(
+        targets, camera_scale, camera_transl, H, W,
+        sensor_width=36, focal_length=5000):
+    ''' The per-target camera conversion used before '''
+    camera_scale = camera_scale.detach().cpu().numpy()
+    camera_transl = camera_transl.detach().cpu().numpy()
+
+    output = defaultdict(lambda: [])
+    for ii, target in enumerate(targets):
+        orig_bbox_size = target.get_field('orig_bbox_size')
+        bbox_center = target.get_field('orig_center')
+        z = 2 * focal_length / (camera_scale[ii] * orig_bbox_size)
+
+        output['shift_x'].append(- (bbox_center[0] / W - 0.5))
+        output['shift_y'].append((bbox_center[1] - 0.5 * H) / W)
+        output['transl'].append(
+            [camera_transl[ii, 0].item(), camera_transl[ii, 1].item(),
+             z.item()])
+        output['focal_length_in_mm'].append(focal_length / W * sensor_width)
+        output['focal_length_in_px'].append(focal_length)
+        output['center'].append(bbox_center)
+        output['sensor_width'].append(sensor_width)
+    return {key: np.stack(val, axis=0) for key, val in output.items()}
+
+
+def legacy_postprocess(model_output, body_imgs, targets, H, W):
+    ''' The sequence of transfers of the previous demo loop '''
+    body_imgs = body_imgs.detach().cpu().numpy()
+    body_output = model_output['body']
+    stage_out = body_output['stage_02']
+    stage_vertices = stage_out['vertices'].detach().cpu().numpy()
+    final_out = body_output['final']
+    vertices = final_out['vertices'].detach().cpu().numpy()
+    camera_parameters = body_output['camera_parameters']
+    hd_params = legacy_weak_persp_to_blender(
+        targets, camera_parameters['scale'].detach(),
+        camera_parameters['translation'].detach(), H=H, W=W)
+    params = {key: final_out[key].detach().cpu().numpy()
+              for key in PARAM_SHAPES}
+    return body_imgs, stage_vertices, vertices, hd_params, params
+
+
+def build_detections(num_frames, boxes_per_frame, num_candidates, device):
+    ''' Creates detector outputs with `boxes_per_frame` confident boxes '''
+    H, W = FRAME_SIZE
+    outputs = []
+    for _ in range(num_frames):
+        xy = torch.rand(num_candidates, 2) * torch.tensor([W / 2, H / 2])
+        wh = torch.rand(num_candidates, 2) * 200 + 100
+        scores = torch.rand(num_candidates) * 0.4
+        scores[:boxes_per_frame] += 0.6
+        outputs.append({
+            'boxes': torch.cat([xy, xy + wh], dim=1).to(device=device),
+            'scores': scores.to(device=device)})
+    return outputs
+
+
+def build_model_output(batch_size, device):
+    ''' Creates SMPLXNet outputs and targets for `batch_size` people '''
+    def stage():
+        out = {'vertices': torch.randn(
+            batch_size, NUM_VERTICES, 3, device=device)}
+        out.update({key: torch.randn(batch_size, *shape, device=device)
+                    for key, shape in PARAM_SHAPES.items()})
+        return out
+
+    model_output = {'body': {
+        'num_stages': 3, 'stage_02': stage(), 'final': stage(),
+        'camera_parameters': {
+            'scale': torch.rand(batch_size, 1, device=device) + 0.5,
+            'translation': torch.randn(batch_size, 2, device=device)},
+    }}
+
+    H, W = FRAME_SIZE
+    targets = []
+    for _ in range(batch_size):
+        target = BoundingBox(np.array([0, 0, 256, 256]), (256, 256, 3))
+        target.add_field('orig_bbox_size', np.float32(
+            np.random.uniform(200, 600)))
+        target.add_field('orig_center', np.array(
+            [np.random.uniform(0, W), np.random.uniform(0, H)],
+            dtype=np.float32))
+        targets.append(target)
+    body_imgs = torch.randn(batch_size, 3, 256, 256, device=device)
+    return model_output, body_imgs, targets
+
+
+def measure(func, num_iters, device):
+    ''' Returns the counted syncs of one call and the time per call '''
+    func()
+    counter = SyncCounter()
+    with counter(device):
+        func()
+
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        func()
+    synchronize(device)
+    return counter, (time.perf_counter() - start) / num_iters
+
+
+def main(
+    batch_sizes,
+    boxes_per_frame=2,
+    num_candidates=100,
+    num_iters=20,
+    device='auto',
+):
+    device = select_device(device)
+    logger.info(f'Device: {device}')
+    H, W = FRAME_SIZE
+
+    for batch_size in batch_sizes:
+        num_frames = max(1, batch_size // boxes_per_frame)
+        detections = build_detections(
+            num_frames, boxes_per_frame, num_candidates, device)
+        detector = FakeDetector(detections)
+        images = [np.zeros((64, 64, 3), dtype=np.float32)
+                  for _ in range(num_frames)]
+        model_output, body_imgs, targets = build_model_output(
+            batch_size, device)
+
+        legacy_boxes = legacy_detect_people(detector, images, device)
+        boxes = detect_people(detector, images, device)
+        assert all(np.allclose(legacy, curr)
+                   for legacy, curr in zip(legacy_boxes, boxes))
+
+        legacy_out = legacy_postprocess(
+            model_output, body_imgs, targets, H, W)
+        host_out = postprocess_output(
+            model_output, targets, H, W, param_keys=PARAM_SHAPES)
+        diff = max(np.abs(legacy_out[3][key] - host_out['hd_params'][key])
+                   .max() for key in legacy_out[3])
+
+        paths = {
+            'legacy': lambda: (
+                legacy_detect_people(detector, images, device),
+                legacy_postprocess(model_output, body_imgs, targets, H, W)),
+            'batched': lambda: (
+                detect_people(detector, images, device),
+                postprocess_output(
+                    model_output, targets, H, W,
+                    param_keys=PARAM_SHAPES)),
+        }
+        for name, func in paths.items():
+            counter, curr_time = measure(func, num_iters, device)
+            msg = (f'people: {batch_size}, frames: {num_frames}, {name}:'
+                   f' {counter.count / num_frames:.1f} syncs / frame,'
+                   f' {curr_time / num_frames * 1000:.3f} ms / frame')
+            if device.type == 'cuda':
+                msg += (f', CUDA syncs / frame:'
+                        f' {counter.cuda_syncs / num_frames:.1f}')
+            logger.info(msg)
+        logger.info(f'people: {batch_size}, max camera difference:'
+                    f' {diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the syncs of the post-processing',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch-sizes', dest='batch_sizes', type=int,
+                        nargs='+', default=[1, 8, 32],
+                        help='The numbers of people per batch')
+    parser.add_argument('--boxes-per-frame', dest='boxes_per_frame',
+                        default=2, type=int,
+                        help='The number of detected people per frame')
+    parser.add_argument('--num-candidates', dest='num_candidates',
+                        default=100, type=int,
+                        help='The number of raw detections per frame')
+    parser.add_argument('--num-iters', dest='num_iters', default=20,
+                        type=int, help='Number of timed iterations')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for the benchmark')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(batch_sizes=cmd_args.batch_sizes,
+         boxes_per_frame=cmd_args.boxes_per_frame,
+         num_candidates=cmd_args.num_candidates,
+         num_iters=cmd_args.num_iters, device=cmd_args.device)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Compares the HDRenderer against the persistent-scene BatchedHDRenderer
+    and the SoftwareRenderer
+
+    Run from the root of the repository, e.g. on a headless machine:
+
+        PYOPENGL_PLATFORM=egl python -m benchmarks.render_benchmark \
+            --batch-size 8 --degrees 90 180 270
+
+    Without a body model the meshes are icospheres of a similar size to the
+    SMPL-X mesh, pass `--model-path` to render SMPL-X meshes instead.
+'''
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import trimesh
+
+from loguru import logger
+
+from expose.utils.plot_utils import HDRenderer, BatchedHDRenderer
+from expose.utils.rasterizer import SoftwareRenderer
+
+
+def build_meshes(batch_size, model_path=None, seed=0):
+    rng = np.random.RandomState(seed)
+    if model_path:
+        import torch
+        import smplx
+
+        body_model = smplx.create(model_path, model_type='smplx')
+        with torch.no_grad():
+            output = body_model(
+                betas=torch.from_numpy(
+                    rng.randn(batch_size, 10).astype(np.float32)),
+                body_pose=torch.from_numpy(
+                    0.2 * rng.randn(batch_size, 63).astype(np.float32)),
+            )
+        vertices = output.vertices.numpy()
+        faces = body_model.faces.astype(np.int64)
+    else:
+        sphere = trimesh.creation.icosphere(subdivisions=5, radius=0.5)
+        faces = np.asarray(sphere.faces, dtype=np.int64)
+        vertices = np.stack([
+            np.asarray(sphere.vertices) * [0.6, 1.8, 0.4] +
+            0.002 * rng.randn(*sphere.vertices.shape)
+            for _ in range(batch_size)]).astype(np.float32)
+    return vertices, faces
+
+
+def render_reference(renderer, vertices, faces, camera, bg_imgs, degrees):
+    outputs = [renderer(
+        vertices, faces, bg_imgs=bg_imgs, return_with_alpha=True,
+        body_color=[0.4, 0.4, 0.7], **camera)]
+    for deg in degrees:
+        outputs.append(renderer(
+            vertices, faces, bg_imgs=bg_imgs, return_with_alpha=True,
+            render_bg=False, body_color=[0.4, 0.4, 0.7], deg=deg,
+            **camera))
+    return np.stack(outputs)
+
+
+def render_batched(renderer, vertices, faces, camera, bg_imgs, degrees):
+    return renderer.render_views(
+        vertices, faces, bg_imgs=bg_imgs, return_with_alpha=True,
+        degrees=[0] + list(degrees),
+        render_bg=[True] + [False] * len(degrees),
+        body_color=[0.4, 0.4, 0.7], **camera)
+
+
+def time_renderer(func, num_iters, *args):
+    # The first call compiles the shaders and uploads the static buffers
+    output = func(*args)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        output = func(*args)
+    return (time.perf_counter() - start) / num_iters, output
+
+
+def main(batch_size=8, degrees=(90, 180, 270), height=1080, width=1920,
+         num_iters=5, model_path=None):
+    vertices, faces = build_meshes(batch_size, model_path=model_path)
+    logger.info(f'Meshes: {batch_size} x {vertices.shape[1]} vertices,'
+                f' {len(faces)} faces, views: {1 + len(degrees)}')
+
+    focal_length = 5000
+    camera = dict(
+        focal_length=np.full([batch_size], focal_length, dtype=np.float32),
+        camera_translation=np.tile(
+            [[0.0, 0.0, 2 * focal_length / height]], [batch_size, 1]),
+        camera_center=np.tile([[width * 0.5, height * 0.5]], [batch_size, 1]),
+    )
+    bg_imgs = np.random.RandomState(1).rand(
+        batch_size, 3, height, width).astype(np.float32)
+
+    ref_time, ref_imgs = time_renderer(
+        render_reference, num_iters, HDRenderer(img_size=256),
+        vertices, faces, camera, bg_imgs, degrees)
+    batched_time, batched_imgs = time_renderer(
+        render_batched, num_iters, BatchedHDRenderer(img_size=256),
+        vertices, faces, camera, bg_imgs, degrees)
+
+    software_time, software_imgs = time_renderer(
+        render_batched, num_iters, SoftwareRenderer(),
+        vertices, faces, camera, bg_imgs, degrees)
+
+    logger.info(f'HDRenderer: {ref_time * 1000:.1f} ms per batch')
+    for name, curr_time, imgs in [
+            ('BatchedHDRenderer', batched_time, batched_imgs),
+            ('SoftwareRenderer', software_time, software_imgs)]:
+        diff = np.abs(ref_imgs - imgs)
+        logger.info(f'{name}: {curr_time * 1000:.1f} ms per batch,'
+                    f' speedup: {ref_time / curr_time:.2f}x,'
+                    f' image difference max: {diff.max():.4f},'
+                    f' mean: {diff.mean():.6f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HD renderers',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch-size', dest='batch_size', default=8,
+                        type=int, help='Number of bodies per batch')
+    parser.add_argument('--degrees', type=float, nargs='*',
+                        default=[90, 180, 270],
+                        help='Extra views around the vertical axis')
+    parser.add_argument('--height', default=1080, type=int,
+                        help='Height of the background images')
+    parser.add_argument('--width', default=1920, type=int,
+                        help='Width of the background images')
+    parser.add_argument('--num-iters', dest='num_iters', default=5,
+                        type=int, help='Number of timed iterations')
+    parser.add_argument('--model-path', dest='model_path', default='',
+                        type=str,
+                        help='Folder with the SMPL-X model, if empty the'
+                        ' benchmark renders icospheres')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(batch_size=cmd_args.batch_size, degrees=cmd_args.degrees,
+         height=cmd_args.height, width=cmd_args.width,
+         num_iters=cmd_args.num_iters, model_path=cmd_args.model_path)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Compares the float and the uint8 visualization paths of the demo
+
+    Run from the root of the repository:
+
+        python -m benchmarks.visualization_benchmark --batch-sizes 1 4 \
+            --height 1080 --width 1920
+
+    A synthetic RGBA rendering of a body is composited on normalized
+    frames, from the normalized tensor to the uint8 image written to the
+    PNG files. The float path is the one the demo used before: it undoes
+    the normalization with an extra alpha channel, transposes and clips the
+    frames, blends in float and converts the result to uint8. The uint8
+    path denormalizes with `denormalize_to_uint8` and blends with
+    `alpha_composite_uint8`. The benchmark reports the time per frame and
+    the peak of the host memory allocated for a frame.
+'''
+
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import torch
+
+from loguru import logger
+
+from expose.utils.demo_utils import (
+    denormalize_to_uint8, undo_img_normalization)
+from expose.utils.img_utils import alpha_composite_uint8
+
+MEAN = np.array([0.485, 0.456, 0.406])
+STD = np.array([0.229, 0.224, 0.225])
+
+
+def build_inputs(batch_size, height, width):
+    ''' Creates normalized frames and RGBA renderings of a box-shaped body '''
+    images = torch.randn(batch_size, 3, height, width)
+    renderings = np.zeros([batch_size, height, width, 4], dtype=np.uint8)
+    top, left = height // 5, width // 3
+    renderings[:, top:height - top, left:width - left] = (102, 102, 178, 255)
+    return images, renderings
+
+
+def float_path(images, renderings):
+    hd_imgs = images.detach().cpu().numpy()
+    hd_imgs = np.transpose(undo_img_normalization(hd_imgs, MEAN, STD),
+                           [0, 2, 3, 1])
+    hd_imgs = np.clip(hd_imgs, 0, 1.0)
+    bg_imgs = np.transpose(hd_imgs, [0, 3, 1, 2])
+
+    output = []
+    for bg_img, rendering in zip(bg_imgs, renderings):
+        color = np.transpose(rendering, [2, 0, 1]).astype(np.float32) / 255.0
+        valid_mask = (color[3] > 0)[np.newaxis]
+        output.append(np.clip(
+            color * valid_mask + (1 - valid_mask) * bg_img, 0, 1))
+    output = np.stack(output)
+    return np.clip(np.transpose(output, [0, 2, 3, 1]) * 255, 0, 255).astype(
+        np.uint8)
+
+
+def uint8_path(images, renderings):
+    hd_imgs = denormalize_to_uint8(images, MEAN, STD).cpu().numpy()
+    return np.stack([
+        alpha_composite_uint8(bg_img, rendering, with_alpha=True)
+        for bg_img, rendering in zip(hd_imgs, renderings)])
+
+
+def measure(func, num_iters):
+    ''' Returns the time and the peak host allocation in MB of a call '''
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        func()
+    return (time.perf_counter() - start) / num_iters, peak / 2 ** 20
+
+
+def main(batch_sizes, height=1080, width=1920, num_iters=10):
+    for batch_size in batch_sizes:
+        images, renderings = build_inputs(batch_size, height, width)
+        diff = np.abs(
+            float_path(images, renderings).astype(np.int16) -
+            uint8_path(images, renderings)).max()
+
+        results = {
+            'float': measure(
+                lambda: float_path(images, renderings), num_iters),
+            'uint8': measure(
+                lambda: uint8_path(images, renderings), num_iters),
+        }
+        float_time = results['float'][0]
+        for name, (curr_time, peak_mb) in results.items():
+            logger.info(
+                f'frames: {batch_size}, {name}:'
+                f' {curr_time / batch_size * 1000:.2f} ms / frame,'
+                f' speedup: {float_time / curr_time:.2f}x,'
+                f' peak memory: {peak_mb / batch_size:.1f} MB / frame')
+        logger.info(f'frames: {batch_size}, max abs difference: {diff}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the visualization paths',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch-sizes', dest='batch_sizes', type=int,
+                        nargs='+', default=[1, 4],
+                        help='The numbers of frames per call')
+    parser.add_argument('--height', default=1080, type=int,
+                        help='The height of the frames')
+    parser.add_argument('--width', default=1920, type=int,
+                        help='The width of the frames')
+    parser.add_argument('--num-iters', dest='num_iters', default=10,
+                        type=int, help='Number of timed iterations')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(batch_sizes=cmd_args.batch_sizes, height=cmd_args.height,
+         width=cmd_args.width, num_iters=cmd_args.num_iters)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Measures the latency and accuracy of warm-started regression on a video
+
+    Run from the root of the repository:
+
+        python -m benchmarks.warm_start_benchmark --exp-cfg data/conf.yaml \
+            --source video.mp4 --stages 1 2 3
+
+    People are detected on every frame and associated across frames by
+    IoU. On every frame the model runs once from the mean parameters with
+    all its stages, which serves as the reference, and once for every
+    number of warm-started stages, seeded with the state that the same
+    variant predicted for the person on the previous frame. The MPJPE and
+    V2V of every variant are computed w.r.t. the reference with the
+    alignments of the `Evaluator`.
+'''
+
+import time
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import cv2
+import torch
+
+from loguru import logger
+from tqdm import tqdm
+
+from expose.config import cfg
+from expose.config.cmd_parser import set_face_contour
+from expose.data.build import collate_batch
+from expose.data.datasets.image_folder import crop_box_sample
+from expose.data.detection import build_detector, detect_people
+from expose.data.targets.image_list import to_image_list
+from expose.data.tracking import BoxTracker, TrackStateCache
+from expose.data.transforms import build_transforms
+from expose.evaluation import compute_agreement
+from expose.utils.demo_utils import build_model
+from expose.utils.device_utils import select_device, synchronize
+from expose.utils.metrics import (
+    ProcrustesAlignmentMPJPE, RootAlignmentMPJPE)
+
+
+def read_frames(source, max_frames=-1):
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError(f'Could not open video source: {source}')
+    index = 0
+    try:
+        while max_frames < 0 or index < max_frames:
+            success, bgr_img = capture.read()
+            if not success:
+                break
+            yield cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB).astype(
+                np.float32) / 255.0
+            index += 1
+    finally:
+        capture.release()
+
+
+def crop_frame(image, boxes, transforms, frame_idx, scale_factor=1.2):
+    samples = []
+    frame_tensor = None
+    for box_idx, bbox in enumerate(boxes):
+        full_img, cropped_img, target, index = crop_box_sample(
+            image, bbox, f'frame_{frame_idx:06d}', box_idx,
+            transforms=transforms, scale_factor=scale_factor,
+            return_full_img=frame_tensor is None)
+        if frame_tensor is None:
+            frame_tensor = full_img
+        samples.append((frame_tensor, cropped_img, target, index))
+    if len(samples) < 1:
+        return None
+    return collate_batch(samples, return_full_imgs=True, pin_memory=False)
+
+
+def run_model(model, batch, device, init_state=None, num_stages=None):
+    full_imgs, body_imgs, body_targets = batch
+    full_imgs = to_image_list(full_imgs).to(device=device)
+    body_imgs = body_imgs.to(device=device)
+    body_targets = [target.to(device) for target in body_targets]
+
+    synchronize(device)
+    start = time.perf_counter()
+    output = model(body_imgs, body_targets, full_imgs=full_imgs,
+                   device=device, init_state=init_state,
+                   num_stages=num_stages)
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    body_output = output['body']
+    final = body_output.get(
+        'final', body_output.get(
+            f'stage_{body_output["num_stages"] - 1:02d}'))
+    return final, body_output['regression_state'], elapsed
+
+
+@torch.no_grad()
+def main(exp_cfg, source, stages=(1, 2), device='auto', max_frames=-1,
+         min_score=0.5):
+    device = select_device(device)
+    model = build_model(exp_cfg, device)
+    rcnn_model = build_detector(device)
+    transforms = build_transforms(
+        exp_cfg.datasets.body.transforms, is_train=False)
+
+    tracker = BoxTracker(detect_every=1)
+    caches = {num_stages: TrackStateCache() for num_stages in stages}
+
+    joint_alignments = {'procrustes': ProcrustesAlignmentMPJPE(),
+                        'root': RootAlignmentMPJPE()}
+    vertex_alignments = {'procrustes': ProcrustesAlignmentMPJPE()}
+    errors = defaultdict(list)
+    times = defaultdict(float)
+    num_people = 0
+
+    for frame_idx, image in enumerate(
+            tqdm(read_frames(source, max_frames=max_frames))):
+        boxes = detect_people(
+            rcnn_model, [image], device, min_score=min_score)[0]
+        tracker.update(boxes, frame_idx)
+        track_ids = tracker.track_ids
+        batch = crop_frame(image, tracker.boxes, transforms, frame_idx)
+        if batch is None:
+            continue
+        num_people += len(track_ids)
+
+        ref_out, _, elapsed = run_model(model, batch, device)
+        times['reference'] += elapsed
+
+        for num_stages in stages:
+            cache = caches[num_stages]
+            out, state, elapsed = run_model(
+                model, batch, device, init_state=cache.gather(track_ids),
+                num_stages=num_stages)
+            cache.update(track_ids, state)
+            times[num_stages] += elapsed
+
+            for key, val in compute_agreement(
+                    out['joints'], ref_out['joints'],
+                    joint_alignments).items():
+                errors[(num_stages, f'{key}/MPJPE')].append(val)
+            for key, val in compute_agreement(
+                    out['vertices'], ref_out['vertices'],
+                    vertex_alignments).items():
+                errors[(num_stages, f'{key}/V2V')].append(val)
+
+    if num_people < 1:
+        logger.error(f'No people were detected in {source}')
+        return
+
+    ref_time = times['reference']
+    logger.info(f'Reference: {ref_time / num_people * 1000:.1f} ms per'
+                ' person')
+    for num_stages in stages:
+        metrics = ', '.join(
+            f'{name}: {np.concatenate(val).mean() * 1000:.2f} mm'
+            for (curr_stages, name), val in errors.items()
+            if curr_stages == num_stages)
+        logger.info(
+            f'Warm start with {num_stages} stages:'
+            f' {times[num_stages] / num_people * 1000:.1f} ms per person,'
+            f' speedup: {ref_time / max(times[num_stages], 1e-8):.2f}x,'
+            f' {metrics}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark warm-started regression on a video',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--exp-cfg', type=str, dest='exp_cfg',
+                        help='The configuration of the experiment')
+    parser.add_argument('--exp-opts', default=[], dest='exp_opts',
+                        nargs='*', help='Extra command line arguments')
+    parser.add_argument('--source', type=str, required=True,
+                        help='A video file or an image sequence pattern')
+    parser.add_argument('--stages', type=int, nargs='+', default=[1, 2],
+                        help='The numbers of warm-started stages to compare')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for inference')
+    parser.add_argument('--max-frames', dest='max_frames', default=-1,
+                        type=int, help='Stop after this many frames')
+    parser.add_argument('--min-score', dest='min_score', default=0.5,
+                        type=float,
+                        help='Minimum score of the person detections')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda x: tqdm.write(x, end=''), level='INFO',
+               colorize=True)
+
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
+    cfg.is_training = False
+    set_face_contour(cfg, use_face_contour=cfg.datasets.use_face_contour)
+
+    main(cfg, cmd_args.source, stages=cmd_args.stages,
+         device=cmd_args.device, max_frames=cmd_args.max_frames,
+         min_score=cmd_args.min_score)
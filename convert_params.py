@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+''' Converts the per-person parameter files of a demo run to a store
+
+    Earlier versions of the demo wrote one `{fname}_params.npz` file per
+    detected person. This script collects them into a columnar parameter
+    store, the format that the demo now writes with `--save-params`:
+
+        python convert_params.py --npz-folder demo_output \
+            --output demo_output/params
+
+    The store is read with `expose.utils.param_store.ParamStore`.
+'''
+import sys
+import time
+import argparse
+
+from loguru import logger
+
+from expose.utils.param_store import ParamStore, convert_npz_tree
+
+
+def main(npz_folder: str, output_path: str, batch_size: int = 1024) -> None:
+    start = time.perf_counter()
+    num_rows = convert_npz_tree(
+        npz_folder, output_path, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    logger.info(f'Converted {num_rows} files in {elapsed:.2f} s')
+
+    store = ParamStore(output_path)
+    columns = ', '.join(
+        f'{name}: {store.column(name).shape[1:]}' for name in store.columns)
+    logger.info(f'{len(store)} rows, columns: {columns}')
+
+
+if __name__ == '__main__':
+    arg_formatter = argparse.ArgumentDefaultsHelpFormatter
+    description = 'Convert per-person npz parameter files to a store'
+    parser = argparse.ArgumentParser(formatter_class=arg_formatter,
+                                     description=description)
+    parser.add_argument('--npz-folder', dest='npz_folder', required=True,
+                        type=str,
+                        help='The demo output folder with the npz files')
+    parser.add_argument('--output', dest='output_path', required=True,
+                        type=str, help='The folder of the parameter store')
+    parser.add_argument('--batch-size', dest='batch_size', default=1024,
+                        type=int, help='Files appended to the store at once')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    main(cmd_args.npz_folder, cmd_args.output_path,
+         batch_size=cmd_args.batch_size)
@@ -15,61 +15,50 @@
 # Contact: ps-license@tuebingen.mpg.de
 
 
-import sys
 import os
 import os.path as osp
-from typing import List, Optional
-import functools
+from typing import List, Optional, Union
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
 
 import resource
 import numpy as np
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 from loguru import logger
 import cv2
 import argparse
 import time
-import open3d as o3d
 from tqdm import tqdm
 from threadpoolctl import threadpool_limits
-import PIL.Image as pil_img
 import matplotlib.pyplot as plt
 
 import torch
-import torch.utils.data as dutils
-from torchvision.models.detection import keypointrcnn_resnet50_fpn
-from torchvision.transforms import Compose, Normalize, ToTensor
-
-from expose.data.datasets import ImageFolder, ImageFolderWithBoxes
 
 from expose.data.targets.image_list import to_image_list
-from expose.utils.checkpointer import Checkpointer
 
-from expose.data.build import collate_batch
+from expose.data.detection import DetectionCropLoader, build_detector
 from expose.data.transforms import build_transforms
 
-from expose.models.smplx_net import SMPLXNet
 from expose.config import cfg
 from expose.config.cmd_parser import set_face_contour
-from expose.utils.plot_utils import HDRenderer
+from expose.utils.device_utils import (
+    select_device, synchronize, configure_threads)
+from expose.utils.demo_utils import (
+    RENDERERS, build_model, build_renderer, denormalize_to_uint8,
+    postprocess_output)
+from expose.utils.async_writer import AsyncResultWriter
+from expose.utils.mesh_io import MESH_FORMATS, get_topology
+from expose.utils.param_store import ParamStoreWriter
+from expose.utils.video_sink import (
+    VIDEO_BACKENDS, FrameCompositor, VideoSink)
+from expose.utils.timer import PROFILER
 
 rlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
 resource.setrlimit(resource.RLIMIT_NOFILE, (rlimit[1], rlimit[1]))
 
 
-Vec3d = o3d.utility.Vector3dVector
-Vec3i = o3d.utility.Vector3iVector
-
-
-def collate_fn(batch):
-    output_dict = dict()
-
-    for d in batch:
-        for key, val in d.items():
-            if key not in output_dict:
-                output_dict[key] = []
-            output_dict[key].append(val)
-    return output_dict
+def shard_prefix(shard_idx: int, num_shards: int) -> str:
+    ''' The prefix of the videos and the parameter store of a shard '''
+    return f'shard_{shard_idx:03d}_' if num_shards > 1 else ''
 
 
 def preprocess_images(
@@ -78,136 +67,42 @@ def preprocess_images(
     num_workers: int = 8, batch_size: int = 1,
     min_score: float = 0.5,
     scale_factor: float = 1.2,
-    device: Optional[torch.device] = None
-) -> dutils.DataLoader:
+    device: Optional[torch.device] = None,
+    channels_last: bool = False,
+    shard_idx: int = 0,
+    num_shards: int = 1,
+) -> DetectionCropLoader:
 
     if device is None:
-        device = torch.device('cuda')
-        if not torch.cuda.is_available():
-            logger.error('CUDA is not available!')
-            sys.exit(3)
-
-    rcnn_model = keypointrcnn_resnet50_fpn(pretrained=True)
-    rcnn_model.eval()
-    rcnn_model = rcnn_model.to(device=device)
+        device = select_device('auto')
 
-    transform = Compose(
-        [ToTensor(), ]
-    )
-
-    # Load the images
-    dataset = ImageFolder(image_folder, transforms=transform)
-    rcnn_dloader = dutils.DataLoader(
-        dataset, batch_size=batch_size, num_workers=num_workers,
-        collate_fn=collate_fn
-    )
-
-    out_dir = osp.expandvars('$HOME/Dropbox/boxes')
-    os.makedirs(out_dir, exist_ok=True)
-
-    img_paths = []
-    bboxes = []
-    for bidx, batch in enumerate(
-            tqdm(rcnn_dloader, desc='Processing with R-CNN')):
-        batch['images'] = [x.to(device=device) for x in batch['images']]
-
-        output = rcnn_model(batch['images'])
-        for ii, x in enumerate(output):
-            img = np.transpose(
-                batch['images'][ii].detach().cpu().numpy(), [1, 2, 0])
-            img = (img * 255).astype(np.uint8)
-
-            img_path = batch['paths'][ii]
-            _, fname = osp.split(img_path)
-            fname, _ = osp.splitext(fname)
-
-            #  out_path = osp.join(out_dir, f'{fname}_{ii:03d}.jpg')
-            for n, bbox in enumerate(output[ii]['boxes']):
-                bbox = bbox.detach().cpu().numpy()
-                if output[ii]['scores'][n].item() < min_score:
-                    continue
-                img_paths.append(img_path)
-                bboxes.append(bbox)
-
-                #  cv2.rectangle(img, tuple(bbox[:2]), tuple(bbox[2:]),
-                #  (255, 0, 0))
-            #  cv2.imwrite(out_path, img[:, :, ::-1])
+    rcnn_model = build_detector(device, channels_last=channels_last)
 
     dataset_cfg = exp_cfg.get('datasets', {})
     body_dsets_cfg = dataset_cfg.get('body', {})
 
     body_transfs_cfg = body_dsets_cfg.get('transforms', {})
     transforms = build_transforms(body_transfs_cfg, is_train=False)
-    batch_size = body_dsets_cfg.get('batch_size', 64)
-
-    expose_dset = ImageFolderWithBoxes(
-        img_paths, bboxes, scale_factor=scale_factor, transforms=transforms)
-
-    expose_collate = functools.partial(
-        collate_batch, use_shared_memory=num_workers > 0,
-        return_full_imgs=True)
-    expose_dloader = dutils.DataLoader(
-        expose_dset,
-        batch_size=batch_size,
+    expose_batch_size = body_dsets_cfg.get('batch_size', 64)
+
+    # Every frame is decoded once, detected and cropped from the same buffer
+    expose_dloader = DetectionCropLoader(
+        image_folder,
+        rcnn_model,
+        transforms=transforms,
+        device=device,
+        batch_size=expose_batch_size,
+        rcnn_batch=batch_size,
         num_workers=num_workers,
-        collate_fn=expose_collate,
-        drop_last=False,
-        pin_memory=True,
+        min_score=min_score,
+        scale_factor=scale_factor,
+        pin_memory=device.type == 'cuda',
+        shard_idx=shard_idx,
+        num_shards=num_shards,
     )
     return expose_dloader
 
 
-def weak_persp_to_blender(
-        targets,
-        camera_scale,
-        camera_transl,
-        H, W,
-        sensor_width=36,
-        focal_length=5000):
-    ''' Converts weak-perspective camera to a perspective camera
-    '''
-    if torch.is_tensor(camera_scale):
-        camera_scale = camera_scale.detach().cpu().numpy()
-    if torch.is_tensor(camera_transl):
-        camera_transl = camera_transl.detach().cpu().numpy()
-
-    output = defaultdict(lambda: [])
-    for ii, target in enumerate(targets):
-        orig_bbox_size = target.get_field('orig_bbox_size')
-        bbox_center = target.get_field('orig_center')
-        z = 2 * focal_length / (camera_scale[ii] * orig_bbox_size)
-
-        transl = [
-            camera_transl[ii, 0].item(), camera_transl[ii, 1].item(),
-            z.item()]
-        shift_x = - (bbox_center[0] / W - 0.5)
-        shift_y = (bbox_center[1] - 0.5 * H) / W
-        focal_length_in_mm = focal_length / W * sensor_width
-        output['shift_x'].append(shift_x)
-        output['shift_y'].append(shift_y)
-        output['transl'].append(transl)
-        output['focal_length_in_mm'].append(focal_length_in_mm)
-        output['focal_length_in_px'].append(focal_length)
-        output['center'].append(bbox_center)
-        output['sensor_width'].append(sensor_width)
-    for key in output:
-        output[key] = np.stack(output[key], axis=0)
-    return output
-
-
-def undo_img_normalization(image, mean, std, add_alpha=True):
-    if torch.is_tensor(image):
-        image = image.detach().cpu().numpy().squeeze()
-
-    out_img = (image * std[np.newaxis, :, np.newaxis, np.newaxis] +
-               mean[np.newaxis, :, np.newaxis, np.newaxis])
-    if add_alpha:
-        out_img = np.pad(
-            out_img, [[0, 0], [0, 1], [0, 0], [0, 0]],
-            mode='constant', constant_values=1.0)
-    return out_img
-
-
 @torch.no_grad()
 def main(
     image_folder: str,
@@ -222,12 +117,28 @@ def main(
     save_params: bool = False,
     save_mesh: bool = False,
     degrees: Optional[List[float]] = [],
-) -> None:
+    device: Union[str, torch.device] = 'auto',
+    channels_last: bool = False,
+    bf16: bool = False,
+    writer_threads: int = 4,
+    writer_queue_size: int = 64,
+    renderer_type: str = 'hd',
+    profile: bool = False,
+    profile_trace: str = '',
+    loader_workers: int = 8,
+    shard_idx: int = 0,
+    num_shards: int = 1,
+    output_format: str = 'png',
+    video_fps: float = 30,
+    video_backend: str = 'auto',
+    mesh_format: str = 'ply',
+    min_score: float = 0.5,
+) -> dict:
 
-    device = torch.device('cuda')
-    if not torch.cuda.is_available():
-        logger.error('CUDA is not available!')
-        sys.exit(3)
+    device = select_device(device)
+    profile = profile or bool(profile_trace)
+    if profile:
+        PROFILER.enable()
 
     logger.remove()
     logger.add(lambda x: tqdm.write(x, end=''),
@@ -235,31 +146,17 @@ def main(
                colorize=True)
 
     expose_dloader = preprocess_images(
-        image_folder, exp_cfg, batch_size=rcnn_batch, device=device)
+        image_folder, exp_cfg, num_workers=loader_workers,
+        batch_size=rcnn_batch, min_score=min_score, device=device,
+        channels_last=channels_last, shard_idx=shard_idx,
+        num_shards=num_shards)
 
     demo_output_folder = osp.expanduser(osp.expandvars(demo_output_folder))
     logger.info(f'Saving results to: {demo_output_folder}')
     os.makedirs(demo_output_folder, exist_ok=True)
 
-    model = SMPLXNet(exp_cfg)
-    try:
-        model = model.to(device=device)
-    except RuntimeError:
-        # Re-submit in case of a device error
-        sys.exit(3)
-
-    output_folder = exp_cfg.output_folder
-    checkpoint_folder = osp.join(output_folder, exp_cfg.checkpoint_folder)
-    checkpointer = Checkpointer(
-        model, save_dir=checkpoint_folder, pretrained=exp_cfg.pretrained)
-
-    arguments = {'iteration': 0, 'epoch_number': 0}
-    extra_checkpoint_data = checkpointer.load_checkpoint()
-    for key in arguments:
-        if key in extra_checkpoint_data:
-            arguments[key] = extra_checkpoint_data[key]
-
-    model = model.eval()
+    model = build_model(
+        exp_cfg, device, channels_last=channels_last, bf16=bf16)
 
     means = np.array(exp_cfg.datasets.body.transforms.mean)
     std = np.array(exp_cfg.datasets.body.transforms.std)
@@ -268,10 +165,45 @@ def main(
     body_crop_size = exp_cfg.get('datasets', {}).get('body', {}).get(
         'transforms').get('crop_size', 256)
     if render:
-        hd_renderer = HDRenderer(img_size=body_crop_size)
+        hd_renderer = build_renderer(renderer_type, img_size=body_crop_size)
+    # Renderers that support it draw all the views of a body in one pass
+    use_batched_renderer = render and hasattr(hd_renderer, 'render_views')
+
+    # Outputs are written in the background while the next batch is processed
+    result_writer = AsyncResultWriter(
+        num_workers=writer_threads, max_queue_size=writer_queue_size)
+    # Every shard of a run writes its own videos and parameter store, which
+    # are merged by the launcher
+    prefix = shard_prefix(shard_idx, num_shards)
+    # The video sink streams the visualizations into one video per view,
+    # instead of a folder of images per person
+    video_sink = None
+    if output_format == 'video':
+        video_sink = VideoSink(
+            demo_output_folder, fps=video_fps, backend=video_backend,
+            prefix=prefix)
+    save_png = save_vis and video_sink is None
+    # The people of a frame are composited into one image per view, so the
+    # overlays are rendered without the frame as background
+    compositor = None
+    if video_sink is not None and save_vis:
+        views = OrderedDict([('hd_imgs', True), ('hd_orig_overlay', True),
+                             ('hd_overlay', True)])
+        for deg in degrees:
+            views[f'hd_rendering_{deg:03.0f}'] = False
+        compositor = FrameCompositor(
+            video_sink, views, expose_dloader.dataset.frame_idxs,
+            expose_dloader.dataset.paths)
+    render_frame_bg = compositor is None
+    # The parameters of all the people are appended to a columnar store
+    param_store = None
+    if save_params:
+        param_store = ParamStoreWriter(
+            osp.join(demo_output_folder, f'{prefix}params'))
 
     total_time = 0
     cnt = 0
+    num_imgs = 0
     for bidx, batch in enumerate(tqdm(expose_dloader, dynamic_ncols=True)):
 
         full_imgs_list, body_imgs, body_targets = batch
@@ -283,79 +215,58 @@ def main(
         body_targets = [target.to(device) for target in body_targets]
         full_imgs = full_imgs.to(device=device)
 
-        torch.cuda.synchronize()
+        if channels_last:
+            body_imgs = body_imgs.contiguous(
+                memory_format=torch.channels_last)
+
+        synchronize(device)
         start = time.perf_counter()
         model_output = model(body_imgs, body_targets, full_imgs=full_imgs,
                              device=device)
-        torch.cuda.synchronize()
+        synchronize(device)
         elapsed = time.perf_counter() - start
         cnt += 1
+        num_imgs += len(body_targets)
         total_time += elapsed
 
-        hd_imgs = full_imgs.images.detach().cpu().numpy().squeeze()
-        body_imgs = body_imgs.detach().cpu().numpy()
-        body_output = model_output.get('body')
-
         _, _, H, W = full_imgs.shape
-        #  logger.info(f'{H}, {W}')
-        #  H, W, _ = hd_imgs.shape
+        final_out = model_output['body']['final']
+        faces = final_out['faces']
+        # The encoded face blocks of the mesh files are reused for all people
+        mesh_topology = get_topology(faces) if save_mesh else None
+        param_keys = []
+        if save_params:
+            param_keys = [key for key, val in final_out.items()
+                          if torch.is_tensor(val)]
+        extra = {}
         if render:
-            hd_imgs = np.transpose(undo_img_normalization(hd_imgs, means, std),
-                                   [0, 2, 3, 1])
-            hd_imgs = np.clip(hd_imgs, 0, 1.0)
-            right_hand_crops = body_output.get('right_hand_crops')
-            left_hand_crops = torch.flip(
-                body_output.get('left_hand_crops'), dims=[-1])
-            head_crops = body_output.get('head_crops')
-            bg_imgs = undo_img_normalization(body_imgs, means, std)
-
-            right_hand_crops = undo_img_normalization(
-                right_hand_crops, means, std)
-            left_hand_crops = undo_img_normalization(
-                left_hand_crops, means, std)
-            head_crops = undo_img_normalization(head_crops, means, std)
-
-        body_output = model_output.get('body', {})
-        num_stages = body_output.get('num_stages', 3)
-        stage_n_out = body_output.get(f'stage_{num_stages - 1:02d}', {})
-        model_vertices = stage_n_out.get('vertices', None)
-
-        if stage_n_out is not None:
-            model_vertices = stage_n_out.get('vertices', None)
-
-        faces = stage_n_out['faces']
-        if model_vertices is not None:
-            model_vertices = model_vertices.detach().cpu().numpy()
-            camera_parameters = body_output.get('camera_parameters', {})
-            camera_scale = camera_parameters['scale'].detach()
-            camera_transl = camera_parameters['translation'].detach()
+            # The frames are converted to uint8 on the device, so the
+            # overlays are composited without full-resolution float images
+            extra['hd_imgs'] = denormalize_to_uint8(
+                full_imgs.images, means, std)
+            if full_imgs.frame_idxs is not None:
+                extra['frame_idxs'] = full_imgs.frame_idxs
+        # Everything that is needed on the host is moved in one transfer
+        host_out = postprocess_output(
+            model_output, body_targets, H=H, W=W,
+            sensor_width=sensor_width, focal_length=focal_length,
+            param_keys=param_keys, extra=extra)
+        model_vertices = host_out['stage_vertices']
+        final_model_vertices = host_out['vertices']
+        hd_params = host_out['hd_params']
+        batch_params = host_out['params']
 
-        out_img = OrderedDict()
+        if render:
+            hd_imgs = host_out['hd_imgs']
+            if 'frame_idxs' in host_out:
+                # Every frame is stored once, expand them to one per person
+                hd_imgs = hd_imgs[host_out['frame_idxs']]
+            bg_hd_imgs = hd_imgs
 
-        final_model_vertices = None
-        stage_n_out = model_output.get('body', {}).get('final', {})
-        if stage_n_out is not None:
-            final_model_vertices = stage_n_out.get('vertices', None)
-
-        if final_model_vertices is not None:
-            final_model_vertices = final_model_vertices.detach().cpu().numpy()
-            camera_parameters = model_output.get('body', {}).get(
-                'camera_parameters', {})
-            camera_scale = camera_parameters['scale'].detach()
-            camera_transl = camera_parameters['translation'].detach()
-
-        hd_params = weak_persp_to_blender(
-            body_targets,
-            camera_scale=camera_scale,
-            camera_transl=camera_transl,
-            H=H, W=W,
-            sensor_width=sensor_width,
-            focal_length=focal_length,
-        )
+        out_img = OrderedDict()
 
         if save_vis:
-            bg_hd_imgs = np.transpose(hd_imgs, [0, 3, 1, 2])
-            out_img['hd_imgs'] = bg_hd_imgs
+            out_img['hd_imgs'] = hd_imgs
         if render:
             # Render the initial predictions on the original image resolution
             hd_orig_overlays = hd_renderer(
@@ -364,87 +275,106 @@ def main(
                 camera_translation=hd_params['transl'],
                 camera_center=hd_params['center'],
                 bg_imgs=bg_hd_imgs,
+                render_bg=render_frame_bg,
                 return_with_alpha=True,
+                uint8=True,
             )
             out_img['hd_orig_overlay'] = hd_orig_overlays
 
         # Render the overlays of the final prediction
-        if render:
-            hd_overlays = hd_renderer(
-                final_model_vertices,
-                faces,
+        if use_batched_renderer:
+            # The final overlay and all the extra views share the same
+            # vertices, so they are rendered from a single mesh upload
+            views = hd_renderer.render_views(
+                final_model_vertices, faces,
                 focal_length=hd_params['focal_length_in_px'],
                 camera_translation=hd_params['transl'],
                 camera_center=hd_params['center'],
                 bg_imgs=bg_hd_imgs,
+                degrees=[0] + list(degrees),
+                render_bg=[render_frame_bg] + [False] * len(degrees),
                 return_with_alpha=True,
-                body_color=[0.4, 0.4, 0.7]
+                uint8=True,
+                body_color=[0.4, 0.4, 0.7],
             )
-            out_img['hd_overlay'] = hd_overlays
-
-        for deg in degrees:
+            out_img['hd_overlay'] = views[0]
+            for deg, hd_overlays in zip(degrees, views[1:]):
+                out_img[f'hd_rendering_{deg:03.0f}'] = hd_overlays
+        elif render:
             hd_overlays = hd_renderer(
-                final_model_vertices, faces,
+                final_model_vertices,
+                faces,
                 focal_length=hd_params['focal_length_in_px'],
                 camera_translation=hd_params['transl'],
                 camera_center=hd_params['center'],
                 bg_imgs=bg_hd_imgs,
+                render_bg=render_frame_bg,
                 return_with_alpha=True,
-                render_bg=False,
-                body_color=[0.4, 0.4, 0.7],
-                deg=deg,
+                uint8=True,
+                body_color=[0.4, 0.4, 0.7]
             )
-            out_img[f'hd_rendering_{deg:03.0f}'] = hd_overlays
+            out_img['hd_overlay'] = hd_overlays
 
-        if save_vis:
-            for key in out_img.keys():
-                out_img[key] = np.clip(
-                    np.transpose(
-                        out_img[key], [0, 2, 3, 1]) * 255, 0, 255).astype(
-                            np.uint8)
+        if render and not use_batched_renderer:
+            for deg in degrees:
+                hd_overlays = hd_renderer(
+                    final_model_vertices, faces,
+                    focal_length=hd_params['focal_length_in_px'],
+                    camera_translation=hd_params['transl'],
+                    camera_center=hd_params['center'],
+                    bg_imgs=bg_hd_imgs,
+                    return_with_alpha=True,
+                    uint8=True,
+                    render_bg=False,
+                    body_color=[0.4, 0.4, 0.7],
+                    deg=deg,
+                )
+                out_img[f'hd_rendering_{deg:03.0f}'] = hd_overlays
+
+        if compositor is not None:
+            for idx, target in enumerate(body_targets):
+                compositor.add(
+                    target.get_field('frame_idx'), hd_imgs[idx],
+                    {name: curr_img[idx] for name, curr_img in out_img.items()
+                     if name != 'hd_imgs'},
+                    depth=hd_params['transl'][idx, 2])
+        if param_store is not None:
+            rows = dict(batch_params)
+            rows.update(hd_params)
+            rows['fname'] = np.array(
+                [target.get_field('fname') for target in body_targets])
+            # Maps the rows to the input images and the frames of the videos
+            rows['frame_idx'] = np.array(
+                [target.get_field('frame_idx') for target in body_targets])
+            param_store.append(rows)
+            # The faces and the other values shared by all the people
+            for key, val in final_out.items():
+                if not torch.is_tensor(val):
+                    param_store.set_constant(key, val)
 
         for idx in tqdm(range(len(body_targets)), 'Saving ...'):
             fname = body_targets[idx].get_field('fname')
             curr_out_path = osp.join(demo_output_folder, fname)
-            os.makedirs(curr_out_path, exist_ok=True)
+            if save_png or save_mesh:
+                os.makedirs(curr_out_path, exist_ok=True)
 
-            if save_vis:
+            if save_png:
                 for name, curr_img in out_img.items():
-                    pil_img.fromarray(curr_img[idx]).save(
-                        osp.join(curr_out_path, f'{name}.png'))
+                    result_writer.save_image(
+                        osp.join(curr_out_path, f'{name}.png'), curr_img[idx])
 
             if save_mesh:
                 # Store the mesh predicted by the body-crop network
-                naive_mesh = o3d.geometry.TriangleMesh()
-                naive_mesh.vertices = Vec3d(
-                    model_vertices[idx] + hd_params['transl'][idx])
-                naive_mesh.triangles = Vec3i(faces)
-                mesh_fname = osp.join(curr_out_path, f'body_{fname}.ply')
-                o3d.io.write_triangle_mesh(mesh_fname, naive_mesh)
+                result_writer.save_mesh(
+                    osp.join(curr_out_path, f'body_{fname}.{mesh_format}'),
+                    model_vertices[idx] + hd_params['transl'][idx],
+                    mesh_topology)
 
                 # Store the final mesh
-                expose_mesh = o3d.geometry.TriangleMesh()
-                expose_mesh.vertices = Vec3d(
-                    final_model_vertices[idx] + hd_params['transl'][idx])
-                expose_mesh.triangles = Vec3i(faces)
-                mesh_fname = osp.join(curr_out_path, f'{fname}.ply')
-                o3d.io.write_triangle_mesh(mesh_fname, expose_mesh)
-
-            if save_params:
-                params_fname = osp.join(curr_out_path, f'{fname}_params.npz')
-                out_params = dict(fname=fname)
-                for key, val in stage_n_out.items():
-                    if torch.is_tensor(val):
-                        val = val.detach().cpu().numpy()[idx]
-                    out_params[key] = val
-                for key, val in hd_params.items():
-                    if torch.is_tensor(val):
-                        val = val.detach().cpu().numpy()
-                    if np.isscalar(val[idx]):
-                        out_params[key] = val[idx].item()
-                    else:
-                        out_params[key] = val[idx]
-                np.savez_compressed(params_fname, **out_params)
+                result_writer.save_mesh(
+                    osp.join(curr_out_path, f'{fname}.{mesh_format}'),
+                    final_model_vertices[idx] + hd_params['transl'][idx],
+                    mesh_topology)
 
             if show:
                 nrows = 1
@@ -473,13 +403,31 @@ def main(
                 else:
                     plt.show()
 
-    logger.info(f'Average inference time: {total_time / cnt}')
-
-
-if __name__ == '__main__':
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = False
-
+        logger.debug(f'Result writer queue depth: {result_writer.depth}')
+
+    # Wait for all pending writes and sync them to disk
+    result_writer.close()
+    if compositor is not None:
+        compositor.close()
+    if video_sink is not None:
+        video_sink.close()
+    if param_store is not None:
+        param_store.close()
+
+    if cnt > 0:
+        logger.info(f'Average inference time: {total_time / cnt}')
+        logger.info(
+            f'Average inference time per image: {total_time / num_imgs}')
+    if profile:
+        PROFILER.log_summary()
+    if profile_trace:
+        PROFILER.export_chrome_trace(profile_trace)
+    return {'num_batches': cnt, 'num_people': num_imgs,
+            'inference_time': total_time,
+            'num_images': len(expose_dloader.dataset)}
+
+
+def build_parser() -> argparse.ArgumentParser:
     arg_formatter = argparse.ArgumentDefaultsHelpFormatter
     description = 'PyTorch SMPL-X Regressor Demo'
     parser = argparse.ArgumentParser(formatter_class=arg_formatter,
@@ -524,10 +472,88 @@ if __name__ == '__main__':
                         help='Whether to save meshes')
     parser.add_argument('--save-params', dest='save_params', default=False,
                         type=lambda x: x.lower() in ['true'],
-                        help='Whether to save parameters')
+                        help='Whether to save the parameters of all the'
+                        ' people to a columnar store in the output folder')
+    parser.add_argument('--min-score', dest='min_score', default=0.5,
+                        type=float,
+                        help='Minimum score of the person detections')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for inference: auto, cpu,'
+                        ' cuda or cuda:N')
+    parser.add_argument('--num-threads', dest='num_threads', default=0,
+                        type=int,
+                        help='Intra-op threads for CPU inference, 0 uses all'
+                        ' the available cores')
+    parser.add_argument('--channels-last', dest='channels_last',
+                        default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones in channels-last layout')
+    parser.add_argument('--bf16', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones under bfloat16 autocast')
+    parser.add_argument('--loader-workers', dest='loader_workers', default=8,
+                        type=int,
+                        help='Processes that decode the images')
+    parser.add_argument('--writer-threads', dest='writer_threads', default=4,
+                        type=int,
+                        help='Background threads that write the results, 0'
+                        ' writes on the inference thread')
+    parser.add_argument('--writer-queue-size', dest='writer_queue_size',
+                        default=64, type=int,
+                        help='Maximum number of pending result writes')
+    parser.add_argument('--renderer', dest='renderer_type', default='hd',
+                        choices=RENDERERS,
+                        help='The renderer used for the visualizations. The'
+                        ' batched renderer keeps a persistent scene and'
+                        ' renders all the views of a body at once, the'
+                        ' software renderer needs no OpenGL context')
+    parser.add_argument('--profile', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Record the wall time and peak memory of the'
+                        ' model stages and log their percentiles')
+    parser.add_argument('--profile-trace', dest='profile_trace', default='',
+                        type=str,
+                        help='Save the profiled stages as a Chrome trace'
+                        ' to this JSON file')
+    parser.add_argument('--output-format', dest='output_format',
+                        default='png', choices=['png', 'video'],
+                        help='Save the visualizations as PNG files per person'
+                        ' or stream them into one video per view, with all'
+                        ' the people of an image in one frame')
+    parser.add_argument('--video-fps', dest='video_fps', default=30,
+                        type=float,
+                        help='The frame rate of the videos')
+    parser.add_argument('--video-backend', dest='video_backend',
+                        default='auto', choices=VIDEO_BACKENDS,
+                        help='The video encoder, auto uses the ffmpeg'
+                        ' executable when it is available and OpenCV'
+                        ' otherwise')
+    parser.add_argument('--mesh-format', dest='mesh_format', default='ply',
+                        choices=MESH_FORMATS,
+                        help='The file format of the saved meshes')
+    return parser
+
+
+def merge_cfg(cmd_args):
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
 
-    cmd_args = parser.parse_args()
+    cfg.datasets.body.batch_size = cmd_args.expose_batch
 
+    cfg.is_training = False
+    cfg.datasets.body.splits.test = cmd_args.datasets
+    use_face_contour = cfg.datasets.use_face_contour
+    set_face_contour(cfg, use_face_contour=use_face_contour)
+    return cfg
+
+
+def run(cmd_args, shard_idx: int = 0, num_shards: int = 1) -> dict:
+    ''' Runs the demo with the parsed command line arguments
+
+        With `num_shards > 1` the folder is split into `num_shards`
+        contiguous blocks of images and only the block `shard_idx` is
+        processed.
+    '''
     image_folder = cmd_args.image_folder
     show = cmd_args.show
     output_folder = cmd_args.output_folder
@@ -537,23 +563,17 @@ if __name__ == '__main__':
     save_params = cmd_args.save_params
     save_mesh = cmd_args.save_mesh
     degrees = cmd_args.degrees
-    expose_batch = cmd_args.expose_batch
     rcnn_batch = cmd_args.rcnn_batch
 
-    cfg.merge_from_file(cmd_args.exp_cfg)
-    cfg.merge_from_list(cmd_args.exp_opts)
+    exp_cfg = merge_cfg(cmd_args)
 
-    cfg.datasets.body.batch_size = expose_batch
-
-    cfg.is_training = False
-    cfg.datasets.body.splits.test = cmd_args.datasets
-    use_face_contour = cfg.datasets.use_face_contour
-    set_face_contour(cfg, use_face_contour=use_face_contour)
+    device = select_device(cmd_args.device)
+    num_threads = configure_threads(device, cmd_args.num_threads)
 
-    with threadpool_limits(limits=1):
-        main(
+    with threadpool_limits(limits=num_threads):
+        return main(
             image_folder,
-            cfg,
+            exp_cfg,
             show=show,
             demo_output_folder=output_folder,
             pause=pause,
@@ -563,4 +583,27 @@ if __name__ == '__main__':
             save_params=save_params,
             degrees=degrees,
             rcnn_batch=rcnn_batch,
+            device=device,
+            channels_last=cmd_args.channels_last,
+            bf16=cmd_args.bf16,
+            writer_threads=cmd_args.writer_threads,
+            writer_queue_size=cmd_args.writer_queue_size,
+            renderer_type=cmd_args.renderer_type,
+            profile=cmd_args.profile,
+            profile_trace=cmd_args.profile_trace,
+            loader_workers=cmd_args.loader_workers,
+            shard_idx=shard_idx,
+            num_shards=num_shards,
+            output_format=cmd_args.output_format,
+            video_fps=cmd_args.video_fps,
+            video_backend=cmd_args.video_backend,
+            mesh_format=cmd_args.mesh_format,
+            min_score=cmd_args.min_score,
         )
+
+
+if __name__ == '__main__':
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+
+    run(build_parser().parse_args())
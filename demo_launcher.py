@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+''' Runs the demo on a folder with several processes on a CPU node
+
+    The images of the folder are split into K contiguous blocks, one per
+    worker process, each with its own detector and SMPLXNet and an intra-op
+    budget of T threads. All the workers write to the same output folder.
+    The parameter store and the videos of every worker have a shard prefix
+    and are concatenated after all the workers have finished. The people
+    are numbered per image, e.g. `img.jpg_001`, and the workers detect them
+    with the same `--min-score`, so the folder ends up with the same layout
+    as a single `demo.py` run with the same options:
+
+        python demo_launcher.py --image-folder images \
+            --exp-cfg data/conf.yaml --output-folder demo_output \
+            --save-params true
+
+    Unless they are given, K and T are picked by a short calibration run,
+    which measures the per-image latency of the pipeline on a few images of
+    the folder for every thread budget. Every budget T allows
+    `num_cpus // T` workers, further limited by the memory that one worker
+    needs, and the pair with the highest estimated throughput is used.
+'''
+import os
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+
+import gc
+import sys
+import glob
+import json
+import time
+import queue
+import shutil
+import resource
+import os.path as osp
+import multiprocessing as mp
+from typing import Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+from threadpoolctl import threadpool_limits
+
+import torch
+
+import demo
+from expose.data.build import collate_batch
+from expose.data.datasets.image_folder import ImageFolder, crop_box_sample
+from expose.data.detection import build_detector, detect_people
+from expose.data.targets.image_list import to_image_list
+from expose.data.transforms import build_transforms
+from expose.utils.demo_utils import build_model
+from expose.utils.device_utils import (
+    select_device, synchronize, configure_threads, get_num_cpus)
+from expose.utils.img_utils import read_img
+from expose.utils.param_store import merge_stores
+from expose.utils.video_sink import concat_videos
+
+
+def thread_budgets(num_cpus: int) -> List[int]:
+    ''' The powers of two up to the number of cores, and the cores '''
+    budgets = [2 ** ii for ii in range(int(np.log2(num_cpus)) + 1)]
+    if budgets[-1] != num_cpus:
+        budgets.append(num_cpus)
+    return budgets
+
+
+def available_memory() -> int:
+    ''' The memory in bytes that new processes can use without swapping '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_image(
+    model, rcnn_model, transforms, image, device, min_score=0.5,
+    scale_factor=1.2,
+) -> None:
+    boxes = detect_people(rcnn_model, [image], device, min_score=min_score)[0]
+    samples = []
+    frame_tensor = None
+    for box_idx, bbox in enumerate(boxes):
+        full_img, cropped_img, target, index = crop_box_sample(
+            image, bbox, 'calibration', box_idx, transforms=transforms,
+            scale_factor=scale_factor, return_full_img=frame_tensor is None)
+        if frame_tensor is None:
+            frame_tensor = full_img
+        samples.append((frame_tensor, cropped_img, target, index))
+    if len(samples) < 1:
+        return
+    full_imgs, body_imgs, body_targets = collate_batch(
+        samples, return_full_imgs=True, pin_memory=False)
+    model(body_imgs.to(device=device),
+          [target.to(device) for target in body_targets],
+          full_imgs=to_image_list(full_imgs).to(device=device),
+          device=device)
+    synchronize(device)
+
+
+@torch.no_grad()
+def calibrate(
+    exp_cfg,
+    image_paths: List[str],
+    device: torch.device,
+    budgets: List[int],
+    channels_last: bool = False,
+    bf16: bool = False,
+    min_score: float = 0.5,
+) -> Tuple[Dict[int, float], int]:
+    ''' Measures the per-image latency of the pipeline for every budget
+
+        Returns
+        -------
+            latencies: dict
+                The seconds per image for every number of threads
+            peak_memory: int
+                The peak resident memory of a worker in bytes
+    '''
+    model = build_model(
+        exp_cfg, device, channels_last=channels_last, bf16=bf16)
+    rcnn_model = build_detector(device, channels_last=channels_last)
+    transforms = build_transforms(
+        exp_cfg.datasets.body.transforms, is_train=False)
+    images = [read_img(path) for path in image_paths]
+
+    latencies = {}
+    for num_threads in budgets:
+        torch.set_num_threads(num_threads)
+        with threadpool_limits(limits=num_threads):
+            # The first image warms up the kernels of this thread budget
+            process_image(model, rcnn_model, transforms, images[0], device,
+                          min_score=min_score)
+            start = time.perf_counter()
+            for image in images:
+                process_image(model, rcnn_model, transforms, image, device,
+                              min_score=min_score)
+            latencies[num_threads] = (
+                time.perf_counter() - start) / len(images)
+        logger.info(
+            f'{num_threads} threads:'
+            f' {latencies[num_threads] * 1000:.1f} ms per image')
+
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    del model, rcnn_model
+    gc.collect()
+    return latencies, peak_memory
+
+
+def select_config(
+    latencies: Dict[int, float],
+    num_cpus: int,
+    max_procs: int,
+) -> Tuple[int, int, float]:
+    ''' Picks the number of workers and threads with the best throughput
+
+        The throughput of K workers is estimated as K times the throughput
+        of a single worker with the same thread budget, so the contention
+        for memory bandwidth between the workers is not taken into account.
+        Ties are resolved in favour of fewer workers.
+    '''
+    best = None
+    for num_threads, latency in sorted(latencies.items()):
+        num_procs = max(min(num_cpus // num_threads, max_procs), 1)
+        throughput = num_procs / latency
+        if best is None or throughput > best[2] * 1.0001:
+            best = (num_procs, num_threads, throughput)
+    return best
+
+
+def run_shard(cmd_args, shard_idx: int, num_shards: int, results) -> None:
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    try:
+        stats = demo.run(cmd_args, shard_idx=shard_idx, num_shards=num_shards)
+        results.put((shard_idx, stats))
+    except Exception:
+        logger.exception(f'Shard {shard_idx} failed')
+        results.put((shard_idx, None))
+
+
+def merge_shard_outputs(cmd_args, output_folder: str, num_shards: int) -> None:
+    ''' Merges the parameter stores and the videos of the shards '''
+    if num_shards < 2:
+        return
+    prefixes = [demo.shard_prefix(shard_idx, num_shards)
+                for shard_idx in range(num_shards)]
+
+    store_paths = [osp.join(output_folder, f'{prefix}params')
+                   for prefix in prefixes]
+    store_paths = [path for path in store_paths if osp.isdir(path)]
+    if len(store_paths) > 0:
+        merge_stores(store_paths, osp.join(output_folder, 'params'))
+        for path in store_paths:
+            shutil.rmtree(path)
+
+    first_videos = glob.glob(osp.join(output_folder, f'{prefixes[0]}*.mp4'))
+    for first_video in sorted(first_videos):
+        view = osp.basename(first_video)[len(prefixes[0]):]
+        video_paths = [osp.join(output_folder, f'{prefix}{view}')
+                       for prefix in prefixes]
+        video_paths = [path for path in video_paths if osp.exists(path)]
+        output_path = concat_videos(
+            video_paths, osp.join(output_folder, view),
+            fps=cmd_args.video_fps, backend=cmd_args.video_backend)
+        logger.info(f'Merged {len(video_paths)} videos into {output_path}')
+        for path in video_paths:
+            os.remove(path)
+
+
+def main(cmd_args) -> None:
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    if cmd_args.show:
+        logger.warning('The results cannot be displayed by the workers')
+        cmd_args.show = False
+
+    device = select_device(cmd_args.device)
+    num_images = len(ImageFolder(cmd_args.image_folder))
+    if num_images < 1:
+        logger.error(f'No images found in {cmd_args.image_folder}')
+        sys.exit(1)
+
+    num_cpus = get_num_cpus()
+    num_procs = cmd_args.num_procs
+    num_threads = cmd_args.threads_per_proc
+    calibration = {}
+    if device.type == 'cuda':
+        # The workers would share the GPU, which needs no calibration
+        num_procs = max(num_procs, 1)
+    elif num_procs > 0 and num_threads < 1:
+        num_threads = max(num_cpus // num_procs, 1)
+    elif num_procs < 1:
+        budgets = ([num_threads] if num_threads > 0 else
+                   thread_budgets(num_cpus))
+        configure_threads(device, num_cpus)
+        exp_cfg = demo.merge_cfg(cmd_args)
+        image_paths = ImageFolder(cmd_args.image_folder).paths[
+            :cmd_args.calibration_images].tolist()
+        logger.info(
+            f'Calibrating on {len(image_paths)} images with {budgets}'
+            ' threads')
+        latencies, peak_memory = calibrate(
+            exp_cfg, image_paths, device, budgets,
+            channels_last=cmd_args.channels_last, bf16=cmd_args.bf16,
+            min_score=cmd_args.min_score)
+
+        max_procs = int(0.9 * available_memory() // max(peak_memory, 1))
+        if cmd_args.max_procs > 0:
+            max_procs = min(max_procs, cmd_args.max_procs)
+        num_procs, num_threads, throughput = select_config(
+            latencies, num_cpus, max(max_procs, 1))
+        logger.info(
+            f'Peak memory per worker: {peak_memory / 2 ** 30:.2f} GiB,'
+            f' estimated throughput: {throughput:.2f} images/s')
+        calibration = {
+            'latencies': {str(key): val for key, val in latencies.items()},
+            'peak_memory': peak_memory,
+            'estimated_throughput': throughput}
+    num_procs = min(num_procs, num_images)
+
+    cmd_args.num_threads = num_threads
+    cmd_args.loader_workers = max(cmd_args.loader_workers // num_procs, 1)
+    logger.info(
+        f'Processing {num_images} images with {num_procs} workers and'
+        f' {num_threads} threads per worker on {num_cpus} cores')
+
+    # Spawned workers do not inherit the thread pools of the calibration
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    start = time.perf_counter()
+    workers = []
+    for shard_idx in range(num_procs):
+        worker = ctx.Process(
+            target=run_shard, name=f'demo_shard_{shard_idx:02d}',
+            args=(cmd_args, shard_idx, num_procs, results))
+        worker.start()
+        workers.append(worker)
+
+    shard_stats = {}
+    while len(shard_stats) < num_procs:
+        try:
+            shard_idx, stats = results.get(timeout=1.0)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        shard_stats[shard_idx] = stats
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    failed = [shard_idx for shard_idx in range(num_procs)
+              if shard_stats.get(shard_idx) is None]
+    done = [stats for stats in shard_stats.values() if stats is not None]
+    processed = sum(stats['num_images'] for stats in done)
+    summary = {
+        'num_procs': num_procs, 'threads_per_proc': num_threads,
+        'num_images': processed,
+        'num_people': sum(stats['num_people'] for stats in done),
+        'elapsed': elapsed, 'throughput': processed / elapsed,
+        'failed_shards': failed, 'calibration': calibration}
+    logger.info(
+        f'Processed {processed} images in {elapsed:.1f} s,'
+        f' {summary["throughput"]:.2f} images/s')
+
+    output_folder = osp.expanduser(osp.expandvars(cmd_args.output_folder))
+    os.makedirs(output_folder, exist_ok=True)
+    with open(osp.join(output_folder, 'launcher_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    if len(failed) > 0:
+        # The outputs of the finished shards are kept as they are
+        logger.error(f'Failed shards: {failed}')
+        sys.exit(1)
+    merge_shard_outputs(cmd_args, output_folder, num_procs)
+
+
+if __name__ == '__main__':
+    parser = demo.build_parser()
+    parser.description = 'Runs the demo with several worker processes'
+    parser.add_argument('--num-procs', dest='num_procs', default=0,
+                        type=int,
+                        help='The number of worker processes, 0 picks it'
+                        ' with a calibration run')
+    parser.add_argument('--threads-per-proc', dest='threads_per_proc',
+                        default=0, type=int,
+                        help='The intra-op threads of every worker, 0 picks'
+                        ' them with a calibration run')
+    parser.add_argument('--max-procs', dest='max_procs', default=0,
+                        type=int,
+                        help='Upper bound of the calibrated number of'
+                        ' workers, 0 is only bounded by the cores and the'
+                        ' available memory')
+    parser.add_argument('--calibration-images', dest='calibration_images',
+                        default=4, type=int,
+                        help='The number of images timed for every thread'
+                        ' budget')
+    main(parser.parse_args())
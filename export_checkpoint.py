@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+''' Writes the inference-only weights of SMPLXNet to a mappable file
+
+    The training checkpoint also stores the optimizer, scheduler and
+    discriminator states and is unpickled as a whole on every start. This
+    script loads it once and keeps only the state dict of the model:
+
+        python export_checkpoint.py --exp-cfg data/conf.yaml \
+            --output data/checkpoints/inference.wmckpt
+
+    The file is then used by every entry point with
+
+        --exp-opts inference_checkpoint data/checkpoints/inference.wmckpt
+'''
+import sys
+import os.path as osp
+import time
+import resource
+import argparse
+
+import torch
+
+from loguru import logger
+
+from expose.config import cfg
+from expose.config.cmd_parser import set_face_contour
+from expose.models.smplx_net import SMPLXNet
+from expose.utils.checkpointer import (
+    Checkpointer, save_inference_checkpoint, load_inference_weights)
+
+
+def peak_memory() -> float:
+    ''' The peak resident memory of the process in GiB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+
+
+@torch.no_grad()
+def main(exp_cfg, output_path: str = '', verify: bool = True) -> None:
+    checkpoint_folder = osp.join(
+        exp_cfg.output_folder, exp_cfg.checkpoint_folder)
+    if not output_path:
+        output_path = osp.join(checkpoint_folder, 'inference.wmckpt')
+
+    model = SMPLXNet(exp_cfg).eval()
+    start = time.perf_counter()
+    checkpointer = Checkpointer(
+        model, save_dir=checkpoint_folder, pretrained=exp_cfg.pretrained)
+    if len(checkpointer.load_checkpoint()) < 1:
+        logger.error('No checkpoint to export')
+        sys.exit(1)
+    load_time = time.perf_counter() - start
+    logger.info(
+        f'Loaded the training checkpoint in {load_time:.2f} s, peak memory:'
+        f' {peak_memory():.2f} GiB')
+
+    state_dict = model.state_dict()
+    num_bytes = save_inference_checkpoint(
+        state_dict, output_path,
+        metadata={'exp_cfg': exp_cfg.dump(), 'torch': torch.__version__})
+    logger.info(
+        f'Wrote {len(state_dict)} tensors, {num_bytes / 2 ** 20:.1f} MiB, to'
+        f' {output_path}')
+
+    if not verify:
+        return
+    mapped_model = SMPLXNet(exp_cfg).eval()
+    start = time.perf_counter()
+    load_inference_weights(mapped_model, output_path)
+    map_time = time.perf_counter() - start
+    mapped_state = mapped_model.state_dict()
+    mismatches = [
+        key for key, val in state_dict.items()
+        if key not in mapped_state or not torch.equal(val, mapped_state[key])]
+    if len(mismatches) > 0:
+        logger.error(f'The exported weights do not match: {mismatches}')
+        sys.exit(1)
+    logger.info(
+        f'Verified the exported weights, mapped in {map_time * 1000:.1f} ms,'
+        f' {load_time / max(map_time, 1e-8):.1f}x faster than the training'
+        ' checkpoint')
+
+
+if __name__ == '__main__':
+    arg_formatter = argparse.ArgumentDefaultsHelpFormatter
+    description = 'Export the inference weights of SMPLXNet'
+    parser = argparse.ArgumentParser(formatter_class=arg_formatter,
+                                     description=description)
+    parser.add_argument('--exp-cfg', type=str, dest='exp_cfg', required=True,
+                        help='The configuration of the experiment')
+    parser.add_argument('--exp-opts', default=[], dest='exp_opts',
+                        nargs='*', help='Extra command line arguments')
+    parser.add_argument('--output', dest='output_path', default='',
+                        type=str,
+                        help='The exported file, defaults to'
+                        ' inference.wmckpt in the checkpoint folder')
+    parser.add_argument('--verify', default=True,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Map the exported file into a new model and'
+                        ' compare the weights')
+
+    cmd_args = parser.parse_args()
+
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
+    cfg.is_training = False
+    # The source of the export is always the training checkpoint
+    cfg.inference_checkpoint = ''
+    use_face_contour = cfg.datasets.use_face_contour
+    set_face_contour(cfg, use_face_contour=use_face_contour)
+
+    main(cfg, output_path=cmd_args.output_path, verify=cmd_args.verify)
@@ -17,6 +17,9 @@ _C.body_model.num_expression_coeffs = 10
 _C.body_model.use_feet_keypoints = True
 _C.body_model.use_face_keypoints = True
 _C.body_model.use_face_contour = False
+# The folder of the prebuilt body models, e.g.
+# ~/.cache/wondermirror/body_models. The cache is disabled when empty.
+_C.body_model.cache_folder = ''
 
 _C.body_model.global_orient = CN()
 # The configuration for the parameterization of the body pose
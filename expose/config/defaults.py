@@ -194,6 +194,9 @@ _C.smplx_valid_verts_fn = 'data/smplx_valid_verts.npz'
 _C.use_hands_for_shape = False
 _C.j14_regressor_path = 'data/SMPLX_to_J14.pkl'
 _C.pretrained = ''
+# An inference-only weights file written by `export_checkpoint.py`. When set,
+# it is memory-mapped instead of loading the training checkpoint
+_C.inference_checkpoint = ''
 
 _C.use_adv_training = False
 
@@ -281,6 +284,13 @@ _C.network.attention.head_bbox_thresh = 0.4
 _C.network.attention.update_wrists = True
 _C.network.attention.mask_hand_keyps = True
 _C.network.attention.mask_head_keyps = True
+# Crop and refine at inference only the hands and heads with at least
+# `min_visible` of their projected joints inside the frame and a crop of at
+# least `min_size` pixels. The other people keep the body network estimates.
+_C.network.attention.part_gating = CN()
+_C.network.attention.part_gating.enable = False
+_C.network.attention.part_gating.min_visible = 0.5
+_C.network.attention.part_gating.min_size = 16.0
 # Merged network that regresses all parameters from a global feature vector
 _C.network.attention.smplx = CN()
 _C.network.attention.smplx.feature_key = 'avg_pooling'
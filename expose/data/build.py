@@ -165,6 +165,11 @@ class MemoryPinning(object):
         self.images = images
         self.targets = targets
 
+    def __iter__(self):
+        # Pinning is skipped when no accelerator is present, e.g. for CPU
+        # inference, so the batch must unpack like the pinned tuple
+        return iter((self.img_list, self.images, self.targets))
+
     def pin_memory(
             self
     ) -> Tuple[Union[ImageList, List[Tensor]], Tensor, List[GenericTarget]]:
@@ -180,6 +185,25 @@ class MemoryPinning(object):
         )
 
 
+def collate_full_imgs(
+        images: List[Tensor]) -> ImageList:
+    ''' Stores each distinct full resolution frame of a batch once
+
+        Samples that share the same frame tensor, e.g. all the people
+        detected in one image, are mapped to a single entry of the image list
+        through its box-to-frame index tensor.
+    '''
+    unique_imgs, frame_idxs, seen = [], [], {}
+    for img in images:
+        key = id(img)
+        if key not in seen:
+            seen[key] = len(unique_imgs)
+            unique_imgs.append(img)
+        frame_idxs.append(seen[key])
+    return to_image_list(
+        unique_imgs, frame_idxs=torch.tensor(frame_idxs, dtype=torch.long))
+
+
 def collate_batch(batch, use_shared_memory=False, return_full_imgs=False,
                   pin_memory=True):
     if return_full_imgs:
@@ -196,9 +220,12 @@ def collate_batch(batch, use_shared_memory=False, return_full_imgs=False,
         else:
             out_targets.append(t)
     out_cropped_images = []
-    for img in cropped_images:
+    out_full_imgs = []
+    for ii, img in enumerate(cropped_images):
         if img is None:
             continue
+        if return_full_imgs:
+            out_full_imgs.append(images[ii])
         if len(img.shape) < 4:
             img.unsqueeze_(dim=0)
         out_cropped_images.append(img.clone())
@@ -208,8 +235,7 @@ def collate_batch(batch, use_shared_memory=False, return_full_imgs=False,
 
     full_img_list = None
     if return_full_imgs:
-        #  full_img_list = to_image_list(images)
-        full_img_list = images
+        full_img_list = collate_full_imgs(out_full_imgs)
     out = None
     if use_shared_memory:
         numel = sum([x.numel() for x in out_cropped_images if x is not None])
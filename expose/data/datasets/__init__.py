@@ -15,7 +15,7 @@
 # Contact: ps-license@tuebingen.mpg.de
 
 
-from .image_folder import ImageFolder, ImageFolderWithBoxes
+from .image_folder import ImageFolder, ImageFolderWithBoxes, crop_box_sample
 from .ehf import EHF
 from .curated_fittings import CuratedFittings
 from .threedpw import ThreeDPW
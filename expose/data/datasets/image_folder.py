@@ -38,18 +38,25 @@ class ImageFolder(dutils.Dataset):
     def __init__(self,
                  data_folder='data/images',
                  transforms=None,
+                 shard_idx=0,
+                 num_shards=1,
                  **kwargs):
         super(ImageFolder, self).__init__()
 
         paths = []
         self.transforms = transforms
         data_folder = osp.expandvars(data_folder)
-        for fname in os.listdir(data_folder):
+        for fname in sorted(os.listdir(data_folder)):
             if not any(fname.endswith(ext) for ext in EXTS):
                 continue
             paths.append(osp.join(data_folder, fname))
+        # Every process of a sharded run takes a contiguous block of images,
+        # so that the outputs of the shards are merged by concatenation
+        self.frame_idxs = np.array_split(
+            np.arange(len(paths)), num_shards)[shard_idx]
+        paths = [paths[idx] for idx in self.frame_idxs]
 
-        self.paths = np.stack(paths)
+        self.paths = np.array(paths)
 
     def __len__(self):
         return len(self.paths)
@@ -62,10 +69,41 @@ class ImageFolder(dutils.Dataset):
 
         return {
             'images': img,
-            'paths': self.paths[index]
+            'paths': self.paths[index],
+            'frame_idxs': self.frame_idxs[index],
         }
 
 
+def crop_box_sample(img, bbox, img_path, index, transforms=None,
+                    scale_factor=1.2, return_full_img=True):
+    ''' Builds the body crop sample of a detection from a decoded image
+
+        Shared by `ImageFolderWithBoxes` and the fused detection loader,
+        which crops all the boxes of a frame from the same buffer. When
+        `return_full_img` is False the conversion and normalization of the
+        full image are skipped and None is returned in its place.
+    '''
+    target = BoundingBox(bbox, size=img.shape)
+
+    center, scale, bbox_size = bbox_to_center_scale(
+        bbox, dset_scale_factor=scale_factor)
+    target.add_field('bbox_size', bbox_size)
+    target.add_field('orig_bbox_size', bbox_size)
+    target.add_field('orig_center', center)
+    target.add_field('center', center)
+    target.add_field('scale', scale)
+
+    _, fname = osp.split(img_path)
+    target.add_field('fname', f'{fname}_{index:03d}')
+
+    full_img, cropped_image = img, None
+    if transforms is not None:
+        full_img, cropped_image, target = transforms(
+            img, target, return_full_img=return_full_img)
+
+    return full_img, cropped_image, target, index
+
+
 class ImageFolderWithBoxes(dutils.Dataset):
     def __init__(self,
                  img_paths,
@@ -87,22 +125,6 @@ class ImageFolderWithBoxes(dutils.Dataset):
     def __getitem__(self, index):
         img = read_img(self.paths[index])
 
-        bbox = self.bboxes[index]
-
-        target = BoundingBox(bbox, size=img.shape)
-
-        center, scale, bbox_size = bbox_to_center_scale(
-            bbox, dset_scale_factor=self.scale_factor)
-        target.add_field('bbox_size', bbox_size)
-        target.add_field('orig_bbox_size', bbox_size)
-        target.add_field('orig_center', center)
-        target.add_field('center', center)
-        target.add_field('scale', scale)
-
-        _, fname = osp.split(self.paths[index])
-        target.add_field('fname', f'{fname}_{index:03d}')
-
-        if self.transforms is not None:
-            full_img, cropped_image, target = self.transforms(img, target)
-
-        return full_img, cropped_image, target, index
+        return crop_box_sample(
+            img, self.bboxes[index], self.paths[index], index,
+            transforms=self.transforms, scale_factor=self.scale_factor)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import List, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as dutils
+
+from loguru import logger
+from tqdm import tqdm
+
+from .build import collate_batch, MemoryPinning
+from .datasets.image_folder import ImageFolder, crop_box_sample
+
+from expose.utils.typing_utils import Array
+
+
+def collate_frames(batch):
+    output_dict = dict()
+
+    for d in batch:
+        for key, val in d.items():
+            if key not in output_dict:
+                output_dict[key] = []
+            output_dict[key].append(val)
+    return output_dict
+
+
+def build_detector(
+        device: torch.device,
+        channels_last: bool = False) -> nn.Module:
+    ''' Builds the Keypoint R-CNN person detector used by the demos '''
+    from torchvision.models.detection import keypointrcnn_resnet50_fpn
+
+    rcnn_model = keypointrcnn_resnet50_fpn(pretrained=True)
+    rcnn_model.eval()
+    rcnn_model = rcnn_model.to(device=device)
+    if channels_last:
+        rcnn_model = rcnn_model.to(memory_format=torch.channels_last)
+    return rcnn_model
+
+
+@torch.no_grad()
+def detect_people(
+        rcnn_model: nn.Module,
+        images: List[Array],
+        device: torch.device,
+        min_score: float = 0.5) -> List[Array]:
+    ''' Runs the detector on a list of decoded HxWx3 float images
+
+        The input tensors are views of the decoded buffers, so no extra
+        host copy is made before the transfer to the device.
+
+        Returns
+        -------
+            boxes: list of arrays
+                One Nx4 array of (xmin, ymin, xmax, ymax) boxes per image,
+                with all the detections scoring below `min_score` removed.
+    '''
+    rcnn_images = [
+        torch.from_numpy(img).permute(2, 0, 1).to(device=device)
+        for img in images]
+    output = rcnn_model(rcnn_images)
+    if len(output) < 1:
+        return []
+
+    # The detections of all the images are moved to the host in a single
+    # transfer and filtered there. Masking on the device would synchronize
+    # as well, since the number of kept boxes decides the output size.
+    packed = torch.cat([
+        torch.cat([out['boxes'], out['scores'][:, None],
+                   torch.full_like(out['scores'][:, None], ii)], dim=1)
+        for ii, out in enumerate(output)])
+    packed = packed.detach().cpu().numpy()
+    packed = packed[packed[:, 4] >= min_score]
+
+    img_idxs = packed[:, 5].astype(np.int64)
+    splits = np.searchsorted(img_idxs, np.arange(1, len(output)))
+    return np.split(packed[:, :4], splits)
+
+
+class DetectionCropLoader(object):
+    ''' Decodes, detects and crops every frame of a folder once
+
+        Each frame is decoded a single time by the `ImageFolder` workers.
+        The decoded buffer is fed to the detector and then all the body crops
+        of the frame are cut from the same buffer, instead of re-reading the
+        image from disk for every detected box. The crops and the body
+        transforms of a frame run on a pool of `crop_workers` threads, which
+        defaults to `num_workers`, while the detector processes the next
+        frames. Iterating over the loader yields the same
+        `(full_imgs, body_imgs, body_targets)` batches as a `DataLoader`
+        over `ImageFolderWithBoxes`.
+
+        The people of a frame are numbered from zero in their `fname`,
+        e.g. `img.jpg_001` for the second person of `img.jpg`, so the names
+        of the outputs do not depend on the other frames or on the shard of
+        the folder that a process runs.
+    '''
+
+    def __init__(
+        self,
+        image_folder: str,
+        rcnn_model: nn.Module,
+        transforms=None,
+        device: Optional[torch.device] = None,
+        batch_size: int = 64,
+        rcnn_batch: int = 1,
+        num_workers: int = 8,
+        min_score: float = 0.5,
+        scale_factor: float = 1.2,
+        pin_memory: bool = False,
+        shard_idx: int = 0,
+        num_shards: int = 1,
+        crop_workers: Optional[int] = None,
+    ) -> None:
+        super(DetectionCropLoader, self).__init__()
+        if device is None:
+            device = torch.device('cpu')
+        self.device = device
+        self.rcnn_model = rcnn_model
+        self.transforms = transforms
+        self.batch_size = batch_size
+        self.min_score = min_score
+        self.scale_factor = scale_factor
+        self.pin_memory = pin_memory
+        self.crop_workers = (
+            num_workers if crop_workers is None else crop_workers)
+        self.num_boxes = 0
+
+        self.dataset = ImageFolder(
+            image_folder, transforms=None, shard_idx=shard_idx,
+            num_shards=num_shards)
+        self.frame_loader = dutils.DataLoader(
+            self.dataset, batch_size=rcnn_batch, num_workers=num_workers,
+            collate_fn=collate_frames)
+
+    def _collate(self, samples):
+        batch = collate_batch(
+            samples, use_shared_memory=False, return_full_imgs=True,
+            pin_memory=self.pin_memory)
+        if isinstance(batch, MemoryPinning):
+            batch = batch.pin_memory()
+        return batch
+
+    def _crop_frame(self, img, img_path, frame_idx, img_boxes):
+        samples = []
+        frame_tensor = None
+        for box_idx, bbox in enumerate(img_boxes):
+            # Only the first box converts the full frame, the rest share its
+            # tensor, so that the collated batch stores each frame once
+            full_img, cropped_img, target, index = crop_box_sample(
+                img, bbox, img_path, box_idx, transforms=self.transforms,
+                scale_factor=self.scale_factor,
+                return_full_img=frame_tensor is None)
+            if frame_tensor is None:
+                frame_tensor = full_img
+            # The index of the image in the folder, which maps the people
+            # to the frames of the outputs
+            target.add_field('frame_idx', int(frame_idx))
+            samples.append((frame_tensor, cropped_img, target, index))
+        return samples
+
+    def _frame_samples(self):
+        ''' Yields the samples of every frame, in the order of the frames '''
+        num_boxes = 0
+        pool = None
+        if self.crop_workers > 0:
+            pool = ThreadPoolExecutor(
+                self.crop_workers, thread_name_prefix='crop_worker')
+        # Bounds the number of frames that wait for their crops
+        max_pending = 2 * max(self.crop_workers, 1)
+        pending = deque()
+        try:
+            for frames in tqdm(self.frame_loader,
+                               desc='Processing with R-CNN'):
+                boxes = detect_people(
+                    self.rcnn_model, frames['images'], self.device,
+                    min_score=self.min_score)
+
+                for img, img_path, frame_idx, img_boxes in zip(
+                        frames['images'], frames['paths'],
+                        frames['frame_idxs'], boxes):
+                    if pool is None:
+                        yield self._crop_frame(
+                            img, img_path, frame_idx, img_boxes)
+                    else:
+                        pending.append(pool.submit(
+                            self._crop_frame, img, img_path, frame_idx,
+                            img_boxes))
+                    num_boxes += len(img_boxes)
+
+                while len(pending) > max_pending:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        self.num_boxes = num_boxes
+
+    def __iter__(self):
+        samples = []
+        for frame_samples in self._frame_samples():
+            for sample in frame_samples:
+                samples.append(sample)
+                if len(samples) >= self.batch_size:
+                    yield self._collate(samples)
+                    samples = []
+        if len(samples) > 0:
+            yield self._collate(samples)
+        logger.info(f'Detected {self.num_boxes} people in'
+                    f' {len(self.dataset)} images')
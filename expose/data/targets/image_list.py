@@ -14,7 +14,7 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
-from typing import List, Union
+from typing import List, Union, Optional, Tuple
 import sys
 import numpy as np
 import torch
@@ -22,10 +22,46 @@ from loguru import logger
 from expose.utils.typing_utils import Tensor
 
 
+def frame_idxs_to_runs(
+        frame_idxs: Optional[Tensor]) -> Optional[List[Tuple[int, int, int]]]:
+    ''' Groups consecutive boxes that belong to the same frame
+
+        Returns a list of (frame_idx, start, end) tuples, so that boxes
+        start:end are all cut from the frame frame_idx.
+    '''
+    if frame_idxs is None:
+        return None
+    runs = []
+    for box_idx, frame_idx in enumerate(frame_idxs.tolist()):
+        if len(runs) > 0 and runs[-1][0] == frame_idx:
+            runs[-1][2] = box_idx + 1
+        else:
+            runs.append([frame_idx, box_idx, box_idx + 1])
+    return [tuple(run) for run in runs]
+
+
 class ImageList(object):
     def __init__(self, images: torch.Tensor,
                  img_sizes: List[torch.Size],
-                 padding=None):
+                 padding=None,
+                 frame_idxs: Optional[Tensor] = None,
+                 frame_runs: Optional[List[Tuple[int, int, int]]] = None):
+        ''' A batch of full resolution images
+
+            Parameters
+            ----------
+                images: torch.Tensor
+                    A FxCxHxW tensor with the zero padded frames
+                img_sizes: list
+                    The size of each frame before padding
+                frame_idxs: torch.Tensor, optional
+                    A tensor of size B, the number of boxes, with the index of
+                    the frame of each box. If it is not given, then every box
+                    has its own frame.
+                frame_runs: list, optional
+                    The grouping of consecutive boxes per frame, computed from
+                    `frame_idxs` when not given
+        '''
         self.images = images
         self.img_sizes = img_sizes
         self.sizes_tensor = torch.stack(
@@ -37,6 +73,11 @@ class ImageList(object):
                  for s in padding]).to(dtype=self.images.dtype)
         self._shape = self.images.shape
 
+        self.frame_idxs = frame_idxs
+        if frame_runs is None:
+            frame_runs = frame_idxs_to_runs(frame_idxs)
+        self.frame_runs = frame_runs
+
     def as_image_list(self) -> List[Tensor]:
         return self.images
 
@@ -47,6 +88,10 @@ class ImageList(object):
     def shape(self):
         return self._shape
 
+    @property
+    def num_frames(self) -> int:
+        return self._shape[0]
+
     @property
     def device(self):
         return self.images.device
@@ -58,8 +103,20 @@ class ImageList(object):
     def pin_memory(self):
         if not self.images.is_pinned():
             self.images = self.images.pin_memory()
+        if self.frame_idxs is not None and not self.frame_idxs.is_pinned():
+            self.frame_idxs = self.frame_idxs.pin_memory()
         return self
 
+    def select_boxes(self, box_idxs: Tensor) -> 'ImageList':
+        ''' Returns the image list of a subset of the boxes
+
+            The frames are shared with this list and not copied.
+        '''
+        frame_idxs = (box_idxs if self.frame_idxs is None else
+                      self.frame_idxs.index_select(0, box_idxs))
+        return ImageList(self.images, self.sizes_tensor,
+                         frame_idxs=frame_idxs)
+
     def __del__(self):
         del self.images
         del self.sizes_tensor
@@ -68,7 +125,11 @@ class ImageList(object):
     def to(self, *args, **kwargs):
         images = self.images.to(*args, **kwargs)
         sizes_tensor = self.sizes_tensor.to(*args, **kwargs)
-        return ImageList(images, sizes_tensor)
+        frame_idxs = self.frame_idxs
+        if frame_idxs is not None:
+            frame_idxs = frame_idxs.to(device=images.device)
+        return ImageList(images, sizes_tensor, frame_idxs=frame_idxs,
+                         frame_runs=self.frame_runs)
 
 
 class ImageListPacked(object):
@@ -78,21 +139,64 @@ class ImageListPacked(object):
         starts: List[int],
         num_elements: List[int],
         img_sizes: List[torch.Size],
+        frame_idxs: Optional[Tensor] = None,
+        frame_runs: Optional[List[Tuple[int, int, int]]] = None,
     ) -> None:
-        '''
+        ''' A batch of full resolution images flattened into one tensor
+
+            Parameters
+            ----------
+                packed_tensor: torch.Tensor
+                    The concatenation of the flattened CxHxW frames
+                starts: list
+                    The offset of each frame in the packed tensor
+                num_elements: list
+                    The number of elements of each frame
+                img_sizes: list
+                    The CxHxW size of each frame
+                frame_idxs: torch.Tensor, optional
+                    The index of the frame of each box, see `ImageList`
+                frame_runs: list, optional
+                    The grouping of consecutive boxes per frame, computed from
+                    `frame_idxs` when not given
         '''
         self.packed_tensor = packed_tensor
-        self.starts = starts
+        self.starts = [int(start) for start in starts]
         self.num_elements = num_elements
         self.img_sizes = img_sizes
+        self.frame_idxs = frame_idxs
+        if frame_runs is None:
+            frame_runs = frame_idxs_to_runs(frame_idxs)
+        self.frame_runs = frame_runs
 
         self._shape = [len(starts)] + [max(s) for s in zip(*img_sizes)]
 
         _, self.heights, self.widths = zip(*img_sizes)
+        # Size: Fx2, the height and width of each frame
+        self.sizes_tensor = torch.tensor(
+            list(zip(self.heights, self.widths)), dtype=packed_tensor.dtype,
+            device=packed_tensor.device)
 
     def as_tensor(self):
         return self.packed_tensor
 
+    def select_boxes(self, box_idxs: Tensor) -> 'ImageListPacked':
+        ''' Returns the image list of a subset of the boxes
+
+            The frames are shared with this list and not copied.
+        '''
+        frame_idxs = (box_idxs if self.frame_idxs is None else
+                      self.frame_idxs.index_select(0, box_idxs))
+        return ImageListPacked(
+            self.packed_tensor, self.starts, self.num_elements,
+            self.img_sizes, frame_idxs=frame_idxs)
+
+    def frame(self, frame_idx: int) -> Tensor:
+        ''' Returns a CxHxW view of a frame, without copying the data '''
+        c, h, w = self.img_sizes[frame_idx]
+        start = self.starts[frame_idx]
+        return self.packed_tensor[start:start + c * h * w].view(c, h, w)
+
     def as_image_list(self):
         out_list = []
 
@@ -124,18 +228,27 @@ class ImageListPacked(object):
     def dtype(self):
         return self.packed_tensor.dtype
 
+    @property
+    def num_frames(self) -> int:
+        return self._shape[0]
+
     def pin_memory(self):
-        if not self.images.is_pinned():
-            self.images = self.images.pin_memory()
+        if not self.packed_tensor.is_pinned():
+            self.packed_tensor = self.packed_tensor.pin_memory()
         return self
 
     def to(self, *args, **kwargs):
         self.packed_tensor = self.packed_tensor.to(*args, **kwargs)
+        self.sizes_tensor = self.sizes_tensor.to(*args, **kwargs)
+        if self.frame_idxs is not None:
+            self.frame_idxs = self.frame_idxs.to(
+                device=self.packed_tensor.device)
         return self
 
 
 def to_image_list_concat(
-        images: List[Tensor]
+        images: List[Tensor],
+        frame_idxs: Optional[Tensor] = None,
 ) -> ImageList:
     if images is None:
         return images
@@ -158,14 +271,22 @@ def to_image_list_concat(
         shape = img.shape
         batched[ii, :shape[0], :shape[1], :shape[2]] = img
 
-    return ImageList(batched, sizes, padding=padding)
+    return ImageList(batched, sizes, padding=padding, frame_idxs=frame_idxs)
 
 
-def to_image_list_packed(images: List[Tensor]) -> ImageListPacked:
+def to_image_list_packed(
+        images: List[Tensor],
+        frame_idxs: Optional[Tensor] = None,
+) -> ImageListPacked:
     if images is None:
         return images
     if isinstance(images, ImageListPacked):
         return images
+    if isinstance(images, ImageList):
+        # Unpad the frames of an already collated batch
+        images, frame_idxs = [
+            img[:, :int(h), :int(w)] for img, (h, w) in zip(
+                images.images, images.img_sizes)], images.frame_idxs
     # Store the size of each image
     # Compute the number of elements in each image
     sizes = [img.shape for img in images]
@@ -175,14 +296,16 @@ def to_image_list_packed(images: List[Tensor]) -> ImageListPacked:
     packed = torch.cat([img.flatten() for img in images])
     # Compute the start index of each image tensor in the packed tensor
     starts = [0] + list(np.cumsum(num_element_list))[:-1]
-    return ImageListPacked(packed, starts, num_element_list, sizes)
+    return ImageListPacked(packed, starts, num_element_list, sizes,
+                           frame_idxs=frame_idxs)
 
 
 def to_image_list(
     images: List[Tensor],
-    use_packed=False
+    use_packed=False,
+    frame_idxs: Optional[Tensor] = None,
 ) -> Union[ImageList, ImageListPacked]:
     '''
     '''
     func = to_image_list_packed if use_packed else to_image_list_concat
-    return func(images)
+    return func(images, frame_idxs=frame_idxs)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from loguru import logger
+
+from .utils.bbox import keyps_to_bbox, pairwise_bbox_iou, bbox_area
+from expose.utils.typing_utils import Array, Tensor
+
+
+@dataclass
+class Track:
+    track_id: int
+    bbox: Array
+    last_detection: int
+    num_propagated: int = 0
+
+
+def proj_joints_to_image(
+    proj_joints: Array,
+    crop_transforms: Array,
+    crop_size: int,
+) -> Array:
+    ''' Converts projected joints from body crop to image coordinates
+
+        Parameters
+        ----------
+            proj_joints: np.ndarray
+                BxJx2 joints in the [-1, 1] coordinates of the body crops
+            crop_transforms: np.ndarray
+                Bx3x3 transformations from the image to the body crops
+            crop_size: int
+                The size of the body crops
+        Returns
+        -------
+            joints: np.ndarray
+                BxJx2 joints in image pixels
+    '''
+    crop_joints = (np.asarray(proj_joints) * 0.5 + 0.5) * crop_size
+    inv_crop_transforms = np.linalg.inv(np.asarray(crop_transforms))
+    return (np.einsum('bij,bkj->bki', inv_crop_transforms[:, :2, :2],
+                      crop_joints) +
+            inv_crop_transforms[:, np.newaxis, :2, 2])
+
+
+class BoxTracker(object):
+    ''' Tracks the boxes of people so the detector runs on few frames
+
+        The detector runs every `detect_every` frames. In between, the box of
+        every person is propagated from the joints projected by SMPLXNet on
+        the previous frame. Detections are associated to the existing tracks
+        by IoU, so every person keeps its track id. A track is lost when its
+        propagated box leaves the image or moves more than allowed by
+        `min_motion_iou` between two frames, which triggers a new detection.
+        People entering an empty scene are found by the scheduled detections.
+
+        Parameters
+        ----------
+            detect_every: int
+                Run the detector every N frames, 1 detects on every frame
+            iou_threshold: float
+                The minimum IoU between a detection and a propagated box to
+                continue a track
+            box_scale: float
+                Scale applied to the box around the projected joints, so that
+                it covers the same extent as a detection
+            min_visible: float
+                The minimum fraction of a propagated box inside the image
+            min_motion_iou: float
+                The minimum IoU between the boxes of a track in consecutive
+                frames
+    '''
+
+    def __init__(
+        self,
+        detect_every: int = 5,
+        iou_threshold: float = 0.3,
+        box_scale: float = 1.2,
+        min_visible: float = 0.5,
+        min_motion_iou: float = 0.3,
+    ) -> None:
+        super(BoxTracker, self).__init__()
+        self.detect_every = max(detect_every, 1)
+        self.iou_threshold = iou_threshold
+        self.box_scale = box_scale
+        self.min_visible = min_visible
+        self.min_motion_iou = min_motion_iou
+
+        self.tracks: List[Track] = []
+        self.next_id = 0
+        self.last_detection = None
+        self.lost = False
+
+        self.num_frames = 0
+        self.num_detections = 0
+
+    @property
+    def boxes(self) -> Array:
+        if len(self.tracks) < 1:
+            return np.zeros([0, 4], dtype=np.float32)
+        return np.stack([track.bbox for track in self.tracks])
+
+    @property
+    def track_ids(self) -> Array:
+        return np.array([track.track_id for track in self.tracks],
+                        dtype=np.int64)
+
+    def is_scheduled(self, frame_index: int) -> bool:
+        ''' Whether the detector is scheduled to run on this frame '''
+        return frame_index % self.detect_every == 0
+
+    def needs_detection(self, frame_index: int) -> bool:
+        ''' Whether the boxes of the frame cannot be propagated '''
+        return (self.lost or self.last_detection is None or
+                frame_index - self.last_detection >= self.detect_every)
+
+    def _associate(self, boxes: Array) -> List[Tuple[int, int]]:
+        ''' Greedily matches detections and tracks with the highest IoU '''
+        if len(boxes) < 1 or len(self.tracks) < 1:
+            return []
+        ious = pairwise_bbox_iou(boxes, self.boxes)
+        matches = []
+        used_boxes, used_tracks = set(), set()
+        for flat_idx in np.argsort(-ious, axis=None):
+            box_idx, track_idx = np.unravel_index(flat_idx, ious.shape)
+            if ious[box_idx, track_idx] < self.iou_threshold:
+                break
+            if box_idx in used_boxes or track_idx in used_tracks:
+                continue
+            used_boxes.add(box_idx)
+            used_tracks.add(track_idx)
+            matches.append((int(box_idx), int(track_idx)))
+        return matches
+
+    def update(self, boxes: Array, frame_index: int) -> Array:
+        ''' Replaces the tracks with the detections of a frame
+
+            Detections that overlap a track continue it, the rest start new
+            tracks. Tracks without a detection are ended, since the detector
+            is more reliable than the propagated boxes.
+
+            Returns
+            -------
+                boxes: np.ndarray
+                    The boxes of the tracks, in the order of `track_ids`
+        '''
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        matched = dict(self._associate(boxes))
+
+        tracks = []
+        for box_idx, bbox in enumerate(boxes):
+            if box_idx in matched:
+                track_id = self.tracks[matched[box_idx]].track_id
+            else:
+                track_id = self.next_id
+                self.next_id += 1
+            tracks.append(Track(track_id, bbox, last_detection=frame_index))
+
+        self.tracks = tracks
+        self.last_detection = frame_index
+        self.lost = False
+        self.num_detections += 1
+        return self.boxes
+
+    def propagate(
+        self,
+        proj_joints: Array,
+        crop_transforms: Array,
+        crop_size: int,
+        img_size: Tuple[int, int],
+    ) -> None:
+        ''' Moves the tracks to the boxes of the projected joints
+
+            Parameters
+            ----------
+                proj_joints: np.ndarray
+                    The BxJx2 `proj_joints` predicted for the current boxes,
+                    in the order of `track_ids`
+                crop_transforms: np.ndarray
+                    The Bx3x3 image to body crop transformations
+                crop_size: int
+                    The size of the body crops
+                img_size: tuple
+                    The height and width of the frame
+        '''
+        self.num_frames += 1
+        if len(self.tracks) < 1:
+            return
+        H, W = img_size[:2]
+        joints = proj_joints_to_image(proj_joints, crop_transforms, crop_size)
+        conf = np.ones(joints.shape[1], dtype=np.float32)
+
+        tracks = []
+        for track, track_joints in zip(self.tracks, joints):
+            bbox = keyps_to_bbox(track_joints, conf, scale=self.box_scale)
+            if bbox is None:
+                continue
+            clipped = np.clip(bbox, 0, [W, H, W, H])
+            visible = float(bbox_area(clipped) / max(bbox_area(bbox), 1e-8))
+            motion_iou = float(pairwise_bbox_iou(bbox, track.bbox))
+            if visible < self.min_visible or motion_iou < self.min_motion_iou:
+                continue
+            track.bbox = bbox
+            track.num_propagated += 1
+            tracks.append(track)
+
+        if len(tracks) < len(self.tracks):
+            logger.debug(
+                f'Lost {len(self.tracks) - len(tracks)} tracks,'
+                ' detecting again')
+            self.lost = True
+        self.tracks = tracks
+
+    def log_summary(self) -> None:
+        if self.num_frames < 1:
+            return
+        logger.info(
+            f'Detector ran on {self.num_detections} of {self.num_frames}'
+            f' frames ({self.num_detections / self.num_frames:.1%}),'
+            f' tracks: {self.next_id}')
+
+
+class TrackStateCache(object):
+    ''' Keeps the regression state of every track between frames
+
+        The `regression_state` predicted for the people of a frame is stored
+        per track id and gathered as the `init_state` of the next frame, so
+        the regressors of SMPLXNet start from the previous estimate of the
+        same person.
+    '''
+
+    def __init__(self) -> None:
+        super(TrackStateCache, self).__init__()
+        self.states: Dict[int, Dict[str, Tensor]] = {}
+
+    def gather(self, track_ids: Array) -> Optional[Dict[str, Tensor]]:
+        ''' Returns the initial state of the tracks, None if none has one '''
+        states = [self.states.get(int(track_id)) for track_id in track_ids]
+        reference = next((state for state in states if state is not None),
+                         None)
+        if reference is None:
+            return None
+
+        init_state = {}
+        for key, val in reference.items():
+            init_state[key] = torch.stack([
+                torch.zeros_like(val) if state is None or key not in state
+                else state[key] for state in states])
+        init_state['valid'] = torch.tensor(
+            [state is not None for state in states], dtype=torch.bool,
+            device=reference['body'].device)
+        return init_state
+
+    def update(self, track_ids: Array, state: Dict[str, Tensor]) -> None:
+        ''' Stores the state of the current tracks, dropping the rest '''
+        self.states = {
+            int(track_id): {key: val[idx] for key, val in state.items()}
+            for idx, track_id in enumerate(track_ids)}
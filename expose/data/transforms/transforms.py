@@ -457,9 +457,12 @@ class ToTensor(object):
     def __str__(self):
         return 'ToTensor()'
 
-    def __call__(self, image, cropped_image, target, **kwargs):
+    def __call__(self, image, cropped_image, target, return_full_img=True,
+                 **kwargs):
         target.to_tensor()
-        return F.to_tensor(image), F.to_tensor(cropped_image), target
+        # The full image can be skipped when it is shared by several crops
+        full_img = F.to_tensor(image) if return_full_img else None
+        return full_img, F.to_tensor(cropped_image), target
 
 
 class Normalize(object):
@@ -479,8 +482,10 @@ class Normalize(object):
         return msg
 
     def __call__(self, image, cropped_image, target, **kwargs):
-        output_image = F.normalize(
-            image, mean=self.mean, std=self.std)
+        output_image = None
+        if image is not None:
+            output_image = F.normalize(
+                image, mean=self.mean, std=self.std)
         output_cropped_image = F.normalize(
             cropped_image, mean=self.mean, std=self.std)
         return output_image, output_cropped_image, target
@@ -18,6 +18,6 @@ from .keypoints import read_keypoints
 from .sampling import EqualSampler
 from .bbox import (bbox_area, bbox_to_wh, points_to_bbox, bbox_iou,
                    center_size_to_bbox, scale_to_bbox_size,
-                   bbox_to_center_scale,
+                   bbox_to_center_scale, pairwise_bbox_iou,
                    )
 from .transforms import flip_pose
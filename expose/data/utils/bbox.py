@@ -169,3 +169,30 @@ def bbox_iou(bbox1, bbox2, epsilon=1e-9):
         union = (area1 + area2 - isect).squeeze()
 
     return isect / (union + epsilon)
+
+
+def pairwise_bbox_iou(bboxes1, bboxes2, epsilon=1e-9):
+    ''' Computes the IoU between all pairs of two sets of bounding boxes
+
+        Parameters
+        ----------
+            bboxes1: np.ndarray
+                A Nx4 array of bounding boxes in xyxy format
+            bboxes2: np.ndarray
+                A Mx4 array of bounding boxes in xyxy format
+        Returns
+        -------
+            ious: np.ndarray
+                A NxM array with the IoU of every pair of boxes
+    '''
+    bboxes1 = np.asarray(bboxes1, dtype=np.float32).reshape(-1, 1, 4)
+    bboxes2 = np.asarray(bboxes2, dtype=np.float32).reshape(1, -1, 4)
+
+    left_top = np.maximum(bboxes1[..., :2], bboxes2[..., :2])
+    right_bottom = np.minimum(bboxes1[..., 2:], bboxes2[..., 2:])
+    wh = np.clip(right_bottom - left_top, 0, None)
+    isect = wh[..., 0] * wh[..., 1]
+
+    area1 = np.prod(bboxes1[..., 2:] - bboxes1[..., :2], axis=-1)
+    area2 = np.prod(bboxes2[..., 2:] - bboxes2[..., :2], axis=-1)
+    return isect / (area1 + area2 - isect + epsilon)
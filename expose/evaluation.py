@@ -55,6 +55,33 @@ def make_filter(name):
     return filter
 
 
+def compute_agreement(est_points, ref_points, alignments):
+    ''' Computes the per-point errors of predictions w.r.t. reference ones
+
+        Used to compare two variants of the same model, e.g. a quantized and
+        a float one, on images without ground-truth. The alignments are the
+        same ones used by the `Evaluator`, so the errors of joints and
+        vertices are the MPJPE and V2V of the variant, using the predictions
+        of the reference model as the ground-truth.
+
+        Returns
+        -------
+            errors: dict
+                A BxN array of point errors for every alignment
+    '''
+    if torch.is_tensor(est_points):
+        est_points = est_points.detach().cpu().numpy()
+    if torch.is_tensor(ref_points):
+        ref_points = ref_points.detach().cpu().numpy()
+
+    errors = {}
+    for alignment_name, alignment in alignments.items():
+        errors[alignment_name] = np.stack([
+            alignment(est_points[bidx], ref_points[bidx])['point']
+            for bidx in range(est_points.shape[0])])
+    return errors
+
+
 class Evaluator(object):
     def __init__(self, exp_cfg, rank=0, distributed=False):
         super(Evaluator, self).__init__()
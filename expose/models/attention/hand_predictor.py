@@ -36,7 +36,7 @@ import torch.nn.init as nninit
 from smplx import build_layer
 
 from ..backbone import build_backbone
-from ..common.networks import MLP, IterativeRegression
+from ..common.networks import MLP, IterativeRegression, AdaptiveStages
 from ..common.pose_utils import build_pose_decoder
 from ..nnutils import init_weights
 from ..camera import CameraParams, build_cam_proj
@@ -47,6 +47,7 @@ from expose.data.utils import flip_pose
 from expose.data.targets.keypoints import FLIP_INDS
 
 from expose.utils.typing_utils import Tensor
+from expose.utils.timer import PROFILER
 
 
 class HandPredictor(nn.Module):
@@ -225,12 +226,22 @@ class HandPredictor(nn.Module):
                 parent_rots: Optional[Tensor] = None,
                 num_hand_imgs: int = 0,
                 device: torch.device = None,
+                num_stages: Optional[int] = None,
+                adaptive: Optional[AdaptiveStages] = None,
+                num_right_hand_imgs: Optional[int] = None,
                 ) -> Dict[str, Dict[str, Tensor]]:
-        ''' Forward pass of the hand predictor '''
+        ''' Forward pass of the hand predictor
+
+            The crops cut from the bodies come first, the right hands followed
+            by the flipped left hands. There are as many right as left hands,
+            unless `num_right_hand_imgs` is given.
+        '''
         batch_size = hand_imgs.shape[0]
         num_body_data = batch_size - num_hand_imgs
         if batch_size == 0:
             return {}
+        if num_right_hand_imgs is None:
+            num_right_hand_imgs = num_body_data // 2
 
         if device is None:
             device = hand_imgs.device
@@ -241,13 +252,17 @@ class HandPredictor(nn.Module):
                 1, 1, 3, 3).expand(batch_size, -1, -1, -1).clone()
 
         right_hand_idxs = torch.arange(
-            0, num_body_data // 2, dtype=torch.long, device=device)
+            0, num_right_hand_imgs, dtype=torch.long, device=device)
         left_hand_idxs = torch.arange(
-            num_body_data // 2, num_body_data, dtype=torch.long, device=device)
+            num_right_hand_imgs, num_body_data, dtype=torch.long,
+            device=device)
 
-        hand_features = self.backbone(hand_imgs)
-        hand_parameters, hand_deltas = self.regressor(
-            hand_features[self.feature_key], cond=hand_mean)
+        with PROFILER.stage('backbone'):
+            hand_features = self.backbone(hand_imgs)
+        with PROFILER.stage('regressor'):
+            hand_parameters, hand_deltas = self.regressor(
+                hand_features[self.feature_key], cond=hand_mean,
+                num_stages=num_stages, adaptive=adaptive)
 
         hand_model_parameters = []
         model_parameters = []
@@ -268,14 +283,14 @@ class HandPredictor(nn.Module):
             if len(right_hand_idxs) > 0:
                 raw_right_wrist_pose = self.global_orient_decoder.encode(
                     dec_wrist_pose[right_hand_idxs].unsqueeze(dim=1)).reshape(
-                        num_body_data // 2, -1)
+                        len(right_hand_idxs), -1)
 
             if len(left_hand_idxs) > 0:
                 left_wrist_poses = flip_pose(
                     dec_wrist_pose[left_hand_idxs], pose_format='rot-mat')
                 raw_left_wrist_pose = self.global_orient_decoder.encode(
                     left_wrist_poses.unsqueeze(dim=1)).reshape(
-                        num_body_data // 2, -1)
+                        len(left_hand_idxs), -1)
 
             dec_hand_pose = self.hand_pose_decoder(
                 parameters_dict['hand_pose'])
@@ -304,11 +319,14 @@ class HandPredictor(nn.Module):
                 raise RuntimeError(
                     f'Invalid hand model type: {self.hand_model_type}')
 
-        output = {'num_stages': self.num_stages,
+        num_stages = len(hand_parameters)
+        output = {'num_stages': num_stages,
                   'features': hand_features[self.feature_key],
+                  # The final estimate, used to seed the next frame
+                  'raw_parameters': hand_parameters[-1].detach(),
                   }
 
-        for stage in range(self.num_stages):
+        for stage in range(num_stages):
             # Only update the current stage if the parameters exist
             key = f'stage_{stage:02d}'
             output[key] = model_parameters[stage]
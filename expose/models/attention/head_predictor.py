@@ -38,7 +38,7 @@ import torch.nn.init as nninit
 from smplx import build_layer
 
 from ..backbone import build_backbone
-from ..common.networks import MLP, IterativeRegression
+from ..common.networks import MLP, IterativeRegression, AdaptiveStages
 from ..common.pose_utils import build_pose_decoder
 from ..camera import build_cam_proj, CameraParams
 
@@ -46,6 +46,7 @@ from expose.data.targets.keypoints import KEYPOINT_NAMES
 from expose.utils.rotation_utils import batch_rodrigues, batch_rot2aa
 
 from expose.utils.typing_utils import Tensor
+from expose.utils.timer import PROFILER
 
 
 class HeadPredictor(nn.Module):
@@ -266,6 +267,8 @@ class HeadPredictor(nn.Module):
                 num_head_imgs: int = 0,
                 head_mean: Optional[Tensor] = None,
                 device: torch.device = None,
+                num_stages: Optional[int] = None,
+                adaptive: Optional[AdaptiveStages] = None,
                 ) -> Dict[str, Dict[str, Tensor]]:
         '''
         '''
@@ -276,10 +279,13 @@ class HeadPredictor(nn.Module):
         if batch_size == 0:
             return {}
 
-        head_features = self.backbone(head_imgs)
-        head_parameters, head_deltas = self.regressor(
-            head_features[self.feature_key],
-            cond=head_mean)
+        with PROFILER.stage('backbone'):
+            head_features = self.backbone(head_imgs)
+        with PROFILER.stage('regressor'):
+            head_parameters, head_deltas = self.regressor(
+                head_features[self.feature_key],
+                cond=head_mean, num_stages=num_stages,
+                adaptive=adaptive)
 
         head_model_params = []
         model_parameters = []
@@ -314,12 +320,15 @@ class HeadPredictor(nn.Module):
                 raise RuntimeError(
                     f'Invalid head model type: {self.head_model_type}')
 
+        num_stages = len(head_parameters)
         output = {
-            'num_stages': self.num_stages,
+            'num_stages': num_stages,
             'features': head_features[self.feature_key],
+            # The final estimate, used to seed the next frame
+            'raw_parameters': head_parameters[-1].detach(),
         }
 
-        for stage in range(self.num_stages):
+        for stage in range(num_stages):
             # Only update the current stage if there are enough params
             key = f'stage_{stage:02d}'
             output[key] = model_parameters[stage]
@@ -54,8 +54,10 @@ from smplx import build_layer as build_body_model
 from smplx.utils import find_joint_kin_chain
 
 from ..backbone import build_backbone
-from ..common.networks import MLP, IterativeRegression
-from ..common.bbox_sampler import CropSampler, ToCrops
+from ..common.networks import (
+    MLP, IterativeRegression, AdaptiveStages, seed_condition)
+from ..common.bbox_sampler import (
+    CropSampler, ToCrops, CropTargets, crop_targets_from_list)
 from ..nnutils import init_weights
 from ..common.pose_utils import build_all_pose_params
 from ..camera import build_cam_proj, CameraParams
@@ -65,7 +67,32 @@ from expose.data.targets import ImageList, ImageListPacked
 from expose.data.targets.keypoints import KEYPOINT_NAMES, get_part_idxs
 from expose.data.utils import flip_pose, bbox_iou, center_size_to_bbox
 
+from expose.utils.body_model_cache import build_cached_body_model
 from expose.utils.typing_utils import Tensor
+from expose.utils.timer import PROFILER
+from expose.utils.torch_utils import invert_affine_2d
+
+
+def select_rows(tensor: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+    ''' Selects the rows of a tensor, all of them if `rows` is None '''
+    return tensor if rows is None else tensor.index_select(0, rows)
+
+
+def scatter_rows(
+    values: Optional[Tensor],
+    rows: Optional[Tensor],
+    default: Tensor,
+) -> Tensor:
+    ''' Places the values of a subset of the people into a full batch
+
+        `default` contains one row per person and is kept for the people that
+        are not in `rows`. When `rows` is None, `values` has all the people.
+    '''
+    if rows is None:
+        return values
+    if len(rows) == 0:
+        return default
+    return default.index_copy(0, rows, values.to(dtype=default.dtype))
 
 
 class SMPLXHead(nn.Module):
@@ -244,8 +271,11 @@ class SMPLXHead(nn.Module):
 
         model_path = osp.expandvars(body_model_cfg.pop('model_folder', ''))
         model_type = body_model_cfg.pop('type', 'smplx')
-        self.body_model = build_body_model(
+        cache_folder = body_model_cfg.pop('cache_folder', '')
+        self.body_model = build_cached_body_model(
             model_path,
+            build_body_model,
+            cache_folder=cache_folder,
             model_type=model_type,
             dtype=dtype,
             **body_model_cfg)
@@ -388,7 +418,7 @@ class SMPLXHead(nn.Module):
         self.body_feature_key = smplx_net_cfg.get('feature_key', 'avg_pooling')
         feat_dim = feat_dims[self.body_feature_key]
 
-        print("feat_dims output dimension of backbone model:", feat_dims)
+        logger.debug(f'Output dimensions of the backbone: {feat_dims}')
 
         regressor_cfg = smplx_net_cfg.get('mlp', {})
         regressor = MLP(feat_dim + self.append_params * param_dim,
@@ -426,6 +456,13 @@ class SMPLXHead(nn.Module):
             'scale_factor', 2.0)
         self.head_cropper = CropSampler(head_crop_size)
 
+        # At inference, crop and refine only the hands and heads that are
+        # visible in the frame
+        gating_cfg = attention_net_cfg.get('part_gating', {})
+        self.gate_parts = gating_cfg.get('enable', False)
+        self.gate_min_visible = gating_cfg.get('min_visible', 0.5)
+        self.gate_min_size = gating_cfg.get('min_size', 16.0)
+
         self.head_predictor = HeadPredictor(
             exp_cfg,
             pose_desc_dict['global_orient'],
@@ -650,6 +687,64 @@ class SMPLXHead(nn.Module):
         else:
             raise ValueError(f'Merge function {merge_type} is not supported')
 
+    def box_frame_sizes(
+        self,
+        full_imgs: Union[Tensor, ImageList, ImageListPacked],
+        batch_size: int,
+    ) -> Tensor:
+        ''' Returns the height and width of the frame of every box '''
+        if torch.is_tensor(full_imgs):
+            _, _, H, W = full_imgs.shape
+            return full_imgs.new_tensor([H, W]).expand(batch_size, -1)
+        frame_sizes = full_imgs.sizes_tensor.to(device=full_imgs.device)
+        if full_imgs.frame_idxs is not None:
+            frame_sizes = frame_sizes.index_select(0, full_imgs.frame_idxs)
+        return frame_sizes[:, -2:]
+
+    def gate_part(
+        self,
+        part_joints: Tensor,
+        points_to_crop: Dict[str, Tensor],
+        frame_sizes: Tensor,
+    ) -> Optional[Tensor]:
+        ''' Finds the people whose part should be refined
+
+            A part is refined when enough of its projected joints fall inside
+            the frame and its crop is not too small.
+
+            Parameters
+            ----------
+                part_joints: torch.Tensor
+                    BxJx2 projected joints of the part in body crop pixels
+                points_to_crop: dict
+                    The output of `ToCrops` for the part
+                frame_sizes: torch.Tensor
+                    Bx2 tensor with the height and width of the frame of every
+                    person
+
+            Returns
+            -------
+                idxs: torch.Tensor or None
+                    The indices of the people whose part is refined, None if
+                    the part of every person is refined
+        '''
+        inv_crop_transforms = points_to_crop['inv_crop_transforms']
+        img_joints = torch.einsum(
+            'bij,bkj->bki',
+            [inv_crop_transforms[:, :2, :2], part_joints]) + (
+                inv_crop_transforms[:, :2, 2].unsqueeze(dim=1))
+        frame_size = frame_sizes.flip(-1).unsqueeze(dim=1).to(
+            dtype=img_joints.dtype)
+        inside = (img_joints.ge(0) & img_joints.lt(frame_size)).all(dim=-1)
+        visible = inside.to(dtype=img_joints.dtype).mean(dim=-1)
+
+        keep = (visible.ge(self.gate_min_visible) &
+                points_to_crop['orig_bbox_size'].reshape(-1).ge(
+                    self.gate_min_size))
+        if bool(keep.all()):
+            return None
+        return keep.nonzero().reshape(-1)
+
     def toggle_losses(self, iteration):
         self.body_loss.toggle_losses(iteration)
         self.keyp_loss.toggle_losses(iteration)
@@ -955,17 +1050,54 @@ class SMPLXHead(nn.Module):
                 head_imgs: Optional[Tensor] = None,
                 head_targets: Optional[List] = None,
                 full_imgs: Optional[Union[ImageList, ImageListPacked]] = None,
+                init_state: Optional[Dict[str, Tensor]] = None,
+                num_stages: Optional[int] = None,
+                adaptive: Optional[AdaptiveStages] = None,
                 ) -> Dict[str, Dict[str, Tensor]]:
         ''' Forward pass of the attention predictor
+
+            Parameters
+            ----------
+                init_state: dict, optional
+                    The `regression_state` returned for the same people,
+                    e.g. on the previous frame of a video, used as the
+                    initial estimate of the body, hand and head regressors
+                    instead of the mean parameters. The optional boolean
+                    `valid` entry marks the people that have a state.
+                num_stages: int, optional
+                    The number of regression stages to run when every person
+                    has an initial state
+                adaptive: AdaptiveStages, optional
+                    Stops the body, hand and head regressors early when their
+                    estimates converge or the time budget is spent. The
+                    stages used by each are returned in `stages_used`.
         '''
         batch_size, _, crop_size, _ = images.shape
         device = images.device
         dtype = images.dtype
 
-        feat_dict = self.backbone(images)
+        seed_valid, seed_stages = None, None
+        if init_state is not None:
+            seed_valid = init_state.get('valid')
+            if seed_valid is None or bool(seed_valid.all()):
+                seed_stages = num_stages
+        else:
+            init_state = {}
+
+        with PROFILER.stage('backbone'):
+            feat_dict = self.backbone(images)
         body_features = feat_dict[self.body_feature_key]
 
-        body_parameters, body_deltas = self.regressor(body_features)
+        with PROFILER.stage('regressor'):
+            body_cond = None
+            if init_state.get('body') is not None:
+                body_cond = seed_condition(
+                    self.regressor.get_mean(), init_state['body'],
+                    seed_valid)
+            body_parameters, body_deltas = self.regressor(
+                body_features, cond=body_cond, num_stages=seed_stages,
+                adaptive=adaptive)
+        num_stages = len(body_parameters)
 
         losses = {}
         # A list of dicts for the parameters predicted at each stage. The key
@@ -990,7 +1122,6 @@ class SMPLXHead(nn.Module):
                     out_dict[key] = val
 
             param_dicts.append(out_dict)
-            print("Betas out dict: ", type(out_dict['betas']), out_dict['betas'])
             curr_params_dict.clear()
             for key, val in self.flat_body_params_to_dict(deltas).items():
                 deltas_dict[key].append(val)
@@ -1004,7 +1135,7 @@ class SMPLXHead(nn.Module):
             merged_params = {}
             for key in param_dicts[0].keys():
                 param = []
-                for idx in range(self.num_stages):
+                for idx in range(num_stages):
                     if param_dicts[idx][key] is None:
                         continue
                     param.append(param_dicts[idx][key])
@@ -1012,8 +1143,9 @@ class SMPLXHead(nn.Module):
 
         # Compute the body surface using the current estimation of the pose and
         # the shape
-        body_model_output = self.body_model(
-            get_skin=True, return_shaped=True, **merged_params)
+        with PROFILER.stage('body_model'):
+            body_model_output = self.body_model(
+                get_skin=True, return_shaped=True, **merged_params)
 
         # Split the vertices, joints, etc. to stages
         out_params = defaultdict(lambda: dict())
@@ -1024,16 +1156,16 @@ class SMPLXHead(nn.Module):
                     curr_val, batch_size, dim=0)
                 # If the number of outputs is equal to the number of stages
                 # then store each stage
-                if len(out_list) == self.num_stages:
+                if len(out_list) == num_stages:
                     for idx in range(len(out_list)):
                         out_params[f'stage_{idx:02d}'][key] = out_list[idx]
                 # Else add only the last
                 else:
-                    out_key = f'stage_{self.num_stages - 1:02d}'
+                    out_key = f'stage_{num_stages - 1:02d}'
                     out_params[out_key][key] = out_list[-1]
 
         # Add the predicted parameters to the output dictionary
-        for stage in range(self.num_stages):
+        for stage in range(num_stages):
             stage_key = f'stage_{stage:02d}'
             if len(out_params[stage_key]) < 1:
                 continue
@@ -1067,13 +1199,13 @@ class SMPLXHead(nn.Module):
 
         # Project the joints on the image plane
         proj_joints = self.projection(
-            out_params[f'stage_{self.num_stages - 1:02d}']['joints'],
+            out_params[f'stage_{num_stages - 1:02d}']['joints'],
             scale=scale, translation=translation)
 
         # Add the projected joints
         out_params['proj_joints'] = proj_joints
         # the number of stages
-        out_params['num_stages'] = self.num_stages
+        out_params['num_stages'] = num_stages
         # and the camera parameters to the output
         out_params['camera_parameters'] = CameraParams(
             translation=translation, scale=scale)
@@ -1083,7 +1215,26 @@ class SMPLXHead(nn.Module):
         if self.predict_head or self.predict_hands:
             final_body_pose = raw_body_pose_from_body_net.clone()
 
+        # Stack the crop fields once, they are shared by the hand and head
+        # crops
+        crop_targets = targets
+        if ((self.predict_hands and self.apply_hand_network_on_body) or
+                (self.predict_head and self.apply_head_network_on_body)):
+            if not isinstance(crop_targets, CropTargets):
+                crop_targets = crop_targets_from_list(
+                    targets, device=proj_joints.device,
+                    dtype=proj_joints.dtype)
+
+        # The people whose hands and head are cropped and refined, None for
+        # all of them
+        right_hand_people, left_hand_people, head_people = None, None, None
+        gate_parts = (
+            self.gate_parts and not self.training and full_imgs is not None)
+        if gate_parts:
+            frame_sizes = self.box_frame_sizes(full_imgs, batch_size)
+
         hand_predictions, head_predictions = {}, {}
+        hand_state, head_state = None, None
         num_hand_imgs = 0
         left_hand_mask, right_hand_mask = None, None
         if self.predict_hands:
@@ -1094,44 +1245,68 @@ class SMPLXHead(nn.Module):
                      0.5 + 0.5) * crop_size)
                 #  left_hand_joints = torch.index_select(
                 #  proj_joints, 1, self.left_hand_idxs)
-                left_hand_points_to_crop = self.points_to_crops(
-                    full_imgs, left_hand_joints, targets,
-                    scale_factor=self.hand_scale_factor, crop_size=crop_size,
-                )
+                with PROFILER.stage('to_crops'):
+                    left_hand_points_to_crop = self.points_to_crops(
+                        full_imgs, left_hand_joints, crop_targets,
+                        scale_factor=self.hand_scale_factor,
+                        crop_size=crop_size,
+                    )
                 left_hand_center = left_hand_points_to_crop['center']
                 left_hand_orig_bbox_size = left_hand_points_to_crop[
                     'orig_bbox_size']
                 left_hand_bbox_size = left_hand_points_to_crop['bbox_size']
                 left_hand_inv_crop_transforms = left_hand_points_to_crop[
                     'inv_crop_transforms']
-
-                left_hand_cropper_out = self.hand_cropper(
-                    full_imgs, left_hand_center, left_hand_orig_bbox_size)
+                if gate_parts:
+                    left_hand_people = self.gate_part(
+                        left_hand_joints, left_hand_points_to_crop,
+                        frame_sizes)
+
+                with PROFILER.stage('crop_sampler'):
+                    left_hand_cropper_out = self.hand_cropper(
+                        full_imgs, left_hand_center, left_hand_orig_bbox_size,
+                        sample_idxs=left_hand_people)
                 left_hand_crops = left_hand_cropper_out['images']
                 left_hand_points = left_hand_cropper_out['sampling_grid']
                 left_hand_crop_transform = left_hand_cropper_out['transform']
 
                 right_hand_joints = (torch.index_select(
                     proj_joints, 1, self.right_hand_idxs) * 0.5 + 0.5) * crop_size
-                right_hand_points_to_crop = self.points_to_crops(
-                    full_imgs, right_hand_joints, targets,
-                    scale_factor=self.hand_scale_factor, crop_size=crop_size,
-                )
+                with PROFILER.stage('to_crops'):
+                    right_hand_points_to_crop = self.points_to_crops(
+                        full_imgs, right_hand_joints, crop_targets,
+                        scale_factor=self.hand_scale_factor,
+                        crop_size=crop_size,
+                    )
                 right_hand_center = right_hand_points_to_crop['center']
                 right_hand_orig_bbox_size = right_hand_points_to_crop[
                     'orig_bbox_size']
                 right_hand_bbox_size = right_hand_points_to_crop['bbox_size']
-
-                right_hand_cropper_out = self.hand_cropper(
-                    full_imgs, right_hand_center, right_hand_orig_bbox_size)
+                if gate_parts:
+                    right_hand_people = self.gate_part(
+                        right_hand_joints, right_hand_points_to_crop,
+                        frame_sizes)
+
+                with PROFILER.stage('crop_sampler'):
+                    right_hand_cropper_out = self.hand_cropper(
+                        full_imgs, right_hand_center,
+                        right_hand_orig_bbox_size,
+                        sample_idxs=right_hand_people)
                 right_hand_crops = right_hand_cropper_out['images']
                 right_hand_points = right_hand_cropper_out['sampling_grid']
                 right_hand_crop_transform = right_hand_cropper_out['transform']
 
-                # Store the transformation parameters
-                out_params['left_hand_crops'] = left_hand_crops.detach()
+                # Store the transformation parameters, the skipped hands
+                # have empty crops
+                out_params['left_hand_crops'] = scatter_rows(
+                    left_hand_crops, left_hand_people,
+                    left_hand_crops.new_zeros(
+                        (batch_size,) + left_hand_crops.shape[1:])).detach()
                 out_params['left_hand_points'] = left_hand_points.detach()
-                out_params['right_hand_crops'] = right_hand_crops.detach()
+                out_params['right_hand_crops'] = scatter_rows(
+                    right_hand_crops, right_hand_people,
+                    right_hand_crops.new_zeros(
+                        (batch_size,) + right_hand_crops.shape[1:])).detach()
                 out_params['right_hand_points'] = right_hand_points.detach()
 
                 out_params['right_hand_crop_transform'] = (
@@ -1157,11 +1332,15 @@ class SMPLXHead(nn.Module):
                 all_hand_imgs.append(right_hand_crops)
                 all_hand_imgs.append(torch.flip(left_hand_crops, dims=(-1,)))
                 hand_global_orient += [
-                    global_orient_from_body_net,
+                    select_rows(
+                        global_orient_from_body_net, right_hand_people),
                     flip_pose(
-                        global_orient_from_body_net, pose_format='rot-mat')]
+                        select_rows(
+                            global_orient_from_body_net, left_hand_people),
+                        pose_format='rot-mat')]
                 hand_body_pose += [
-                    body_pose_from_body_net, body_pose_from_body_net]
+                    select_rows(body_pose_from_body_net, right_hand_people),
+                    select_rows(body_pose_from_body_net, left_hand_people)]
 
             if hand_imgs is not None and self.apply_hand_network_on_hands:
                 # Add the hand only images
@@ -1205,42 +1384,104 @@ class SMPLXHead(nn.Module):
                     num_body_imgs=num_body_imgs,
                     num_hand_imgs=num_hand_imgs,
                 )
+                if (init_state.get('hand') is not None and
+                        num_body_imgs > 0):
+                    # The state stores the right and the flipped left hand
+                    # of every person
+                    hand_seed = init_state['hand']
+                    hand_mean = torch.cat([
+                        seed_condition(
+                            hand_mean[:2 * num_body_imgs],
+                            torch.cat([hand_seed[:, 0], hand_seed[:, 1]]),
+                            None if seed_valid is None else
+                            seed_valid.repeat(2)),
+                        hand_mean[2 * num_body_imgs:]], dim=0)
+
+                num_right_hand_imgs = None
+                if num_body_imgs > 0:
+                    # The conditions of all the hands, kept as the state of
+                    # the hands that are not refined
+                    hand_state = torch.stack([
+                        hand_mean[:batch_size],
+                        hand_mean[batch_size:2 * batch_size]], dim=1).detach()
+                    if (right_hand_people is not None or
+                            left_hand_people is not None):
+                        # Keep the conditions of the cropped hands only
+                        people = torch.arange(
+                            batch_size, dtype=torch.long, device=device)
+                        hand_rows = torch.cat([
+                            select_rows(people, right_hand_people),
+                            select_rows(people, left_hand_people) + batch_size,
+                            torch.arange(
+                                2 * batch_size, len(hand_mean),
+                                dtype=torch.long, device=device)])
+                        hand_mean = hand_mean.index_select(0, hand_rows)
+                        parent_rots = parent_rots.index_select(0, hand_rows)
+                    num_right_hand_imgs = len(right_hand_crops)
 
                 # Feed the hand images and the offsets to the hand-only
                 # predictor
                 all_hand_imgs = torch.cat(all_hand_imgs, dim=0)
 
-                hand_predictions = self.hand_predictor(
-                    all_hand_imgs,
-                    hand_mean=hand_mean,
-                    global_orient_from_body_net=hand_global_orient,
-                    body_pose_from_body_net=hand_body_pose,
-                    parent_rots=parent_rots,
-                    num_hand_imgs=num_hand_imgs,
-                )
+                with PROFILER.stage('hand_predictor'):
+                    hand_predictions = self.hand_predictor(
+                        all_hand_imgs,
+                        hand_mean=hand_mean,
+                        global_orient_from_body_net=hand_global_orient,
+                        body_pose_from_body_net=hand_body_pose,
+                        parent_rots=parent_rots,
+                        num_hand_imgs=num_hand_imgs,
+                        num_stages=seed_stages,
+                        adaptive=adaptive,
+                        num_right_hand_imgs=num_right_hand_imgs,
+                    )
                 num_hand_stages = hand_predictions.get('num_stages', 1)
                 hand_network_output = hand_predictions.get(
                     f'stage_{num_hand_stages - 1:02d}')
 
-            if self.apply_hand_network_on_body:
+            # When every hand is skipped the estimates of the body network
+            # are kept
+            if self.apply_hand_network_on_body and len(hand_predictions) > 0:
                 # Find which images belong to the left hand and which ones to
                 # the right hand
+                num_left_hand_imgs = len(left_hand_crops)
                 hands_from_body_idxs = torch.arange(
-                    0, 2 * batch_size, dtype=torch.long, device=device)
+                    0, num_right_hand_imgs + num_left_hand_imgs,
+                    dtype=torch.long, device=device)
                 right_hand_from_body_idxs = hands_from_body_idxs[
-                    :batch_size]
-                left_hand_from_body_idxs = hands_from_body_idxs[batch_size:]
-
-                right_hand_features = hand_predictions.get(
-                    'features')[right_hand_from_body_idxs]
-                left_hand_features = hand_predictions.get(
-                    'features')[left_hand_from_body_idxs]
+                    :num_right_hand_imgs]
+                left_hand_from_body_idxs = hands_from_body_idxs[
+                    num_right_hand_imgs:]
+
+                # The features of the skipped hands are zero
+                hand_features = hand_predictions.get('features')
+                right_hand_features = scatter_rows(
+                    hand_features[right_hand_from_body_idxs],
+                    right_hand_people,
+                    hand_features.new_zeros(
+                        (batch_size,) + hand_features.shape[1:]))
+                left_hand_features = scatter_rows(
+                    hand_features[left_hand_from_body_idxs],
+                    left_hand_people,
+                    hand_features.new_zeros(
+                        (batch_size,) + hand_features.shape[1:]))
+
+                raw_hand_params = hand_predictions['raw_parameters']
+                hand_state = torch.stack([
+                    scatter_rows(
+                        raw_hand_params[right_hand_from_body_idxs],
+                        right_hand_people, hand_state[:, 0]),
+                    scatter_rows(
+                        raw_hand_params[left_hand_from_body_idxs],
+                        left_hand_people, hand_state[:, 1])], dim=1)
 
                 right_hand_mask = None
                 raw_right_hand_pose_dict = self.right_hand_pose_merging_func(
                     from_body=raw_right_hand_pose_from_body_net,
-                    from_part=hand_network_output.get(
-                        'raw_right_hand_pose')[right_hand_from_body_idxs],
+                    from_part=scatter_rows(
+                        hand_network_output.get('raw_right_hand_pose')[
+                            right_hand_from_body_idxs],
+                        right_hand_people, raw_right_hand_pose_from_body_net),
                     body_feat=body_features,
                     part_feat=right_hand_features,
                     mask=right_hand_mask,
@@ -1248,10 +1489,11 @@ class SMPLXHead(nn.Module):
                 raw_right_hand_pose = raw_right_hand_pose_dict['merged']
 
                 if self.update_wrists:
-                    right_wrist_pose_from_part = hand_network_output.get(
-                        'raw_right_wrist_pose')
                     right_wrist_pose_from_body = raw_body_pose_from_body_net[
                         :, self.right_wrist_idx - 1]
+                    right_wrist_pose_from_part = scatter_rows(
+                        hand_network_output.get('raw_right_wrist_pose'),
+                        right_hand_people, right_wrist_pose_from_body)
                     raw_right_wrist_pose_dict = (
                         self.right_wrist_pose_merging_func(
                             from_body=right_wrist_pose_from_body,
@@ -1277,8 +1519,10 @@ class SMPLXHead(nn.Module):
                         flipped_left_hand_pose).reshape(batch_size, -1))
                 # Merge the predictions of the body network and the part
                 # network for the articulation of the left hand
-                left_hand_pose_from_part = hand_network_output.get(
-                    'raw_right_hand_pose')[left_hand_from_body_idxs]
+                left_hand_pose_from_part = scatter_rows(
+                    hand_network_output.get('raw_right_hand_pose')[
+                        left_hand_from_body_idxs],
+                    left_hand_people, raw_left_to_right_hand_pose_from_body)
                 raw_left_to_right_hand_pose_dict = (
                     self.left_hand_pose_merging_func(
                         from_body=raw_left_to_right_hand_pose_from_body,
@@ -1292,10 +1536,11 @@ class SMPLXHead(nn.Module):
                     'merged']
 
                 if self.update_wrists:
-                    left_wrist_pose_from_part = hand_network_output.get(
-                        'raw_left_wrist_pose')
                     left_wrist_pose_from_body = raw_body_pose_from_body_net[
                         :, self.left_wrist_idx - 1]
+                    left_wrist_pose_from_part = scatter_rows(
+                        hand_network_output.get('raw_left_wrist_pose'),
+                        left_hand_people, left_wrist_pose_from_body)
                     raw_left_wrist_pose_dict = (
                         self.left_wrist_pose_merging_func(
                             from_body=left_wrist_pose_from_body,
@@ -1324,19 +1569,26 @@ class SMPLXHead(nn.Module):
                     proj_joints, 1, self.head_idxs) * 0.5 + 0.5) * crop_size
                 #  head_joints = torch.index_select(
                 #  proj_joints, 1, self.head_idxs)
-                head_point_to_crop_output = self.points_to_crops(
-                    full_imgs, head_joints, targets,
-                    scale_factor=self.head_scale_factor, crop_size=crop_size,
-                )
+                with PROFILER.stage('to_crops'):
+                    head_point_to_crop_output = self.points_to_crops(
+                        full_imgs, head_joints, crop_targets,
+                        scale_factor=self.head_scale_factor,
+                        crop_size=crop_size,
+                    )
                 head_center = head_point_to_crop_output['center']
                 head_orig_bbox_size = head_point_to_crop_output[
                     'orig_bbox_size']
                 head_bbox_size = head_point_to_crop_output['bbox_size']
                 head_inv_crop_transforms = head_point_to_crop_output[
                     'inv_crop_transforms']
-
-                head_cropper_out = self.head_cropper(
-                    full_imgs, head_center, head_orig_bbox_size)
+                if gate_parts:
+                    head_people = self.gate_part(
+                        head_joints, head_point_to_crop_output, frame_sizes)
+
+                with PROFILER.stage('crop_sampler'):
+                    head_cropper_out = self.head_cropper(
+                        full_imgs, head_center, head_orig_bbox_size,
+                        sample_idxs=head_people)
                 head_crops = head_cropper_out['images']
                 head_points = head_cropper_out['sampling_grid']
                 # Contains the transformation that is used to transform the
@@ -1344,7 +1596,10 @@ class SMPLXHead(nn.Module):
                 # coordinates.
                 head_crop_transform = head_cropper_out['transform']
 
-                out_params['head_crops'] = head_crops.detach()
+                out_params['head_crops'] = scatter_rows(
+                    head_crops, head_people,
+                    head_crops.new_zeros(
+                        (batch_size,) + head_crops.shape[1:])).detach()
                 out_params['head_points'] = head_points.detach()
                 out_params['head_crop_transform'] = (
                     head_crop_transform.detach())
@@ -1361,8 +1616,10 @@ class SMPLXHead(nn.Module):
             # head-only sub-network.
             head_global_orient, head_body_pose = [], []
             if self.apply_head_network_on_body:
-                head_global_orient += [global_orient_from_body_net]
-                head_body_pose += [body_pose_from_body_net]
+                head_global_orient += [
+                    select_rows(global_orient_from_body_net, head_people)]
+                head_body_pose += [
+                    select_rows(body_pose_from_body_net, head_people)]
 
             if head_imgs is not None and self.apply_head_network_on_head:
                 all_head_imgs.append(head_imgs)
@@ -1398,24 +1655,54 @@ class SMPLXHead(nn.Module):
                     num_body_imgs=num_body_imgs,
                     head_targets=head_targets,
                 )
+                if (init_state.get('head') is not None and
+                        num_body_imgs > 0):
+                    head_mean = torch.cat([
+                        seed_condition(
+                            head_mean[:num_body_imgs], init_state['head'],
+                            seed_valid),
+                        head_mean[num_body_imgs:]], dim=0)
+                if num_body_imgs > 0:
+                    # The conditions of all the heads, kept as the state of
+                    # the heads that are not refined
+                    head_state = head_mean[:num_body_imgs].detach()
+                    if head_people is not None:
+                        head_rows = torch.cat([
+                            head_people, torch.arange(
+                                num_body_imgs, len(head_mean),
+                                dtype=torch.long, device=device)])
+                        head_mean = head_mean.index_select(0, head_rows)
                 all_head_imgs = torch.cat(all_head_imgs, dim=0)
 
-                head_predictions = self.head_predictor(
-                    all_head_imgs,
-                    head_mean=head_mean,
-                    global_orient_from_body_net=head_global_orient,
-                    body_pose_from_body_net=head_body_pose,
-                    num_head_imgs=num_head_imgs,
-                )
+                with PROFILER.stage('head_predictor'):
+                    head_predictions = self.head_predictor(
+                        all_head_imgs,
+                        head_mean=head_mean,
+                        global_orient_from_body_net=head_global_orient,
+                        body_pose_from_body_net=head_body_pose,
+                        num_head_imgs=num_head_imgs,
+                        num_stages=seed_stages,
+                        adaptive=adaptive,
+                    )
 
                 num_head_stages = head_predictions.get('num_stages', 1)
                 head_network_output = head_predictions.get(
                     f'stage_{num_head_stages - 1:02d}')
-                if self.apply_head_network_on_body:
+                # When every head is skipped the estimates of the body
+                # network are kept
+                if (self.apply_head_network_on_body and
+                        len(head_predictions) > 0):
                     head_from_body_idxs = torch.arange(
-                        0, batch_size, dtype=torch.long, device=device)
-                    head_features = head_predictions.get(
-                        'features')[head_from_body_idxs]
+                        0, len(head_crops), dtype=torch.long, device=device)
+                    head_features = head_predictions.get('features')
+                    head_features = scatter_rows(
+                        head_features[head_from_body_idxs], head_people,
+                        head_features.new_zeros(
+                            (batch_size,) + head_features.shape[1:]))
+                    head_state = scatter_rows(
+                        head_predictions['raw_parameters'][
+                            head_from_body_idxs],
+                        head_people, head_state)
                     # During training only use predictions from bounding boxes
                     # with enough IoU.
                     head_mask = None
@@ -1423,8 +1710,10 @@ class SMPLXHead(nn.Module):
                         'raw_jaw_pose')
                     # Replace the jaw pose only from the predictions taken from
                     # valid head crops
-                    raw_jaw_pose_from_part = head_network_output.get(
-                        'raw_jaw_pose')[head_from_body_idxs]
+                    raw_jaw_pose_from_part = scatter_rows(
+                        head_network_output.get('raw_jaw_pose')[
+                            head_from_body_idxs],
+                        head_people, raw_jaw_pose_from_body)
                     raw_jaw_pose_dict = self.jaw_pose_merging_func(
                         from_body=raw_jaw_pose_from_body,
                         from_part=raw_jaw_pose_from_part,
@@ -1435,9 +1724,10 @@ class SMPLXHead(nn.Module):
                     raw_jaw_pose = raw_jaw_pose_dict['merged']
 
                     expression_from_body = param_dicts[-1].get('expression')
-                    expression_from_head = head_network_output.get(
-                        'expression')[head_from_body_idxs,
-                                      :self.num_expression_coeffs]
+                    expression_from_head = scatter_rows(
+                        head_network_output.get('expression')[
+                            head_from_body_idxs, :self.num_expression_coeffs],
+                        head_people, expression_from_body)
                     expression_dict = self.expression_merging_func(
                         from_body=expression_from_body,
                         from_part=expression_from_head,
@@ -1467,8 +1757,10 @@ class SMPLXHead(nn.Module):
 
         if self.apply_hand_network_on_body or self.apply_head_network_on_body:
             # Compute the mesh using the new hand and face parameters
-            final_body_model_output = self.body_model(
-                get_skin=True, return_shaped=True, **final_body_parameters)
+            with PROFILER.stage('final_body_model'):
+                final_body_model_output = self.body_model(
+                    get_skin=True, return_shaped=True,
+                    **final_body_parameters)
             param_dicts.append({
                 **final_body_parameters, **final_body_model_output})
 
@@ -1484,7 +1776,7 @@ class SMPLXHead(nn.Module):
             out_params['proj_joints'] = proj_joints
             out_params['final']['proj_joints'] = proj_joints
         else:
-            joints3d = out_params[f'stage_{self.num_stages - 1:02d}']['joints']
+            joints3d = out_params[f'stage_{num_stages - 1:02d}']['joints']
 
         body_crop_size = images.shape[2]
         # Convert the projected joints from [-1, 1] to body image
@@ -1509,7 +1801,7 @@ class SMPLXHead(nn.Module):
             out_params['hd_proj_joints'] = hd_proj_joints.detach()
 
         if self.apply_head_network_on_body:
-            inv_head_crop_transf = torch.inverse(head_crop_transform)
+            inv_head_crop_transf = invert_affine_2d(head_crop_transform)
             head_img_keypoints = torch.einsum(
                 'bij,bkj->bki',
                 [inv_head_crop_transf[:, :2, :2],
@@ -1519,7 +1811,8 @@ class SMPLXHead(nn.Module):
                 head_img_keypoints.detach() * self.head_crop_size)
 
         if self.apply_hand_network_on_body:
-            inv_left_hand_crop_transf = torch.inverse(left_hand_crop_transform)
+            inv_left_hand_crop_transf = invert_affine_2d(
+                left_hand_crop_transform)
             left_hand_img_keypoints = torch.einsum(
                 'bij,bkj->bki',
                 [inv_left_hand_crop_transf[:, :2, :2],
@@ -1528,7 +1821,7 @@ class SMPLXHead(nn.Module):
             out_params['left_hand_proj_joints'] = (
                 left_hand_img_keypoints.detach() * self.hand_crop_size)
 
-            inv_right_hand_crop_transf = torch.inverse(
+            inv_right_hand_crop_transf = invert_affine_2d(
                 right_hand_crop_transform)
             right_hand_img_keypoints = torch.einsum(
                 'bij,bkj->bki',
@@ -1538,6 +1831,20 @@ class SMPLXHead(nn.Module):
             out_params['right_hand_proj_joints'] = (
                 right_hand_img_keypoints.detach() * self.hand_crop_size)
 
+        # The final estimates of the regressors, which can be used as the
+        # `init_state` of the same people in the next frame
+        regression_state = {'body': body_parameters[-1].detach()}
+        if self.apply_hand_network_on_body and hand_state is not None:
+            regression_state['hand'] = hand_state
+        if self.apply_head_network_on_body and head_state is not None:
+            regression_state['head'] = head_state
+        out_params['regression_state'] = regression_state
+        out_params['stages_used'] = {
+            'body': num_stages,
+            'hand': hand_predictions.get('num_stages', 0),
+            'head': head_predictions.get('num_stages', 0),
+        }
+
         if self.training:
             # Create the tensor of ground-truth HD keypoints
             gt_hd_keypoints = []
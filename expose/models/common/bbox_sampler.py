@@ -14,8 +14,9 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
-from typing import Tuple, Union, Dict
+from typing import Tuple, Union, Dict, List, NamedTuple, Optional
 import sys
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -25,6 +26,37 @@ from loguru import logger
 from expose.data.utils import points_to_bbox
 from expose.data.targets import ImageList, ImageListPacked, GenericTarget
 from expose.utils.typing_utils import Tensor
+from expose.utils.torch_utils import invert_affine_2d
+
+
+class CropTargets(NamedTuple):
+    ''' The crop fields of a batch of targets stored as tensors
+
+        Used instead of the list of targets when the model is traced, so that
+        the crop transformations are inputs of the graph and not constants.
+    '''
+    crop_transforms: Tensor
+    bbox_sizes: Tensor
+
+
+def crop_targets_from_list(
+    targets: List[GenericTarget],
+    device: Optional[torch.device] = None,
+    dtype=torch.float32,
+) -> CropTargets:
+    ''' Stacks the crop fields of a list of targets
+
+        The fields are gathered on the host and copied to the device once, so
+        callers that crop several parts should convert the targets before
+        calling `ToCrops`.
+    '''
+    crop_transforms = np.stack(
+        [t.get_field('crop_transform') for t in targets])
+    bbox_sizes = np.array(
+        [t.get_field('bbox_size') for t in targets], dtype=np.float32)
+    return CropTargets(
+        torch.as_tensor(crop_transforms, dtype=dtype, device=device),
+        torch.as_tensor(bbox_sizes, dtype=dtype, device=device))
 
 
 class ToCrops(nn.Module):
@@ -35,7 +67,7 @@ class ToCrops(nn.Module):
         self,
         full_imgs: Union[ImageList, ImageListPacked],
         points: Tensor,
-        targets: GenericTarget,
+        targets: Union[List[GenericTarget], CropTargets],
         scale_factor: float = 1.0,
         crop_size: int = 256
     ) -> Dict[str, Tensor]:
@@ -44,18 +76,12 @@ class ToCrops(nn.Module):
         dtype = points.dtype
 
         # Get the image to crop transformations and bounding box sizes
-        crop_transforms = []
-        img_bbox_sizes = []
-        for t in targets:
-            crop_transforms.append(t.get_field('crop_transform'))
-            img_bbox_sizes.append(t.get_field('bbox_size'))
-
-        img_bbox_sizes = torch.tensor(
-            img_bbox_sizes, dtype=dtype, device=device)
-
-        crop_transforms = torch.tensor(
-            crop_transforms, dtype=dtype, device=device)
-        inv_crop_transforms = torch.inverse(crop_transforms)
+        if not isinstance(targets, CropTargets):
+            targets = crop_targets_from_list(
+                targets, device=device, dtype=dtype)
+        crop_transforms = targets.crop_transforms.to(dtype=dtype)
+        img_bbox_sizes = targets.bbox_sizes.to(dtype=dtype)
+        inv_crop_transforms = invert_affine_2d(crop_transforms)
 
         center_body_crop, bbox_size = points_to_bbox(
             points, bbox_scale_factor=scale_factor)
@@ -104,96 +130,34 @@ class CropSampler(nn.Module):
     def extra_repr(self) -> str:
         return f'Crop size: {self.crop_size}'
 
-    def bilinear_sampling(x0, x1, y0, y1):
-        pass
-
-    def _sample_packed(self, full_imgs: ImageListPacked, sampling_grid,
-                       padding_mode='zeros'):
-        device, dtype = sampling_grid.device, sampling_grid.dtype
-        batch_size = sampling_grid.shape[0]
-        tensor = full_imgs.as_tensor()
-
-        flat_sampling_grid = sampling_grid.reshape(batch_size, -1, 2)
-        x, y = flat_sampling_grid[:, :, 0], flat_sampling_grid[:, :, 1]
-
-        # Get the closest spatial locations
-        x0 = torch.floor(x).to(dtype=torch.long)
-        x1 = x0 + 1
-
-        y0 = torch.floor(y).to(dtype=torch.long)
-        y1 = y0 + 1
-
-        # Size: B
-        start_idxs = torch.tensor(
-            full_imgs.starts, dtype=torch.long, device=device)
-        # Size: 3
-        rgb_idxs = torch.arange(3, dtype=torch.long, device=device)
-        # Size: B
-        height_tensor = torch.tensor(
-            full_imgs.heights, dtype=torch.long, device=device)
-        # Size: B
-        width_tensor = torch.tensor(
-            full_imgs.widths, dtype=torch.long, device=device)
-
-        # Size: BxP
-        x0_in_bounds = x0.ge(0) & x0.le(width_tensor[:, None] - 1)
-        x1_in_bounds = x0.ge(0) & x0.le(width_tensor[:, None] - 1)
-        y0_in_bounds = y0.ge(0) & y0.le(height_tensor[:, None] - 1)
-        y1_in_bounds = y0.ge(0) & y0.le(height_tensor[:, None] - 1)
-
-        zero = torch.tensor(0, dtype=torch.long, device=device)
-        x0 = torch.max(
-            torch.min(x0, width_tensor[:, None] - 1), zero)
-        x1 = torch.max(torch.min(x1, width_tensor[:, None] - 1), zero)
-        y0 = torch.max(torch.min(y0, height_tensor[:, None] - 1), zero)
-        y1 = torch.max(torch.min(y1, height_tensor[:, None] - 1), zero)
-
-        flat_rgb_idxs = (
-            rgb_idxs[None, :, None] * (width_tensor[:, None, None]) *
-            height_tensor[:, None, None])
-        x0_y0_in_bounds = (x0_in_bounds & y0_in_bounds).unsqueeze(
-            dim=1).expand(-1, 3, -1)
-        x1_y0_in_bounds = (x1_in_bounds & y0_in_bounds).unsqueeze(
-            dim=1).expand(-1, 3, -1)
-        x0_y1_in_bounds = (x0_in_bounds & y1_in_bounds).unsqueeze(
-            dim=1).expand(-1, 3, -1)
-        x1_y1_in_bounds = (x1_in_bounds & y1_in_bounds).unsqueeze(
-            dim=1).expand(-1, 3, -1)
-
-        idxs_x0_y0 = (start_idxs[:, None, None] +
-                      flat_rgb_idxs +
-                      y0[:, None, :] *
-                      width_tensor[:, None, None] + x0[:, None, :])
-        idxs_x1_y0 = (start_idxs[:, None, None] +
-                      flat_rgb_idxs +
-                      y0[:, None, :] *
-                      width_tensor[:, None, None] + x1[:, None, :])
-        idxs_x0_y1 = (start_idxs[:, None, None] +
-                      flat_rgb_idxs +
-                      y1[:, None, :] * width_tensor[:, None, None] +
-                      x0[:, None, :])
-        idxs_x1_y1 = (start_idxs[:, None, None] +
-                      flat_rgb_idxs +
-                      y1[:, None, :] * width_tensor[:, None, None] +
-                      x1[:, None, :])
-
-        Ia = torch.zeros(idxs_x0_y0.shape, dtype=dtype, device=device)
-        Ia[x0_y0_in_bounds] = tensor[idxs_x0_y0[x0_y0_in_bounds]]
-
-        Ib = torch.zeros(idxs_x1_y0.shape, dtype=dtype, device=device)
-        Ib[x1_y0_in_bounds] = tensor[idxs_x1_y0[x1_y0_in_bounds]]
-
-        Ic = torch.zeros(idxs_x0_y1.shape, dtype=dtype, device=device)
-        Ic[x0_y1_in_bounds] = tensor[idxs_x0_y1[x0_y1_in_bounds]]
-
-        Id = torch.zeros(idxs_x1_y1.shape, dtype=dtype, device=device)
-        Id[x1_y1_in_bounds] = tensor[idxs_x1_y1[x1_y1_in_bounds]]
-
-        f1 = (x1 - x)[:, None] * Ia + (x - x0)[:, None] * Ib
-        f2 = (x1 - x)[:, None] * Ic + (x - x0)[:, None] * Id
-
-        output = (y1 - y)[:, None] * f1 + (y - y0)[:, None] * f2
-        return output.reshape(batch_size, 3, self.crop_size, self.crop_size)
+    def _sample_packed(
+        self,
+        full_imgs: ImageListPacked,
+        sampling_grid: Tensor
+    ) -> Tensor:
+        ''' Samples the crops directly from views of the packed frames
+
+            The grid is already normalized with the size of the frame of each
+            box, so every frame is sampled with a single `grid_sample` call
+            and the packed buffer is never copied.
+        '''
+        frame_runs = full_imgs.frame_runs
+        if frame_runs is None:
+            frame_runs = [
+                (ii, ii, ii + 1) for ii in range(full_imgs.num_frames)]
+
+        out_images = []
+        for frame_idx, start, end in frame_runs:
+            frame = full_imgs.frame(frame_idx).unsqueeze(dim=0)
+            frame_grid = sampling_grid[start:end].reshape(
+                1, -1, self.crop_size, 2)
+            crops = F.grid_sample(frame, frame_grid, align_corners=True)
+            out_images.append(crops.reshape(
+                frame.shape[1], end - start, self.crop_size,
+                self.crop_size).transpose(0, 1))
+        if len(out_images) == 1:
+            return out_images[0]
+        return torch.cat(out_images, dim=0)
 
     def _sample_padded(
         self,
@@ -206,14 +170,37 @@ class CropSampler(nn.Module):
             full_imgs.as_tensor() if isinstance(full_imgs, (ImageList,)) else
             full_imgs
         )
-        # Get the sub-images using bilinear interpolation
-        return F.grid_sample(tensor, sampling_grid, align_corners=True)
+        frame_runs = getattr(full_imgs, 'frame_runs', None)
+        # The crops are sampled in one call only when every box has its own
+        # frame, at the same position as the box
+        if frame_runs is None or (
+                len(frame_runs) == len(tensor) and
+                all(frame_idx == start and end - start == 1
+                    for frame_idx, start, end in frame_runs)):
+            # Get the sub-images using bilinear interpolation
+            return F.grid_sample(tensor, sampling_grid, align_corners=True)
+
+        # Frames shared by several boxes are stored once, so all the crops of
+        # a frame are sampled together by stacking their grids vertically
+        num_channels = tensor.shape[1]
+        out_images = []
+        for frame_idx, start, end in frame_runs:
+            frame_grid = sampling_grid[start:end].reshape(
+                1, -1, self.crop_size, 2)
+            crops = F.grid_sample(
+                tensor[frame_idx:frame_idx + 1], frame_grid,
+                align_corners=True)
+            out_images.append(crops.reshape(
+                num_channels, end - start, self.crop_size,
+                self.crop_size).transpose(0, 1))
+        return torch.cat(out_images, dim=0)
 
     def forward(
             self,
             full_imgs: Union[Tensor, ImageList, ImageListPacked],
             center: Tensor,
-            bbox_size: Tensor
+            bbox_size: Tensor,
+            sample_idxs: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         ''' Crops the HD images using the provided bounding boxes
 
@@ -227,16 +214,26 @@ class CropSampler(nn.Module):
                     image
                 bbox_size: torch.Tensor
                     A size B tensor that contains the size of the corp
+                sample_idxs: torch.Tensor, optional
+                    The indices of the boxes that are cropped. The transforms
+                    and the grids are returned for all boxes.
 
             Returns
             -------
                 cropped_images: torch.Tensoror
                     The images cropped from the high resolution input
                 sampling_grid: torch.Tensor
-                    The grid used to sample the crops
+                    The grid used to sample the crops, normalized to [-1, 1]
+                    for padded frames and in pixels for packed frames
+                normalized_grid: torch.Tensor
+                    The grid used to sample the crops, normalized to [-1, 1]
+                    with the size of the frame of each box
         '''
 
-        batch_size, _, H, W = full_imgs.shape
+        # A frame can be shared by several boxes, so the batch size is given by
+        # the number of boxes and not by the number of images
+        batch_size = center.shape[0]
+        _, _, H, W = full_imgs.shape
         transforms = torch.eye(
             3, dtype=full_imgs.dtype, device=full_imgs.device).reshape(
             1, 3, 3).expand(batch_size, -1, -1).contiguous()
@@ -271,6 +268,16 @@ class CropSampler(nn.Module):
             size_bbox_sizer[:, 0, 0] = 2.0 / (W - 1)
             size_bbox_sizer[:, 1, 1] = 2.0 / (H - 1)
             size_bbox_sizer[:, :2, 2] = -1
+        elif isinstance(full_imgs, (ImageListPacked, )):
+            # Packed frames are not padded, so every box is normalized with
+            # the size of its own frame
+            frame_sizes = full_imgs.sizes_tensor
+            if full_imgs.frame_idxs is not None:
+                frame_sizes = frame_sizes.index_select(
+                    0, full_imgs.frame_idxs)
+            size_bbox_sizer[:, 0, 0] = 2.0 / (frame_sizes[:, 1] - 1)
+            size_bbox_sizer[:, 1, 1] = 2.0 / (frame_sizes[:, 0] - 1)
+            size_bbox_sizer[:, :2, 2] = -1
 
         #  full_transform = transforms
         full_transform = torch.bmm(size_bbox_sizer, transforms)
@@ -284,18 +291,39 @@ class CropSampler(nn.Module):
         sampling_grid = sampling_grid.reshape(
             -1, self.crop_size, self.crop_size, 2).transpose(1, 2)
 
-        if isinstance(full_imgs, (ImageList, torch.Tensor)):
+        # The returned grid of packed frames is in pixel coordinates, since
+        # they have no common size
+        output_grid = sampling_grid
+        if isinstance(full_imgs, (ImageListPacked, )):
+            output_grid = (torch.bmm(
+                transforms[:, :2, :2], batch_grid.transpose(1, 2)) +
+                transforms[:, :2, [2]]).transpose(1, 2).reshape(
+                -1, self.crop_size, self.crop_size, 2).transpose(1, 2)
+
+        crop_grid = sampling_grid
+        if sample_idxs is not None:
+            crop_grid = sampling_grid.index_select(0, sample_idxs)
+            full_imgs = (
+                full_imgs.index_select(0, sample_idxs)
+                if torch.is_tensor(full_imgs) else
+                full_imgs.select_boxes(sample_idxs))
+
+        if len(crop_grid) == 0:
+            out_images = crop_grid.new_zeros(
+                (0, full_imgs.shape[1], self.crop_size, self.crop_size))
+        elif isinstance(full_imgs, (ImageList, torch.Tensor)):
             out_images = self._sample_padded(
-                full_imgs, sampling_grid
+                full_imgs, crop_grid
             )
         elif isinstance(full_imgs, (ImageListPacked, )):
-            out_images = self._sample_packed(full_imgs, sampling_grid)
+            out_images = self._sample_packed(full_imgs, crop_grid)
         else:
             raise TypeError(
                 f'Crop sampling not supported for type: {type(full_imgs)}')
 
         return {'images': out_images,
-                'sampling_grid': sampling_grid.reshape(batch_size, -1, 2),
+                'sampling_grid': output_grid.reshape(batch_size, -1, 2),
+                'normalized_grid': sampling_grid.reshape(batch_size, -1, 2),
                 'transform': transforms,
                 'hd_to_crop': hd_to_crop,
                 }
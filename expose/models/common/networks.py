@@ -16,6 +16,8 @@
 
 from typing import Optional, Tuple, List
 import sys
+import time
+from dataclasses import dataclass
 
 import math
 
@@ -132,6 +134,41 @@ class FrozenBatchNorm2d(nn.Module):
                     res.add_module(name, new_child)
         return res
 
+    @classmethod
+    def convert_to_batchnorm(cls, module):
+        """
+        Convert FrozenBatchNorm in module into BatchNorm2d in eval mode.
+
+        The returned modules compute the same function, but are recognized
+        by the fusion passes of PyTorch, which fold them into the weights of
+        the preceding convolutions.
+
+        Args:
+            module (torch.nn.Module):
+
+        Returns:
+            If module is FrozenBatchNorm, returns a new module.
+            Otherwise, in-place convert module and return it.
+        """
+        res = module
+        if isinstance(module, cls):
+            num_features = len(module.weight)
+            # The forward pass uses the default epsilon of F.batch_norm
+            res = nn.BatchNorm2d(num_features, eps=1e-5).to(
+                device=module.weight.device)
+            res.weight.data.copy_(module.weight.data)
+            res.bias.data.copy_(module.bias.data)
+            res.running_mean.data.copy_(module.running_mean.data)
+            res.running_var.data.copy_(module.running_var.data)
+            res.requires_grad_(False)
+            res.eval()
+        else:
+            for name, child in module.named_children():
+                new_child = cls.convert_to_batchnorm(child)
+                if new_child is not child:
+                    res.add_module(name, new_child)
+        return res
+
     def forward(self, x):
         # Cast all fixed parameters to half() if necessary
         if x.dtype == torch.float16:
@@ -258,6 +295,26 @@ class MLP(nn.Module):
         return self.output_layer(curr_input)
 
 
+@dataclass
+class AdaptiveStages:
+    ''' Stops the iterative regression early
+
+        Regression stops after the first stage whose largest absolute delta
+        is below `delta_threshold`, or after any stage that ends past the
+        `deadline`, a `time.perf_counter()` value. At least one stage always
+        runs. Checking the deltas synchronizes with the device.
+    '''
+    delta_threshold: float = 0.0
+    deadline: Optional[float] = None
+
+    def should_stop(self, deltas: Tensor) -> bool:
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return True
+        if self.delta_threshold > 0:
+            return bool(deltas.abs().max() < self.delta_threshold)
+        return False
+
+
 class IterativeRegression(nn.Module):
     def __init__(self, module, mean_param, num_stages=1,
                  append_params=True, learn_mean=False,
@@ -299,7 +356,9 @@ class IterativeRegression(nn.Module):
     def forward(
         self,
         features: Tensor,
-        cond: Optional[Tensor] = None
+        cond: Optional[Tensor] = None,
+        num_stages: Optional[int] = None,
+        adaptive: Optional[AdaptiveStages] = None,
     ) -> Tuple[List[Tensor], List[Tensor]]:
         ''' Computes deltas on top of condition iteratively
 
@@ -307,7 +366,21 @@ class IterativeRegression(nn.Module):
             ----------
                 features: torch.Tensor
                     Input features
+                cond: torch.Tensor, optional
+                    The initial estimate of the parameters, defaults to the
+                    mean parameters. A good estimate, e.g. the parameters of
+                    the previous frame of a video, needs fewer stages.
+                num_stages: int, optional
+                    The number of stages to run, at most the number of
+                    stages of the module
+                adaptive: AdaptiveStages, optional
+                    Stops before `num_stages` when the estimate converged or
+                    the time budget is spent. The number of stages used is
+                    the length of the returned lists.
         '''
+        if num_stages is None:
+            num_stages = self.num_stages
+        num_stages = min(max(num_stages, 1), self.num_stages)
         batch_size = features.shape[0]
         expand_shape = [batch_size] + [-1] * len(features.shape[1:])
 
@@ -334,7 +407,9 @@ class IterativeRegression(nn.Module):
         num_params = deltas[-1].shape[1]
         parameters.append(cond[:, :num_params].clone() + deltas[-1])
 
-        for stage_idx in range(1, self.num_stages):
+        for stage_idx in range(1, num_stages):
+            if adaptive is not None and adaptive.should_stop(deltas[-1]):
+                break
             module_input = torch.cat(
                 [features, parameters[stage_idx - 1]], dim=-1)
             params_upd = self.module(module_input)
@@ -342,3 +417,29 @@ class IterativeRegression(nn.Module):
             parameters.append(parameters[stage_idx - 1] + params_upd)
 
         return parameters, deltas
+
+
+def seed_condition(
+    default: Tensor,
+    seed: Optional[Tensor] = None,
+    valid: Optional[Tensor] = None,
+) -> Tensor:
+    ''' Replaces the rows of a regression condition with known estimates
+
+        Parameters
+        ----------
+            default: torch.Tensor
+                BxP condition, or 1xP mean parameters
+            seed: torch.Tensor, optional
+                BxP initial estimates, e.g. from the previous frame
+            valid: torch.Tensor, optional
+                B boolean mask of the rows of `seed` that are used
+    '''
+    if seed is None:
+        return default
+    seed = seed.to(dtype=default.dtype, device=default.device)
+    default = default.expand_as(seed)
+    if valid is None:
+        return seed.clone()
+    return torch.where(valid.reshape(-1, 1).to(device=seed.device),
+                       seed, default)
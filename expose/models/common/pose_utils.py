@@ -319,8 +319,13 @@ class ContinuousRotReprDecoder(nn.Module):
             b1 * reshaped_input[:, :, 1].clone(), dim=1, keepdim=True)
         # Compute the second vector by finding the orthogonal complement to it
         b2 = F.normalize(reshaped_input[:, :, 1] - dot_prod * b1, dim=1)
-        # Finish building the basis by taking the cross product
-        b3 = torch.cross(b1, b2, dim=1)
+        # Finish building the basis by taking the cross product, written
+        # out so that the decoder can be exported to ONNX
+        b3 = torch.stack([
+            b1[:, 1] * b2[:, 2] - b1[:, 2] * b2[:, 1],
+            b1[:, 2] * b2[:, 0] - b1[:, 0] * b2[:, 2],
+            b1[:, 0] * b2[:, 1] - b1[:, 1] * b2[:, 0],
+        ], dim=1)
         rot_mats = torch.stack([b1, b2, b3], dim=-1)
 
         return rot_mats.view(batch_size, -1, 3, 3)
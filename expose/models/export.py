@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import Dict, Tuple
+import os
+import os.path as osp
+
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+from expose.models.common.bbox_sampler import CropTargets
+from expose.utils.typing_utils import Tensor
+
+OUTPUT_NAMES = (
+    'vertices',
+    'joints',
+    'proj_joints',
+    'camera_scale',
+    'camera_translation',
+    'global_orient',
+    'body_pose',
+    'left_hand_pose',
+    'right_hand_pose',
+    'jaw_pose',
+    'betas',
+    'expression',
+)
+INPUT_NAMES = (
+    'images',
+    'full_imgs',
+    'frame_idxs',
+    'crop_transforms',
+    'bbox_sizes',
+)
+
+
+class SMPLXInferenceModule(nn.Module):
+    ''' Inference-only view of SMPLXNet with tensor inputs and outputs
+
+        The module shares the parameters of a loaded SMPLXNet. The targets
+        and the image list of the regular forward are replaced by tensors and
+        the outputs of the final stage are returned as a fixed tuple, ordered
+        as `OUTPUT_NAMES`, so the module can be traced to TorchScript and
+        exported to ONNX. The dictionaries built inside the forward pass are
+        resolved while tracing, so the exported graph only contains tensor
+        operations. Since the number of stages and the split of the batch
+        are Python values, a graph is traced for a fixed batch size.
+
+        Parameters
+        ----------
+            model: SMPLXNet
+                A model in evaluation mode with the checkpoint loaded
+    '''
+
+    def __init__(self, model: nn.Module) -> None:
+        super(SMPLXInferenceModule, self).__init__()
+        self.smplx = model.smplx
+        self.num_stages = self.smplx.num_stages
+
+    def forward(
+        self,
+        images: Tensor,
+        full_imgs: Tensor,
+        frame_idxs: Tensor,
+        crop_transforms: Tensor,
+        bbox_sizes: Tensor,
+    ) -> Tuple[Tensor, ...]:
+        ''' Forward pass
+
+            Parameters
+            ----------
+                images: torch.Tensor
+                    Bx3xHxW body crops
+                full_imgs: torch.Tensor
+                    Nx3xH'xW' full resolution frames
+                frame_idxs: torch.Tensor
+                    The index of the frame of each body crop
+                crop_transforms: torch.Tensor
+                    Bx3x3 transformations from the frames to the body crops
+                bbox_sizes: torch.Tensor
+                    The size of the box of each body in the frame
+        '''
+        targets = CropTargets(crop_transforms, bbox_sizes)
+        box_imgs = full_imgs.index_select(0, frame_idxs)
+        output = self.smplx(images, targets=targets, full_imgs=box_imgs)
+        return outputs_to_tuple(output, self.num_stages)
+
+
+def outputs_to_tuple(
+    output: Dict,
+    num_stages: int,
+) -> Tuple[Tensor, ...]:
+    ''' Extracts the tensors of `OUTPUT_NAMES` from the output of SMPLXNet '''
+    body = output['body']
+    final = body.get('final', body[f'stage_{num_stages - 1:02d}'])
+    camera = body['camera_parameters']
+    values = {
+        'proj_joints': body['proj_joints'],
+        'camera_scale': camera.scale,
+        'camera_translation': camera.translation,
+    }
+    return tuple(
+        values[name] if name in values else final[name]
+        for name in OUTPUT_NAMES)
+
+
+@torch.no_grad()
+def export_torchscript(
+    module: SMPLXInferenceModule,
+    example_inputs: Tuple[Tensor, ...],
+    path: str,
+) -> torch.jit.ScriptModule:
+    ''' Traces the module and saves the TorchScript graph '''
+    os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+    traced = torch.jit.trace(module, example_inputs, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    traced.save(path)
+    logger.info(f'Saved TorchScript model to {path}')
+    return traced
+
+
+@torch.no_grad()
+def export_onnx(
+    module: SMPLXInferenceModule,
+    example_inputs: Tuple[Tensor, ...],
+    path: str,
+    opset_version: int = 17,
+) -> None:
+    ''' Exports the module to ONNX
+
+        The graph needs opset 16 or newer for `grid_sample`, which is used to
+        cut the hand and head crops from the full resolution frames.
+    '''
+    os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+    torch.onnx.export(
+        module, example_inputs, path,
+        input_names=list(INPUT_NAMES),
+        output_names=list(OUTPUT_NAMES),
+        opset_version=opset_version,
+        do_constant_folding=True,
+    )
+    logger.info(f'Saved ONNX model to {path}')
+
+
+def build_onnx_session(path: str, num_threads: int = 0):
+    ''' Creates an onnxruntime session on the CPU '''
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = (
+        ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(
+        path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def run_onnx_session(
+    session,
+    inputs: Tuple[Tensor, ...],
+) -> Tuple[Tensor, ...]:
+    feed = {
+        name: tensor.detach().cpu().numpy()
+        for name, tensor in zip(INPUT_NAMES, inputs)}
+    outputs = session.run(list(OUTPUT_NAMES), feed)
+    return tuple(torch.from_numpy(out) for out in outputs)
+
+
+def compare_outputs(
+    reference: Tuple[Tensor, ...],
+    outputs: Tuple[Tensor, ...],
+) -> Dict[str, float]:
+    ''' Returns the maximum absolute difference of every output '''
+    return {
+        name: float((ref.detach().cpu().float() -
+                     out.detach().cpu().float()).abs().max())
+        for name, ref, out in zip(OUTPUT_NAMES, reference, outputs)}
@@ -25,6 +25,7 @@ import torch.nn as nn
 from loguru import logger
 
 from .attention import build_attention_head
+from expose.utils.timer import PROFILER
 
 
 class SMPLXNet(nn.Module):
@@ -59,7 +60,10 @@ class SMPLXNet(nn.Module):
                 hand_imgs=None, hand_targets=None,
                 head_imgs=None, head_targets=None,
                 full_imgs=None,
-                device=None):
+                device=None,
+                init_state=None,
+                num_stages=None,
+                adaptive=None):
 
         if not self.training:
             pass
@@ -68,10 +72,13 @@ class SMPLXNet(nn.Module):
 
         losses = {}
 
-        output = self.smplx(images, targets=targets,
-                            hand_imgs=hand_imgs, hand_targets=hand_targets,
-                            head_imgs=head_imgs, head_targets=head_targets,
-                            full_imgs=full_imgs)
+        with PROFILER.stage('smplx_head'):
+            output = self.smplx(
+                images, targets=targets,
+                hand_imgs=hand_imgs, hand_targets=hand_targets,
+                head_imgs=head_imgs, head_targets=head_targets,
+                full_imgs=full_imgs, init_state=init_state,
+                num_stages=num_stages, adaptive=adaptive)
 
         output['losses'] = losses
         return output
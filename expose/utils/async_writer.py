@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Callable, Dict, List
+import os
+import os.path as osp
+import queue
+import threading
+
+import numpy as np
+import PIL.Image as pil_img
+
+from loguru import logger
+
+from .mesh_io import write_mesh
+from .typing_utils import Array
+
+
+def write_image(path: str, image: Array) -> None:
+    pil_img.fromarray(image).save(path)
+
+
+def write_params(path: str, params: Dict[str, Array]) -> None:
+    np.savez_compressed(path, **params)
+
+
+def fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AsyncResultWriter(object):
+    ''' Persists demo outputs on a pool of background threads
+
+        The writer receives arrays that are already on the host and writes
+        them while the next batch is processed. The queue is bounded, so
+        inference blocks instead of buffering an unbounded amount of results
+        when the disk is slower than the model. With `num_workers=0` every
+        write happens synchronously on the calling thread.
+
+        Parameters
+        ----------
+            num_workers: int
+                The number of writer threads
+            max_queue_size: int
+                The maximum number of pending writes
+    '''
+
+    def __init__(
+        self,
+        num_workers: int = 4,
+        max_queue_size: int = 64,
+    ) -> None:
+        super(AsyncResultWriter, self).__init__()
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.lock = threading.Lock()
+        self.pending_paths = []
+        self.errors = []
+        self.num_written = 0
+        self.max_depth = 0
+        self.closed = False
+
+        self.workers = []
+        for ii in range(num_workers):
+            worker = threading.Thread(
+                target=self._worker_loop, name=f'result_writer_{ii:02d}',
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    @property
+    def depth(self) -> int:
+        ''' The number of writes waiting in the queue '''
+        return self.queue.qsize()
+
+    def _write(self, func: Callable, path: str, *args) -> None:
+        try:
+            os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+            func(path, *args)
+        except Exception as e:
+            logger.error(f'Could not write {path}: {e}')
+            with self.lock:
+                self.errors.append((path, e))
+            return
+        with self.lock:
+            self.pending_paths.append(path)
+            self.num_written += 1
+
+    def _worker_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func: Callable, path: str, *args) -> None:
+        if self.closed:
+            raise RuntimeError('The result writer is closed')
+        if self.num_workers < 1:
+            self._write(func, path, *args)
+            return
+        self.queue.put((func, path) + args)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def save_image(self, path: str, image: Array) -> None:
+        self.submit(write_image, path, image)
+
+    def save_mesh(self, path: str, vertices: Array, faces: Array) -> None:
+        self.submit(write_mesh, path, vertices, faces)
+
+    def save_params(self, path: str, params: Dict[str, Array]) -> None:
+        self.submit(write_params, path, params)
+
+    def flush(self) -> List[str]:
+        ''' Waits for all queued writes and syncs the files to disk
+
+            Returns
+            -------
+                paths: list
+                    The files written since the previous flush
+        '''
+        if self.num_workers > 0:
+            self.queue.join()
+
+        with self.lock:
+            paths, self.pending_paths = self.pending_paths, []
+            errors, self.errors = self.errors, []
+
+        folders = set()
+        for path in paths:
+            fsync_path(path)
+            folders.add(osp.dirname(path) or '.')
+        # Persist the directory entries of the new files as well
+        for folder in folders:
+            fsync_path(folder)
+
+        if len(errors) > 0:
+            raise IOError(
+                f'Failed to write {len(errors)} files, first: {errors[0][0]}')
+        return paths
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            for _ in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            logger.info(
+                f'Wrote {self.num_written} files, maximum queue depth:'
+                f' {self.max_depth}')
+
+    def __enter__(self) -> 'AsyncResultWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Any, Callable, Dict, List, Optional, Set
+import os
+import os.path as osp
+import json
+import time
+import queue
+import multiprocessing as mp
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from ..data.datasets.image_folder import EXTS
+from .mesh_io import MESH_FORMATS
+
+# The options a manifest line can set, with their defaults
+JOB_OPTIONS = {'save_params': True, 'save_mesh': False, 'save_vis': False,
+               'mesh_format': 'ply'}
+
+
+@dataclass
+class Job:
+    ''' A line of a job manifest
+
+        Every line of the manifest is a JSON object with either an `images`
+        list, a single `image` or a `capture_dir`, whose images are processed
+        in sorted order. The optional `id` names the job in the result log
+        and defaults to the line number, `output_folder` defaults to a folder
+        named after the id and the remaining keys are the options in
+        `JOB_OPTIONS`.
+    '''
+    key: str
+    line: int
+    images: List[str]
+    output_folder: str
+    options: Dict[str, Any] = field(default_factory=dict)
+
+
+def list_capture_images(capture_dir: str) -> List[str]:
+    return [osp.join(capture_dir, fname)
+            for fname in sorted(os.listdir(capture_dir))
+            if osp.splitext(fname)[1].lower() in EXTS]
+
+
+def parse_job(
+    spec: Dict[str, Any],
+    line: int,
+    output_folder: str,
+    defaults: Optional[Dict[str, Any]] = None,
+) -> Job:
+    unknown = set(spec) - {
+        'id', 'image', 'images', 'capture_dir', 'output_folder'} - set(
+            JOB_OPTIONS)
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown job keys: {sorted(unknown)}')
+
+    if 'images' in spec:
+        images = list(spec['images'])
+    elif 'image' in spec:
+        images = [spec['image']]
+    elif 'capture_dir' in spec:
+        images = list_capture_images(spec['capture_dir'])
+    else:
+        raise ValueError('A job needs `images`, `image` or `capture_dir`')
+
+    key = str(spec.get('id', line))
+    options = dict(JOB_OPTIONS, **(defaults or {}))
+    options.update({key: spec[key] for key in JOB_OPTIONS if key in spec})
+    if options['mesh_format'] not in MESH_FORMATS:
+        raise ValueError(
+            f'Unknown mesh format: {options["mesh_format"]}, expected one'
+            f' of {MESH_FORMATS}')
+    return Job(
+        key=key, line=line, images=images,
+        output_folder=spec.get('output_folder', osp.join(output_folder, key)),
+        options=options)
+
+
+def read_manifest(
+    path: str,
+    output_folder: str,
+    defaults: Optional[Dict[str, Any]] = None,
+) -> List[Job]:
+    ''' Reads the jobs of a JSONL manifest
+
+        Empty lines and lines starting with `#` are skipped. Line numbers
+        start at 1, so that they match the ones shown by editors.
+    '''
+    jobs, keys = [], set()
+    with open(path, 'r') as f:
+        for line, text in enumerate(f, start=1):
+            text = text.strip()
+            if len(text) < 1 or text.startswith('#'):
+                continue
+            try:
+                job = parse_job(
+                    json.loads(text), line, output_folder, defaults=defaults)
+            except (ValueError, TypeError, OSError) as e:
+                raise ValueError(f'{path}:{line}: {e}')
+            if job.key in keys:
+                raise ValueError(f'{path}:{line}: duplicate job id {job.key}')
+            keys.add(job.key)
+            jobs.append(job)
+    return jobs
+
+
+def read_completed(log_path: str) -> Set[str]:
+    ''' Returns the ids of the jobs that finished in a previous run
+
+        A crash can leave a partial last line, which is ignored, as are the
+        records of the jobs that failed, so that they are retried.
+    '''
+    completed = set()
+    if not osp.exists(log_path):
+        return completed
+    with open(log_path, 'r') as f:
+        for text in f:
+            try:
+                record = json.loads(text)
+            except ValueError:
+                continue
+            if record.get('status') == 'ok':
+                completed.add(record['id'])
+    return completed
+
+
+class ResultLog(object):
+    ''' Append-only JSONL log of the finished jobs
+
+        Every record is synced to disk before the next one is written. The
+        log doubles as the checkpoint of the run: a job is skipped on resume
+        once a successful record for it is in the log.
+    '''
+
+    def __init__(self, path: str) -> None:
+        super(ResultLog, self).__init__()
+        os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.file = open(path, 'a')
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> 'ResultLog':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def run_job(processor: Callable, job: Job, worker_idx: int) -> Dict[str, Any]:
+    ''' Runs a job and creates its record for the result log
+
+        The processor returns a dictionary with the statistics of the job,
+        such as the number of images and people and the time spent in each
+        step, which is merged into the record.
+    '''
+    record = {'id': job.key, 'line': job.line, 'worker': worker_idx,
+              'num_images': len(job.images)}
+    start = time.perf_counter()
+    try:
+        record.update(processor(job))
+        record['status'] = 'ok'
+    except Exception as e:
+        logger.exception(f'Job {job.key} failed')
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    record['elapsed'] = time.perf_counter() - start
+    record['finished'] = time.time()
+    return record
+
+
+def worker_loop(
+    worker_idx: int,
+    build_processor: Callable,
+    tasks: mp.Queue,
+    results: mp.Queue,
+    current_jobs,
+) -> None:
+    ''' The main function of a worker process
+
+        The processor, which holds the models, is built once and used for
+        all the jobs the worker takes from the task queue. The index of the
+        job a worker runs is stored in shared memory, since a queued
+        message can be lost when the process dies, so that the parent knows
+        which job was lost.
+    '''
+    processor = build_processor(worker_idx)
+    results.put(('ready', worker_idx, None))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            job_idx, job = task
+            current_jobs[worker_idx] = job_idx
+            results.put(('finished', worker_idx,
+                         run_job(processor, job, worker_idx)))
+    finally:
+        if hasattr(processor, 'close'):
+            processor.close()
+
+
+def run_jobs(
+    jobs: List[Job],
+    build_processor: Callable,
+    log_path: str,
+    num_workers: int = 1,
+    poll_interval: float = 1.0,
+) -> Dict[str, Any]:
+    ''' Runs the jobs of a manifest on a pool of worker processes
+
+        Jobs that already have a successful record in the result log are
+        skipped. The remaining ones are put on a shared queue, so every
+        worker takes the next job as soon as it is done with the previous
+        one, and only the parent process writes to the log. With
+        `num_workers=0` the jobs run in the calling process.
+
+        Parameters
+        ----------
+            jobs: list
+                The jobs of the manifest
+            build_processor: callable
+                Called with the index of a worker in that worker, returns
+                the callable that processes a job. It is sent to the
+                workers, so it must be picklable.
+            log_path: str
+                The JSONL result log, which is also the checkpoint
+            num_workers: int
+                The number of worker processes
+        Returns
+        -------
+            summary: dict
+                The number of completed, failed, skipped and lost jobs, and
+                of the `unfinished` jobs that no worker ran, e.g. because
+                all the workers exited before taking them
+    '''
+    completed = read_completed(log_path)
+    pending = [job for job in jobs if job.key not in completed]
+    summary = {'jobs': len(jobs), 'skipped': len(jobs) - len(pending),
+               'completed': 0, 'failed': 0, 'lost': 0, 'unfinished': 0}
+    logger.info(
+        f'{len(pending)} pending jobs, {summary["skipped"]} already'
+        f' completed')
+    if len(pending) < 1:
+        return summary
+
+    start = time.perf_counter()
+    with ResultLog(log_path) as result_log:
+        def record_result(record: Dict[str, Any]) -> None:
+            result_log.write(record)
+            status = record['status']
+            if status == 'ok':
+                summary['completed'] += 1
+            elif status == 'lost':
+                summary['lost'] += 1
+            else:
+                summary['failed'] += 1
+            num_done = (
+                summary['completed'] + summary['failed'] + summary['lost'])
+            logger.info(
+                f'[{num_done}/{len(pending)}] Job {record["id"]}: {status},'
+                f' {record.get("elapsed", 0.0):.2f} s')
+
+        if num_workers < 1:
+            processor = build_processor(0)
+            try:
+                for job in pending:
+                    record_result(run_job(processor, job, 0))
+            finally:
+                if hasattr(processor, 'close'):
+                    processor.close()
+        else:
+            summary['unfinished'] = run_workers(
+                pending, build_processor, record_result,
+                num_workers=num_workers, poll_interval=poll_interval)
+
+    summary['elapsed'] = time.perf_counter() - start
+    logger.info(
+        f'{summary["completed"]} jobs completed, {summary["failed"]} failed,'
+        f' {summary["lost"]} lost, {summary["unfinished"]} unfinished in'
+        f' {summary["elapsed"]:.1f} s')
+    return summary
+
+
+def run_workers(
+    pending: List[Job],
+    build_processor: Callable,
+    record_result: Callable,
+    num_workers: int = 1,
+    poll_interval: float = 1.0,
+) -> int:
+    ''' Runs the pending jobs on worker processes
+
+        Returns
+        -------
+            num_unfinished: int
+                The number of jobs without a result, which are neither
+                recorded as done nor as lost and run on resume
+    '''
+    # Spawned workers do not inherit CUDA or OpenMP state from the parent
+    ctx = mp.get_context('spawn')
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for job_idx, job in enumerate(pending):
+        tasks.put((job_idx, job))
+    num_workers = min(num_workers, len(pending))
+    for _ in range(num_workers):
+        tasks.put(None)
+    current_jobs = ctx.Array('l', [-1] * num_workers, lock=False)
+
+    workers = []
+    for worker_idx in range(num_workers):
+        worker = ctx.Process(
+            target=worker_loop, name=f'job_worker_{worker_idx:02d}',
+            args=(worker_idx, build_processor, tasks, results, current_jobs))
+        worker.start()
+        workers.append(worker)
+
+    finished, dead = set(), set()
+    try:
+        while len(finished) < len(pending):
+            try:
+                kind, worker_idx, payload = results.get(
+                    timeout=poll_interval)
+            except queue.Empty:
+                for worker_idx, worker in enumerate(workers):
+                    if worker_idx in dead or worker.exitcode is None:
+                        continue
+                    dead.add(worker_idx)
+                    job_idx = current_jobs[worker_idx]
+                    if job_idx < 0 or pending[job_idx].key in finished:
+                        continue
+                    # Record the job of a crashed worker as lost, so that it
+                    # is retried by the next run
+                    job = pending[job_idx]
+                    logger.error(
+                        f'Worker {worker_idx} died while running job'
+                        f' {job.key}, exit code: {worker.exitcode}')
+                    finished.add(job.key)
+                    record_result({
+                        'id': job.key, 'line': job.line,
+                        'worker': worker_idx,
+                        'num_images': len(job.images), 'status': 'lost',
+                        'error': f'Exit code: {worker.exitcode}',
+                        'finished': time.time()})
+                if len(dead) == len(workers) and results.empty():
+                    logger.error(
+                        f'All the workers exited with'
+                        f' {len(pending) - len(finished)} jobs left')
+                    break
+                continue
+
+            if kind == 'ready':
+                logger.info(f'Worker {worker_idx} is ready')
+            elif kind == 'finished':
+                finished.add(payload['id'])
+                record_result(payload)
+    except KeyboardInterrupt:
+        logger.warning('Interrupted, the unfinished jobs run on resume')
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    return len(pending) - len(finished)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+''' A cache of the body models built from the SMPL-X model files
+
+    Building a body model parses the npz/pkl file of the model and derives
+    the shape and pose blend shapes, the joint regressor and the skinning
+    weights, which takes a large part of the start-up time of a worker. The
+    cache stores the derived arrays once, in the flat format of the inference
+    checkpoints, and maps them on load. The layer is rebuilt around them from
+    a JSON description of its modules: the class, which must come from the
+    `smplx` package, and the scalar attributes. Nothing is unpickled, so a
+    cache file cannot run code in the process that loads it.
+'''
+from typing import Any, Callable, Dict, List, Optional
+import os
+import os.path as osp
+import json
+import hashlib
+import importlib
+from importlib import metadata
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+from .checkpointer import (
+    save_inference_checkpoint, load_inference_checkpoint)
+
+CACHE_EXT = '.wmbm'
+# Changes when the layout of the cache files changes
+CACHE_FORMAT = 2
+# The packages whose modules can be rebuilt from a cache file
+ALLOWED_PACKAGES = ('smplx',)
+# The attributes that every module has, handled by `nn.Module.__init__`
+MODULE_STATE = frozenset(vars(nn.Module()))
+
+
+def smplx_version() -> str:
+    ''' The version of the installed smplx package '''
+    try:
+        return metadata.version('smplx')
+    except metadata.PackageNotFoundError:
+        import smplx
+        return getattr(smplx, '__version__', 'unknown')
+
+
+def model_files(model_path: str):
+    ''' The name, size and modification time of the model files '''
+    if not osp.isdir(model_path):
+        stat = os.stat(model_path)
+        return [(osp.basename(model_path), stat.st_size, stat.st_mtime_ns)]
+    files = []
+    for root, _, fnames in os.walk(model_path):
+        for fname in sorted(fnames):
+            if osp.splitext(fname)[1] not in ('.npz', '.pkl'):
+                continue
+            path = osp.join(root, fname)
+            stat = os.stat(path)
+            files.append((osp.relpath(path, model_path), stat.st_size,
+                          stat.st_mtime_ns))
+    return sorted(files)
+
+
+def body_model_cache_path(
+    cache_folder: str,
+    model_path: str,
+    builder: Callable,
+    model_type: str = 'smplx',
+    **kwargs,
+) -> str:
+    ''' Returns the cache file of a body model
+
+        The name contains the model type, gender and the number of shape
+        and expression coefficients. It ends with a hash of the model
+        files, the smplx version and all the arguments of the builder, so
+        that a changed model file, package or option creates a new entry.
+    '''
+    key = json.dumps({
+        'format': CACHE_FORMAT,
+        'smplx': smplx_version(),
+        'model_path': osp.abspath(model_path),
+        'files': model_files(model_path),
+        'builder': f'{builder.__module__}.{builder.__qualname__}',
+        'model_type': model_type,
+        'kwargs': kwargs,
+    }, sort_keys=True, default=str)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    fname = (f'{model_type}_{kwargs.get("gender", "neutral")}'
+             f'_{kwargs.get("num_betas", 10)}b'
+             f'_{kwargs.get("num_expression_coeffs", 10)}e_{digest}'
+             f'{CACHE_EXT}')
+    return osp.join(cache_folder, fname)
+
+
+def module_class(path: str) -> type:
+    ''' Imports a module class of an allowed package from its path '''
+    module_name, _, qualname = path.partition(':')
+    if module_name.split('.')[0] not in ALLOWED_PACKAGES:
+        raise ValueError(f'{path} is not a body model class')
+    cls = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        cls = getattr(cls, name)
+    if not (isinstance(cls, type) and issubclass(cls, nn.Module)):
+        raise ValueError(f'{path} is not a module')
+    return cls
+
+
+def encode_attribute(value: Any) -> Any:
+    ''' Converts an attribute of a module to a JSON value '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode_attribute(val) for val in value]
+    if isinstance(value, tuple):
+        return {'tuple': [encode_attribute(val) for val in value]}
+    if isinstance(value, torch.dtype):
+        return {'dtype': str(value).rpartition('.')[-1]}
+    raise TypeError(f'Cannot cache an attribute of type {type(value)}')
+
+
+def decode_attribute(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decode_attribute(val) for val in value]
+    if isinstance(value, dict) and 'tuple' in value:
+        return tuple(decode_attribute(val) for val in value['tuple'])
+    if isinstance(value, dict) and 'dtype' in value:
+        dtype = getattr(torch, value['dtype'])
+        if not isinstance(dtype, torch.dtype):
+            raise ValueError(f'Unknown type: {value["dtype"]}')
+        return dtype
+    return value
+
+
+def save_body_model(model: nn.Module, path: str) -> int:
+    ''' Writes the arrays and the description of a body model to a file '''
+    tensors, modules = {}, []
+    for module_name, module in model.named_modules():
+        prefix = f'{module_name}.' if module_name else ''
+        cls = type(module)
+        spec = {
+            'name': module_name,
+            'class': f'{cls.__module__}:{cls.__qualname__}',
+            'training': module.training,
+            'parameters': {}, 'buffers': [], 'arrays': {},
+            'attributes': {},
+            'non_persistent': sorted(module._non_persistent_buffers_set),
+        }
+        # Fail on save instead of on every load
+        module_class(spec['class'])
+
+        for name, param in module._parameters.items():
+            if param is not None:
+                tensors[prefix + name] = param.detach()
+                spec['parameters'][name] = param.requires_grad
+        for name, buffer in module._buffers.items():
+            if buffer is not None:
+                tensors[prefix + name] = buffer
+                spec['buffers'].append(name)
+        for name, value in vars(module).items():
+            if name in MODULE_STATE:
+                continue
+            if isinstance(value, np.ndarray):
+                if value.dtype.hasobject:
+                    raise TypeError(f'Cannot cache the array {name}')
+                # Stored as bytes, since torch lacks some of the numpy types
+                array = np.ascontiguousarray(value)
+                tensors[prefix + name] = torch.from_numpy(
+                    array.reshape(-1).view(np.uint8).copy())
+                spec['arrays'][name] = {
+                    'dtype': array.dtype.str, 'shape': list(array.shape)}
+            else:
+                spec['attributes'][name] = encode_attribute(value)
+        modules.append(spec)
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    num_bytes = save_inference_checkpoint(
+        tensors, tmp_path, metadata={'modules': modules})
+    # Workers that start at the same time never see a partial file
+    os.replace(tmp_path, path)
+    return num_bytes
+
+
+def build_module(spec: Dict[str, Any], tensors: Dict[str, torch.Tensor],
+                 prefix: str = '') -> nn.Module:
+    ''' Creates a module from its description without its constructor '''
+    cls = module_class(spec['class'])
+    module = cls.__new__(cls)
+    nn.Module.__init__(module)
+    module.training = spec['training']
+
+    for name, value in spec['attributes'].items():
+        module.__dict__[name] = decode_attribute(value)
+    for name, array_spec in spec['arrays'].items():
+        module.__dict__[name] = tensors[prefix + name].numpy().view(
+            np.dtype(array_spec['dtype'])).reshape(array_spec['shape'])
+    for name, requires_grad in spec['parameters'].items():
+        module._parameters[name] = nn.Parameter(
+            tensors[prefix + name], requires_grad=requires_grad)
+    for name in spec['buffers']:
+        module._buffers[name] = tensors[prefix + name]
+    module._non_persistent_buffers_set.update(spec['non_persistent'])
+    return module
+
+
+def load_body_model(path: str) -> nn.Module:
+    ''' Rebuilds a body model around the mapped arrays of a cache file '''
+    tensors, header = load_inference_checkpoint(path)
+    modules: List[Dict[str, Any]] = header['modules']
+
+    model = build_module(modules[0], tensors)
+    # The modules are stored in pre-order, so every parent exists already
+    for spec in modules[1:]:
+        parent_name, _, name = spec['name'].rpartition('.')
+        parent = model.get_submodule(parent_name)
+        parent._modules[name] = build_module(
+            spec, tensors, prefix=f'{spec["name"]}.')
+    return model
+
+
+def build_cached_body_model(
+    model_path: str,
+    builder: Callable,
+    cache_folder: Optional[str] = None,
+    model_type: str = 'smplx',
+    **kwargs: Any,
+) -> nn.Module:
+    ''' Builds a body model, or loads it from the cache
+
+        Parameters
+        ----------
+            model_path: str
+                The model file or folder, as passed to the builder
+            builder: callable
+                `smplx.build_layer` or `smplx.create`
+            cache_folder: str, optional
+                The folder of the cache, the cache is not used if empty
+            model_type: str
+                The type of the body model
+        Returns
+        -------
+            body_model: nn.Module
+                The body model
+    '''
+    if not cache_folder:
+        return builder(model_path, model_type=model_type, **kwargs)
+
+    cache_folder = osp.expanduser(osp.expandvars(cache_folder))
+    cache_path = body_model_cache_path(
+        cache_folder, model_path, builder, model_type=model_type, **kwargs)
+    if osp.exists(cache_path):
+        try:
+            model = load_body_model(cache_path)
+            logger.info(f'Loaded the body model from {cache_path}')
+            return model
+        except Exception as e:
+            logger.warning(f'Rebuilding the body model, {cache_path}: {e}')
+
+    model = builder(model_path, model_type=model_type, **kwargs)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        num_bytes = save_body_model(model, cache_path)
+        logger.info(
+            f'Cached the body model to {cache_path},'
+            f' {num_bytes / 2 ** 20:.1f} MiB')
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f'Could not cache the body model: {e}')
+    return model
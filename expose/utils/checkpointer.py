@@ -14,15 +14,149 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
+from typing import Any, Dict, Optional, Tuple
 import sys
 
 import os
 import os.path as osp
+import json
+import struct
 
+import numpy as np
 import torch
+import torch.nn as nn
 
 from loguru import logger
 
+# The magic string and the header length of an inference checkpoint
+INFERENCE_CKPT_MAGIC = b'WMCKPT01'
+INFERENCE_CKPT_PREFIX = struct.Struct('<8sQ')
+# The alignment in bytes of every tensor, so that the mapped views can be
+# used by vectorized kernels
+INFERENCE_CKPT_ALIGNMENT = 64
+
+DTYPE_NAMES = {
+    torch.float64: 'float64', torch.float32: 'float32',
+    torch.float16: 'float16', torch.bfloat16: 'bfloat16',
+    torch.int64: 'int64', torch.int32: 'int32', torch.int16: 'int16',
+    torch.int8: 'int8', torch.uint8: 'uint8', torch.bool: 'bool',
+}
+NAME_DTYPES = {name: dtype for dtype, name in DTYPE_NAMES.items()}
+
+
+def align(offset: int, alignment: int = INFERENCE_CKPT_ALIGNMENT) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_inference_checkpoint(
+    state_dict: Dict[str, torch.Tensor],
+    path: str,
+    metadata: Optional[Dict[str, Any]] = None,
+) -> int:
+    ''' Writes the tensors of a state dict to a flat, mappable file
+
+        The file starts with a magic string and the length of a JSON header,
+        which lists the name, type, shape and offset of every tensor. The
+        tensors follow the header, contiguous and aligned, so that they can
+        be used directly from a memory map.
+
+        Returns
+        -------
+            num_bytes: int
+                The size of the file
+    '''
+    specs, tensors = [], []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype not in DTYPE_NAMES:
+            raise ValueError(f'Unsupported type of {name}: {tensor.dtype}')
+        nbytes = tensor.numel() * tensor.element_size()
+        specs.append({'name': name, 'dtype': DTYPE_NAMES[tensor.dtype],
+                      'shape': list(tensor.shape), 'offset': offset,
+                      'nbytes': nbytes})
+        tensors.append(tensor)
+        offset = align(offset + nbytes)
+
+    header = json.dumps(
+        {'tensors': specs, 'metadata': metadata or {}}).encode('utf-8')
+    data_start = align(INFERENCE_CKPT_PREFIX.size + len(header))
+
+    os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(INFERENCE_CKPT_PREFIX.pack(INFERENCE_CKPT_MAGIC, len(header)))
+        f.write(header)
+        for spec, tensor in zip(specs, tensors):
+            f.seek(data_start + spec['offset'])
+            # Byte views avoid a round trip through numpy, which has no
+            # bfloat16 type
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+        f.truncate(data_start + offset)
+    return data_start + offset
+
+
+def load_inference_checkpoint(
+    path: str,
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    ''' Maps an inference checkpoint without reading it
+
+        The file is mapped copy-on-write: the returned tensors share the
+        pages of the page cache, which are only read when a weight is used,
+        and an in-place update copies the touched page instead of modifying
+        the file. Processes that map the same file share its memory.
+
+        Returns
+        -------
+            state_dict: dict
+                The tensors of the checkpoint, views of the mapped file
+            metadata: dict
+                The metadata stored by `save_inference_checkpoint`
+    '''
+    with open(path, 'rb') as f:
+        magic, header_size = INFERENCE_CKPT_PREFIX.unpack(
+            f.read(INFERENCE_CKPT_PREFIX.size))
+        if magic != INFERENCE_CKPT_MAGIC:
+            raise ValueError(f'{path} is not an inference checkpoint')
+        header = json.loads(f.read(header_size))
+    data_start = align(INFERENCE_CKPT_PREFIX.size + header_size)
+
+    data = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode='c'))
+
+    state_dict = {}
+    for spec in header['tensors']:
+        start = data_start + spec['offset']
+        tensor = data[start:start + spec['nbytes']]
+        state_dict[spec['name']] = tensor.view(
+            NAME_DTYPES[spec['dtype']]).reshape(spec['shape'])
+    return state_dict, header['metadata']
+
+
+def load_inference_weights(
+    model: nn.Module,
+    path: str,
+) -> Dict[str, Any]:
+    ''' Loads an inference checkpoint into a model on any device
+
+        On the CPU the parameters and buffers of the model are replaced by
+        the mapped tensors, so the weights are neither copied nor kept twice
+        in memory. On other devices the mapped tensors are copied to the
+        model, which still skips the unpickling of a training checkpoint.
+    '''
+    state_dict, metadata = load_inference_checkpoint(path)
+    device = next(model.parameters()).device
+    # Assigning the tensors needs PyTorch 2.1
+    assign = (device.type == 'cpu' and 'assign' in
+              model.load_state_dict.__code__.co_varnames)
+    kwargs = {'assign': True} if assign else {}
+    missing, unexpected = model.load_state_dict(
+        state_dict, strict=False, **kwargs)
+    if len(missing) > 0:
+        logger.warning(f'The following keys were not found: {missing}')
+    if len(unexpected) > 0:
+        logger.warning(
+            f'The following keys were not expected: {unexpected}')
+    return metadata
+
 
 class Checkpointer(object):
     def __init__(self, model, optimizer=None, scheduler=None,
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Dict, Iterable, Optional, Union
+import sys
+import os.path as osp
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+from .checkpointer import Checkpointer, load_inference_weights
+from .device_utils import optimize_for_inference, to_host
+from .typing_utils import Array, Tensor
+
+
+def build_model(
+    exp_cfg,
+    device: torch.device,
+    channels_last: bool = False,
+    bf16: bool = False,
+) -> nn.Module:
+    ''' Builds SMPLXNet and loads the latest checkpoint for inference
+
+        If the configuration sets `inference_checkpoint`, the weights are
+        mapped from that file instead of the training checkpoint.
+    '''
+    from expose.models.smplx_net import SMPLXNet
+
+    model = SMPLXNet(exp_cfg)
+    try:
+        model = model.to(device=device)
+    except RuntimeError:
+        # Re-submit in case of a device error
+        sys.exit(3)
+
+    inference_checkpoint = exp_cfg.get('inference_checkpoint', '')
+    if inference_checkpoint:
+        inference_checkpoint = osp.expandvars(inference_checkpoint)
+        logger.info(f'Mapping the weights from {inference_checkpoint}')
+        load_inference_weights(model, inference_checkpoint)
+    else:
+        checkpoint_folder = osp.join(
+            exp_cfg.output_folder, exp_cfg.checkpoint_folder)
+        checkpointer = Checkpointer(
+            model, save_dir=checkpoint_folder,
+            pretrained=exp_cfg.pretrained)
+        checkpointer.load_checkpoint()
+
+    model = model.eval()
+    model = optimize_for_inference(
+        model, channels_last=channels_last, bf16=bf16)
+    return model
+
+
+def target_boxes(
+    targets,
+    device: Optional[torch.device] = None,
+) -> Tensor:
+    ''' Stacks the original box sizes and centers of the targets
+
+        Returns
+        -------
+            boxes: torch.tensor, Nx3
+                The size and the (x, y) center of every box, created on the
+                host and copied to the device without a synchronization
+    '''
+    boxes = np.array(
+        [np.concatenate([np.reshape(target.get_field('orig_bbox_size'), 1),
+                         np.reshape(target.get_field('orig_center'), 2)])
+         for target in targets], dtype=np.float32).reshape(-1, 3)
+    return torch.from_numpy(boxes).to(device=device, non_blocking=True)
+
+
+def perspective_camera(
+    camera_scale: Tensor,
+    camera_transl: Tensor,
+    boxes: Tensor,
+    H: Union[float, Array],
+    W: Union[float, Array],
+    sensor_width: Union[float, Array] = 36,
+    focal_length: Union[float, Array] = 5000,
+) -> Dict[str, Tensor]:
+    ''' Converts weak-perspective cameras to perspective cameras
+
+        All the people of a batch are converted at once on the device of the
+        camera parameters.
+
+        Parameters
+        ----------
+            camera_scale: torch.tensor, Bx1
+                The scale of the weak-perspective cameras
+            camera_transl: torch.tensor, Bx2
+                The translation of the weak-perspective cameras
+            boxes: torch.tensor, Bx3
+                The size and center of the boxes, see `target_boxes`
+            H, W, sensor_width, focal_length: float or array
+                A value for all the people or an array with one per person
+    '''
+    def as_param(value):
+        # Scalars are used as they are, arrays hold a value per person
+        if np.isscalar(value):
+            return value
+        return torch.as_tensor(value, dtype=boxes.dtype).to(
+            device=boxes.device, non_blocking=True)
+
+    H, W = as_param(H), as_param(W)
+    sensor_width = as_param(sensor_width)
+    focal_length = as_param(focal_length)
+    bbox_size, bbox_center = boxes[:, 0], boxes[:, 1:]
+    camera_scale = camera_scale.reshape(-1).to(dtype=boxes.dtype)
+    z = 2 * focal_length / (camera_scale * bbox_size)
+    transl = torch.cat(
+        [camera_transl[:, :2].to(dtype=boxes.dtype), z[:, None]], dim=1)
+
+    ones = torch.ones_like(bbox_size)
+    return {
+        'shift_x': 0.5 - bbox_center[:, 0] / W,
+        'shift_y': (bbox_center[:, 1] - 0.5 * H) / W,
+        'transl': transl,
+        'focal_length_in_mm': ones * (focal_length / W * sensor_width),
+        'focal_length_in_px': ones * focal_length,
+        'center': bbox_center,
+        'sensor_width': ones * sensor_width,
+    }
+
+
+def weak_persp_to_blender(
+        targets,
+        camera_scale,
+        camera_transl,
+        H, W,
+        sensor_width=36,
+        focal_length=5000):
+    ''' Converts weak-perspective camera to a perspective camera
+    '''
+    camera_scale = torch.as_tensor(camera_scale)
+    camera_transl = torch.as_tensor(camera_transl)
+    boxes = target_boxes(targets, device=camera_scale.device)
+    return to_host(perspective_camera(
+        camera_scale, camera_transl, boxes, H=H, W=W,
+        sensor_width=sensor_width, focal_length=focal_length))
+
+
+def postprocess_output(
+    model_output: Dict,
+    targets,
+    H: Union[float, Array],
+    W: Union[float, Array],
+    sensor_width: Union[float, Array] = 36,
+    focal_length: Union[float, Array] = 5000,
+    param_keys: Iterable[str] = (),
+    extra: Optional[Dict[str, Tensor]] = None,
+) -> Dict[str, Array]:
+    ''' Collects the outputs of a batch on the host with one transfer
+
+        Returns
+        -------
+            outputs: dict
+                The `vertices` of the final estimate, the `stage_vertices`
+                of the last regression stage, the perspective cameras in
+                `hd_params`, the requested final parameters in `params` and
+                the host copies of the `extra` tensors
+    '''
+    body_output = model_output.get('body', {})
+    num_stages = body_output.get('num_stages', 3)
+    stage_out = body_output.get(f'stage_{num_stages - 1:02d}', {})
+    final_out = body_output.get('final', stage_out)
+    camera_parameters = body_output['camera_parameters']
+
+    camera = perspective_camera(
+        camera_parameters['scale'], camera_parameters['translation'],
+        target_boxes(targets, device=camera_parameters['scale'].device),
+        H=H, W=W, sensor_width=sensor_width, focal_length=focal_length)
+
+    tensors = dict(extra or {})
+    tensors['vertices'] = final_out['vertices']
+    tensors['stage_vertices'] = stage_out.get(
+        'vertices', final_out['vertices'])
+    tensors.update(
+        {f'hd_params/{key}': val for key, val in camera.items()})
+    tensors.update(
+        {f'params/{key}': final_out[key] for key in param_keys})
+
+    outputs = {'hd_params': {}, 'params': {}}
+    for key, val in to_host(tensors).items():
+        group, _, name = key.rpartition('/')
+        if group:
+            outputs[group][name] = val
+        else:
+            outputs[key] = val
+    return outputs
+
+
+def undo_img_normalization(image, mean, std, add_alpha=True):
+    if torch.is_tensor(image):
+        image = image.detach().cpu().numpy().squeeze()
+
+    out_img = (image * std[np.newaxis, :, np.newaxis, np.newaxis] +
+               mean[np.newaxis, :, np.newaxis, np.newaxis])
+    if add_alpha:
+        out_img = np.pad(
+            out_img, [[0, 0], [0, 1], [0, 0], [0, 0]],
+            mode='constant', constant_values=1.0)
+    return out_img
+
+
+def denormalize_to_uint8(
+    images: Tensor,
+    mean: Array,
+    std: Array,
+) -> Tensor:
+    ''' Converts normalized BxCxHxW images to BxHxWxC uint8 images
+
+        The scaling, the clamping, the rounding and the layout change run
+        as a single pass on the device of the images, so the host only
+        receives a quarter of the bytes of the float images.
+    '''
+    scale = torch.as_tensor(
+        np.asarray(std) * 255, dtype=images.dtype, device=images.device)
+    # The offset of 0.5 rounds to the nearest value on the cast to uint8
+    offset = torch.as_tensor(
+        np.asarray(mean) * 255 + 0.5, dtype=images.dtype,
+        device=images.device)
+    output = torch.empty(
+        [images.shape[0], images.shape[2], images.shape[3],
+         images.shape[1]], dtype=torch.uint8, device=images.device)
+    output.copy_(torch.addcmul(
+        offset[:, None, None], images, scale[:, None, None]).clamp_(
+            0, 255).permute(0, 2, 3, 1))
+    return output
+
+
+RENDERERS = ('hd', 'batched', 'software')
+
+
+def build_renderer(
+    renderer_type: str = 'hd',
+    img_size: int = 256,
+    device: Optional[torch.device] = None,
+):
+    ''' Creates the renderer used for the HD overlays
+
+        The pyrender backends are imported here, so that the software
+        rasterizer can be used on machines without an OpenGL context.
+
+        Parameters
+        ----------
+            renderer_type: str
+                One of `hd`, `batched` or `software`
+            img_size: int
+                The default viewport size of the pyrender backends
+            device: torch.device, optional
+                The device of the software rasterizer, defaults to the
+                device of the rendered vertices
+    '''
+    if renderer_type == 'software':
+        from .rasterizer import SoftwareRenderer
+        return SoftwareRenderer(img_size=img_size, device=device)
+    elif renderer_type == 'batched':
+        from .plot_utils import BatchedHDRenderer
+        return BatchedHDRenderer(img_size=img_size)
+    elif renderer_type == 'hd':
+        from .plot_utils import HDRenderer
+        return HDRenderer(img_size=img_size)
+    else:
+        raise ValueError(f'Unknown renderer: {renderer_type}')
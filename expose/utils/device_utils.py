@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import sys
+import os
+from typing import Dict, Union, Optional
+
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+
+def select_device(device: Union[str, torch.device] = 'auto') -> torch.device:
+    ''' Resolves the requested device
+
+        "auto" picks CUDA when it is available and falls back to the CPU.
+        Explicitly requesting CUDA on a machine without it keeps the old
+        behaviour and exits with code 3, so that cluster jobs are
+        re-submitted.
+    '''
+    if isinstance(device, torch.device):
+        device = str(device)
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        logger.error('CUDA is not available!')
+        sys.exit(3)
+    return device
+
+
+def synchronize(device: torch.device) -> None:
+    ''' Waits for all pending kernels, a no-op on the CPU '''
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def to_host(tensors: Dict[str, torch.Tensor]) -> Dict:
+    ''' Moves a group of tensors to the host with a single synchronization
+
+        The device tensors are copied asynchronously and the stream is
+        synchronized once, instead of once per `.cpu()` call. Half and
+        bfloat16 tensors are returned as float32 arrays. Values that are not
+        tensors are returned unchanged.
+    '''
+    host, devices = {}, set()
+    for key, val in tensors.items():
+        if not torch.is_tensor(val):
+            host[key] = val
+            continue
+        val = val.detach()
+        if val.dtype in (torch.float16, torch.bfloat16):
+            val = val.float()
+        if val.device.type == 'cuda':
+            devices.add(val.device)
+            val = val.to('cpu', non_blocking=True)
+        host[key] = val
+    for device in devices:
+        torch.cuda.synchronize(device)
+    return {key: val.numpy() if torch.is_tensor(val) else val
+            for key, val in host.items()}
+
+
+def get_num_cpus() -> int:
+    ''' Returns the number of cores this process is allowed to run on '''
+    if hasattr(os, 'sched_getaffinity'):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return max(os.cpu_count() or 1, 1)
+
+
+def configure_threads(
+        device: torch.device,
+        num_threads: Optional[int] = None) -> int:
+    ''' Sets the intra-op thread budget for the given device
+
+        On the GPU the host threads only feed the device, so a single
+        BLAS/OpenMP thread is used, as before. On the CPU the budget
+        defaults to all the cores available to the process.
+
+        Returns
+        -------
+            num_threads: int
+                The number of threads that should also be passed to
+                `threadpool_limits`, so that numpy and OpenCV do not
+                oversubscribe the cores used by PyTorch.
+    '''
+    if device.type == 'cuda':
+        return 1 if num_threads is None or num_threads < 1 else num_threads
+
+    if num_threads is None or num_threads < 1:
+        num_threads = get_num_cpus()
+    torch.set_num_threads(num_threads)
+    try:
+        # Inter-op parallelism is not used by the eager forward pass
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any parallel work has started
+        pass
+    logger.info(f'Using {num_threads} intra-op CPU threads')
+    return num_threads
+
+
+class BackboneWrapper(nn.Module):
+    ''' Runs a feature extractor with CPU friendly execution settings
+
+        The input is converted to the channels-last memory format and the
+        forward pass can optionally run under bfloat16 autocast. All
+        floating point outputs are returned as contiguous float32 tensors,
+        so the regression heads and the body model are unaffected.
+    '''
+
+    def __init__(
+        self,
+        backbone: nn.Module,
+        channels_last: bool = False,
+        bf16: bool = False,
+    ) -> None:
+        super(BackboneWrapper, self).__init__()
+        self.backbone = backbone
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def extra_repr(self) -> str:
+        return (f'Channels last: {self.channels_last}\n'
+                f'BFloat16: {self.bf16}')
+
+    def get_output_dim(self):
+        return self.backbone.get_output_dim()
+
+    @staticmethod
+    def _to_float(output):
+        if torch.is_tensor(output):
+            if output.is_floating_point():
+                return output.float().contiguous()
+            return output
+        if isinstance(output, dict):
+            return {key: BackboneWrapper._to_float(val)
+                    for key, val in output.items()}
+        if isinstance(output, (list, tuple)):
+            return type(output)(BackboneWrapper._to_float(val)
+                                for val in output)
+        return output
+
+    def forward(self, images):
+        if self.channels_last and images.dim() == 4:
+            images = images.contiguous(memory_format=torch.channels_last)
+        if self.bf16:
+            with torch.autocast(device_type=images.device.type,
+                                dtype=torch.bfloat16):
+                output = self.backbone(images)
+        else:
+            output = self.backbone(images)
+        return self._to_float(output)
+
+
+def optimize_for_inference(
+    model: nn.Module,
+    channels_last: bool = False,
+    bf16: bool = False,
+) -> nn.Module:
+    ''' Applies the channels-last layout and bfloat16 autocast to a model
+
+        Every submodule called `backbone`, i.e. the body, hand and head
+        feature extractors, is wrapped in a `BackboneWrapper`. This changes
+        the keys of the state dict, so it must be called after the
+        checkpoint has been loaded.
+    '''
+    if not channels_last and not bf16:
+        return model
+
+    if bf16 and not hasattr(torch, 'autocast'):
+        logger.warning(
+            'bfloat16 autocast requires a newer version of PyTorch')
+        bf16 = False
+
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    parents = [module for module in model.modules()
+               if isinstance(getattr(module, 'backbone', None), nn.Module) and
+               not isinstance(module, BackboneWrapper)]
+    for module in parents:
+        module.backbone = BackboneWrapper(
+            module.backbone, channels_last=channels_last, bf16=bf16)
+    logger.info(f'Wrapped {len(parents)} backbones, channels last:'
+                f' {channels_last}, bfloat16: {bf16}')
+    return model
@@ -31,3 +31,57 @@ def read_img(img_fn: str, dtype=np.float32) -> Array:
         if img.dtype == np.uint8:
             img = img.astype(dtype) / 255.0
     return img
+
+
+def float_to_uint8(img: Array) -> Array:
+    ''' Converts an image in [0, 1] to uint8 without float intermediates '''
+    return cv2.convertScaleAbs(img, alpha=255.0)
+
+
+def div255(values: Array) -> Array:
+    ''' Divides uint16 products of two uint8 values by 255 with rounding '''
+    values = values + 128
+    return (values + (values >> 8)) >> 8
+
+
+def alpha_composite_uint8(
+    bg_img: Array,
+    rendering: Array,
+    with_alpha: bool = False,
+) -> Array:
+    ''' Blends an RGBA rendering over a background in fixed-point
+
+        Only the rows and columns that contain covered pixels are blended,
+        the rest of the output is a copy of the background.
+
+        Parameters
+        ----------
+            bg_img: np.ndarray, HxWx3, uint8
+                The background image
+            rendering: np.ndarray, HxWx4, uint8
+                The rendering, whose alpha channel is used as the opacity
+            with_alpha: bool, optional
+                Whether to append an opaque alpha channel to the output
+
+        Returns
+        -------
+            output: np.ndarray, HxWx3 or HxWx4, uint8
+    '''
+    H, W = bg_img.shape[:2]
+    output = np.empty([H, W, 4 if with_alpha else 3], dtype=np.uint8)
+    output[..., :3] = bg_img[..., :3]
+    if with_alpha:
+        output[..., 3] = 255
+
+    alpha = rendering[..., 3]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if len(rows) < 1:
+        return output
+    cols = np.flatnonzero(alpha.any(axis=0))
+    region = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+    alpha = alpha[region][..., np.newaxis].astype(np.uint16)
+    fg = rendering[region][..., :3].astype(np.uint16)
+    bg = output[region][..., :3].astype(np.uint16)
+    output[region][..., :3] = div255(fg * alpha + bg * (255 - alpha))
+    return output
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import List, Tuple
+import os.path as osp
+import json
+import re
+import struct
+import threading
+
+import numpy as np
+
+from .typing_utils import Array
+
+MESH_FORMATS = ('ply', 'obj', 'glb')
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+PLY_FORMATS = {'binary_little_endian': '<', 'binary_big_endian': '>',
+               'ascii': ''}
+# A triangle of a binary PLY file: the vertex count and three indices
+PLY_FACE_DTYPE = np.dtype([('count', 'u1'), ('indices', '<i4', (3,))])
+
+GLB_MAGIC = 0x46546C67
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+GLB_HEADER = struct.Struct('<III')
+GLB_CHUNK_HEADER = struct.Struct('<II')
+GL_FLOAT = 5126
+GL_UNSIGNED_INT = 5125
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+
+
+def pad_to(data: bytes, alignment: int = 4, fill: bytes = b'\x00') -> bytes:
+    return data + fill * (-len(data) % alignment)
+
+
+class MeshTopology(object):
+    ''' The faces of a mesh and their encodings in every file format
+
+        The faces of the meshes of a run never change, so the face block of
+        each format is encoded once and written as-is for every mesh. Only
+        the vertices are formatted per mesh.
+    '''
+
+    def __init__(self, faces: Array) -> None:
+        super(MeshTopology, self).__init__()
+        self.faces = np.ascontiguousarray(faces, dtype=np.int64)
+        self.blocks = {}
+
+    @property
+    def num_faces(self) -> int:
+        return len(self.faces)
+
+    def ply_block(self) -> bytes:
+        if 'ply' not in self.blocks:
+            block = np.empty(self.num_faces, dtype=PLY_FACE_DTYPE)
+            block['count'] = 3
+            block['indices'] = self.faces
+            self.blocks['ply'] = block.tobytes()
+        return self.blocks['ply']
+
+    def obj_block(self) -> bytes:
+        if 'obj' not in self.blocks:
+            self.blocks['obj'] = (
+                'f %d %d %d\n' * self.num_faces %
+                tuple((self.faces + 1).ravel())).encode('ascii')
+        return self.blocks['obj']
+
+    def glb_block(self) -> bytes:
+        if 'glb' not in self.blocks:
+            self.blocks['glb'] = pad_to(
+                self.faces.astype('<u4').tobytes())
+        return self.blocks['glb']
+
+
+class TopologyCache(object):
+    ''' Returns the same `MeshTopology` for equal face arrays '''
+
+    def __init__(self, max_size: int = 8) -> None:
+        super(TopologyCache, self).__init__()
+        self.max_size = max_size
+        self.topologies = []
+        self.lock = threading.Lock()
+
+    def __call__(self, faces) -> MeshTopology:
+        if isinstance(faces, MeshTopology):
+            return faces
+        faces = np.asarray(faces)
+        with self.lock:
+            for topology in self.topologies:
+                if (topology.faces.shape == faces.shape and
+                        np.array_equal(topology.faces, faces)):
+                    return topology
+            topology = MeshTopology(faces)
+            self.topologies = [topology] + self.topologies[
+                :self.max_size - 1]
+        return topology
+
+
+get_topology = TopologyCache()
+
+
+def mesh_format(path: str) -> str:
+    ext = osp.splitext(path)[1].lower().lstrip('.')
+    if ext not in MESH_FORMATS:
+        raise ValueError(f'Unknown mesh format: {path}')
+    return ext
+
+
+def write_ply(path: str, vertices: Array, faces) -> None:
+    ''' Writes a binary little-endian PLY file with float32 vertices '''
+    topology = get_topology(faces)
+    vertices = np.ascontiguousarray(vertices, dtype='<f4')
+    header = (
+        'ply\nformat binary_little_endian 1.0\n'
+        f'element vertex {len(vertices)}\n'
+        'property float x\nproperty float y\nproperty float z\n'
+        f'element face {topology.num_faces}\n'
+        'property list uchar int vertex_indices\nend_header\n')
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(vertices.tobytes())
+        f.write(topology.ply_block())
+
+
+def write_obj(path: str, vertices: Array, faces) -> None:
+    ''' Writes an OBJ file with the vertices and the triangles '''
+    topology = get_topology(faces)
+    vertices = np.asarray(vertices, dtype=np.float64)
+    with open(path, 'wb') as f:
+        f.write(('v %.6f %.6f %.6f\n' * len(vertices) %
+                 tuple(vertices.ravel())).encode('ascii'))
+        f.write(topology.obj_block())
+
+
+def write_glb(path: str, vertices: Array, faces) -> None:
+    ''' Writes a binary glTF file with a single triangle mesh '''
+    topology = get_topology(faces)
+    vertices = np.ascontiguousarray(vertices, dtype='<f4')
+    positions = pad_to(vertices.tobytes())
+    indices = topology.glb_block()
+
+    gltf = {
+        'asset': {'version': '2.0'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0}],
+        'meshes': [{'primitives': [
+            {'attributes': {'POSITION': 0}, 'indices': 1}]}],
+        'buffers': [{'byteLength': len(positions) + len(indices)}],
+        'bufferViews': [
+            {'buffer': 0, 'byteOffset': 0,
+             'byteLength': vertices.nbytes, 'target': GL_ARRAY_BUFFER},
+            {'buffer': 0, 'byteOffset': len(positions),
+             'byteLength': topology.num_faces * 12,
+             'target': GL_ELEMENT_ARRAY_BUFFER},
+        ],
+        'accessors': [
+            {'bufferView': 0, 'componentType': GL_FLOAT,
+             'count': len(vertices), 'type': 'VEC3',
+             'min': vertices.min(axis=0).tolist(),
+             'max': vertices.max(axis=0).tolist()},
+            {'bufferView': 1, 'componentType': GL_UNSIGNED_INT,
+             'count': topology.num_faces * 3, 'type': 'SCALAR'},
+        ],
+    }
+    json_chunk = pad_to(
+        json.dumps(gltf, separators=(',', ':')).encode('utf-8'), fill=b' ')
+    bin_size = len(positions) + len(indices)
+    total_size = (GLB_HEADER.size + 2 * GLB_CHUNK_HEADER.size +
+                  len(json_chunk) + bin_size)
+    with open(path, 'wb') as f:
+        f.write(GLB_HEADER.pack(GLB_MAGIC, 2, total_size))
+        f.write(GLB_CHUNK_HEADER.pack(len(json_chunk), GLB_JSON_CHUNK))
+        f.write(json_chunk)
+        f.write(GLB_CHUNK_HEADER.pack(bin_size, GLB_BIN_CHUNK))
+        f.write(positions)
+        f.write(indices)
+
+
+def parse_ply_header(f) -> Tuple[str, List[Tuple[str, int, List]]]:
+    ''' Returns the format and the (name, count, properties) elements '''
+    if f.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file')
+    fmt, elements = None, []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('The PLY header is not terminated')
+        tokens = line.decode('ascii').split()
+        if len(tokens) < 1 or tokens[0] in ('comment', 'obj_info'):
+            continue
+        if tokens[0] == 'end_header':
+            break
+        if tokens[0] == 'format':
+            fmt = tokens[1]
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property':
+            elements[-1][2].append(tokens[1:])
+    return fmt, elements
+
+
+def read_ply(path: str) -> Tuple[Array, Array]:
+    ''' Reads the vertices and the triangles of a PLY file
+
+        Binary files are read with one structured `np.fromfile` call per
+        element, as long as the faces are triangles.
+    '''
+    with open(path, 'rb') as f:
+        fmt, elements = parse_ply_header(f)
+        if fmt not in PLY_FORMATS:
+            raise ValueError(f'Unknown PLY format: {fmt}')
+        byte_order = PLY_FORMATS[fmt]
+        if fmt == 'ascii':
+            data = f.read().split()
+
+        vertices, faces = None, None
+        offset = 0
+        for name, count, properties in elements:
+            if any(prop[0] == 'list' for prop in properties):
+                if (len(properties) != 1 or
+                        properties[0][-1] not in ('vertex_indices',
+                                                  'vertex_index')):
+                    raise ValueError(f'Unsupported PLY element: {name}')
+                _, count_type, index_type, _ = properties[0]
+                dtype = np.dtype([
+                    ('count', byte_order + PLY_TYPES[count_type]),
+                    ('indices', byte_order + PLY_TYPES[index_type], (3,))])
+            else:
+                dtype = np.dtype([
+                    (prop[1], byte_order + PLY_TYPES[prop[0]])
+                    for prop in properties])
+
+            if fmt == 'ascii':
+                num_values = count * sum(
+                    int(np.prod(dtype[key].shape)) for key in dtype.names)
+                values = np.array(data[offset:offset + num_values],
+                                  dtype=np.float64)
+                offset += num_values
+                array = np.empty(count, dtype=dtype)
+                values = values.reshape(count, -1)
+                if 'indices' in dtype.names:
+                    array['count'] = values[:, 0]
+                    array['indices'] = values[:, 1:]
+                else:
+                    for idx, key in enumerate(dtype.names):
+                        array[key] = values[:, idx]
+            else:
+                array = np.fromfile(f, dtype=dtype, count=count)
+
+            if name == 'vertex':
+                vertices = np.stack(
+                    [array['x'], array['y'], array['z']], axis=1)
+            elif name == 'face':
+                if count > 0 and np.any(array['count'] != 3):
+                    raise ValueError(f'{path} contains non-triangle faces')
+                faces = array['indices'].astype(np.int64)
+    return vertices, faces
+
+
+OBJ_VERTEX_LINE = re.compile(rb'^v ([^\n]*)', re.MULTILINE)
+OBJ_FACE_LINE = re.compile(rb'^f ([^\n]*)', re.MULTILINE)
+OBJ_INDEX_SUFFIX = re.compile(rb'/[^\s]*')
+
+
+def read_obj(path: str) -> Tuple[Array, Array]:
+    ''' Reads the vertices and the triangles of an OBJ file
+
+        The texture and normal indices of the faces are ignored.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    vertex_lines = OBJ_VERTEX_LINE.findall(data)
+    face_lines = OBJ_FACE_LINE.findall(data)
+
+    vertices = np.fromstring(
+        b' '.join(vertex_lines), dtype=np.float64, sep=' ')
+    vertices = vertices.reshape(len(vertex_lines), -1)[:, :3]
+    face_block = b' '.join(face_lines)
+    if b'/' in face_block:
+        face_block = OBJ_INDEX_SUFFIX.sub(b'', face_block)
+    faces = np.fromstring(face_block, dtype=np.int64, sep=' ')
+    if faces.size != 3 * len(face_lines):
+        raise ValueError(f'{path} contains non-triangle faces')
+    faces = faces.reshape(-1, 3)
+    # Negative indices are relative to the end of the vertex list
+    faces = np.where(faces < 0, faces + len(vertices), faces - 1)
+    return vertices.astype(np.float32), faces
+
+
+def read_glb(path: str) -> Tuple[Array, Array]:
+    ''' Reads the first primitive of a binary glTF file '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, _, _ = GLB_HEADER.unpack_from(data, 0)
+    if magic != GLB_MAGIC:
+        raise ValueError(f'{path} is not a GLB file')
+
+    offset = GLB_HEADER.size
+    chunks = {}
+    while offset < len(data):
+        length, chunk_type = GLB_CHUNK_HEADER.unpack_from(data, offset)
+        offset += GLB_CHUNK_HEADER.size
+        chunks[chunk_type] = data[offset:offset + length]
+        offset += length
+    gltf = json.loads(chunks[GLB_JSON_CHUNK])
+    buffer = chunks[GLB_BIN_CHUNK]
+
+    dtypes = {GL_FLOAT: '<f4', GL_UNSIGNED_INT: '<u4', 5123: '<u2',
+              5121: 'u1'}
+    sizes = {'SCALAR': 1, 'VEC3': 3}
+
+    def accessor(idx):
+        spec = gltf['accessors'][idx]
+        view = gltf['bufferViews'][spec['bufferView']]
+        start = view.get('byteOffset', 0) + spec.get('byteOffset', 0)
+        array = np.frombuffer(
+            buffer, dtype=dtypes[spec['componentType']],
+            count=spec['count'] * sizes[spec['type']], offset=start)
+        return array.reshape(spec['count'], sizes[spec['type']])
+
+    primitive = gltf['meshes'][0]['primitives'][0]
+    vertices = accessor(primitive['attributes']['POSITION'])
+    faces = accessor(primitive['indices']).reshape(-1, 3)
+    return vertices.astype(np.float32), faces.astype(np.int64)
+
+
+MESH_WRITERS = {'ply': write_ply, 'obj': write_obj, 'glb': write_glb}
+MESH_READERS = {'ply': read_ply, 'obj': read_obj, 'glb': read_glb}
+
+
+def write_mesh(path: str, vertices: Array, faces) -> None:
+    ''' Writes a mesh in the format given by the extension of the path
+
+        Parameters
+        ----------
+            path: str
+                A `.ply`, `.obj` or `.glb` file
+            vertices: np.ndarray, Vx3
+                The vertices of the mesh
+            faces: np.ndarray or MeshTopology, Fx3
+                The triangles, whose encoded blocks are cached
+    '''
+    MESH_WRITERS[mesh_format(path)](path, vertices, faces)
+
+
+def read_mesh(path: str) -> Tuple[Array, Array]:
+    ''' Reads the vertices and the triangles of a `.ply`, `.obj` or `.glb` '''
+    return MESH_READERS[mesh_format(path)](path)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import NewType
+
+import numpy as np
+import torch
+
+Tensor = NewType('Tensor', torch.Tensor)
+Array = NewType('Array', np.ndarray)
+
+
+def build_vertex_face_adjacency(faces: Array, num_vertices: int) -> Array:
+    ''' Returns a VxK array with the face corners of each vertex
+
+        Corner `3 * f + k` is the k-th vertex of face f. Rows are padded with
+        the index 3F, i.e. the number of corners, so that the array can be
+        used to gather from per-corner values with an extra zero row appended.
+    '''
+    vertex_ids = faces.reshape(-1)
+    num_corners = len(vertex_ids)
+
+    order = np.argsort(vertex_ids, kind='stable')
+    sorted_vertex_ids = vertex_ids[order]
+    counts = np.bincount(vertex_ids, minlength=num_vertices)
+    starts = np.cumsum(counts) - counts
+    slots = np.arange(num_corners) - starts[sorted_vertex_ids]
+
+    adjacency = np.full([num_vertices, counts.max()], num_corners,
+                        dtype=np.int64)
+    adjacency[sorted_vertex_ids, slots] = order
+    return adjacency
+
+
+class VertexNormals(object):
+    ''' Angle weighted vertex normals for a fixed topology
+
+        Matches the smooth normals that `pyrender.Mesh.from_trimesh` uses.
+        The vertex-to-face adjacency is computed once and the intermediate
+        buffers are reused between calls, so the normals of a new set of
+        vertices are computed with a few vectorized operations.
+    '''
+
+    def __init__(self, faces: Array, num_vertices: int) -> None:
+        super(VertexNormals, self).__init__()
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.num_vertices = num_vertices
+        self.adjacency = build_vertex_face_adjacency(
+            self.faces, num_vertices)
+
+        num_corners = self.faces.size
+        # The last row stays zero and is gathered by the padded entries
+        self.corner_normals = np.zeros([num_corners + 1, 3],
+                                       dtype=np.float32)
+        self.gathered = np.empty(
+            self.adjacency.shape + (3,), dtype=np.float32)
+        self.normals = np.empty([num_vertices, 3], dtype=np.float32)
+
+    def __call__(self, vertices: Array) -> Array:
+        triangles = vertices[self.faces]
+        # The edges leaving each corner of the triangles
+        edges_out = np.roll(triangles, -1, axis=1) - triangles
+        edges_in = np.roll(triangles, 1, axis=1) - triangles
+        edges_out /= np.maximum(
+            np.linalg.norm(edges_out, axis=-1, keepdims=True), 1e-12)
+        edges_in /= np.maximum(
+            np.linalg.norm(edges_in, axis=-1, keepdims=True), 1e-12)
+        angles = np.arccos(np.clip(
+            np.sum(edges_out * edges_in, axis=-1), -1, 1))
+
+        face_normals = np.cross(edges_out[:, 0], edges_in[:, 0])
+        face_normals /= np.maximum(
+            np.linalg.norm(face_normals, axis=-1, keepdims=True), 1e-12)
+
+        self.corner_normals[:-1] = (
+            face_normals[:, np.newaxis] * angles[..., np.newaxis]).reshape(
+                -1, 3)
+        np.take(self.corner_normals, self.adjacency, axis=0,
+                out=self.gathered)
+        np.sum(self.gathered, axis=1, out=self.normals)
+        norm = np.linalg.norm(self.normals, axis=1, keepdims=True)
+        np.divide(self.normals, np.maximum(norm, 1e-12), out=self.normals)
+        return self.normals
+
+
+def compute_vertex_normals(
+        vertices: Tensor,
+        faces: Tensor,
+        adjacency: Tensor) -> Tensor:
+    ''' Batched angle weighted vertex normals
+
+        Parameters
+        ----------
+            vertices: torch.Tensor
+                A BxVx3 tensor with the vertices of the meshes
+            faces: torch.Tensor
+                The Fx3 faces shared by all meshes
+            adjacency: torch.Tensor
+                The output of `build_vertex_face_adjacency` for the faces
+        Returns
+        -------
+            normals: torch.Tensor
+                A BxVx3 tensor with the unit vertex normals
+    '''
+    batch_size = vertices.shape[0]
+    triangles = vertices[:, faces]
+    edges_out = torch.roll(triangles, -1, dims=2) - triangles
+    edges_in = torch.roll(triangles, 1, dims=2) - triangles
+    edges_out = edges_out / edges_out.norm(dim=-1, keepdim=True).clamp(
+        min=1e-12)
+    edges_in = edges_in / edges_in.norm(dim=-1, keepdim=True).clamp(
+        min=1e-12)
+    angles = torch.acos(
+        (edges_out * edges_in).sum(dim=-1).clamp(-1, 1))
+
+    face_normals = torch.cross(edges_out[:, :, 0], edges_in[:, :, 0], dim=-1)
+    face_normals = face_normals / face_normals.norm(
+        dim=-1, keepdim=True).clamp(min=1e-12)
+
+    corner_normals = (face_normals.unsqueeze(dim=2) *
+                      angles.unsqueeze(dim=-1)).reshape(batch_size, -1, 3)
+    # Append the zero row gathered by the padded adjacency entries
+    corner_normals = torch.cat(
+        [corner_normals, corner_normals.new_zeros([batch_size, 1, 3])],
+        dim=1)
+    normals = corner_normals[:, adjacency].sum(dim=2)
+    return normals / normals.norm(dim=-1, keepdim=True).clamp(min=1e-12)
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Any, Dict, Iterator, List, Optional
+import os
+import os.path as osp
+import glob
+import json
+
+import numpy as np
+
+from loguru import logger
+
+from .async_writer import fsync_path
+from .typing_utils import Array
+
+PARAM_STORE_VERSION = 1
+# The description of the columns, the number of committed rows is the
+# commit point of the store
+PARAM_STORE_META = 'store.json'
+# The values of the per-person npz files that are shared by all the people
+CONSTANT_KEYS = ('faces',)
+
+
+def is_string_array(array: Array) -> bool:
+    return array.dtype.kind in 'USO'
+
+
+class ParamStoreWriter(object):
+    ''' Appends the parameters of the demo outputs to a columnar store
+
+        The store is a folder with one binary file per column, holding the
+        rows back to back, so a column of N rows is a single NxD array.
+        String columns, e.g. the names of the frames, are stored as UTF-8
+        bytes with the end offset of every row. Values shared by all the
+        rows, like the faces of the mesh, are stored once as constants.
+
+        Appended rows are committed by `flush`, which syncs the columns
+        and then atomically replaces `store.json` with the new number of
+        rows. Bytes written after the last commit, e.g. by a crashed
+        process, are ignored by the readers and truncated when the store
+        is opened again for appending.
+
+        Parameters
+        ----------
+            path: str
+                The folder of the store, created if it does not exist
+            metadata: dict, optional
+                JSON serializable values stored with the columns
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        super(ParamStoreWriter, self).__init__()
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = osp.join(path, PARAM_STORE_META)
+        if osp.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'version': PARAM_STORE_VERSION, 'num_rows': 0,
+                         'columns': {}, 'constants': [], 'metadata': {}}
+        self.meta['metadata'].update(metadata or {})
+
+        self.num_rows = self.meta['num_rows']
+        self.files = {}
+        self.sizes = {}
+        for name, spec in self.meta['columns'].items():
+            self._open_column(name, spec)
+
+    def _column_files(self, name: str, spec: Dict) -> List[str]:
+        files = [osp.join(self.path, f'{name}.bin')]
+        if spec['kind'] == 'string':
+            files.append(osp.join(self.path, f'{name}.idx'))
+        return files
+
+    def _committed_sizes(self, name: str, spec: Dict) -> List[int]:
+        if spec['kind'] == 'string':
+            if self.num_rows < 1:
+                return [0, 0]
+            offsets = np.fromfile(
+                osp.join(self.path, f'{name}.idx'), dtype=np.int64,
+                count=self.num_rows)
+            return [int(offsets[-1]), self.num_rows * 8]
+        row_size = int(np.prod(spec['shape'], dtype=np.int64)) * (
+            np.dtype(spec['dtype']).itemsize)
+        return [self.num_rows * row_size]
+
+    def _open_column(self, name: str, spec: Dict) -> None:
+        files = []
+        for path, size in zip(self._column_files(name, spec),
+                              self._committed_sizes(name, spec)):
+            if osp.exists(path) and osp.getsize(path) > size:
+                # Drop the rows that were written after the last commit
+                os.truncate(path, size)
+            files.append(open(path, 'ab'))
+        self.files[name] = files
+        if spec['kind'] == 'string':
+            self.sizes[name] = self._committed_sizes(name, spec)[0]
+
+    def _add_column(self, name: str, value: Array) -> None:
+        if self.num_rows > 0:
+            raise ValueError(
+                f'Cannot add the column {name} to a store with rows')
+        if is_string_array(value):
+            spec = {'kind': 'string'}
+        else:
+            spec = {'kind': 'array', 'dtype': value.dtype.name,
+                    'shape': list(value.shape[1:])}
+        self.meta['columns'][name] = spec
+        self._open_column(name, spec)
+
+    def append(self, rows: Dict[str, Array]) -> int:
+        ''' Appends a batch of rows
+
+            Parameters
+            ----------
+                rows: dict
+                    Arrays with one row per entry along the first axis. The
+                    first batch defines the columns, all the later batches
+                    must contain the same keys and row shapes.
+
+            Returns
+            -------
+                num_rows: int
+                    The number of appended rows
+        '''
+        rows = {key: np.asarray(val) for key, val in rows.items()}
+        num_rows = {len(val) for val in rows.values()}
+        if len(num_rows) != 1:
+            raise ValueError(
+                f'The columns have different numbers of rows: {num_rows}')
+        num_rows = num_rows.pop()
+
+        if len(self.meta['columns']) < 1:
+            for key, val in rows.items():
+                self._add_column(key, val)
+        if set(rows) != set(self.meta['columns']):
+            raise ValueError(
+                f'Expected the columns {sorted(self.meta["columns"])},'
+                f' got {sorted(rows)}')
+
+        for key, val in rows.items():
+            spec = self.meta['columns'][key]
+            if spec['kind'] == 'string':
+                data = [str(item).encode('utf-8') for item in val]
+                lengths = np.array([len(item) for item in data],
+                                   dtype=np.int64)
+                offsets = self.sizes[key] + np.cumsum(lengths)
+                self.files[key][0].write(b''.join(data))
+                self.files[key][1].write(offsets.tobytes())
+                if len(offsets) > 0:
+                    self.sizes[key] = int(offsets[-1])
+                continue
+            if list(val.shape[1:]) != spec['shape']:
+                raise ValueError(
+                    f'Expected rows of shape {spec["shape"]} for {key},'
+                    f' got {list(val.shape[1:])}')
+            val = np.ascontiguousarray(val, dtype=spec['dtype'])
+            self.files[key][0].write(val.tobytes())
+
+        self.num_rows += num_rows
+        return num_rows
+
+    def set_constant(self, name: str, value: Array) -> None:
+        ''' Stores a value shared by all the rows, e.g. the faces '''
+        value = np.asarray(value)
+        path = osp.join(self.path, f'{name}.npy')
+        if name in self.meta['constants']:
+            if not np.array_equal(np.load(path), value):
+                raise ValueError(f'The constant {name} has changed')
+            return
+        np.save(path, value)
+        self.meta['constants'].append(name)
+
+    def flush(self) -> None:
+        ''' Commits the appended rows '''
+        for files in self.files.values():
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.meta['num_rows'] = self.num_rows
+        meta_path = osp.join(self.path, PARAM_STORE_META)
+        tmp_path = f'{meta_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, meta_path)
+        fsync_path(self.path)
+
+    def close(self) -> None:
+        if self.files is None:
+            return
+        self.flush()
+        for files in self.files.values():
+            for f in files:
+                f.close()
+        self.files = None
+        logger.info(f'Stored {self.num_rows} rows in {self.path}')
+
+    def __enter__(self) -> 'ParamStoreWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ParamStore(object):
+    ''' Random access to the rows of a parameter store
+
+        The columns are memory-mapped when they are first used, so reading
+        a few rows only touches the pages that hold them.
+
+        Parameters
+        ----------
+            path: str
+                The folder of the store
+    '''
+
+    def __init__(self, path: str) -> None:
+        super(ParamStore, self).__init__()
+        self.path = path
+        with open(osp.join(path, PARAM_STORE_META), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] > PARAM_STORE_VERSION:
+            raise ValueError(
+                f'Unsupported parameter store version: {self.meta["version"]}')
+        self.num_rows = self.meta['num_rows']
+        self.metadata = self.meta['metadata']
+        self.arrays = {}
+        self.constants = {}
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.meta['columns'])
+
+    def _map(self, path: str, dtype, shape) -> Array:
+        if self.num_rows < 1:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+
+    def column(self, name: str) -> Array:
+        ''' Returns a column as an array with one row per entry
+
+            Array columns are read-only memory maps, string columns are
+            decoded to an array of str.
+        '''
+        spec = self.meta['columns'][name]
+        if name in self.arrays:
+            return self.arrays[name]
+        if spec['kind'] == 'string':
+            offsets = self._map(osp.join(self.path, f'{name}.idx'),
+                                np.int64, [self.num_rows])
+            data = np.fromfile(osp.join(self.path, f'{name}.bin'),
+                               dtype=np.uint8,
+                               count=int(offsets[-1]) if len(offsets) else 0)
+            starts = np.concatenate([[0], offsets[:-1]])
+            array = np.array([data[start:end].tobytes().decode('utf-8')
+                              for start, end in zip(starts, offsets)])
+        else:
+            array = self._map(osp.join(self.path, f'{name}.bin'),
+                              spec['dtype'], [self.num_rows] + spec['shape'])
+        self.arrays[name] = array
+        return array
+
+    def constant(self, name: str) -> Array:
+        if name not in self.constants:
+            self.constants[name] = np.load(
+                osp.join(self.path, f'{name}.npy'))
+        return self.constants[name]
+
+    def rows(self, idxs, columns: Optional[List[str]] = None) -> Dict:
+        ''' Returns the values of the selected rows for each column '''
+        columns = self.columns if columns is None else columns
+        return {name: np.asarray(self.column(name)[idxs])
+                for name in columns}
+
+    def __getitem__(self, idx: int) -> Dict[str, Array]:
+        if idx < 0:
+            idx += self.num_rows
+        if idx < 0 or idx >= self.num_rows:
+            raise IndexError(f'Row {idx} is out of range')
+        return self.rows(idx)
+
+    def __iter__(self) -> Iterator[Dict[str, Array]]:
+        for idx in range(self.num_rows):
+            yield self[idx]
+
+    def find(self, column: str, value) -> Array:
+        ''' Returns the indices of the rows whose column equals `value` '''
+        return np.flatnonzero(self.column(column) == value)
+
+
+def merge_stores(
+    paths: List[str],
+    store_path: str,
+    batch_size: int = 1024,
+) -> int:
+    ''' Appends the rows of several stores to one store, in the given order
+
+        All the stores must have the same columns and constants, e.g. the
+        stores of the shards of a demo run.
+
+        Returns
+        -------
+            num_rows: int
+                The number of appended rows
+    '''
+    num_rows = 0
+    with ParamStoreWriter(store_path) as writer:
+        for path in paths:
+            store = ParamStore(path)
+            writer.meta['metadata'].update(store.metadata)
+            for name in store.meta['constants']:
+                writer.set_constant(name, store.constant(name))
+            for start in range(0, len(store), batch_size):
+                num_rows += writer.append(store.rows(
+                    slice(start, start + batch_size)))
+            writer.flush()
+    logger.info(f'Merged {len(paths)} stores into {store_path}')
+    return num_rows
+
+
+def convert_npz_tree(
+    folder: str,
+    store_path: str,
+    batch_size: int = 1024,
+) -> int:
+    ''' Converts the per-person npz files of a demo output folder
+
+        Every `*_params.npz` file under `folder` becomes a row of the store,
+        in the sorted order of the paths. The `faces` are stored once.
+
+        Returns
+        -------
+            num_rows: int
+                The number of converted files
+    '''
+    paths = sorted(glob.glob(
+        osp.join(folder, '**', '*_params.npz'), recursive=True))
+    logger.info(f'Converting {len(paths)} parameter files from {folder}')
+
+    num_rows = 0
+    with ParamStoreWriter(store_path, metadata={'source': folder}) as writer:
+        for start in range(0, len(paths), batch_size):
+            batch = {}
+            for path in paths[start:start + batch_size]:
+                with np.load(path) as data:
+                    for key in data.files:
+                        if key in CONSTANT_KEYS:
+                            writer.set_constant(key, data[key])
+                        else:
+                            batch.setdefault(key, []).append(data[key])
+            num_rows += writer.append(
+                {key: np.stack(val) for key, val in batch.items()})
+            writer.flush()
+    return num_rows
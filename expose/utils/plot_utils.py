@@ -28,6 +28,9 @@ import pyrender
 from loguru import logger
 import cv2
 
+from .img_utils import alpha_composite_uint8
+from .mesh_utils import VertexNormals
+
 
 Tensor = NewType('Tensor', torch.Tensor)
 Array = NewType('Array', np.ndarray)
@@ -762,6 +765,7 @@ class HDRenderer(OverlayRenderer):
                  deg: float = 0,
                  return_with_alpha: bool = False,
                  body_color: List[float] = None,
+                 uint8: bool = False,
                  **kwargs):
         '''
             Parameters
@@ -789,6 +793,10 @@ class HDRenderer(OverlayRenderer):
                 Default value is False.
             body_color: list, optional
                 The color used to render the image.
+            uint8: bool, optional
+                When True, `bg_imgs` are BxHxWx3 uint8 images and the
+                output is a BxHxWxC uint8 array composited with the alpha
+                of the rendering, without float intermediates.
         '''
         if torch.is_tensor(vertices):
             vertices = vertices.detach().cpu().numpy()
@@ -807,7 +815,10 @@ class HDRenderer(OverlayRenderer):
             if body_color is None:
                 body_color = COLORS['N']
 
-            _, H, W = bg_imgs[bidx].shape
+            if uint8:
+                H, W = bg_imgs[bidx].shape[:2]
+            else:
+                _, H, W = bg_imgs[bidx].shape
             # Update the renderer's viewport
             self.renderer.viewport_height = H
             self.renderer.viewport_width = W
@@ -823,6 +834,14 @@ class HDRenderer(OverlayRenderer):
             flags = (pyrender.RenderFlags.RGBA |
                      pyrender.RenderFlags.SKIP_CULL_FACES)
             color, depth = self.renderer.render(self.scene, flags=flags)
+            if uint8:
+                if render_bg:
+                    color = alpha_composite_uint8(
+                        bg_imgs[bidx], color, with_alpha=return_with_alpha)
+                elif not return_with_alpha:
+                    color = color[..., :3]
+                output_imgs.append(color)
+                continue
             color = np.transpose(color, [2, 0, 1]).astype(np.float32) / 255.0
             color = np.clip(color, 0, 1)
 
@@ -853,3 +872,209 @@ class HDRenderer(OverlayRenderer):
                 else:
                     output_imgs.append(color[:-1])
         return np.stack(output_imgs, axis=0)
+
+
+class BatchedHDRenderer(HDRenderer):
+    ''' HDRenderer that keeps a persistent scene between calls
+
+        The scene holds a single mesh node and a single camera node, which
+        are updated in place instead of being removed and re-created for
+        every item. The vertices are copied into a reusable host buffer and
+        the normals are computed with `VertexNormals`, so no trimesh object
+        is built. Rotations around the body are applied through the pose of
+        the mesh node, which lets all the requested view angles of an item
+        be rendered from a single upload of its vertices.
+    '''
+
+    def __init__(self, **kwargs):
+        super(BatchedHDRenderer, self).__init__(**kwargs)
+        self.camera = pyrender.IntrinsicsCamera(
+            fx=5000, fy=5000, cx=self.img_size * 0.5,
+            cy=self.img_size * 0.5)
+        self.camera_node = self.scene.add(
+            self.camera, pose=np.eye(4), name='camera')
+        self.mesh_node = None
+
+        self.flip = self.transf(np.radians(180), [1, 0, 0])
+        self.normals = None
+        self.positions = None
+        self.materials = {}
+
+    def _get_material(self, body_color):
+        key = tuple(body_color)
+        if key not in self.materials:
+            color = list(body_color) + [1.0] * (4 - len(body_color))
+            self.materials[key] = self.mat_constructor(
+                metallicFactor=0.0, alphaMode='BLEND',
+                baseColorFactor=color)
+        return self.materials[key]
+
+    def update_camera(self, focal_length, translation, center):
+        self.camera.fx = focal_length
+        self.camera.fy = focal_length
+        self.camera.cx = center[0]
+        self.camera.cy = center[1]
+
+        camera_pose = np.eye(4)
+        camera_pose[:3, 3] = translation
+        camera_pose[0, 3] *= (-1)
+        self.scene.set_pose(self.camera_node, camera_pose)
+
+    def update_mesh(self, vertices, faces, body_color=(1.0, 1.0, 1.0, 1.0),
+                    deg=0):
+        num_vertices = len(vertices)
+        if (self.normals is None or
+                self.normals.num_vertices != num_vertices or
+                self.normals.faces.shape != faces.shape or
+                not np.array_equal(self.normals.faces, faces)):
+            self.normals = VertexNormals(faces, num_vertices)
+            self.positions = np.empty([num_vertices, 3], dtype=np.float32)
+            self.indices = np.ascontiguousarray(faces, dtype=np.uint32)
+
+        np.copyto(self.positions, vertices, casting='unsafe')
+        primitive = pyrender.Primitive(
+            positions=self.positions,
+            normals=self.normals(self.positions),
+            indices=self.indices,
+            material=self._get_material(body_color),
+            mode=pyrender.constants.GLTF.TRIANGLES)
+        # The renderer uploads the new buffers and releases the previous
+        # ones, since the mesh of the node changed
+        mesh = pyrender.Mesh([primitive])
+        if self.mesh_node is None:
+            self.mesh_node = self.scene.add(mesh, name='body_mesh')
+        else:
+            self.mesh_node.mesh = mesh
+        self.set_view(deg)
+
+    def set_view(self, deg=0):
+        ''' Rotates the mesh around the vertical axis through its center '''
+        pose = self.flip
+        if deg != 0:
+            rot = self.transf(
+                np.radians(deg), [0, 1, 0],
+                point=self.positions.mean(axis=0))
+            pose = self.flip @ rot
+        self.scene.set_pose(self.mesh_node, pose)
+
+    @torch.no_grad()
+    def render_views(self,
+                     vertices: Tensor,
+                     faces: Union[Tensor, Array],
+                     focal_length: Union[Tensor, Array],
+                     camera_translation: Union[Tensor, Array],
+                     camera_center: Union[Tensor, Array],
+                     bg_imgs: Array,
+                     degrees: List[float] = (0,),
+                     render_bg: Union[bool, List[bool]] = True,
+                     return_with_alpha: bool = False,
+                     body_color: List[float] = None,
+                     uint8: bool = False,
+                     **kwargs) -> Array:
+        ''' Renders every item of the batch from all the requested angles
+
+            Parameters
+            ----------
+            degrees: list of float
+                The rotations around the vertical axis of the body
+            render_bg: bool or list of bool
+                Whether to overlay the rendering on the background, either
+                for all views or separately for each one
+
+            The remaining arguments are the same as `HDRenderer.__call__`.
+
+            Returns
+            -------
+            images: np.ndarray
+                An array of size len(degrees) x B x C x H x W, or a uint8
+                array of size len(degrees) x B x H x W x C with `uint8`
+        '''
+        if torch.is_tensor(vertices):
+            vertices = vertices.detach().cpu().numpy()
+        if torch.is_tensor(faces):
+            faces = faces.detach().cpu().numpy()
+        if torch.is_tensor(focal_length):
+            focal_length = focal_length.detach().cpu().numpy()
+        if torch.is_tensor(camera_translation):
+            camera_translation = camera_translation.detach().cpu().numpy()
+        if torch.is_tensor(camera_center):
+            camera_center = camera_center.detach().cpu().numpy()
+        if body_color is None:
+            body_color = COLORS['N']
+        if isinstance(render_bg, bool):
+            render_bg = [render_bg] * len(degrees)
+
+        batch_size = vertices.shape[0]
+        flags = (pyrender.RenderFlags.RGBA |
+                 pyrender.RenderFlags.SKIP_CULL_FACES)
+
+        output_imgs = [[] for _ in degrees]
+        for bidx in range(batch_size):
+            if uint8:
+                H, W = bg_imgs[bidx].shape[:2]
+            else:
+                _, H, W = bg_imgs[bidx].shape
+            if (self.renderer.viewport_height != H or
+                    self.renderer.viewport_width != W):
+                self.renderer.viewport_height = H
+                self.renderer.viewport_width = W
+
+            self.update_camera(
+                focal_length=focal_length[bidx],
+                translation=camera_translation[bidx],
+                center=camera_center[bidx],
+            )
+            self.update_mesh(vertices[bidx], faces, body_color=body_color)
+
+            curr_bg_img = bg_imgs[bidx]
+            if not uint8 and return_with_alpha and curr_bg_img.shape[0] < 4:
+                curr_bg_img = np.concatenate(
+                    [curr_bg_img, np.ones_like(curr_bg_img[[0]])], axis=0)
+
+            for view_idx, (deg, use_bg) in enumerate(zip(degrees, render_bg)):
+                self.set_view(deg)
+                color, _ = self.renderer.render(self.scene, flags=flags)
+                if uint8:
+                    if use_bg:
+                        color = alpha_composite_uint8(
+                            curr_bg_img, color, with_alpha=return_with_alpha)
+                    elif not return_with_alpha:
+                        color = color[..., :3]
+                    output_imgs[view_idx].append(color)
+                    continue
+                color = np.transpose(color, [2, 0, 1]).astype(
+                    np.float32) / 255.0
+
+                if use_bg:
+                    valid_mask = (color[3] > 0)[np.newaxis]
+                    if not return_with_alpha:
+                        color = color[:-1]
+                    color = np.clip(
+                        color * valid_mask + (1 - valid_mask) * curr_bg_img,
+                        0, 1)
+                elif not return_with_alpha:
+                    color = color[:-1]
+                output_imgs[view_idx].append(color)
+        return np.stack([np.stack(imgs, axis=0) for imgs in output_imgs],
+                        axis=0)
+
+    @torch.no_grad()
+    def __call__(self,
+                 vertices: Tensor,
+                 faces: Union[Tensor, Array],
+                 focal_length: Union[Tensor, Array],
+                 camera_translation: Union[Tensor, Array],
+                 camera_center: Union[Tensor, Array],
+                 bg_imgs: Array,
+                 render_bg: bool = True,
+                 deg: float = 0,
+                 return_with_alpha: bool = False,
+                 body_color: List[float] = None,
+                 uint8: bool = False,
+                 **kwargs):
+        return self.render_views(
+            vertices, faces, focal_length=focal_length,
+            camera_translation=camera_translation,
+            camera_center=camera_center, bg_imgs=bg_imgs, degrees=[deg],
+            render_bg=render_bg, return_with_alpha=return_with_alpha,
+            body_color=body_color, uint8=uint8)[0]
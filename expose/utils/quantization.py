@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import Callable, Dict, List, Tuple
+import copy
+
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+from .device_utils import BackboneWrapper
+
+QUANTIZATION_BACKENDS = ('x86', 'fbgemm', 'qnnpack', 'onednn')
+
+
+class QuantizedBackbone(nn.Module):
+    ''' An int8 feature extractor with the interface of the original one
+
+        The quantized graph takes and returns float32 tensors, the
+        activations are quantized at the input and dequantized at every
+        output, so the attention heads are unaffected.
+    '''
+
+    def __init__(
+        self,
+        backbone: nn.Module,
+        output_dim: Dict[str, int],
+        backend: str = 'x86',
+    ) -> None:
+        super(QuantizedBackbone, self).__init__()
+        self.backbone = backbone
+        self.output_dim = output_dim
+        self.backend = backend
+
+    def extra_repr(self) -> str:
+        return f'Backend: {self.backend}'
+
+    def get_output_dim(self):
+        return self.output_dim
+
+    def forward(self, x):
+        return self.backbone(x.contiguous())
+
+
+def find_backbones(model: nn.Module) -> List[Tuple[str, nn.Module]]:
+    ''' Returns the modules that own a `backbone` feature extractor '''
+    return [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(getattr(module, 'backbone', None), nn.Module) and
+        not isinstance(module, (BackboneWrapper, QuantizedBackbone))]
+
+
+def prepare_backbones(
+    model: nn.Module,
+    backend: str = 'x86',
+    img_size: int = 256,
+) -> List[str]:
+    ''' Inserts the calibration observers in the body, hand and head backbones
+
+        Every `FrozenBatchNorm2d` is converted to an equivalent `BatchNorm2d`,
+        which the FX fusion pass folds, together with the following ReLU,
+        into the weights of the preceding convolution. The model must be on
+        the CPU and in evaluation mode, and the checkpoint must already be
+        loaded. After running the model on the calibration images, call
+        `convert_backbones` to obtain the int8 modules.
+
+        Returns
+        -------
+            names: list
+                The names of the modules whose backbone was prepared
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    from expose.models.common.networks import FrozenBatchNorm2d
+
+    if backend not in QUANTIZATION_BACKENDS:
+        raise ValueError(f'Unknown quantization backend: {backend}')
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    example_inputs = (torch.zeros([1, 3, img_size, img_size]),)
+
+    prepared = []
+    for name, module in find_backbones(model):
+        backbone = module.backbone
+        if isinstance(backbone, BackboneWrapper):
+            # The int8 kernels replace the channels last and bf16 settings
+            backbone = backbone.backbone
+        output_dim = backbone.get_output_dim()
+        backbone = FrozenBatchNorm2d.convert_to_batchnorm(
+            copy.deepcopy(backbone)).eval()
+        try:
+            observed = prepare_fx(backbone, qconfig_mapping, example_inputs)
+        except Exception as e:
+            logger.warning(
+                f'Could not trace the backbone of {name or "model"},'
+                f' keeping it in float32: {e}')
+            continue
+        module.backbone = QuantizedBackbone(
+            observed, output_dim, backend=backend)
+        prepared.append(name)
+    logger.info(f'Prepared {len(prepared)} backbones for calibration')
+    return prepared
+
+
+def convert_backbones(model: nn.Module) -> int:
+    ''' Replaces the calibrated backbones with their int8 versions '''
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    num_converted = 0
+    for module in model.modules():
+        backbone = getattr(module, 'backbone', None)
+        if not isinstance(backbone, QuantizedBackbone):
+            continue
+        backbone.backbone = convert_fx(backbone.backbone)
+        num_converted += 1
+    logger.info(f'Converted {num_converted} backbones to int8')
+    return num_converted
+
+
+@torch.no_grad()
+def quantize_backbones(
+    model: nn.Module,
+    calibrate: Callable[[nn.Module], None],
+    backend: str = 'x86',
+    img_size: int = 256,
+) -> nn.Module:
+    ''' Post-training static quantization of the backbones of a model
+
+        Parameters
+        ----------
+            model: nn.Module
+                The float model, it is left unchanged
+            calibrate: callable
+                Runs the given model on the calibration data. The observers
+                record the activation ranges of the crops that actually reach
+                each backbone, including the hand and head crops.
+            backend: str
+                The quantized engine, `x86` or `fbgemm` on servers, `qnnpack`
+                on ARM
+        Returns
+        -------
+            model: nn.Module
+                A copy of the model with int8 backbones
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    prepare_backbones(model, backend=backend, img_size=img_size)
+    calibrate(model)
+    convert_backbones(model)
+    return model
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import List, NewType, Optional, Tuple, Union
+import math
+
+import numpy as np
+import torch
+
+from .mesh_utils import build_vertex_face_adjacency, compute_vertex_normals
+
+Tensor = NewType('Tensor', torch.Tensor)
+Array = NewType('Array', np.ndarray)
+
+DEFAULT_BODY_COLOR = [1.0, 1.0, 0.9]
+
+
+def create_raymond_light_dirs() -> Array:
+    ''' The directions towards the three lights used by the pyrender scenes
+    '''
+    thetas = np.pi * np.array([1.0 / 6.0, 1.0 / 6.0, 1.0 / 6.0])
+    phis = np.pi * np.array([0.0, 2.0 / 3.0, 4.0 / 3.0])
+
+    light_dirs = np.stack([
+        np.sin(thetas) * np.cos(phis),
+        np.sin(thetas) * np.sin(phis),
+        np.cos(thetas)], axis=1)
+    return light_dirs / np.linalg.norm(light_dirs, axis=1, keepdims=True)
+
+
+class SoftwareRenderer(object):
+    ''' A vectorized z-buffer rasterizer that needs no OpenGL context
+
+        The renderer reproduces the camera model and lighting of
+        `HDRenderer`: the meshes are flipped around the x-axis, projected
+        with a perspective camera and shaded with the Lambertian term of the
+        three directional Raymond lights, followed by the same display gamma
+        as the pyrender shader. The specular term of pyrender's material is
+        not modeled.
+
+        All the bodies of a batch are rasterized together. For every face
+        the pixels inside its bounding box are enumerated, and the closest
+        face per pixel is selected with a single `scatter_reduce` over keys
+        that pack the depth and the face index. The pairs are processed in
+        chunks of at most `max_pairs` elements to bound the memory.
+
+        Parameters
+        ----------
+            img_size: int
+                Unused, kept for compatibility with the pyrender renderers
+            max_pairs: int
+                The maximum number of face-pixel pairs processed at once
+            znear: float
+                Faces closer to the camera than this are discarded
+            device: torch.device, optional
+                The device used for rasterization, defaults to the device of
+                the vertices
+    '''
+
+    def __init__(
+        self,
+        img_size: int = 224,
+        max_pairs: int = 1 << 22,
+        znear: float = 0.05,
+        device: Optional[torch.device] = None,
+        **kwargs
+    ) -> None:
+        super(SoftwareRenderer, self).__init__()
+        self.img_size = img_size
+        self.max_pairs = max_pairs
+        self.znear = znear
+        self.device = device
+        self.light_dirs = torch.from_numpy(
+            create_raymond_light_dirs().astype(np.float32))
+
+        self.faces = None
+        self.adjacency = None
+
+    def _update_topology(
+        self,
+        faces: Tensor,
+        num_vertices: int,
+        device: torch.device,
+    ) -> None:
+        if (self.faces is not None and self.faces.device == device and
+                self.adjacency.shape[0] == num_vertices and
+                self.faces.shape == faces.shape and
+                torch.equal(self.faces.cpu(), faces)):
+            return
+        self.adjacency = torch.from_numpy(build_vertex_face_adjacency(
+            faces.numpy(), num_vertices)).to(device=device)
+        self.faces = faces.to(device=device)
+
+    def project(
+        self,
+        vertices: Tensor,
+        focal_length: Tensor,
+        camera_translation: Tensor,
+        camera_center: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        ''' Projects the vertices to pixel coordinates
+
+            Returns
+            -------
+                points: torch.Tensor
+                    BxVx2 tensor with the pixel coordinates
+                depth: torch.Tensor
+                    BxV tensor with the distance along the optical axis
+        '''
+        # The flip around the x-axis of the pyrender scene and the mirrored
+        # x-translation of its camera pose cancel out, which leaves the
+        # usual projection of the translated vertices
+        cam_vertices = vertices + camera_translation.unsqueeze(dim=1)
+        depth = cam_vertices[..., 2]
+        inv_depth = 1.0 / depth.clamp(min=1e-8)
+        points = (focal_length.reshape(-1, 1, 1) *
+                  cam_vertices[..., :2] * inv_depth.unsqueeze(dim=-1) +
+                  camera_center.unsqueeze(dim=1))
+        return points, depth
+
+    @staticmethod
+    def plane_coefficients(
+        tri_points: Tensor,
+        tri_depth: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        ''' Per face affine functions of the pixel coordinates
+
+            Parameters
+            ----------
+                tri_points: torch.Tensor
+                    Nx3x2 tensor with the projected vertices of each face
+                tri_depth: torch.Tensor
+                    Nx3 tensor with the depth of the vertices of each face
+            Returns
+            -------
+                coeffs: torch.Tensor
+                    Nx3x3 tensor, row k holds (a, b, c) so that a * x + b * y
+                    + c is the barycentric coordinate of vertex k + 1 for
+                    k < 2 and the inverse depth for k = 2
+                valid: torch.Tensor
+                    N boolean tensor, False for degenerate faces
+        '''
+        v0, v1, v2 = tri_points.unbind(dim=1)
+        e1 = v1 - v0
+        e2 = v2 - v0
+        area = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]
+        valid = area.abs() > 1e-12
+        inv_area = torch.where(valid, 1.0 / area, torch.zeros_like(area))
+
+        a1 = e2[:, 1] * inv_area
+        b1 = -e2[:, 0] * inv_area
+        c1 = -(a1 * v0[:, 0] + b1 * v0[:, 1])
+        a2 = -e1[:, 1] * inv_area
+        b2 = e1[:, 0] * inv_area
+        c2 = -(a2 * v0[:, 0] + b2 * v0[:, 1])
+
+        inv_depth = 1.0 / tri_depth
+        d1 = inv_depth[:, 1] - inv_depth[:, 0]
+        d2 = inv_depth[:, 2] - inv_depth[:, 0]
+        coeffs = torch.stack([
+            torch.stack([a1, b1, c1], dim=1),
+            torch.stack([a2, b2, c2], dim=1),
+            torch.stack([d1 * a1 + d2 * a2, d1 * b1 + d2 * b2,
+                         inv_depth[:, 0] + d1 * c1 + d2 * c2], dim=1),
+        ], dim=1)
+        return coeffs, valid
+
+    def rasterize(
+        self,
+        tri_points: Tensor,
+        tri_depth: Tensor,
+        coeffs: Tensor,
+        valid: Tensor,
+        batch_size: int,
+        H: int,
+        W: int,
+    ) -> Tensor:
+        ''' Finds the closest face for every pixel
+
+            Returns
+            -------
+                face_idxs: torch.Tensor
+                    A B*H*W tensor with the index of the visible face in the
+                    flattened BxF faces, -1 for the background
+        '''
+        device = tri_points.device
+        dtype = tri_points.dtype
+        num_faces = self.faces.shape[0]
+
+        # The pixel centers are at half-integer coordinates
+        lower = torch.ceil(tri_points.amin(dim=1) - 0.5)
+        upper = torch.floor(tri_points.amax(dim=1) - 0.5)
+        col_start = lower[:, 0].clamp(0, W).long()
+        row_start = lower[:, 1].clamp(0, H).long()
+        num_cols = (upper[:, 0].clamp(-1, W - 1).long() -
+                    col_start + 1).clamp(min=0)
+        num_rows = (upper[:, 1].clamp(-1, H - 1).long() -
+                    row_start + 1).clamp(min=0)
+        counts = num_cols * num_rows * (
+            valid & (tri_depth.amin(dim=1) > self.znear))
+
+        face_ids = torch.nonzero(counts > 0).squeeze(dim=1)
+        counts = counts[face_ids]
+        offsets = torch.cumsum(counts, dim=0)
+        # Everything a face-pixel pair needs is expanded from two tensors
+        face_info = torch.stack(
+            [face_ids, col_start[face_ids], row_start[face_ids],
+             num_cols[face_ids], offsets - counts], dim=1)
+        coeffs = coeffs[face_ids].reshape(-1, 9)
+
+        # Keys pack the depth bits, which are monotonic for positive floats,
+        # with the face index, so the minimum key is the closest face
+        max_key = torch.iinfo(torch.int64).max
+        zbuffer = torch.full([batch_size * H * W], max_key,
+                             dtype=torch.int64, device=device)
+
+        total = int(offsets[-1]) if len(offsets) > 0 else 0
+        start, first = 0, 0
+        while start < total:
+            # Split the faces so that every chunk has at most max_pairs
+            # pairs, a single face larger than that is processed alone
+            last = int(torch.searchsorted(
+                offsets, torch.tensor(start + self.max_pairs, device=device),
+                right=True))
+            last = max(last, first + 1)
+            end = int(offsets[last - 1])
+
+            chunk_counts = counts[first:last]
+            info = face_info[first:last].repeat_interleave(
+                chunk_counts, dim=0, output_size=end - start)
+            local = torch.arange(start, end, device=device) - info[:, 4]
+            rows = torch.div(local, info[:, 3], rounding_mode='floor')
+            cols = local - rows * info[:, 3] + info[:, 1]
+            rows += info[:, 2]
+
+            # Evaluate the barycentric coordinates and the inverse depth at
+            # the pixel centers
+            pair_coeffs = coeffs[first:last].repeat_interleave(
+                chunk_counts, dim=0, output_size=end - start).reshape(
+                    -1, 3, 3)
+            x = cols.to(dtype=dtype).add_(0.5).unsqueeze(dim=1)
+            y = rows.to(dtype=dtype).add_(0.5).unsqueeze(dim=1)
+            values = torch.addcmul(
+                torch.addcmul(pair_coeffs[:, :, 2], pair_coeffs[:, :, 0], x),
+                pair_coeffs[:, :, 1], y)
+            inside = ((values[:, 0] >= 0) & (values[:, 1] >= 0) &
+                      (values[:, 0] + values[:, 1] <= 1))
+
+            global_faces = info[:, 0][inside]
+            depth_bits = (1.0 / values[inside, 2]).float().view(torch.int32)
+            keys = (depth_bits.long() << 32) | global_faces
+            pix_idxs = ((global_faces // num_faces) * H * W +
+                        rows[inside] * W + cols[inside])
+            zbuffer.scatter_reduce_(0, pix_idxs, keys, reduce='amin')
+            start, first = end, last
+
+        face_idxs = zbuffer & 0xFFFFFFFF
+        face_idxs[zbuffer == max_key] = -1
+        return face_idxs
+
+    def shade(
+        self,
+        face_idxs: Tensor,
+        coeffs: Tensor,
+        tri_depth: Tensor,
+        tri_normals: Tensor,
+        H: int,
+        W: int,
+        body_color: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        ''' Computes the color of the covered pixels
+
+            Returns
+            -------
+                covered: torch.Tensor
+                    The indices of the covered pixels in the B*H*W images
+                colors: torch.Tensor
+                    Nx3 tensor with the colors of the covered pixels
+        '''
+        covered = torch.nonzero(face_idxs >= 0).squeeze(dim=1)
+        faces = face_idxs[covered]
+
+        # The perspective correct normal is the ratio of an affine function
+        # of the pixel coordinates and the inverse depth, which cancels out
+        # after the normalization
+        scaled = tri_normals / tri_depth.unsqueeze(dim=-1)
+        d1 = scaled[:, 1] - scaled[:, 0]
+        d2 = scaled[:, 2] - scaled[:, 0]
+        normal_coeffs = torch.stack([
+            coeffs[:, 0, 0:1] * d1 + coeffs[:, 1, 0:1] * d2,
+            coeffs[:, 0, 1:2] * d1 + coeffs[:, 1, 1:2] * d2,
+            scaled[:, 0] + coeffs[:, 0, 2:3] * d1 + coeffs[:, 1, 2:3] * d2,
+        ], dim=1)[faces]
+
+        pix = covered % (H * W)
+        x = (pix % W).to(dtype=coeffs.dtype).add_(0.5).unsqueeze(dim=1)
+        y = torch.div(pix, W, rounding_mode='floor').to(
+            dtype=coeffs.dtype).add_(0.5).unsqueeze(dim=1)
+        normals = torch.addcmul(
+            torch.addcmul(normal_coeffs[:, 2], normal_coeffs[:, 0], x),
+            normal_coeffs[:, 1], y)
+        normals = normals / normals.norm(dim=-1, keepdim=True).clamp(
+            min=1e-12)
+        # Normals in the camera frame of the pyrender scene
+        normals = normals * normals.new_tensor([1.0, -1.0, -1.0])
+
+        light_dirs = self.light_dirs.to(
+            device=normals.device, dtype=normals.dtype)
+        irradiance = (normals @ light_dirs.t()).clamp(min=0).sum(dim=-1)
+        # The Lambertian term of the pyrender metallic-roughness material,
+        # followed by the display gamma of its shader
+        diffuse = body_color[:3] * (1 - 0.04) / math.pi
+        colors = (irradiance.unsqueeze(dim=-1) * diffuse).pow(
+            1.0 / 2.2).clamp(0, 1)
+        return covered, colors
+
+    @torch.no_grad()
+    def render_views(self,
+                     vertices: Tensor,
+                     faces: Union[Tensor, Array],
+                     focal_length: Union[Tensor, Array],
+                     camera_translation: Union[Tensor, Array],
+                     camera_center: Union[Tensor, Array],
+                     bg_imgs: Array,
+                     degrees: List[float] = (0,),
+                     render_bg: Union[bool, List[bool]] = True,
+                     return_with_alpha: bool = False,
+                     body_color: List[float] = None,
+                     uint8: bool = False,
+                     **kwargs) -> Array:
+        ''' Renders every item of the batch from all the requested angles
+
+            Same arguments as `BatchedHDRenderer.render_views`.
+
+            Returns
+            -------
+            images: np.ndarray
+                An array of size len(degrees) x B x C x H x W, or a uint8
+                array of size len(degrees) x B x H x W x C with `uint8`
+        '''
+        device = self.device
+        if device is None:
+            device = (vertices.device if torch.is_tensor(vertices) else
+                      torch.device('cpu'))
+        vertices = torch.as_tensor(
+            vertices, dtype=torch.float32, device=device)
+        if torch.is_tensor(faces):
+            faces = faces.detach().cpu()
+        faces = torch.as_tensor(np.asarray(faces), dtype=torch.long)
+        focal_length = torch.as_tensor(
+            focal_length, dtype=torch.float32, device=device).reshape(-1)
+        camera_translation = torch.as_tensor(
+            camera_translation, dtype=torch.float32, device=device)
+        camera_center = torch.as_tensor(
+            camera_center, dtype=torch.float32, device=device)
+        if body_color is None:
+            body_color = DEFAULT_BODY_COLOR
+        alpha = body_color[3] if len(body_color) > 3 else 1.0
+        body_color = torch.tensor(
+            body_color, dtype=torch.float32, device=device)
+        if isinstance(render_bg, bool):
+            render_bg = [render_bg] * len(degrees)
+
+        batch_size, num_vertices = vertices.shape[:2]
+        self._update_topology(faces, num_vertices, device)
+        num_channels = 4 if return_with_alpha else 3
+        # The uint8 images are channels-last and are only converted to float
+        # at the covered pixels
+        if uint8:
+            _, H, W, _ = bg_imgs.shape
+            dtype, max_value = torch.uint8, 255
+        else:
+            _, _, H, W = bg_imgs.shape
+            dtype, max_value = torch.float32, 1.0
+
+        bg = None
+        if any(render_bg):
+            bg = torch.as_tensor(np.asarray(bg_imgs), device=device)
+            if uint8:
+                bg = bg.permute(0, 3, 1, 2)
+            bg = bg.to(dtype=dtype)
+            if bg.shape[1] < num_channels:
+                bg = torch.cat(
+                    [bg, torch.full_like(bg[:, :1], max_value)], dim=1)
+            bg = bg[:, :num_channels].reshape(batch_size, num_channels, -1)
+
+        output = torch.zeros(
+            [len(degrees), batch_size, num_channels, H * W],
+            dtype=dtype, device=device)
+        center = vertices.mean(dim=1, keepdim=True)
+        for view_idx, (deg, use_bg) in enumerate(zip(degrees, render_bg)):
+            curr_vertices = vertices
+            if deg != 0:
+                # Rotate around the vertical axis through the mesh center
+                angle = math.radians(deg)
+                cos, sin = math.cos(angle), math.sin(angle)
+                rot = vertices.new_tensor(
+                    [[cos, 0, sin], [0, 1, 0], [-sin, 0, cos]])
+                curr_vertices = (vertices - center) @ rot.t() + center
+
+            normals = compute_vertex_normals(
+                curr_vertices, self.faces, self.adjacency)
+            points, depth = self.project(
+                curr_vertices, focal_length, camera_translation,
+                camera_center)
+            tri_points = points[:, self.faces].reshape(-1, 3, 2)
+            tri_depth = depth[:, self.faces].reshape(-1, 3)
+            tri_normals = normals[:, self.faces].reshape(-1, 3, 3)
+            coeffs, valid = self.plane_coefficients(tri_points, tri_depth)
+
+            face_idxs = self.rasterize(
+                tri_points, tri_depth, coeffs, valid, batch_size, H, W)
+            covered, colors = self.shade(
+                face_idxs, coeffs, tri_depth, tri_normals, H, W, body_color)
+
+            # Only the covered pixels are blended, the rest of the image is
+            # either the background or empty
+            view = output[view_idx]
+            body_idxs = torch.div(covered, H * W, rounding_mode='floor')
+            pix_idxs = covered - body_idxs * H * W
+            if return_with_alpha:
+                colors = torch.cat(
+                    [colors, colors.new_full([len(colors), 1], alpha)],
+                    dim=1)
+            if use_bg:
+                view.copy_(bg)
+                bg_colors = view[body_idxs, :, pix_idxs].float() / max_value
+                colors = (colors * alpha + (1 - alpha) * bg_colors).clamp(0, 1)
+            if uint8:
+                colors = colors.mul(255).round_()
+            view[body_idxs, :, pix_idxs] = colors.to(dtype=dtype)
+
+        output = output.reshape(len(degrees), batch_size, num_channels, H, W)
+        if uint8:
+            output = output.permute(0, 1, 3, 4, 2)
+        return output.cpu().numpy()
+
+    @torch.no_grad()
+    def __call__(self,
+                 vertices: Tensor,
+                 faces: Union[Tensor, Array],
+                 focal_length: Union[Tensor, Array],
+                 camera_translation: Union[Tensor, Array],
+                 camera_center: Union[Tensor, Array],
+                 bg_imgs: Array,
+                 render_bg: bool = True,
+                 deg: float = 0,
+                 return_with_alpha: bool = False,
+                 body_color: List[float] = None,
+                 uint8: bool = False,
+                 **kwargs) -> Array:
+        ''' Same arguments as `HDRenderer.__call__` '''
+        return self.render_views(
+            vertices, faces, focal_length=focal_length,
+            camera_translation=camera_translation,
+            camera_center=camera_center, bg_imgs=bg_imgs, degrees=[deg],
+            render_bg=render_bg, return_with_alpha=return_with_alpha,
+            body_color=body_color, uint8=uint8)[0]
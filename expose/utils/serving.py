@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import json
+import time
+import struct
+import asyncio
+import itertools
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+from loguru import logger
+
+from .typing_utils import Array
+
+# The length of the JSON header and of the binary payload of a message
+MESSAGE_PREFIX = struct.Struct('!II')
+
+Message = Tuple[Dict[str, Any], Dict[str, Array]]
+
+
+def pack_message(
+    header: Dict[str, Any],
+    arrays: Optional[Dict[str, Array]] = None,
+) -> List[bytes]:
+    ''' Serializes a message into a list of buffers
+
+        A message is a JSON header followed by the raw bytes of its arrays.
+        The shape and type of every array are stored in the header, so the
+        arrays are written without copies with `writer.writelines`.
+    '''
+    specs, buffers = [], []
+    for name, array in (arrays or {}).items():
+        array = np.ascontiguousarray(array)
+        specs.append(
+            {'name': name, 'dtype': array.dtype.str,
+             'shape': list(array.shape)})
+        buffers.append(memoryview(array.reshape(-1).view(np.uint8)))
+    header_bytes = json.dumps(dict(header, arrays=specs)).encode('utf-8')
+    payload_size = sum(len(buf) for buf in buffers)
+    return [MESSAGE_PREFIX.pack(len(header_bytes), payload_size),
+            header_bytes] + buffers
+
+
+def unpack_arrays(specs: List[Dict], payload: bytes) -> Dict[str, Array]:
+    ''' Creates read-only views of the arrays of a message payload '''
+    arrays, offset = {}, 0
+    for spec in specs:
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        arrays[spec['name']] = np.frombuffer(
+            payload, dtype=dtype, count=count, offset=offset).reshape(
+                spec['shape'])
+        offset += count * dtype.itemsize
+    return arrays
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Message]:
+    ''' Reads the next message, None if the connection was closed '''
+    try:
+        prefix = await reader.readexactly(MESSAGE_PREFIX.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise
+    header_size, payload_size = MESSAGE_PREFIX.unpack(prefix)
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size)
+    return header, unpack_arrays(header.pop('arrays', []), payload)
+
+
+def histogram_summary(histogram: Counter) -> Dict[str, int]:
+    return {str(key): histogram[key] for key in sorted(histogram)}
+
+
+class ServingStats(object):
+    ''' Queue depth, batch size, latency and throughput of the service
+
+        The queue depth is sampled when a request arrives and the batch size
+        when a batch is formed. Latencies are measured from the arrival of a
+        request to its response, over a sliding window.
+    '''
+
+    def __init__(self, window: int = 1000, log_every: float = 10.0) -> None:
+        super(ServingStats, self).__init__()
+        self.log_every = log_every
+        self.queue_depths = Counter()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.completed = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def record_arrival(self, queue_depth: int) -> None:
+        self.queue_depths[queue_depth] += 1
+
+    def record_batch(self, batch_size: int) -> None:
+        self.batch_sizes[batch_size] += 1
+
+    def record_response(
+        self,
+        latency: float,
+        queue_wait: float,
+        error: bool = False,
+    ) -> None:
+        self.completed.append(time.perf_counter())
+        self.latencies.append(latency)
+        self.queue_waits.append(queue_wait)
+        self.num_requests += 1
+        self.num_errors += int(error)
+
+    @property
+    def throughput(self) -> float:
+        if len(self.completed) < 2:
+            return 0.0
+        return (len(self.completed) - 1) / max(
+            self.completed[-1] - self.completed[0], 1e-8)
+
+    def summary(self) -> Dict[str, Any]:
+        latencies = np.asarray(self.latencies)
+        queue_waits = np.asarray(self.queue_waits)
+        if len(latencies) < 1:
+            latencies = queue_waits = np.zeros([1])
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            'requests': self.num_requests,
+            'errors': self.num_errors,
+            'throughput': self.throughput,
+            'latency_mean': float(latencies.mean()),
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'queue_wait_p50': float(np.percentile(queue_waits, 50)),
+            'queue_wait_p95': float(np.percentile(queue_waits, 95)),
+            'mean_batch_size': (
+                sum(size * count for size, count in self.batch_sizes.items())
+                / max(num_batches, 1)),
+            'batch_size_histogram': histogram_summary(self.batch_sizes),
+            'queue_depth_histogram': histogram_summary(self.queue_depths),
+        }
+
+    def log(self) -> None:
+        stats = self.summary()
+        logger.info(
+            f'Requests: {stats["requests"]}, errors: {stats["errors"]},'
+            f' throughput: {stats["throughput"]:.2f} req/s, latency'
+            f' (mean/p50/p95): {stats["latency_mean"] * 1000:.1f}/'
+            f'{stats["latency_p50"] * 1000:.1f}/'
+            f'{stats["latency_p95"] * 1000:.1f} ms, mean batch size:'
+            f' {stats["mean_batch_size"]:.2f}')
+        logger.info(f'Batch sizes: {stats["batch_size_histogram"]}')
+        logger.info(f'Queue depths: {stats["queue_depth_histogram"]}')
+
+
+@dataclass
+class PendingRequest:
+    item: Any
+    future: asyncio.Future
+    arrival: float
+
+
+class DynamicBatcher(object):
+    ''' Coalesces concurrent requests into batches
+
+        A batch is closed when it holds `max_batch_size` requests or when its
+        oldest request has waited `max_latency` seconds. Requests that arrive
+        while a batch runs are batched together as soon as the worker is
+        free. The batches are processed in order on a single worker thread,
+        which owns the models.
+
+        Parameters
+        ----------
+            process_batch: callable
+                Receives a list of items and returns one result per item. An
+                exception returned in place of a result is raised for that
+                request only.
+            max_batch_size: int
+                The maximum number of requests per batch
+            max_latency: float
+                The maximum time in seconds that a request waits for other
+                requests to join its batch
+    '''
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_latency: float = 0.01,
+        stats: Optional[ServingStats] = None,
+    ) -> None:
+        super(DynamicBatcher, self).__init__()
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats if stats is not None else ServingStats()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='batcher')
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def submit(self, item: Any) -> Tuple[Any, Dict[str, float]]:
+        ''' Waits for the result of an item
+
+            Returns the result and the time the request waited in the queue
+            and the size of its batch.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self.stats.record_arrival(self.queue.qsize())
+        await self.queue.put(PendingRequest(item, future, time.perf_counter()))
+        return await future
+
+    async def next_batch(self) -> List[PendingRequest]:
+        batch = [await self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                # The window is over, only take what is already waiting
+                if self.queue.empty():
+                    break
+                batch.append(self.queue.get_nowait())
+                continue
+            try:
+                batch.append(
+                    await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            self.stats.record_batch(len(batch))
+            batch_start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.process_batch,
+                    [request.item for request in batch])
+            except Exception as e:
+                logger.exception('Batch failed')
+                results = [e] * len(batch)
+            for request, result in zip(batch, results):
+                if request.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result((result, {
+                        'queue_wait': batch_start - request.arrival,
+                        'batch_size': len(batch)}))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class InferenceServer(object):
+    ''' Serves a dynamic batcher over a local TCP socket
+
+        Every connection can have several requests in flight, the responses
+        carry the `id` of their request and are sent as soon as they are
+        ready. Besides `infer` requests, a `stats` request returns the
+        summary of the `ServingStats`.
+
+        Parameters
+        ----------
+            batcher: DynamicBatcher
+                Runs the batches of decoded requests
+            decode: callable
+                Converts the header and arrays of a request to the item that
+                is passed to the batcher. It runs on the default executor, so
+                that decoding overlaps with the batches.
+    '''
+
+    def __init__(
+        self,
+        batcher: DynamicBatcher,
+        decode: Callable[[Dict, Dict[str, Array]], Any],
+        host: str = '127.0.0.1',
+        port: int = 8765,
+    ) -> None:
+        super(InferenceServer, self).__init__()
+        self.batcher = batcher
+        self.decode = decode
+        self.host = host
+        self.port = port
+        self.stats = batcher.stats
+
+    async def respond(
+        self,
+        header: Dict,
+        arrays: Dict[str, Array],
+        writer: asyncio.StreamWriter,
+        write_lock: asyncio.Lock,
+    ) -> None:
+        arrival = time.perf_counter()
+        response_header = {'id': header.get('id'), 'status': 'ok'}
+        response_arrays = {}
+        request_type = header.get('type', 'infer')
+        try:
+            if request_type == 'stats':
+                response_header['stats'] = self.stats.summary()
+            elif request_type == 'infer':
+                item = await asyncio.get_running_loop().run_in_executor(
+                    None, self.decode, header, arrays)
+                (result_header, response_arrays), timing = (
+                    await self.batcher.submit(item))
+                response_header.update(result_header, **timing)
+            else:
+                raise ValueError(f'Unknown request type: {request_type}')
+        except Exception as e:
+            response_header.update(status='error', error=str(e))
+        if request_type == 'infer':
+            latency = time.perf_counter() - arrival
+            response_header['server_latency'] = latency
+            self.stats.record_response(
+                latency, response_header.get('queue_wait', 0.0),
+                error=response_header['status'] != 'ok')
+
+        try:
+            message = pack_message(response_header, response_arrays)
+        except Exception as e:
+            message = pack_message(
+                {'id': header.get('id'), 'status': 'error', 'error': str(e)})
+        async with write_lock:
+            writer.writelines(message)
+            await writer.drain()
+
+    async def handle_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                task = asyncio.create_task(
+                    self.respond(*message, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def log_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats.log_every)
+            if self.stats.num_requests > 0:
+                self.stats.log()
+
+    async def serve(self) -> None:
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port)
+        logger.info(
+            f'Serving on {self.host}:{self.port}, max batch size:'
+            f' {self.batcher.max_batch_size}, max latency:'
+            f' {self.batcher.max_latency * 1000:.1f} ms')
+        tasks = [asyncio.create_task(self.batcher.run())]
+        if self.stats.log_every > 0:
+            tasks.append(asyncio.create_task(self.log_stats()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.batcher.close()
+            self.stats.log()
+
+
+class InferenceClient(object):
+    ''' A client of the `InferenceServer` that pipelines its requests '''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765) -> None:
+        super(InferenceClient, self).__init__()
+        self.host = host
+        self.port = port
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.reader, self.writer = None, None
+        self.read_task = None
+        self.write_lock = None
+
+    async def connect(self) -> 'InferenceClient':
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port)
+        self.write_lock = asyncio.Lock()
+        self.read_task = asyncio.create_task(self.read_responses())
+        return self
+
+    async def read_responses(self) -> None:
+        error = ConnectionError('The connection was closed')
+        try:
+            while True:
+                message = await read_message(self.reader)
+                if message is None:
+                    break
+                future = self.pending.pop(message[0].get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            error = e
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def request(
+        self,
+        header: Dict[str, Any],
+        arrays: Optional[Dict[str, Array]] = None,
+    ) -> Message:
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        async with self.write_lock:
+            self.writer.writelines(
+                pack_message(dict(header, id=request_id), arrays))
+            await self.writer.drain()
+        return await future
+
+    async def infer(
+        self,
+        image: Array,
+        outputs: Tuple[str, ...] = ('params',),
+        encoded: bool = True,
+    ) -> Message:
+        ''' Sends an image, either the bytes of an image file or a HxWx3
+            uint8 RGB array
+        '''
+        header = {'type': 'infer', 'outputs': list(outputs),
+                  'encoded': encoded}
+        return await self.request(header, {'image': image})
+
+    async def stats(self) -> Dict[str, Any]:
+        header, _ = await self.request({'type': 'stats'})
+        return header['stats']
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            await self.read_task
+
+    async def __aenter__(self) -> 'InferenceClient':
+        return await self.connect()
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+
+async def generate_load(
+    host: str,
+    port: int,
+    images: List[Array],
+    num_requests: int = 100,
+    concurrency: int = 4,
+    outputs: Tuple[str, ...] = ('params',),
+    encoded: bool = True,
+) -> Dict[str, Any]:
+    ''' Sends requests from `concurrency` closed-loop clients
+
+        Every client waits for the response of its request before it sends
+        the next one. The images are sent in a round-robin order.
+
+        Returns
+        -------
+            summary: dict
+                The client-side throughput and latency and the statistics of
+                the server after the run
+    '''
+    request_idxs = itertools.count()
+    latencies, num_errors = [], 0
+
+    async def run_client() -> None:
+        nonlocal num_errors
+        async with InferenceClient(host, port) as client:
+            while True:
+                idx = next(request_idxs)
+                if idx >= num_requests:
+                    break
+                start = time.perf_counter()
+                header, _ = await client.infer(
+                    images[idx % len(images)], outputs=outputs,
+                    encoded=encoded)
+                latencies.append(time.perf_counter() - start)
+                if header.get('status') != 'ok':
+                    num_errors += 1
+                    logger.warning(
+                        f'Request {idx} failed: {header.get("error")}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    async with InferenceClient(host, port) as client:
+        server_stats = await client.stats()
+
+    latencies = np.asarray(latencies) if len(latencies) > 0 else np.zeros([1])
+    return {
+        'requests': num_requests,
+        'errors': num_errors,
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'throughput': num_requests / max(elapsed, 1e-8),
+        'latency_mean': float(latencies.mean()),
+        'latency_p50': float(np.percentile(latencies, 50)),
+        'latency_p95': float(np.percentile(latencies, 95)),
+        'server': server_stats,
+    }
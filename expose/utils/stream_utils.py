@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Union, Dict
+import time
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import cv2
+
+from loguru import logger
+
+from .typing_utils import Array
+
+
+class StreamEnd(object):
+    ''' Marks the end of a stream, it is never dropped from a queue '''
+    pass
+
+
+STREAM_END = StreamEnd()
+
+
+class DropOldestQueue(queue.Queue):
+    ''' A bounded queue that evicts the oldest item when it is full
+
+        Live sources should never block on a slow consumer, since the frames
+        waiting in the queue only get older. With `drop=False` the queue
+        behaves like a regular blocking queue, e.g. for video files where
+        every frame must be processed.
+    '''
+
+    def __init__(self, maxsize: int = 2, drop: bool = True) -> None:
+        super(DropOldestQueue, self).__init__(maxsize=maxsize)
+        self.drop = drop
+        self.num_dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        if not self.drop or isinstance(item, StreamEnd):
+            return super(DropOldestQueue, self).put(
+                item, block=block, timeout=timeout)
+        with self.mutex:
+            while self.maxsize > 0 and self._qsize() >= self.maxsize:
+                oldest = self._get()
+                if isinstance(oldest, StreamEnd):
+                    # Keep the end marker, drop the new item instead
+                    self._put(oldest)
+                    self.num_dropped += 1
+                    return
+                self.unfinished_tasks -= 1
+                self.num_dropped += 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+@dataclass
+class Frame:
+    index: int
+    timestamp: float
+    image: Array
+    data: Dict = field(default_factory=dict)
+
+
+class FrameSource(threading.Thread):
+    ''' Reads frames from a camera device or a video file
+
+        Frames are converted to float32 RGB in [0, 1], the format returned by
+        `read_img`, and pushed to the output queue together with their
+        capture time.
+    '''
+
+    def __init__(
+        self,
+        source: Union[int, str],
+        out_queue: queue.Queue,
+        max_frames: int = -1,
+    ) -> None:
+        super(FrameSource, self).__init__(daemon=True)
+        if isinstance(source, str) and source.isdigit():
+            source = int(source)
+        self.source = source
+        self.out_queue = out_queue
+        self.max_frames = max_frames
+        self.stop_event = threading.Event()
+
+        self.capture = cv2.VideoCapture(self.source)
+        if not self.capture.isOpened():
+            raise IOError(f'Could not open video source: {self.source}')
+
+    @property
+    def is_live(self) -> bool:
+        return isinstance(self.source, int)
+
+    @property
+    def fps(self) -> float:
+        return self.capture.get(cv2.CAP_PROP_FPS)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def run(self) -> None:
+        index = 0
+        try:
+            while not self.stop_event.is_set():
+                if self.max_frames > 0 and index >= self.max_frames:
+                    break
+                success, bgr_img = self.capture.read()
+                if not success:
+                    break
+                timestamp = time.perf_counter()
+                img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB).astype(
+                    np.float32) / 255.0
+                self.out_queue.put(Frame(index, timestamp, img))
+                index += 1
+        finally:
+            self.capture.release()
+            self.out_queue.put(STREAM_END)
+
+
+class StreamStats(object):
+    ''' Sustained throughput and end-to-end latency of a stream
+
+        Latency is measured from the capture of a frame to the end of its
+        processing, throughput over a sliding window of completed frames.
+    '''
+
+    def __init__(self, window: int = 60, log_every: float = 5.0) -> None:
+        super(StreamStats, self).__init__()
+        self.window = window
+        self.log_every = log_every
+        self.completed = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.num_frames = 0
+        self.start = None
+        self.last_log = time.perf_counter()
+
+    def update(self, frame: Frame) -> None:
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        self.completed.append(now)
+        self.latencies.append(now - frame.timestamp)
+        self.num_frames += 1
+
+    @property
+    def fps(self) -> float:
+        if len(self.completed) < 2:
+            return 0.0
+        return (len(self.completed) - 1) / max(
+            self.completed[-1] - self.completed[0], 1e-8)
+
+    def summary(self, num_dropped: int = 0) -> Dict[str, float]:
+        latencies = np.asarray(self.latencies)
+        if len(latencies) < 1:
+            latencies = np.zeros([1])
+        return {
+            'fps': self.fps,
+            'latency_mean': float(latencies.mean()),
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'frames': self.num_frames,
+            'dropped': num_dropped,
+        }
+
+    def maybe_log(self, num_dropped: int = 0) -> None:
+        now = time.perf_counter()
+        if now - self.last_log < self.log_every:
+            return
+        self.last_log = now
+        self.log(num_dropped)
+
+    def log(self, num_dropped: int = 0, overall: bool = False) -> None:
+        stats = self.summary(num_dropped=num_dropped)
+        fps = stats['fps']
+        if overall and self.start is not None and self.num_frames > 1:
+            fps = (self.num_frames - 1) / max(
+                self.completed[-1] - self.start, 1e-8)
+        logger.info(
+            f'FPS: {fps:.2f}, '
+            f'latency (mean/p50/p95): {stats["latency_mean"] * 1000:.1f}/'
+            f'{stats["latency_p50"] * 1000:.1f}/'
+            f'{stats["latency_p95"] * 1000:.1f} ms, '
+            f'frames: {stats["frames"]}, dropped: {num_dropped}')
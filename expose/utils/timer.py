@@ -14,7 +14,16 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
+from typing import Dict, List, Optional
+import os
+import os.path as osp
+import json
 import time
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+import functools
+
 import numpy as np
 import torch
 
@@ -40,3 +49,207 @@ class Timer(object):
         self.elapsed.append(elapsed)
         logger.info(
             f'[{self.name}]: {elapsed:.3f}, {np.mean(self.elapsed):.3f}')
+
+
+class _Stage(object):
+    def __init__(self, profiler: 'StageProfiler', name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._push(self.name)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.profiler._pop()
+
+
+class StageProfiler(object):
+    ''' Hierarchical registry of the wall time and memory of named stages
+
+        Stages are opened with `with profiler.stage('name'):` and can be
+        nested, the full name of a stage is the path of the enclosing stages,
+        e.g. `smplx_head/hand_predictor/backbone`. For every stage the
+        profiler records the wall time and, on CUDA, the peak allocated
+        memory while it was active. When the profiler is disabled `stage`
+        returns a no-op context, so the instrumentation can stay in the
+        forward passes.
+
+        Parameters
+        ----------
+            enabled: bool
+                Whether to record the stages
+            sync: bool
+                Synchronize CUDA at the boundaries of the stages, so that
+                the wall time includes the asynchronous kernels
+            track_memory: bool
+                Record the peak allocated CUDA memory of each stage
+    '''
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        sync: bool = True,
+        track_memory: bool = True,
+    ) -> None:
+        super(StageProfiler, self).__init__()
+        self.enabled = enabled
+        self.sync = sync
+        self.track_memory = track_memory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self._null_context = nullcontext()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.durations = defaultdict(lambda: [])
+            self.peak_memory = defaultdict(lambda: [])
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def enable(self, sync: Optional[bool] = None,
+               track_memory: Optional[bool] = None) -> None:
+        if sync is not None:
+            self.sync = sync
+        if track_memory is not None:
+            self.track_memory = track_memory
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    @property
+    def _use_cuda(self) -> bool:
+        return torch.cuda.is_available() and torch.cuda.is_initialized()
+
+    def _stack(self) -> List[Dict]:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name: str):
+        ''' Returns a context manager that records the stage `name` '''
+        if not self.enabled:
+            return self._null_context
+        return _Stage(self, name)
+
+    def wrap(self, name: str):
+        ''' Decorator that records every call of a function as a stage '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _push(self, name: str) -> None:
+        stack = self._stack()
+        use_cuda = self._use_cuda
+        if use_cuda and self.sync:
+            torch.cuda.synchronize()
+        if use_cuda and self.track_memory:
+            # Keep the peak of the parent so far, the reset discards it
+            if len(stack) > 0:
+                stack[-1]['peak'] = max(
+                    stack[-1]['peak'], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        full_name = name if len(stack) < 1 else f'{stack[-1]["name"]}/{name}'
+        stack.append({'name': full_name, 'peak': 0,
+                      'start': time.perf_counter()})
+
+    def _pop(self) -> None:
+        stack = self._stack()
+        use_cuda = self._use_cuda
+        if use_cuda and self.sync:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        frame = stack.pop()
+
+        peak = None
+        if use_cuda and self.track_memory:
+            # The peak statistics are reset when a nested stage starts, so
+            # the peak of a stage is the maximum over its children as well
+            peak = max(frame['peak'], torch.cuda.max_memory_allocated())
+            if len(stack) > 0:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+        elapsed = end - frame['start']
+        with self.lock:
+            self.durations[frame['name']].append(elapsed)
+            if peak is not None:
+                self.peak_memory[frame['name']].append(peak)
+            self.events.append({
+                'name': frame['name'].rsplit('/', 1)[-1],
+                'cat': frame['name'],
+                'ph': 'X',
+                'ts': (frame['start'] - self.origin) * 1e6,
+                'dur': elapsed * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {} if peak is None else {
+                    'peak_memory_mb': peak / 2 ** 20},
+            })
+
+    def summary(
+        self,
+        percentiles: List[float] = (50, 90, 99),
+    ) -> Dict[str, Dict[str, float]]:
+        ''' Aggregates the recorded stages
+
+            Returns
+            -------
+                summary: dict
+                    For every stage the number of calls, the total and mean
+                    time and the requested percentiles in milliseconds, and
+                    the maximum peak memory in MB when it was tracked
+        '''
+        output = {}
+        with self.lock:
+            for name in sorted(self.durations):
+                durations = np.asarray(self.durations[name]) * 1000
+                stats = {
+                    'count': len(durations),
+                    'total_ms': float(durations.sum()),
+                    'mean_ms': float(durations.mean()),
+                }
+                for perc in percentiles:
+                    stats[f'p{perc:g}_ms'] = float(
+                        np.percentile(durations, perc))
+                if len(self.peak_memory[name]) > 0:
+                    stats['peak_memory_mb'] = float(
+                        max(self.peak_memory[name]) / 2 ** 20)
+                output[name] = stats
+        return output
+
+    def log_summary(self) -> None:
+        summary = self.summary()
+        if len(summary) < 1:
+            return
+        lines = ['Stage timings (ms):']
+        for name, stats in summary.items():
+            msg = (f'{name}: count={stats["count"]},'
+                   f' mean={stats["mean_ms"]:.2f},'
+                   f' p50={stats["p50_ms"]:.2f}, p90={stats["p90_ms"]:.2f},'
+                   f' p99={stats["p99_ms"]:.2f}')
+            if 'peak_memory_mb' in stats:
+                msg += f', peak memory={stats["peak_memory_mb"]:.1f} MB'
+            lines.append(msg)
+        logger.info('\n'.join(lines))
+
+    def export_chrome_trace(self, path: str) -> None:
+        ''' Writes the recorded stages as a Chrome trace
+
+            The file can be opened with chrome://tracing or Perfetto.
+        '''
+        path = osp.expanduser(osp.expandvars(path))
+        os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        logger.info(f'Saved {len(events)} profiling events to {path}')
+
+
+PROFILER = StageProfiler()
@@ -61,3 +61,32 @@ def rot_mat_to_euler(rot_mats: Tensor) -> Tensor:
     sy = torch.sqrt(rot_mats[:, 0, 0] * rot_mats[:, 0, 0] +
                     rot_mats[:, 1, 0] * rot_mats[:, 1, 0])
     return torch.atan2(-rot_mats[:, 2, 0], sy)
+
+
+def invert_affine_2d(transforms: Tensor) -> Tensor:
+    ''' Inverts a batch of 3x3 matrices of 2D affine transformations
+
+        Equivalent to `torch.inverse` for matrices with a last row of
+        (0, 0, 1), but uses the closed form of the 2x2 inverse, which can be
+        traced and exported to ONNX.
+    '''
+    a = transforms[..., 0, 0]
+    b = transforms[..., 0, 1]
+    c = transforms[..., 1, 0]
+    d = transforms[..., 1, 1]
+    inv_det = 1.0 / (a * d - b * c)
+
+    inv_a = d * inv_det
+    inv_b = -b * inv_det
+    inv_c = -c * inv_det
+    inv_d = a * inv_det
+    tx = transforms[..., 0, 2]
+    ty = transforms[..., 1, 2]
+
+    zeros = torch.zeros_like(a)
+    ones = torch.ones_like(a)
+    return torch.stack([
+        torch.stack([inv_a, inv_b, -(inv_a * tx + inv_b * ty)], dim=-1),
+        torch.stack([inv_c, inv_d, -(inv_c * tx + inv_d * ty)], dim=-1),
+        torch.stack([zeros, zeros, ones], dim=-1),
+    ], dim=-2)
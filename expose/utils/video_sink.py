@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from typing import Dict, List, Optional, Sequence
+import os
+import os.path as osp
+import queue
+import shutil
+import subprocess
+import threading
+
+import numpy as np
+import cv2
+
+from loguru import logger
+
+from .img_utils import alpha_composite_uint8, read_img
+from .typing_utils import Array
+
+VIDEO_BACKENDS = ('auto', 'ffmpeg', 'opencv')
+
+
+class FFmpegVideoWriter(object):
+    ''' Pipes raw RGB frames to an ffmpeg process that encodes them
+
+        The frames are encoded with H.264 in a separate process, so the
+        encoding does not hold the GIL. Odd frame sizes are padded by one
+        pixel, since the 4:2:0 chroma subsampling needs even sizes.
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        fps: float = 30,
+        crf: int = 20,
+        preset: str = 'veryfast',
+    ) -> None:
+        super(FFmpegVideoWriter, self).__init__()
+        self.path = path
+        command = [
+            'ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', f'{width}x{height}', '-r', f'{fps}', '-i', '-',
+            '-an', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-c:v', 'libx264', '-preset', preset, '-crf', f'{crf}',
+            '-pix_fmt', 'yuv420p', path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, image: Array) -> None:
+        self.process.stdin.write(np.ascontiguousarray(image).tobytes())
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError(f'ffmpeg failed to encode {self.path}')
+
+
+class OpenCVVideoWriter(object):
+    ''' Encodes RGB frames with the video writer of OpenCV '''
+
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        fps: float = 30,
+        fourcc: str = 'mp4v',
+    ) -> None:
+        super(OpenCVVideoWriter, self).__init__()
+        self.path = path
+        self.writer = cv2.VideoWriter(
+            path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if not self.writer.isOpened():
+            raise IOError(f'Could not open the video writer for {path}')
+
+    def write(self, image: Array) -> None:
+        self.writer.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+    def close(self) -> None:
+        self.writer.release()
+
+
+def build_video_writer(
+    path: str,
+    width: int,
+    height: int,
+    fps: float = 30,
+    backend: str = 'auto',
+):
+    ''' Creates a video writer, `auto` prefers the ffmpeg executable '''
+    if backend == 'auto':
+        backend = 'ffmpeg' if shutil.which('ffmpeg') else 'opencv'
+    if backend == 'ffmpeg':
+        return FFmpegVideoWriter(path, width, height, fps=fps)
+    elif backend == 'opencv':
+        return OpenCVVideoWriter(path, width, height, fps=fps)
+    else:
+        raise ValueError(f'Unknown video backend: {backend}')
+
+
+def video_size(path: str):
+    capture = cv2.VideoCapture(path)
+    try:
+        return (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    finally:
+        capture.release()
+
+
+def concat_videos(
+    paths: List[str],
+    output_path: str,
+    fps: float = 30,
+    backend: str = 'auto',
+) -> str:
+    ''' Concatenates videos, e.g. the videos of the shards of a demo run
+
+        Videos of the same size are joined by the ffmpeg executable without
+        re-encoding them. Otherwise, or without ffmpeg, the frames are
+        decoded and encoded again, resized to the size of the first video.
+    '''
+    sizes = {video_size(path) for path in paths}
+    if (len(sizes) == 1 and backend in ('auto', 'ffmpeg') and
+            shutil.which('ffmpeg')):
+        list_path = f'{output_path}.txt'
+        with open(list_path, 'w') as f:
+            for path in paths:
+                escaped = osp.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        try:
+            subprocess.run(
+                ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'concat',
+                 '-safe', '0', '-i', list_path, '-c', 'copy', output_path],
+                check=True)
+        finally:
+            os.remove(list_path)
+        return output_path
+
+    writer = None
+    try:
+        for path in paths:
+            capture = cv2.VideoCapture(path)
+            try:
+                while True:
+                    success, image = capture.read()
+                    if not success:
+                        break
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    if writer is None:
+                        height, width = image.shape[:2]
+                        writer = build_video_writer(
+                            output_path, width, height, fps=fps,
+                            backend=backend)
+                    elif image.shape[:2] != (height, width):
+                        image = cv2.resize(image, (width, height))
+                    writer.write(image)
+            finally:
+                capture.release()
+    finally:
+        if writer is not None:
+            writer.close()
+    return output_path
+
+
+class VideoSink(object):
+    ''' Streams the demo visualizations into one video file per view
+
+        Every call of `add_frame` appends an image to the video of a view,
+        e.g. `hd_overlay`, which is created when its first frame arrives
+        and whose size is set by that frame. Frames of another size are
+        resized to it. The encoding runs on a background thread that
+        receives the frames through a bounded queue.
+
+        Parameters
+        ----------
+            output_folder: str
+                The folder of the videos
+            fps: float
+                The frame rate of the videos
+            backend: str
+                One of `auto`, `ffmpeg` or `opencv`
+            prefix: str
+                Prepended to the file names, e.g. for the shards of a run
+            max_queue_size: int
+                The maximum number of frames waiting to be encoded
+    '''
+
+    def __init__(
+        self,
+        output_folder: str,
+        fps: float = 30,
+        backend: str = 'auto',
+        prefix: str = '',
+        max_queue_size: int = 32,
+    ) -> None:
+        super(VideoSink, self).__init__()
+        os.makedirs(output_folder, exist_ok=True)
+        self.output_folder = output_folder
+        self.fps = fps
+        self.backend = backend
+        self.prefix = prefix
+
+        self.writers = {}
+        self.sizes = {}
+        self.num_frames = {}
+        self.error = None
+        self.closed = False
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.worker = threading.Thread(
+            target=self._worker_loop, name='video_sink', daemon=True)
+        self.worker.start()
+
+    def video_path(self, view: str) -> str:
+        return osp.join(self.output_folder, f'{self.prefix}{view}.mp4')
+
+    def _write(self, view: str, image: Array) -> None:
+        if view not in self.writers:
+            height, width = image.shape[:2]
+            self.writers[view] = build_video_writer(
+                self.video_path(view), width, height, fps=self.fps,
+                backend=self.backend)
+            self.sizes[view] = (width, height)
+            self.num_frames[view] = 0
+            logger.info(f'Encoding {view} to {self.video_path(view)}')
+
+        image = image[..., :3]
+        width, height = self.sizes[view]
+        if image.shape[:2] != (height, width):
+            image = cv2.resize(image, (width, height))
+        self.writers[view].write(image)
+        self.num_frames[view] += 1
+
+    def _worker_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                if self.error is None:
+                    self._write(*item)
+            except Exception as e:
+                logger.error(f'Could not encode {item[0]}: {e}')
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def add_frame(self, view: str, image: Array) -> None:
+        ''' Queues a HxWx3 or HxWx4 uint8 image for the video of a view '''
+        if self.closed:
+            raise RuntimeError('The video sink is closed')
+        if self.error is not None:
+            raise IOError(f'Video encoding failed: {self.error}')
+        self.queue.put((view, image))
+
+    def close(self) -> List[str]:
+        ''' Finishes the videos
+
+            Returns
+            -------
+                paths: list
+                    The videos written by the sink
+        '''
+        if self.closed:
+            return []
+        self.closed = True
+        self.queue.put(None)
+        self.worker.join()
+
+        paths = []
+        for view, writer in self.writers.items():
+            writer.close()
+            paths.append(writer.path)
+            logger.info(
+                f'Wrote {self.num_frames[view]} frames to {writer.path}')
+
+        if self.error is not None:
+            raise IOError(f'Video encoding failed: {self.error}')
+        return paths
+
+    def __enter__(self) -> 'VideoSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class FrameCompositor(object):
+    ''' Composites the renderings of all the people of a frame for a sink
+
+        The demo renders one person per image. The compositor collects the
+        RGBA layers of the people of a frame, which arrive in the order of
+        the frames, possibly split over two batches. When the next frame
+        starts, it blends them from the farthest to the nearest person over
+        the background of every view and sends one image per view to the
+        sink. Frames without detections are read from their files, so that
+        every video has one frame per input image.
+
+        Parameters
+        ----------
+            sink: VideoSink
+                Receives the composited frames
+            views: dict
+                For every view, whether its background is the frame, e.g.
+                for the overlays, or black, e.g. for the rotated renderings
+            frame_idxs: sequence of int
+                The indices of the frames, in the order of the loader
+            paths: sequence of str
+                The image files of the frames
+    '''
+
+    def __init__(
+        self,
+        sink: VideoSink,
+        views: Dict[str, bool],
+        frame_idxs: Sequence[int],
+        paths: Sequence[str],
+    ) -> None:
+        super(FrameCompositor, self).__init__()
+        self.sink = sink
+        self.views = views
+        self.frame_idxs = list(frame_idxs)
+        self.paths = list(paths)
+        # The position of the next frame that is sent to the sink
+        self.position = 0
+
+        self.image = None
+        self.layers = []
+
+    def _emit(self, image: Array, layers: List) -> None:
+        # The farthest person is blended first
+        layers = sorted(layers, key=lambda layer: -layer[0])
+        for view, use_frame in self.views.items():
+            output = image[..., :3] if use_frame else np.zeros_like(
+                image[..., :3])
+            for _, view_layers in layers:
+                if view in view_layers:
+                    output = alpha_composite_uint8(output, view_layers[view])
+            self.sink.add_frame(view, output)
+        self.position += 1
+
+    def _flush(self) -> None:
+        if self.image is not None:
+            self._emit(self.image, self.layers)
+            self.image, self.layers = None, []
+
+    def _emit_until(self, frame_idx: Optional[int]) -> None:
+        ''' Emits the frames without detections before `frame_idx` '''
+        while (self.position < len(self.frame_idxs) and
+               self.frame_idxs[self.position] != frame_idx):
+            self._emit(read_img(self.paths[self.position], dtype=np.uint8),
+                       [])
+
+    def add(
+        self,
+        frame_idx: int,
+        image: Array,
+        layers: Dict[str, Array],
+        depth: float,
+    ) -> None:
+        ''' Adds the RGBA layers of a person of a frame
+
+            Parameters
+            ----------
+                frame_idx: int
+                    The index of the frame of the person
+                image: np.ndarray, HxWx3, uint8
+                    The frame
+                layers: dict
+                    The HxWx4 uint8 rendering of the person for every view
+                    that shows it
+                depth: float
+                    The distance of the person to the camera
+        '''
+        if self.image is None or frame_idx != self.frame_idxs[
+                self.position]:
+            self._flush()
+            self._emit_until(frame_idx)
+            if self.position >= len(self.frame_idxs):
+                raise ValueError(f'Frame {frame_idx} is out of order')
+            self.image = image
+        self.layers.append((depth, layers))
+
+    def close(self) -> None:
+        ''' Emits the last frame and the frames without detections '''
+        self._flush()
+        self._emit_until(None)
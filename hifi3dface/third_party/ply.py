@@ -1,6 +1,7 @@
 # original source: https://github.com/daavoo/pyntcloud/blob/master/pyntcloud/io/ply.py
 #       HAKUNA MATATA
 
+import re
 import sys
 import numpy as np
 import pandas as pd
@@ -275,27 +276,26 @@ def write_obj(obj_path, v_arr, vt_arr, tri_v_arr, tri_t_arr):
 
     with open(obj_path, "w") as fp:
         fp.write("mtllib test.mtl\n")
-        for x, y, z in v_arr:
-            fp.write("v %f %f %f\n" % (x, y, z))
+        fp.write("v %f %f %f\n" * len(v_arr) % tuple(np.ravel(v_arr)))
         # for u, v in vt_arr:
         #    fp.write('vt %f %f\n' % (v, 1-u))
-        for u, v in vt_arr:
-            fp.write("vt %f %f\n" % (u, v))
+        fp.write("vt %f %f\n" * len(vt_arr) % tuple(np.ravel(vt_arr)))
 
         tri_v_arr += 1
         tri_t_arr += 1
-        for (v1, v2, v3), (t1, t2, t3) in zip(tri_v_arr, tri_t_arr):
-            fp.write(
-                "f %d/%d/%d %d/%d/%d %d/%d/%d\n" % (v1, t1, t1, v2, t2, t2, v3, t3, t3)
-            )
+        # Each corner is written as v/t/t
+        corners = np.stack([tri_v_arr, tri_t_arr, tri_t_arr], axis=-1)
+        fp.write(
+            "f %d/%d/%d %d/%d/%d %d/%d/%d\n" * len(corners)
+            % tuple(corners.ravel())
+        )
 
 
 def read_obj(obj_path):
-    vertices = []
-
-    lines = open(obj_path, "r").readlines()
-    for line in lines:
-        if line.startswith("v "):
-            toks = line.split(" ")[1:]
-            vertices.append([float(toks[0]), float(toks[1]), float(toks[2])])
-    return np.array(vertices)
+    with open(obj_path, "rb") as fp:
+        data = fp.read()
+    lines = re.findall(rb"^v ([^\n]*)", data, re.MULTILINE)
+    vertices = np.array(
+        [line.split(b" ")[:3] for line in lines], dtype=np.float64
+    )
+    return vertices.reshape(-1, 3)
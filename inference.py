@@ -14,7 +14,6 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
-import sys
 import os
 import os.path as osp
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
@@ -24,11 +23,8 @@ import PIL.Image as pil_img
 from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 
-import open3d as o3d
-
 import time
 import argparse
-from collections import defaultdict
 from loguru import logger
 from collections import OrderedDict
 import numpy as np
@@ -37,74 +33,23 @@ import torch
 
 import resource
 
-from expose.utils.plot_utils import HDRenderer
 from expose.config.cmd_parser import set_face_contour
 from expose.config import cfg
-from expose.models.smplx_net import SMPLXNet
 from expose.data import make_all_data_loaders
-from expose.utils.checkpointer import Checkpointer
 from expose.data.targets.image_list import to_image_list
+from expose.utils.device_utils import (
+    select_device, synchronize, configure_threads)
+from expose.utils.timer import PROFILER
+from expose.utils.demo_utils import (
+    RENDERERS, build_model, build_renderer, weak_persp_to_blender,
+    undo_img_normalization)
+from expose.utils.mesh_io import write_mesh
 
 
 rlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
 resource.setrlimit(resource.RLIMIT_NOFILE, (rlimit[1], rlimit[1]))
 
 
-Vec3d = o3d.utility.Vector3dVector
-Vec3i = o3d.utility.Vector3iVector
-
-
-def weak_persp_to_blender(
-        targets,
-        camera_scale,
-        camera_transl,
-        H, W,
-        sensor_width=36,
-        focal_length=5000):
-    ''' Converts weak-perspective camera to a perspective camera
-    '''
-    if torch.is_tensor(camera_scale):
-        camera_scale = camera_scale.detach().cpu().numpy()
-    if torch.is_tensor(camera_transl):
-        camera_transl = camera_transl.detach().cpu().numpy()
-
-    output = defaultdict(lambda: [])
-    for ii, target in enumerate(targets):
-        orig_bbox_size = target.get_field('orig_bbox_size')
-        bbox_center = target.get_field('orig_center')
-        z = 2 * focal_length / (camera_scale[ii] * orig_bbox_size)
-
-        transl = [
-            camera_transl[ii, 0].item(), camera_transl[ii, 1].item(),
-            z.item()]
-        shift_x = - (bbox_center[0] / W - 0.5)
-        shift_y = (bbox_center[1] - 0.5 * H) / W
-        focal_length_in_mm = focal_length / W * sensor_width
-        output['shift_x'].append(shift_x)
-        output['shift_y'].append(shift_y)
-        output['transl'].append(transl)
-        output['focal_length_in_mm'].append(focal_length_in_mm)
-        output['focal_length_in_px'].append(focal_length)
-        output['center'].append(bbox_center)
-        output['sensor_width'].append(sensor_width)
-    for key in output:
-        output[key] = np.stack(output[key], axis=0)
-    return output
-
-
-def undo_img_normalization(image, mean, std, add_alpha=True):
-    if torch.is_tensor(image):
-        image = image.detach().cpu().numpy().squeeze()
-
-    out_img = (image * std[np.newaxis, :, np.newaxis, np.newaxis] +
-               mean[np.newaxis, :, np.newaxis, np.newaxis])
-    if add_alpha:
-        out_img = np.pad(
-            out_img, [[0, 0], [0, 1], [0, 0], [0, 0]],
-            mode='constant', constant_values=1.0)
-    return out_img
-
-
 @torch.no_grad()
 def main(
     exp_cfg,
@@ -116,12 +61,18 @@ def main(
     save_params=False,
     save_mesh=False,
     degrees=[],
+    device='auto',
+    channels_last=False,
+    bf16=False,
+    renderer_type='hd',
+    profile=False,
+    profile_trace='',
 ):
 
-    device = torch.device('cuda')
-    if not torch.cuda.is_available():
-        logger.error('CUDA is not available!')
-        sys.exit(3)
+    device = select_device(device)
+    profile = profile or bool(profile_trace)
+    if profile:
+        PROFILER.enable()
 
     logger.remove()
     logger.add(lambda x: tqdm.write(x, end=''),
@@ -132,25 +83,8 @@ def main(
     logger.info(f'Saving results to: {demo_output_folder}')
     os.makedirs(demo_output_folder, exist_ok=True)
 
-    model = SMPLXNet(exp_cfg)
-    try:
-        model = model.to(device=device)
-    except RuntimeError:
-        # Re-submit in case of a device error
-        sys.exit(3)
-
-    checkpoint_folder = osp.join(
-        exp_cfg.output_folder, exp_cfg.checkpoint_folder)
-    checkpointer = Checkpointer(model, save_dir=checkpoint_folder,
-                                pretrained=exp_cfg.pretrained)
-
-    arguments = {'iteration': 0, 'epoch_number': 0}
-    extra_checkpoint_data = checkpointer.load_checkpoint()
-    for key in arguments:
-        if key in extra_checkpoint_data:
-            arguments[key] = extra_checkpoint_data[key]
-
-    model = model.eval()
+    model = build_model(
+        exp_cfg, device, channels_last=channels_last, bf16=bf16)
 
     means = np.array(exp_cfg.datasets.body.transforms.mean)
     std = np.array(exp_cfg.datasets.body.transforms.std)
@@ -159,7 +93,7 @@ def main(
     body_crop_size = exp_cfg.get('datasets', {}).get('body', {}).get(
         'transforms').get('crop_size', 256)
     if render:
-        hd_renderer = HDRenderer(img_size=body_crop_size)
+        hd_renderer = build_renderer(renderer_type, img_size=body_crop_size)
 
     dataloaders = make_all_data_loaders(exp_cfg, split='test')
 
@@ -167,6 +101,7 @@ def main(
 
     total_time = 0
     cnt = 0
+    num_imgs = 0
     for bidx, batch in enumerate(tqdm(body_dloader, dynamic_ncols=True)):
 
         full_imgs_list, body_imgs, body_targets = batch
@@ -178,16 +113,25 @@ def main(
         body_targets = [target.to(device) for target in body_targets]
         full_imgs = full_imgs.to(device=device)
 
-        torch.cuda.synchronize()
+        if channels_last:
+            body_imgs = body_imgs.contiguous(
+                memory_format=torch.channels_last)
+
+        synchronize(device)
         start = time.perf_counter()
         model_output = model(body_imgs, body_targets, full_imgs=full_imgs,
                              device=device)
-        torch.cuda.synchronize()
+        synchronize(device)
         elapsed = time.perf_counter() - start
         cnt += 1
+        num_imgs += len(body_targets)
         total_time += elapsed
 
-        hd_imgs = full_imgs.images.detach().cpu().numpy().squeeze()
+        hd_imgs = full_imgs.images.detach().cpu().numpy()
+        if full_imgs.frame_idxs is not None:
+            # Every frame is stored once, expand them to one per person
+            hd_imgs = hd_imgs[full_imgs.frame_idxs.cpu().numpy()]
+        hd_imgs = hd_imgs.squeeze()
         body_imgs = body_imgs.detach().cpu().numpy()
         body_output = model_output.get('body')
 
@@ -310,20 +254,15 @@ def main(
 
             if save_mesh:
                 # Store the mesh predicted by the body-crop network
-                naive_mesh = o3d.geometry.TriangleMesh()
-                naive_mesh.vertices = Vec3d(
-                    model_vertices[idx] + hd_params['transl'][idx])
-                naive_mesh.triangles = Vec3i(faces)
-                mesh_fname = osp.join(curr_out_path, f'body_{fname}.ply')
-                o3d.io.write_triangle_mesh(mesh_fname, naive_mesh)
+                write_mesh(
+                    osp.join(curr_out_path, f'body_{fname}.ply'),
+                    model_vertices[idx] + hd_params['transl'][idx], faces)
 
                 # Store the final mesh
-                expose_mesh = o3d.geometry.TriangleMesh()
-                expose_mesh.vertices = Vec3d(
-                    final_model_vertices[idx] + hd_params['transl'][idx])
-                expose_mesh.triangles = Vec3i(faces)
-                mesh_fname = osp.join(curr_out_path, f'{fname}.ply')
-                o3d.io.write_triangle_mesh(mesh_fname, expose_mesh)
+                write_mesh(
+                    osp.join(curr_out_path, f'{fname}.ply'),
+                    final_model_vertices[idx] + hd_params['transl'][idx],
+                    faces)
 
             if save_params:
                 params_fname = osp.join(curr_out_path, f'{fname}_params.npz')
@@ -369,6 +308,12 @@ def main(
                     plt.show()
 
     logger.info(f'Average inference time: {total_time / cnt}')
+    logger.info(
+        f'Average inference time per image: {total_time / num_imgs}')
+    if profile:
+        PROFILER.log_summary()
+    if profile_trace:
+        PROFILER.export_chrome_trace(profile_trace)
 
 
 if __name__ == '__main__':
@@ -410,6 +355,32 @@ if __name__ == '__main__':
     parser.add_argument('--save-params', dest='save_params', default=False,
                         type=lambda x: x.lower() in ['true'],
                         help='Whether to save parameters')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for inference: auto, cpu,'
+                        ' cuda or cuda:N')
+    parser.add_argument('--num-threads', dest='num_threads', default=0,
+                        type=int,
+                        help='Intra-op threads for CPU inference, 0 uses all'
+                        ' the available cores')
+    parser.add_argument('--channels-last', dest='channels_last',
+                        default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones in channels-last layout')
+    parser.add_argument('--bf16', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones under bfloat16 autocast')
+    parser.add_argument('--renderer', dest='renderer_type', default='hd',
+                        choices=RENDERERS,
+                        help='The renderer used for the visualizations, the'
+                        ' software renderer needs no OpenGL context')
+    parser.add_argument('--profile', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Record the wall time and peak memory of the'
+                        ' model stages and log their percentiles')
+    parser.add_argument('--profile-trace', dest='profile_trace', default='',
+                        type=str,
+                        help='Save the profiled stages as a Chrome trace'
+                        ' to this JSON file')
 
     cmd_args = parser.parse_args()
 
@@ -430,11 +401,20 @@ if __name__ == '__main__':
     use_face_contour = cfg.datasets.use_face_contour
     set_face_contour(cfg, use_face_contour=use_face_contour)
 
-    with threadpool_limits(limits=1):
+    device = select_device(cmd_args.device)
+    num_threads = configure_threads(device, cmd_args.num_threads)
+
+    with threadpool_limits(limits=num_threads):
         main(cfg, show=show, demo_output_folder=output_folder, pause=pause,
              focal_length=focal_length,
              save_vis=save_vis,
              save_mesh=save_mesh,
              save_params=save_params,
              degrees=degrees,
+             device=device,
+             channels_last=cmd_args.channels_last,
+             bf16=cmd_args.bf16,
+             renderer_type=cmd_args.renderer_type,
+             profile=cmd_args.profile,
+             profile_trace=cmd_args.profile_trace,
              )
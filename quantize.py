@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+import os
+import os.path as osp
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from loguru import logger
+from tqdm import tqdm
+from threadpoolctl import threadpool_limits
+
+from expose.config import cfg
+from expose.config.cmd_parser import set_face_contour
+from expose.data import make_all_data_loaders
+from expose.data.detection import DetectionCropLoader, build_detector
+from expose.data.targets.image_list import to_image_list
+from expose.data.transforms import build_transforms
+from expose.evaluation import Evaluator, compute_agreement
+from expose.utils.demo_utils import build_model
+from expose.utils.device_utils import configure_threads
+from expose.utils.metrics import (
+    ProcrustesAlignmentMPJPE, RootAlignmentMPJPE)
+from expose.utils.quantization import (
+    QUANTIZATION_BACKENDS, quantize_backbones)
+
+
+def build_loader(image_folder, exp_cfg, rcnn_model, rcnn_batch=1,
+                 num_workers=4):
+    body_dsets_cfg = exp_cfg.get('datasets', {}).get('body', {})
+    transforms = build_transforms(
+        body_dsets_cfg.get('transforms', {}), is_train=False)
+    return DetectionCropLoader(
+        image_folder,
+        rcnn_model,
+        transforms=transforms,
+        batch_size=body_dsets_cfg.get('batch_size', 64),
+        rcnn_batch=rcnn_batch,
+        num_workers=num_workers,
+    )
+
+
+def run_batch(model: nn.Module, batch):
+    full_imgs_list, body_imgs, body_targets = batch
+    full_imgs = to_image_list(full_imgs_list)
+    output = model(body_imgs, body_targets, full_imgs=full_imgs,
+                   device=torch.device('cpu'))
+    body_output = output.get('body', {})
+    num_stages = body_output.get('num_stages', 1)
+    return body_output.get(
+        'final', body_output.get(f'stage_{num_stages - 1:02d}'))
+
+
+@torch.no_grad()
+def main(
+    exp_cfg,
+    calib_folder: str,
+    eval_folder: str = '',
+    output_folder: str = 'quantization',
+    backend: str = 'x86',
+    num_calib_batches: int = 16,
+    rcnn_batch: int = 1,
+    run_evaluator: bool = False,
+    save_model: bool = False,
+) -> None:
+    ''' Quantizes the backbones and reports the accuracy of the int8 model
+
+        The report compares the int8 model with the float model on the
+        images of `eval_folder`, using the float predictions as the
+        ground-truth, and is written to `quantization_report.json`. With
+        `run_evaluator` the `Evaluator` also scores both models on the test
+        datasets of the configuration, which need 3D annotations.
+    '''
+    device = torch.device('cpu')
+    output_folder = osp.expanduser(osp.expandvars(output_folder))
+    os.makedirs(output_folder, exist_ok=True)
+
+    model = build_model(exp_cfg, device)
+    rcnn_model = build_detector(device)
+
+    crop_size = exp_cfg.datasets.body.transforms.get('crop_size', 256)
+    calib_loader = build_loader(
+        calib_folder, exp_cfg, rcnn_model, rcnn_batch=rcnn_batch)
+
+    def calibrate(observed_model):
+        for bidx, batch in enumerate(calib_loader):
+            if num_calib_batches > 0 and bidx >= num_calib_batches:
+                break
+            if batch[0] is None:
+                continue
+            run_batch(observed_model, batch)
+
+    start = time.perf_counter()
+    quant_model = quantize_backbones(
+        model, calibrate, backend=backend, img_size=crop_size)
+    logger.info(f'Calibration: {time.perf_counter() - start:.1f} s')
+
+    if save_model:
+        model_path = osp.join(output_folder, f'model_int8_{backend}.pt')
+        # The whole module is saved, since the int8 graphs cannot be
+        # rebuilt from a state dict without calibrating again
+        torch.save(quant_model, model_path)
+        logger.info(f'Saved the int8 model to {model_path}')
+
+    joint_alignments = {'procrustes': ProcrustesAlignmentMPJPE(),
+                        'root': RootAlignmentMPJPE()}
+    vertex_alignments = {'procrustes': ProcrustesAlignmentMPJPE()}
+
+    mpjpe_err = {key: [] for key in joint_alignments}
+    v2v_err = {key: [] for key in vertex_alignments}
+    times = {'float32': 0.0, 'int8': 0.0}
+    num_people = 0
+    eval_loader = build_loader(
+        eval_folder or calib_folder, exp_cfg, rcnn_model,
+        rcnn_batch=rcnn_batch)
+    for batch in tqdm(eval_loader, desc='Comparing'):
+        if batch[0] is None:
+            continue
+        start = time.perf_counter()
+        ref_output = run_batch(model, batch)
+        times['float32'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        quant_output = run_batch(quant_model, batch)
+        times['int8'] += time.perf_counter() - start
+        num_people += len(batch[2])
+
+        for key, val in compute_agreement(
+                quant_output['joints'], ref_output['joints'],
+                joint_alignments).items():
+            mpjpe_err[key].append(val)
+        for key, val in compute_agreement(
+                quant_output['vertices'], ref_output['vertices'],
+                vertex_alignments).items():
+            v2v_err[key].append(val)
+
+    if num_people < 1:
+        logger.error('No people were detected in the evaluation images')
+        return
+
+    report = {
+        'backend': backend,
+        'num_people': num_people,
+        'latency_ms': {
+            key: val / num_people * 1000 for key, val in times.items()},
+    }
+    report['speedup'] = times['float32'] / max(times['int8'], 1e-8)
+    for metric_name, errors in [('MPJPE', mpjpe_err), ('V2V', v2v_err)]:
+        for alignment_name, val in errors.items():
+            val = np.concatenate(val, axis=0) * 1000
+            report[f'{alignment_name}/{metric_name}'] = {
+                'mean': float(val.mean()),
+                'p95': float(np.percentile(val, 95)),
+                'max': float(val.max()),
+            }
+            logger.info(
+                f'int8 vs float32, {alignment_name} {metric_name}:'
+                f' mean {val.mean():.2f} mm,'
+                f' p95 {np.percentile(val, 95):.2f} mm')
+    logger.info(
+        f'Latency per person (float32/int8):'
+        f' {report["latency_ms"]["float32"]:.1f}/'
+        f'{report["latency_ms"]["int8"]:.1f} ms,'
+        f' speedup: {report["speedup"]:.2f}x')
+
+    report_path = osp.join(output_folder, 'quantization_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Saved the report to {report_path}')
+
+    if run_evaluator:
+        dataloaders = make_all_data_loaders(exp_cfg, split='test')
+        # The float model is logged at step 0 and the int8 one at step 1
+        with Evaluator(exp_cfg) as evaluator:
+            evaluator.run(model, dataloaders, exp_cfg, device, step=0)
+            evaluator.run(quant_model, dataloaders, exp_cfg, device, step=1)
+
+
+if __name__ == '__main__':
+    arg_formatter = argparse.ArgumentDefaultsHelpFormatter
+    description = 'Post-training int8 quantization of the SMPL-X backbones'
+    parser = argparse.ArgumentParser(formatter_class=arg_formatter,
+                                     description=description)
+
+    parser.add_argument('--exp-cfg', type=str, dest='exp_cfg',
+                        help='The configuration of the experiment')
+    parser.add_argument('--exp-opts', default=[], dest='exp_opts',
+                        nargs='*', help='Extra command line arguments')
+    parser.add_argument('--calib-folder', type=str, dest='calib_folder',
+                        required=True,
+                        help='The folder with the calibration images')
+    parser.add_argument('--eval-folder', type=str, dest='eval_folder',
+                        default='',
+                        help='The folder with the images used to compare'
+                        ' the int8 and float models, defaults to the'
+                        ' calibration folder')
+    parser.add_argument('--output-folder', dest='output_folder',
+                        default='quantization', type=str,
+                        help='The folder for the report and the model')
+    parser.add_argument('--backend', default='x86', type=str,
+                        choices=QUANTIZATION_BACKENDS,
+                        help='The quantized engine')
+    parser.add_argument('--num-calib-batches', dest='num_calib_batches',
+                        default=16, type=int,
+                        help='The number of calibration batches, all the'
+                        ' images are used if it is not positive')
+    parser.add_argument('--rcnn-batch', dest='rcnn_batch', default=1,
+                        type=int, help='R-CNN batch size')
+    parser.add_argument('--run-evaluator', dest='run_evaluator',
+                        default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Evaluate both models on the test datasets of'
+                        ' the configuration')
+    parser.add_argument('--save-model', dest='save_model', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Save the int8 model in the output folder')
+    parser.add_argument('--num-threads', dest='num_threads', default=0,
+                        type=int,
+                        help='Number of CPU threads, 0 uses all the cores')
+
+    cmd_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda x: tqdm.write(x, end=''), level='INFO',
+               colorize=True)
+
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
+    cfg.is_training = False
+    set_face_contour(cfg, use_face_contour=cfg.datasets.use_face_contour)
+
+    num_threads = configure_threads(
+        torch.device('cpu'), cmd_args.num_threads)
+    with threadpool_limits(limits=num_threads):
+        main(
+            cfg,
+            cmd_args.calib_folder,
+            eval_folder=cmd_args.eval_folder,
+            output_folder=cmd_args.output_folder,
+            backend=cmd_args.backend,
+            num_calib_batches=cmd_args.num_calib_batches,
+            rcnn_batch=cmd_args.rcnn_batch,
+            run_evaluator=cmd_args.run_evaluator,
+            save_model=cmd_args.save_model,
+        )
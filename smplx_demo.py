@@ -22,6 +22,8 @@ import torch
 
 import smplx
 
+from expose.utils.body_model_cache import build_cached_body_model
+
 
 def main(model_folder,
          model_type='smplx',
@@ -33,13 +35,14 @@ def main(model_folder,
          sample_expression=True,
          num_expression_coeffs=10,
          plotting_module='pyrender',
-         use_face_contour=False):
-
-    model = smplx.create(model_folder, model_type=model_type,
-                         gender=gender, use_face_contour=use_face_contour,
-                         num_betas=num_betas,
-                         num_expression_coeffs=num_expression_coeffs,
-                         ext=ext)
+         use_face_contour=False,
+         cache_folder=''):
+
+    model = build_cached_body_model(
+        model_folder, smplx.create, cache_folder=cache_folder,
+        model_type=model_type, gender=gender,
+        use_face_contour=use_face_contour, num_betas=num_betas,
+        num_expression_coeffs=num_expression_coeffs, ext=ext)
     print(model)
 
     betas, expression = None, None
@@ -158,6 +161,11 @@ if __name__ == '__main__':
     parser.add_argument('--use-face-contour', default=False,
                         type=lambda arg: arg.lower() in ['true', '1'],
                         help='Compute the contour of the face')
+    parser.add_argument('--cache-folder', default='', type=str,
+                        dest='cache_folder',
+                        help='The folder of the prebuilt body models, e.g.'
+                        ' ~/.cache/wondermirror/body_models. The cache is'
+                        ' disabled when empty')
 
     args = parser.parse_args()
 
@@ -180,4 +188,5 @@ if __name__ == '__main__':
          sample_shape=sample_shape,
          sample_expression=sample_expression,
          plotting_module=plotting_module,
-         use_face_contour=use_face_contour)
\ No newline at end of file
+         use_face_contour=use_face_contour,
+         cache_folder=args.cache_folder)
\ No newline at end of file
@@ -0,0 +1,1199 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2020 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import os
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+
+import sys
+import math
+import time
+import json
+import queue
+import asyncio
+import argparse
+import threading
+import functools
+import os.path as osp
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import cv2
+from loguru import logger
+from threadpoolctl import threadpool_limits
+
+import torch
+
+from expose.config import cfg
+from expose.config.cmd_parser import set_face_contour
+from expose.data.build import collate_batch
+from expose.data.datasets.image_folder import crop_box_sample
+from expose.data.detection import build_detector, detect_people
+from expose.data.tracking import BoxTracker, TrackStateCache
+from expose.data.targets.image_list import to_image_list
+from expose.data.transforms import build_transforms
+from expose.models.common.networks import AdaptiveStages
+from expose.utils.async_writer import AsyncResultWriter
+from expose.utils.batch_jobs import Job, read_manifest, run_jobs
+from expose.utils.device_utils import (
+    select_device, synchronize, configure_threads, get_num_cpus, to_host)
+from expose.utils.demo_utils import (
+    RENDERERS, build_model, build_renderer, postprocess_output,
+    weak_persp_to_blender)
+from expose.utils.serving import (
+    DynamicBatcher, InferenceClient, InferenceServer, ServingStats,
+    generate_load)
+from expose.utils.stream_utils import (
+    DropOldestQueue, Frame, FrameSource, StreamEnd, StreamStats, STREAM_END)
+from expose.utils.img_utils import float_to_uint8
+from expose.utils.mesh_io import MESH_FORMATS, get_topology
+from expose.utils.typing_utils import Array
+
+FEET_TO_METERS = 0.3048
+
+# The outputs that a request to the server can ask for
+SERVING_OUTPUTS = ('params', 'meshes', 'overlay')
+# The final SMPL-X parameters returned with the `params` output
+PARAM_KEYS = ('global_orient', 'body_pose', 'left_hand_pose',
+              'right_hand_pose', 'jaw_pose', 'betas', 'expression')
+
+
+@dataclass
+class CameraSetup:
+    ''' The fixed single-camera installation of the mirror
+
+        All distances are in meters. The values are read from
+        `src/camera/setup_single_camera.py`, which describes the real life
+        setting in feet.
+    '''
+    camera_height: float
+    feet_height: float
+    horizontal_distance: float
+    # Horizontal field of view of the camera, in degrees
+    fov: float = 60.0
+
+    @classmethod
+    def from_setup_file(cls, fov: float = 60.0) -> 'CameraSetup':
+        from src.camera import setup_single_camera as setup
+
+        return cls(
+            camera_height=setup.cam_height_off_ground * FEET_TO_METERS,
+            feet_height=setup.feet_height_off_ground * FEET_TO_METERS,
+            horizontal_distance=setup.hori_dist_cam_feet * FEET_TO_METERS,
+            fov=fov,
+        )
+
+    @property
+    def pitch(self) -> float:
+        ''' Angle in degrees between the horizon and the ray to the feet '''
+        return math.degrees(math.atan2(
+            self.camera_height - self.feet_height, self.horizontal_distance))
+
+    @property
+    def subject_depth(self) -> float:
+        ''' Distance of the subject along the horizontal optical axis '''
+        return self.horizontal_distance
+
+    def focal_length(self, width: int) -> float:
+        ''' Focal length in pixels for a frame of the given width '''
+        return 0.5 * width / math.tan(math.radians(self.fov) * 0.5)
+
+
+class FocalCalibration(object):
+    ''' Calibrates the focal length from the known subject distance
+
+        The weak-perspective camera predicts a scale s for a crop of size b,
+        which places the body at depth z = 2 f / (s b). Since the subject
+        stands at a known distance from the fixed camera, the focal length
+        that makes the predicted depth metric is f = z s b / 2. It is
+        estimated as the median over the first detections and then frozen.
+    '''
+
+    def __init__(
+        self,
+        camera_setup: CameraSetup,
+        num_samples: int = 10,
+    ) -> None:
+        super(FocalCalibration, self).__init__()
+        self.camera_setup = camera_setup
+        self.num_samples = num_samples
+        self.samples = []
+        self.focal_length = None
+
+    @property
+    def is_calibrated(self) -> bool:
+        return self.focal_length is not None
+
+    def __call__(self, width: int) -> float:
+        if self.focal_length is not None:
+            return self.focal_length
+        return self.camera_setup.focal_length(width)
+
+    def update(self, camera_scale, orig_bbox_size) -> None:
+        if self.is_calibrated or self.num_samples < 1:
+            return
+        depth = self.camera_setup.subject_depth
+        self.samples.extend(
+            (0.5 * depth * np.asarray(camera_scale).reshape(-1) *
+             np.asarray(orig_bbox_size).reshape(-1)).tolist())
+        if len(self.samples) >= self.num_samples:
+            self.focal_length = float(np.median(self.samples))
+            logger.info(
+                f'Calibrated focal length: {self.focal_length:.1f} px')
+
+
+def crop_people(
+    frame: Frame,
+    boxes: np.ndarray,
+    transforms,
+    scale_factor: float = 1.2,
+) -> List[Tuple]:
+    ''' Builds the body crop samples of all the people of a frame
+
+        The full image is converted once and shared by all the samples, so
+        that `collate_batch` stores the frame a single time.
+    '''
+    samples = []
+    frame_tensor = None
+    for box_idx, bbox in enumerate(boxes):
+        full_img, cropped_img, target, index = crop_box_sample(
+            frame.image, bbox, f'frame_{frame.index:06d}', box_idx,
+            transforms=transforms, scale_factor=scale_factor,
+            return_full_img=frame_tensor is None)
+        if frame_tensor is None:
+            frame_tensor = full_img
+        samples.append((frame_tensor, cropped_img, target, index))
+    return samples
+
+
+class PipelineStage(threading.Thread):
+    ''' Applies a function to every item of a queue in its own thread '''
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Frame], Optional[Frame]],
+        in_queue: queue.Queue,
+        out_queue: queue.Queue,
+    ) -> None:
+        super(PipelineStage, self).__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+
+    def run(self) -> None:
+        try:
+            while True:
+                item = self.in_queue.get()
+                if isinstance(item, StreamEnd):
+                    break
+                output = self.func(item)
+                if output is not None:
+                    self.out_queue.put(output)
+        except Exception:
+            logger.exception(f'Stage {self.name} failed')
+        finally:
+            self.out_queue.put(STREAM_END)
+
+
+class StreamPipeline(object):
+    ''' Capture, detection, regression and rendering of a video stream
+
+        Each step runs in its own thread and the steps are connected by
+        small bounded queues, so that decoding, detection, the SMPLXNet
+        forward pass and rendering of consecutive frames overlap. For live
+        sources the queues evict the oldest frame under backpressure, so the
+        latency stays bounded when the regressor is slower than the camera.
+    '''
+
+    def __init__(
+        self,
+        exp_cfg,
+        device: torch.device,
+        camera_setup: CameraSetup,
+        channels_last: bool = False,
+        bf16: bool = False,
+        min_score: float = 0.5,
+        scale_factor: float = 1.2,
+        calibration_frames: int = 10,
+        sensor_width: float = 36,
+        detect_every: int = 1,
+        track_iou: float = 0.3,
+        track_box_scale: float = 1.2,
+        warm_start_stages: int = 0,
+        stage_delta_threshold: float = 0.0,
+        latency_budget: float = 0.0,
+    ) -> None:
+        super(StreamPipeline, self).__init__()
+        self.device = device
+        self.min_score = min_score
+        self.scale_factor = scale_factor
+        self.sensor_width = sensor_width
+        self.camera_setup = camera_setup
+        self.calibration = FocalCalibration(
+            camera_setup, num_samples=calibration_frames)
+
+        body_transfs_cfg = exp_cfg.datasets.body.transforms
+        self.transforms = build_transforms(body_transfs_cfg, is_train=False)
+        self.channels_last = channels_last
+
+        self.rcnn_model = build_detector(device, channels_last=channels_last)
+        self.model = build_model(
+            exp_cfg, device, channels_last=channels_last, bf16=bf16)
+
+        # Between detections the boxes follow the projected joints
+        self.tracker = None
+        if detect_every > 1 or warm_start_stages > 0:
+            self.tracker = BoxTracker(
+                detect_every=detect_every, iou_threshold=track_iou,
+                box_scale=track_box_scale)
+        # The regressors of tracked people start from their previous state
+        self.warm_start_stages = warm_start_stages
+        self.state_cache = TrackStateCache()
+        # Under load the regressors run fewer stages instead of queueing
+        self.stage_delta_threshold = stage_delta_threshold
+        self.latency_budget = latency_budget
+        self.stage_counts = Counter()
+
+    def run_detector(self, frame: Frame) -> np.ndarray:
+        return detect_people(
+            self.rcnn_model, [frame.image], self.device,
+            min_score=self.min_score)[0]
+
+    @torch.no_grad()
+    def detect(self, frame: Frame) -> Frame:
+        if self.tracker is None:
+            frame.data['batch'] = self.crop(frame, self.run_detector(frame))
+        elif self.tracker.is_scheduled(frame.index):
+            # The crops are cut by the regression stage, which owns the
+            # tracks
+            frame.data['boxes'] = self.run_detector(frame)
+        return frame
+
+    def track(self, frame: Frame) -> Frame:
+        boxes = frame.data.pop('boxes', None)
+        if boxes is None and self.tracker.needs_detection(frame.index):
+            # The tracks were lost or the scheduled frame was dropped
+            boxes = self.run_detector(frame)
+        if boxes is not None:
+            self.tracker.update(boxes, frame.index)
+        frame.data['track_ids'] = self.tracker.track_ids
+        frame.data['batch'] = self.crop(frame, self.tracker.boxes)
+        return frame
+
+    def crop(self, frame: Frame, boxes: np.ndarray):
+        samples = crop_people(
+            frame, boxes, self.transforms, scale_factor=self.scale_factor)
+        if len(samples) < 1:
+            return None
+        return collate_batch(samples, return_full_imgs=True, pin_memory=False)
+
+    @torch.no_grad()
+    def regress(self, frame: Frame) -> Frame:
+        if self.tracker is not None:
+            frame = self.track(frame)
+        batch = frame.data.pop('batch', None)
+        if batch is None:
+            return frame
+        full_imgs, body_imgs, body_targets = batch
+
+        full_imgs = to_image_list(full_imgs).to(device=self.device)
+        body_imgs = body_imgs.to(device=self.device)
+        if self.channels_last:
+            body_imgs = body_imgs.contiguous(
+                memory_format=torch.channels_last)
+        body_targets = [target.to(self.device) for target in body_targets]
+
+        init_state, num_stages = None, None
+        if self.warm_start_stages > 0:
+            init_state = self.state_cache.gather(frame.data['track_ids'])
+            num_stages = self.warm_start_stages
+
+        adaptive = None
+        if self.stage_delta_threshold > 0 or self.latency_budget > 0:
+            # The budget starts at the capture, so frames that waited in the
+            # queues get fewer stages
+            adaptive = AdaptiveStages(
+                delta_threshold=self.stage_delta_threshold,
+                deadline=(frame.timestamp + self.latency_budget
+                          if self.latency_budget > 0 else None))
+
+        model_output = self.model(
+            body_imgs, body_targets, full_imgs=full_imgs, device=self.device,
+            init_state=init_state, num_stages=num_stages, adaptive=adaptive)
+        synchronize(self.device)
+
+        body_output = model_output.get('body', {})
+        frame.data['stages_used'] = body_output['stages_used']
+        self.stage_counts[body_output['stages_used']['body']] += 1
+        final_out = body_output.get('final', {})
+        if self.warm_start_stages > 0:
+            self.state_cache.update(
+                frame.data['track_ids'], body_output['regression_state'])
+        camera_parameters = body_output.get('camera_parameters', {})
+        # The outputs used on the host are moved in one transfer
+        host_out = to_host({
+            'proj_joints': body_output['proj_joints'],
+            'camera_scale': camera_parameters['scale'],
+            'camera_transl': camera_parameters['translation'],
+            'vertices': final_out['vertices'],
+        })
+        if self.tracker is not None:
+            self.tracker.propagate(
+                host_out['proj_joints'],
+                np.stack([t.get_field('crop_transform')
+                          for t in body_targets]),
+                crop_size=body_imgs.shape[-1],
+                img_size=frame.image.shape[:2])
+
+        H, W = frame.image.shape[:2]
+        self.calibration.update(
+            host_out['camera_scale'],
+            [t.get_field('orig_bbox_size') for t in body_targets])
+        hd_params = weak_persp_to_blender(
+            body_targets,
+            camera_scale=host_out['camera_scale'],
+            camera_transl=host_out['camera_transl'],
+            H=H, W=W,
+            sensor_width=self.sensor_width,
+            focal_length=self.calibration(W),
+        )
+
+        frame.data['vertices'] = host_out['vertices']
+        frame.data['faces'] = final_out['faces']
+        frame.data['hd_params'] = hd_params
+        return frame
+
+
+def render_frame(renderer, frame: Frame) -> np.ndarray:
+    ''' Overlays all the people of a frame on the captured image
+
+        The overlays are composited on a uint8 copy of the frame, which is
+        returned as a HxWx3 uint8 image.
+    '''
+    output = float_to_uint8(frame.image)[np.newaxis]
+    if 'vertices' not in frame.data:
+        return output[0]
+
+    hd_params = frame.data['hd_params']
+    vertices = frame.data['vertices']
+    for idx in range(len(vertices)):
+        output = renderer(
+            vertices[[idx]], frame.data['faces'],
+            focal_length=hd_params['focal_length_in_px'][[idx]],
+            camera_translation=hd_params['transl'][[idx]],
+            camera_center=hd_params['center'][[idx]],
+            bg_imgs=output,
+            body_color=[0.4, 0.4, 0.7],
+            uint8=True,
+        )
+    return output[0]
+
+
+class ServingPipeline(object):
+    ''' Detection and regression of the requests sent to the server
+
+        The detector and SMPLXNet stay resident. All the images of a batch of
+        requests go through the detector in one call and all the detected
+        people through a single SMPLXNet forward pass. The outputs are then
+        split per request.
+    '''
+
+    def __init__(
+        self,
+        exp_cfg,
+        device: torch.device,
+        camera_setup: CameraSetup,
+        channels_last: bool = False,
+        bf16: bool = False,
+        min_score: float = 0.5,
+        scale_factor: float = 1.2,
+        sensor_width: float = 36,
+        renderer_type: str = 'hd',
+    ) -> None:
+        super(ServingPipeline, self).__init__()
+        self.device = device
+        self.camera_setup = camera_setup
+        self.min_score = min_score
+        self.scale_factor = scale_factor
+        self.sensor_width = sensor_width
+        self.channels_last = channels_last
+
+        body_transfs_cfg = exp_cfg.datasets.body.transforms
+        self.transforms = build_transforms(body_transfs_cfg, is_train=False)
+        self.rcnn_model = build_detector(device, channels_last=channels_last)
+        self.model = build_model(
+            exp_cfg, device, channels_last=channels_last, bf16=bf16)
+
+        self.renderer_type = renderer_type
+        self.body_crop_size = body_transfs_cfg.get('crop_size', 256)
+        # Created by the batch thread, which owns the GL context
+        self.renderer = None
+
+    def decode(self, header: Dict, arrays: Dict[str, Array]) -> Frame:
+        ''' Converts a request to a frame with a float32 RGB image '''
+        outputs = header.get('outputs', ['params'])
+        unknown = set(outputs) - set(SERVING_OUTPUTS)
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown outputs: {sorted(unknown)}')
+        if 'image' not in arrays:
+            raise ValueError('The request does not contain an image')
+
+        image = arrays['image']
+        if header.get('encoded', True):
+            bgr_img = cv2.imdecode(np.asarray(image), cv2.IMREAD_COLOR)
+            if bgr_img is None:
+                raise ValueError('Could not decode the image')
+            image = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+        if image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError(f'Expected a HxWx3 image, got {image.shape}')
+        image = image.astype(np.float32) / 255.0
+        return Frame(header.get('id', 0), time.perf_counter(), image,
+                     data={'outputs': outputs})
+
+    def respond(self, frame: Frame) -> Tuple[Dict, Dict[str, Array]]:
+        ''' Collects the requested outputs of a processed frame '''
+        outputs = frame.data['outputs']
+        num_people = len(frame.data['boxes'])
+        arrays = {'boxes': frame.data['boxes'].astype(np.float32)}
+        if num_people > 0 and 'params' in outputs:
+            hd_params = frame.data['hd_params']
+            arrays['camera_translation'] = hd_params['transl'].astype(
+                np.float32)
+            arrays['camera_center'] = hd_params['center'].astype(np.float32)
+            arrays['focal_length'] = hd_params['focal_length_in_px'].astype(
+                np.float32)
+            arrays.update(frame.data['params'])
+        if num_people > 0 and 'meshes' in outputs:
+            arrays['vertices'] = frame.data['vertices']
+            arrays['faces'] = frame.data['faces'].astype(np.int32)
+        if 'overlay' in outputs:
+            if self.renderer is None:
+                self.renderer = build_renderer(
+                    self.renderer_type, img_size=self.body_crop_size)
+            arrays['overlay'] = render_frame(self.renderer, frame)
+        return {'num_people': num_people}, arrays
+
+    @torch.no_grad()
+    def process_batch(
+        self,
+        frames: List[Frame],
+    ) -> List[Tuple[Dict, Dict[str, Array]]]:
+        boxes = detect_people(
+            self.rcnn_model, [frame.image for frame in frames], self.device,
+            min_score=self.min_score)
+
+        samples, num_people = [], []
+        for frame, frame_boxes in zip(frames, boxes):
+            frame.data['boxes'] = frame_boxes
+            frame_samples = crop_people(
+                frame, frame_boxes, self.transforms,
+                scale_factor=self.scale_factor)
+            samples += frame_samples
+            num_people.append(len(frame_samples))
+
+        if len(samples) > 0:
+            self.regress(frames, samples, num_people)
+
+        results = []
+        for frame in frames:
+            try:
+                results.append(self.respond(frame))
+            except Exception as e:
+                logger.exception(f'Request {frame.index} failed')
+                results.append(e)
+        return results
+
+    def regress(
+        self,
+        frames: List[Frame],
+        samples: List[Tuple],
+        num_people: List[int],
+    ) -> None:
+        full_imgs, body_imgs, body_targets = collate_batch(
+            samples, return_full_imgs=True, pin_memory=False)
+        full_imgs = full_imgs.to(device=self.device)
+        body_imgs = body_imgs.to(device=self.device)
+        if self.channels_last:
+            body_imgs = body_imgs.contiguous(
+                memory_format=torch.channels_last)
+        body_targets = [target.to(self.device) for target in body_targets]
+
+        model_output = self.model(
+            body_imgs, body_targets, full_imgs=full_imgs, device=self.device)
+        synchronize(self.device)
+
+        # The frames of a batch can differ in size, so the image size and
+        # the focal length of the cameras are given per person
+        sizes = np.array(
+            [frame.image.shape[:2] for frame, count in zip(frames, num_people)
+             for _ in range(count)], dtype=np.float32)
+        focal_length = np.array(
+            [self.camera_setup.focal_length(W) for W in sizes[:, 1]],
+            dtype=np.float32)
+        host_out = postprocess_output(
+            model_output, body_targets, H=sizes[:, 0], W=sizes[:, 1],
+            sensor_width=self.sensor_width, focal_length=focal_length,
+            param_keys=PARAM_KEYS)
+        faces = model_output['body']['final']['faces']
+
+        start = 0
+        for frame, count in zip(frames, num_people):
+            if count < 1:
+                continue
+            people = slice(start, start + count)
+            start += count
+            frame.data['hd_params'] = {
+                key: value[people]
+                for key, value in host_out['hd_params'].items()}
+            frame.data['vertices'] = host_out['vertices'][people]
+            frame.data['faces'] = faces
+            frame.data['params'] = {
+                key: value[people]
+                for key, value in host_out['params'].items()}
+
+
+class ManifestJobProcessor(object):
+    ''' Runs the jobs of a manifest with a resident serving pipeline
+
+        The images of a job are sent through the pipeline in batches and
+        the requested outputs are written in the background. A job returns
+        only after its files are synced to disk, so that a completed record
+        in the result log always has its outputs.
+    '''
+
+    def __init__(
+        self,
+        pipeline: ServingPipeline,
+        batch_size: int = 8,
+        writer_threads: int = 4,
+    ) -> None:
+        super(ManifestJobProcessor, self).__init__()
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.result_writer = AsyncResultWriter(num_workers=writer_threads)
+
+    def __call__(self, job: Job) -> Dict:
+        options = job.options
+        outputs = []
+        # The meshes are stored in the camera frame, which needs the
+        # camera translation returned with the parameters
+        if options['save_params'] or options['save_mesh']:
+            outputs.append('params')
+        if options['save_mesh']:
+            outputs.append('meshes')
+        if options['save_vis']:
+            outputs.append('overlay')
+
+        timings = {'read': 0.0, 'inference': 0.0, 'write': 0.0}
+        num_people = 0
+        for start in range(0, len(job.images), self.batch_size):
+            paths = job.images[start:start + self.batch_size]
+
+            read_start = time.perf_counter()
+            frames = [
+                Frame(start + idx, time.perf_counter(),
+                      image.astype(np.float32) / 255.0,
+                      data={'outputs': outputs})
+                for idx, image in enumerate(
+                    read_request_images(paths, encoded=False))]
+            timings['read'] += time.perf_counter() - read_start
+
+            inference_start = time.perf_counter()
+            results = self.pipeline.process_batch(frames)
+            timings['inference'] += time.perf_counter() - inference_start
+
+            write_start = time.perf_counter()
+            for path, result in zip(paths, results):
+                if isinstance(result, Exception):
+                    raise result
+                header, arrays = result
+                num_people += header['num_people']
+                self.save(job, path, arrays)
+            timings['write'] += time.perf_counter() - write_start
+
+        write_start = time.perf_counter()
+        self.result_writer.flush()
+        timings['write'] += time.perf_counter() - write_start
+        return {'num_people': num_people, 'timings': timings}
+
+    def save(self, job: Job, path: str, arrays: Dict[str, Array]) -> None:
+        fname = osp.splitext(osp.basename(path))[0]
+        out_path = osp.join(job.output_folder, fname)
+
+        overlay = arrays.pop('overlay', None)
+        if overlay is not None:
+            self.result_writer.save_image(f'{out_path}_overlay.png', overlay)
+        vertices = arrays.pop('vertices', None)
+        faces = arrays.pop('faces', None)
+        if job.options['save_mesh'] and vertices is not None:
+            mesh_format = job.options['mesh_format']
+            topology = get_topology(faces)
+            for idx, (person_vertices, transl) in enumerate(
+                    zip(vertices, arrays['camera_translation'])):
+                self.result_writer.save_mesh(
+                    f'{out_path}_{idx:02d}.{mesh_format}',
+                    person_vertices + transl, topology)
+        if job.options['save_params']:
+            self.result_writer.save_params(
+                f'{out_path}_params.npz', dict(arrays, fname=fname))
+
+    def close(self) -> None:
+        self.result_writer.close()
+
+
+@torch.no_grad()
+def stream(
+    exp_cfg,
+    source: str,
+    device: torch.device,
+    camera_setup: CameraSetup,
+    queue_size: int = 2,
+    drop_frames: str = 'auto',
+    show: bool = False,
+    render: bool = True,
+    renderer_type: str = 'hd',
+    max_frames: int = -1,
+    channels_last: bool = False,
+    bf16: bool = False,
+    min_score: float = 0.5,
+    calibration_frames: int = 10,
+    log_every: float = 5.0,
+    detect_every: int = 1,
+    track_iou: float = 0.3,
+    track_box_scale: float = 1.2,
+    warm_start_stages: int = 0,
+    stage_delta_threshold: float = 0.0,
+    latency_budget: float = 0.0,
+) -> StreamStats:
+    pipeline = StreamPipeline(
+        exp_cfg, device, camera_setup,
+        channels_last=channels_last, bf16=bf16, min_score=min_score,
+        calibration_frames=calibration_frames, detect_every=detect_every,
+        track_iou=track_iou, track_box_scale=track_box_scale,
+        warm_start_stages=warm_start_stages,
+        stage_delta_threshold=stage_delta_threshold,
+        latency_budget=latency_budget)
+
+    renderer = None
+    if render or show:
+        body_crop_size = exp_cfg.datasets.body.transforms.get(
+            'crop_size', 256)
+        # Created here, since the GL context belongs to this thread
+        renderer = build_renderer(renderer_type, img_size=body_crop_size)
+
+    frame_queue = DropOldestQueue(queue_size)
+    source_thread = FrameSource(source, frame_queue, max_frames=max_frames)
+    if drop_frames == 'auto':
+        drop = source_thread.is_live
+    else:
+        drop = drop_frames.lower() in ['true']
+    frame_queue.drop = drop
+    logger.info(f'Streaming from {source}, dropping stale frames: {drop}')
+
+    detect_queue = DropOldestQueue(queue_size, drop=drop)
+    result_queue = DropOldestQueue(queue_size, drop=drop)
+    queues = [frame_queue, detect_queue, result_queue]
+    stages = [
+        PipelineStage('detect', pipeline.detect, frame_queue, detect_queue),
+        PipelineStage('regress', pipeline.regress, detect_queue,
+                      result_queue),
+    ]
+
+    stats = StreamStats(log_every=log_every)
+    source_thread.start()
+    for stage in stages:
+        stage.start()
+
+    finished = False
+    try:
+        while True:
+            frame = result_queue.get()
+            if isinstance(frame, StreamEnd):
+                finished = True
+                break
+            if renderer is not None:
+                overlay = render_frame(renderer, frame)
+                if show:
+                    bgr_img = cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR)
+                    cv2.imshow('WonderMirror', bgr_img)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
+            stats.update(frame)
+            stats.maybe_log(sum(q.num_dropped for q in queues))
+    except KeyboardInterrupt:
+        logger.info('Stopping the stream')
+    finally:
+        source_thread.stop()
+        # Unblock the stages, in case the consumer stopped early
+        for q in queues:
+            q.drop = True
+        while not finished:
+            finished = isinstance(result_queue.get(), StreamEnd)
+        source_thread.join()
+        for stage in stages:
+            stage.join()
+        if show:
+            cv2.destroyAllWindows()
+
+    stats.log(sum(q.num_dropped for q in queues), overall=True)
+    if pipeline.tracker is not None:
+        pipeline.tracker.log_summary()
+    logger.info('Body regression stages used: ' + ', '.join(
+        f'{num_stages}: {count} frames'
+        for num_stages, count in sorted(pipeline.stage_counts.items())))
+    return stats
+
+
+def add_model_args(parser) -> None:
+    parser.add_argument('--exp-cfg', type=str, dest='exp_cfg',
+                        required=True,
+                        help='The configuration of the experiment')
+    parser.add_argument('--exp-opts', default=[], dest='exp_opts',
+                        nargs='*', help='Extra command line arguments')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='The device used for inference: auto, cpu,'
+                        ' cuda or cuda:N')
+    parser.add_argument('--num-threads', dest='num_threads', default=0,
+                        type=int,
+                        help='Intra-op threads for CPU inference, 0 uses all'
+                        ' the available cores')
+    parser.add_argument('--channels-last', dest='channels_last',
+                        default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones in channels-last layout')
+    parser.add_argument('--bf16', default=False,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Run the backbones under bfloat16 autocast')
+    parser.add_argument('--min-score', dest='min_score', default=0.5,
+                        type=float,
+                        help='Minimum score of the person detections')
+
+
+def merge_cfg(cmd_args):
+    cfg.merge_from_file(cmd_args.exp_cfg)
+    cfg.merge_from_list(cmd_args.exp_opts)
+    cfg.is_training = False
+    use_face_contour = cfg.datasets.use_face_contour
+    set_face_contour(cfg, use_face_contour=use_face_contour)
+    return cfg
+
+
+def run_stream(cmd_args) -> None:
+    exp_cfg = merge_cfg(cmd_args)
+    logger.remove()
+    logger.add(sys.stderr, level=exp_cfg.logger_level.upper(),
+               colorize=True)
+
+    device = select_device(cmd_args.device)
+    num_threads = configure_threads(device, cmd_args.num_threads)
+
+    camera_setup = CameraSetup.from_setup_file(fov=cmd_args.fov)
+    logger.info(
+        f'Camera height: {camera_setup.camera_height:.2f} m, subject depth:'
+        f' {camera_setup.subject_depth:.2f} m, pitch to the feet:'
+        f' {camera_setup.pitch:.1f} deg')
+
+    with threadpool_limits(limits=num_threads):
+        stream(
+            exp_cfg,
+            cmd_args.source,
+            device,
+            camera_setup,
+            queue_size=cmd_args.queue_size,
+            drop_frames=cmd_args.drop_frames,
+            show=cmd_args.show,
+            render=cmd_args.render,
+            renderer_type=cmd_args.renderer_type,
+            max_frames=cmd_args.max_frames,
+            channels_last=cmd_args.channels_last,
+            bf16=cmd_args.bf16,
+            min_score=cmd_args.min_score,
+            calibration_frames=cmd_args.calibration_frames,
+            log_every=cmd_args.log_every,
+            detect_every=cmd_args.detect_every,
+            track_iou=cmd_args.track_iou,
+            track_box_scale=cmd_args.track_box_scale,
+            warm_start_stages=cmd_args.warm_start_stages,
+            stage_delta_threshold=cmd_args.stage_delta_threshold,
+            latency_budget=cmd_args.latency_budget / 1000,
+        )
+
+
+def run_serve(cmd_args) -> None:
+    exp_cfg = merge_cfg(cmd_args)
+    logger.remove()
+    logger.add(sys.stderr, level=exp_cfg.logger_level.upper(),
+               colorize=True)
+
+    device = select_device(cmd_args.device)
+    num_threads = configure_threads(device, cmd_args.num_threads)
+    camera_setup = CameraSetup.from_setup_file(fov=cmd_args.fov)
+
+    pipeline = ServingPipeline(
+        exp_cfg, device, camera_setup,
+        channels_last=cmd_args.channels_last, bf16=cmd_args.bf16,
+        min_score=cmd_args.min_score, renderer_type=cmd_args.renderer_type)
+    batcher = DynamicBatcher(
+        pipeline.process_batch,
+        max_batch_size=cmd_args.max_batch_size,
+        max_latency=cmd_args.max_latency / 1000,
+        stats=ServingStats(log_every=cmd_args.log_every))
+    server = InferenceServer(
+        batcher, pipeline.decode, host=cmd_args.host, port=cmd_args.port)
+
+    with threadpool_limits(limits=num_threads):
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            logger.info('Stopping the server')
+
+
+def build_job_processor(cmd_args, worker_idx: int) -> ManifestJobProcessor:
+    ''' Creates the models of a job worker, runs in the worker process '''
+    exp_cfg = merge_cfg(cmd_args)
+    logger.remove()
+    logger.add(sys.stderr, level=exp_cfg.logger_level.upper(),
+               colorize=True)
+
+    device = select_device(cmd_args.device)
+    num_threads = cmd_args.num_threads
+    if device.type == 'cpu' and num_threads < 1:
+        # Split the cores between the workers instead of oversubscribing
+        num_threads = max(get_num_cpus() // max(cmd_args.num_workers, 1), 1)
+    num_threads = configure_threads(device, num_threads)
+    threadpool_limits(limits=num_threads)
+
+    pipeline = ServingPipeline(
+        exp_cfg, device, CameraSetup.from_setup_file(fov=cmd_args.fov),
+        channels_last=cmd_args.channels_last, bf16=cmd_args.bf16,
+        min_score=cmd_args.min_score, renderer_type=cmd_args.renderer_type)
+    logger.info(f'Worker {worker_idx} loaded the models on {device}')
+    return ManifestJobProcessor(
+        pipeline, batch_size=cmd_args.batch_size,
+        writer_threads=cmd_args.writer_threads)
+
+
+def run_manifest(cmd_args) -> None:
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', colorize=True)
+
+    defaults = {'save_params': cmd_args.save_params,
+                'save_mesh': cmd_args.save_mesh,
+                'save_vis': cmd_args.save_vis,
+                'mesh_format': cmd_args.mesh_format}
+    jobs = read_manifest(
+        cmd_args.manifest, cmd_args.output_folder, defaults=defaults)
+    log_path = cmd_args.result_log or osp.join(
+        cmd_args.output_folder, 'results.jsonl')
+    logger.info(
+        f'Read {len(jobs)} jobs from {cmd_args.manifest}, logging the'
+        f' results to {log_path}')
+
+    # Only the options are sent to the workers, the handler of the
+    # subcommand is not needed there
+    worker_args = argparse.Namespace(**{
+        key: value for key, value in vars(cmd_args).items()
+        if key != 'func'})
+    summary = run_jobs(
+        jobs, functools.partial(build_job_processor, worker_args), log_path,
+        num_workers=cmd_args.num_workers)
+    # Jobs that no worker ran, e.g. when the models fail to load in every
+    # worker, are a failed run as well
+    if summary['failed'] + summary['lost'] + summary['unfinished'] > 0:
+        sys.exit(1)
+
+
+def read_request_images(paths: List[str], encoded: bool = True) -> List[Array]:
+    ''' Reads the files sent to the server
+
+        Encoded images are sent as the bytes of the file, otherwise they are
+        decoded here and sent as uint8 RGB arrays.
+    '''
+    images = []
+    for path in paths:
+        if encoded:
+            images.append(np.fromfile(path, dtype=np.uint8))
+            continue
+        bgr_img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if bgr_img is None:
+            raise IOError(f'Could not read image: {path}')
+        images.append(cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB))
+    return images
+
+
+async def query(cmd_args) -> None:
+    images = read_request_images(cmd_args.images, encoded=cmd_args.encoded)
+    async with InferenceClient(cmd_args.host, cmd_args.port) as client:
+        # All the images are in flight at once, so the server can batch them
+        responses = await asyncio.gather(*[
+            client.infer(image, outputs=cmd_args.outputs,
+                         encoded=cmd_args.encoded)
+            for image in images])
+
+    os.makedirs(cmd_args.output_folder, exist_ok=True)
+    for path, (header, arrays) in zip(cmd_args.images, responses):
+        if header['status'] != 'ok':
+            logger.error(f'{path}: {header.get("error")}')
+            continue
+        logger.info(
+            f'{path}: {header["num_people"]} people, batch size:'
+            f' {header["batch_size"]}, server latency:'
+            f' {header["server_latency"] * 1000:.1f} ms')
+        fname = osp.splitext(osp.basename(path))[0]
+        overlay = arrays.pop('overlay', None)
+        if overlay is not None:
+            cv2.imwrite(
+                osp.join(cmd_args.output_folder, f'{fname}_overlay.png'),
+                cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+        np.savez_compressed(
+            osp.join(cmd_args.output_folder, f'{fname}.npz'), **arrays)
+
+
+def run_client(cmd_args) -> None:
+    asyncio.run(query(cmd_args))
+
+
+def run_loadgen(cmd_args) -> None:
+    images = read_request_images(cmd_args.images, encoded=cmd_args.encoded)
+    summary = asyncio.run(generate_load(
+        cmd_args.host, cmd_args.port, images,
+        num_requests=cmd_args.num_requests,
+        concurrency=cmd_args.concurrency,
+        outputs=cmd_args.outputs,
+        encoded=cmd_args.encoded))
+
+    server_stats = summary['server']
+    logger.info(
+        f'{summary["requests"]} requests from {summary["concurrency"]}'
+        f' clients in {summary["elapsed"]:.2f} s,'
+        f' throughput: {summary["throughput"]:.2f} req/s,'
+        f' latency (mean/p50/p95): {summary["latency_mean"] * 1000:.1f}/'
+        f'{summary["latency_p50"] * 1000:.1f}/'
+        f'{summary["latency_p95"] * 1000:.1f} ms,'
+        f' errors: {summary["errors"]}')
+    logger.info(
+        f'Server mean batch size: {server_stats["mean_batch_size"]:.2f},'
+        f' batch sizes: {server_stats["batch_size_histogram"]}')
+    if cmd_args.output_json:
+        with open(cmd_args.output_json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def add_client_args(parser) -> None:
+    parser.add_argument('--host', default='127.0.0.1', type=str,
+                        help='The address of the server')
+    parser.add_argument('--port', default=8765, type=int,
+                        help='The port of the server')
+    parser.add_argument('--images', nargs='+', required=True,
+                        help='The image files sent to the server')
+    parser.add_argument('--outputs', nargs='+', default=['params'],
+                        choices=SERVING_OUTPUTS,
+                        help='The outputs requested for every image')
+    parser.add_argument('--encoded', default=True,
+                        type=lambda x: x.lower() in ['true'],
+                        help='Send the image files as they are and decode'
+                        ' them on the server, otherwise send raw RGB arrays')
+
+
+if __name__ == '__main__':
+    arg_formatter = argparse.ArgumentDefaultsHelpFormatter
+    description = 'WonderMirror SMPL-X regression service'
+    parser = argparse.ArgumentParser(formatter_class=arg_formatter,
+                                     description=description)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    stream_parser = subparsers.add_parser(
+        'stream', formatter_class=arg_formatter,
+        help='Run the regressor on a live camera or a video file')
+    add_model_args(stream_parser)
+    stream_parser.add_argument('--source', default='0', type=str,
+                               help='Camera device index or video file')
+    stream_parser.add_argument('--queue-size', dest='queue_size', default=2,
+                               type=int,
+                               help='Capacity of the queues between stages')
+    stream_parser.add_argument('--drop-frames', dest='drop_frames',
+                               default='auto', type=str,
+                               choices=['auto', 'true', 'false'],
+                               help='Drop stale frames under backpressure,'
+                               ' auto only drops for live cameras')
+    stream_parser.add_argument('--show', default=False,
+                               type=lambda x: x.lower() in ['true'],
+                               help='Display the overlays')
+    stream_parser.add_argument('--render', default=True,
+                               type=lambda x: x.lower() in ['true'],
+                               help='Render the overlays')
+    stream_parser.add_argument('--renderer', dest='renderer_type',
+                               default='hd', choices=RENDERERS,
+                               help='The renderer used for the overlays')
+    stream_parser.add_argument('--max-frames', dest='max_frames',
+                               default=-1, type=int,
+                               help='Stop after this many frames')
+    stream_parser.add_argument('--fov', default=60.0, type=float,
+                               help='Horizontal field of view of the camera'
+                               ' in degrees')
+    stream_parser.add_argument('--calibration-frames',
+                               dest='calibration_frames', default=10,
+                               type=int,
+                               help='Number of detections used to calibrate'
+                               ' the focal length from the subject distance,'
+                               ' 0 keeps the field of view estimate')
+    stream_parser.add_argument('--log-every', dest='log_every', default=5.0,
+                               type=float,
+                               help='Seconds between throughput reports')
+    stream_parser.add_argument('--detect-every', dest='detect_every',
+                               default=1, type=int,
+                               help='Run the person detector every N frames'
+                               ' and track the boxes with the projected'
+                               ' joints in between, 1 detects on every'
+                               ' frame')
+    stream_parser.add_argument('--track-iou', dest='track_iou', default=0.3,
+                               type=float,
+                               help='Minimum IoU to associate a detection'
+                               ' with a tracked box')
+    stream_parser.add_argument('--track-box-scale', dest='track_box_scale',
+                               default=1.2, type=float,
+                               help='Scale of the box around the projected'
+                               ' joints of a tracked person')
+    stream_parser.add_argument('--warm-start-stages',
+                               dest='warm_start_stages', default=0,
+                               type=int,
+                               help='Start the regressors of tracked people'
+                               ' from their previous estimate and run this'
+                               ' many stages, 0 disables the warm start')
+    stream_parser.add_argument('--stage-delta-threshold',
+                               dest='stage_delta_threshold', default=0.0,
+                               type=float,
+                               help='Stop the iterative regression when the'
+                               ' largest update of a stage is below this'
+                               ' value, 0 runs all the stages')
+    stream_parser.add_argument('--latency-budget', dest='latency_budget',
+                               default=0.0, type=float,
+                               help='Milliseconds from the capture of a'
+                               ' frame after which no further regression'
+                               ' stages are run, 0 disables the budget')
+    stream_parser.set_defaults(func=run_stream)
+
+    serve_parser = subparsers.add_parser(
+        'serve', formatter_class=arg_formatter,
+        help='Serve batched requests on a local socket')
+    add_model_args(serve_parser)
+    serve_parser.add_argument('--host', default='127.0.0.1', type=str,
+                              help='The address to listen on')
+    serve_parser.add_argument('--port', default=8765, type=int,
+                              help='The port to listen on')
+    serve_parser.add_argument('--max-batch-size', dest='max_batch_size',
+                              default=8, type=int,
+                              help='The maximum number of requests per'
+                              ' batch')
+    serve_parser.add_argument('--max-latency', dest='max_latency',
+                              default=10.0, type=float,
+                              help='Milliseconds a request waits for other'
+                              ' requests to join its batch')
+    serve_parser.add_argument('--renderer', dest='renderer_type',
+                              default='hd', choices=RENDERERS,
+                              help='The renderer used for the overlays')
+    serve_parser.add_argument('--fov', default=60.0, type=float,
+                              help='Horizontal field of view of the'
+                              ' cameras in degrees')
+    serve_parser.add_argument('--log-every', dest='log_every', default=10.0,
+                              type=float,
+                              help='Seconds between statistics reports, 0'
+                              ' only reports when the server stops')
+    serve_parser.set_defaults(func=run_serve)
+
+    client_parser = subparsers.add_parser(
+        'client', formatter_class=arg_formatter,
+        help='Send images to a running server and save the outputs')
+    add_client_args(client_parser)
+    client_parser.add_argument('--output-folder', dest='output_folder',
+                               default='serving_output', type=str,
+                               help='The folder for the outputs')
+    client_parser.set_defaults(func=run_client)
+
+    loadgen_parser = subparsers.add_parser(
+        'loadgen', formatter_class=arg_formatter,
+        help='Measure the throughput of a running server')
+    add_client_args(loadgen_parser)
+    loadgen_parser.add_argument('--num-requests', dest='num_requests',
+                                default=200, type=int,
+                                help='The total number of requests')
+    loadgen_parser.add_argument('--concurrency', default=8, type=int,
+                                help='The number of clients that send'
+                                ' requests at the same time')
+    loadgen_parser.add_argument('--output-json', dest='output_json',
+                                default='', type=str,
+                                help='Write the summary to this file')
+    loadgen_parser.set_defaults(func=run_loadgen)
+
+    jobs_parser = subparsers.add_parser(
+        'jobs', formatter_class=arg_formatter,
+        help='Run the jobs of a JSONL manifest on worker processes,'
+        ' resuming an interrupted run')
+    add_model_args(jobs_parser)
+    jobs_parser.add_argument('--manifest', required=True, type=str,
+                             help='The JSONL file with one job per line')
+    jobs_parser.add_argument('--output-folder', dest='output_folder',
+                             default='jobs_output', type=str,
+                             help='The folder for the outputs of the jobs'
+                             ' that do not set their own')
+    jobs_parser.add_argument('--result-log', dest='result_log', default='',
+                             type=str,
+                             help='The JSONL log of the finished jobs, which'
+                             ' is used to resume the run. Defaults to'
+                             ' results.jsonl in the output folder')
+    jobs_parser.add_argument('--num-workers', dest='num_workers', default=1,
+                             type=int,
+                             help='The number of worker processes, each with'
+                             ' its own copy of the models. 0 runs the jobs'
+                             ' in the main process')
+    jobs_parser.add_argument('--batch-size', dest='batch_size', default=8,
+                             type=int,
+                             help='The number of images of a job that are'
+                             ' processed together')
+    jobs_parser.add_argument('--writer-threads', dest='writer_threads',
+                             default=4, type=int,
+                             help='Background threads that write the'
+                             ' outputs of a worker')
+    jobs_parser.add_argument('--save-params', dest='save_params',
+                             default=True,
+                             type=lambda x: x.lower() in ['true'],
+                             help='Default of the jobs that do not set'
+                             ' save_params')
+    jobs_parser.add_argument('--save-mesh', dest='save_mesh', default=False,
+                             type=lambda x: x.lower() in ['true'],
+                             help='Default of the jobs that do not set'
+                             ' save_mesh')
+    jobs_parser.add_argument('--save-vis', dest='save_vis', default=False,
+                             type=lambda x: x.lower() in ['true'],
+                             help='Default of the jobs that do not set'
+                             ' save_vis')
+    jobs_parser.add_argument('--mesh-format', dest='mesh_format',
+                             default='ply', choices=MESH_FORMATS,
+                             help='Default of the jobs that do not set'
+                             ' mesh_format')
+    jobs_parser.add_argument('--renderer', dest='renderer_type',
+                             default='hd', choices=RENDERERS,
+                             help='The renderer used for the overlays')
+    jobs_parser.add_argument('--fov', default=60.0, type=float,
+                             help='Horizontal field of view of the cameras'
+                             ' in degrees')
+    jobs_parser.set_defaults(func=run_manifest)
+
+    cmd_args = parser.parse_args()
+    cmd_args.func(cmd_args)